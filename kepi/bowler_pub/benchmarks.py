@@ -0,0 +1,312 @@
+# benchmarks.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Benchmarks for bowler_pub. Run them with "manage.py kepi_benchmark".
+"""
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from unittest.mock import patch
+from django.db import transaction
+from kepi.kepi.benchmark import benchmark, local_hostname
+from kepi.bowler_pub.utils import as_json_bytes
+from kepi.bowler_pub.create import create, _visibility_from_fields
+from kepi.bowler_pub.validation import IncomingMessage, _verify
+import kepi.bowler_pub.utils as bowler_utils
+import kepi.sombrero_sendpub.delivery as sombrero_delivery
+from kepi.trilby_api.tests import create_local_person, create_local_status
+import kepi.trilby_api.models as trilby_models
+import kepi.bowler_pub.serializers as bowler_serializers
+import kepi.bowler_pub.fast_serializers as bowler_fast_serializers
+
+def _alice():
+    create_local_person('alice',
+            note = 'I *enjoy* falling down rabbitholes.',
+            )
+
+    # Fetch her afresh each time, as PersonView does.
+    return lambda: trilby_models.LocalPerson.objects.get(
+            local_username = 'alice',
+            )
+
+@benchmark('bowler_pub.serializers.person.drf')
+def person_drf(timer):
+    alice = _alice()
+
+    timer.run(
+            lambda: bowler_serializers.PersonSerializer(alice()).data,
+            )
+
+@benchmark('bowler_pub.serializers.person.fast')
+def person_fast(timer):
+    alice = _alice()
+
+    timer.run(
+            lambda: bowler_fast_serializers.person_as_dict(alice()),
+            )
+
+def _document():
+    """
+    Returns an actor document, with the @context that
+    KepiView adds, which is most of its size.
+    """
+    from kepi.bowler_pub import ATSIGN_CONTEXT
+
+    result = bowler_fast_serializers.person_as_dict(_alice()())
+    result['@context'] = ATSIGN_CONTEXT
+    return result
+
+def _time_json(timer, **kwargs):
+    document = _document()
+    size = len(as_json_bytes(document, **kwargs))
+
+    timer.run(
+            lambda: as_json_bytes(document, **kwargs),
+            bytes = size,
+            )
+
+@benchmark('bowler_pub.json.pretty')
+def json_pretty(timer):
+    _time_json(timer, pretty=True)
+
+@benchmark('bowler_pub.json.compact')
+def json_compact(timer):
+    _time_json(timer, pretty=False)
+
+@benchmark('bowler_pub.json.compact_without_orjson')
+def json_compact_without_orjson(timer):
+    with patch.object(bowler_utils, 'orjson', None):
+        _time_json(timer, pretty=False)
+
+@benchmark('bowler_pub.json.pretty_without_orjson')
+def json_pretty_without_orjson(timer):
+    # This is how we always used to encode.
+    with patch.object(bowler_utils, 'orjson', None):
+        _time_json(timer, pretty=True)
+
+# URLs as is_local() gets them: ours and other people's.
+URLS = [
+        'https://altair.example.com/users/alice',
+        'https://altair.example.com/users/alice/1234',
+        'https://remote.example.org/users/fred',
+        'https://www.w3.org/ns/activitystreams#Public',
+        ]
+
+@benchmark('bowler_pub.utils.is_local')
+def is_local(timer):
+
+    def check_all():
+        for url in URLS:
+            bowler_utils.is_local(url)
+
+    timer.run(check_all,
+            items = len(URLS),
+            )
+
+@benchmark('bowler_pub.utils.uri_to_url')
+def uri_to_url(timer):
+    timer.run(
+            lambda: bowler_utils.uri_to_url('/users/alice/1234'),
+            )
+
+@benchmark('bowler_pub.utils.configured_url')
+def configured_url(timer):
+    timer.run(
+            lambda: bowler_utils.configured_url('STATUS_LINK',
+                username = 'alice',
+                id = 1234,
+                ),
+            )
+
+PUBLIC = 'https://www.w3.org/ns/activitystreams#Public'
+FRED = 'https://remote.example.org/users/fred'
+
+# Addressing of a public, an unlisted, a followers-only
+# and a direct status, as Mastodon sends them.
+ADDRESSING = [
+        {'to': [PUBLIC], 'cc': [FRED+'/followers']},
+        {'to': [FRED+'/followers'], 'cc': [PUBLIC]},
+        {'to': [FRED+'/followers'], 'cc': []},
+        {'to': ['https://altair.example.com/users/alice'], 'cc': []},
+        ]
+
+@benchmark('bowler_pub.create.visibility')
+def visibility(timer):
+    activities = [
+            dict(addressing,
+                type = 'Create',
+                object = dict(addressing, type='Note'),
+                )
+            for addressing in ADDRESSING]
+
+    def decide_all():
+        for activity in activities:
+            _visibility_from_fields(activity)
+
+    timer.run(decide_all,
+            items = len(activities),
+            )
+
+@benchmark('bowler_pub.httpsig.verify')
+def verify(timer):
+    """
+    Checks the signature on an incoming message,
+    as _run_validation() does.
+    """
+    alice = create_local_person('alice')
+    signer = sombrero_delivery._signer_for_localperson(alice)
+
+    headers = signer.sign(
+            {
+                'Date': sombrero_delivery._rfc822_datetime(),
+                'Host': 'altair.example.com',
+                'content-type': 'application/activity+json',
+                },
+            method = 'POST',
+            path = '/sharedInbox',
+            )
+
+    message = IncomingMessage(
+            content_type = headers['content-type'],
+            date = headers['Date'],
+            host = headers['Host'],
+            path = '/sharedInbox',
+            signature = headers['signature'],
+            body = '{}',
+            )
+
+    if not _verify(message, alice.publicKey):
+        raise ValueError('signature was not verified')
+
+    timer.run(
+            lambda: _verify(message, alice.publicKey),
+            )
+
+def _fred():
+    """
+    Creates a remote person, fred, who we already know about,
+    so that create() doesn't have to fetch him. He has no inbox,
+    so that nothing is delivered to him.
+    """
+    fred = trilby_models.RemotePerson(
+            remote_url = FRED,
+            username = 'fred',
+            acct = 'fred@remote.example.org',
+            )
+    fred.save()
+    return fred
+
+def _time_create(timer, fields):
+    """
+    Times create() on "fields". Whatever create() writes is
+    rolled back after each call, so that every call does the
+    same work.
+    """
+
+    def create_and_roll_back():
+        with transaction.atomic():
+            result = create(fields)
+            transaction.set_rollback(True)
+        return result
+
+    # create() returns None when it fails, rather than
+    # raising an exception, and we don't want to time that.
+    if create_and_roll_back() is None:
+        raise ValueError(f'create() failed on {fields}')
+
+    timer.run(create_and_roll_back)
+
+def _alice_status():
+    alice = create_local_person('alice')
+    return alice, create_local_status(
+            posted_by = alice,
+            content = 'Hello world',
+            )
+
+@benchmark('bowler_pub.create.activity.create')
+def create_note(timer):
+    _fred()
+
+    note = {
+            'id': FRED+'/statuses/103256',
+            'type': 'Note',
+            'attributedTo': FRED,
+            'content': '<p>Hello from <a href="https://remote.example.org'+\
+                    '/tags/kepi">#kepi</a>!</p>',
+            'to': [PUBLIC],
+            'cc': [FRED+'/followers'],
+            'tag': [{'type': 'Hashtag', 'name': '#kepi'}],
+            }
+
+    _time_create(timer, {
+        'id': FRED+'/statuses/103256/activity',
+        'type': 'Create',
+        'actor': FRED,
+        'to': note['to'],
+        'cc': note['cc'],
+        'object': note,
+        })
+
+@benchmark('bowler_pub.create.activity.like')
+def create_like(timer):
+    with local_hostname():
+        _fred()
+        alice, status = _alice_status()
+
+        _time_create(timer, {
+            'id': FRED+'#likes/1',
+            'type': 'Like',
+            'actor': FRED,
+            'object': status.url,
+            })
+
+@benchmark('bowler_pub.create.activity.announce')
+def create_announce(timer):
+    with local_hostname():
+        _fred()
+        alice, status = _alice_status()
+
+        _time_create(timer, {
+            'id': FRED+'/statuses/103257/activity',
+            'type': 'Announce',
+            'actor': FRED,
+            'to': [PUBLIC],
+            'object': status.url,
+            })
+
+@benchmark('bowler_pub.create.activity.follow')
+def create_follow(timer):
+    with local_hostname():
+        _fred()
+        alice = create_local_person('alice')
+
+        _time_create(timer, {
+            'id': FRED+'#follows/1',
+            'type': 'Follow',
+            'actor': FRED,
+            'object': alice.url,
+            })
+
+@benchmark('bowler_pub.create.activity.update')
+def create_update(timer):
+    _fred()
+
+    _time_create(timer, {
+        'id': FRED+'#updates/1',
+        'type': 'Update',
+        'actor': FRED,
+        'object': {
+            'id': FRED,
+            'type': 'Person',
+            'preferredUsername': 'fred',
+            'name': 'Fred',
+            'summary': '<p>I have a new bio.</p>',
+            'inbox': FRED+'/inbox',
+            'followers': FRED+'/followers',
+            },
+        })
@@ -120,6 +120,7 @@ def on_follow(fields, address):
             follower = follower,
             following = following,
             offer = fields.get('id'),
+            accept_pending = following.auto_follow,
             )
 
     result.save(
@@ -221,6 +222,13 @@ def on_note(fields, address):
     visibility = _visibility_from_fields(
             fields)
 
+    # Mastodon calls it "conversation"; Pleroma calls it "context".
+    # If neither is given, Status.save() works it out from the thread.
+    conversation = fields.get('conversation') or fields.get('context')
+
+    if not isinstance(conversation, str) or len(conversation)>255:
+        conversation = None
+
     logger.debug('%s: creating status from %s',
         address,
         fields,
@@ -236,6 +244,7 @@ def on_note(fields, address):
             spoiler_text = spoiler_text,
             visibility = visibility,
             language = language,
+            conversation = conversation,
                 )
 
         newbie.save()
@@ -261,14 +270,38 @@ def on_note(fields, address):
 
         logger.debug('%s: adding tags', address)
 
-        for tag in fields['tag']:
+        hashtags = []
+
+        tags = fields['tag']
+
+        if isinstance(tags, dict):
+            # ActivityStreams allows a single tag on its own.
+            tags = [tags]
+        elif not isinstance(tags, list):
+            logger.debug('%s:  -- tags aren\'t a list: %s',
+                    address, tags)
+            tags = []
+
+        for tag in tags:
+
+            if not isinstance(tag, dict):
+                logger.debug('%s:  -- not a tag: %s',
+                        address, tag)
+                continue
+
+            tag_type = str(tag.get('type') or '').lower()
 
-            if 'type' not in tag or 'href' not in tag:
+            if tag_type == 'hashtag' and \
+                    isinstance(tag.get('name'), str):
+                hashtags.append(tag['name'])
+                continue
+
+            if not tag_type or not isinstance(tag.get('href'), str):
                 logger.debug('%s:  -- missing fields: %s',
                         address, tag)
                 continue
 
-            if tag['type'].lower() != 'mention':
+            if tag_type != 'mention':
                 logger.debug('%s:  -- unknown tag type: %s',
                         address, tag)
                 continue
@@ -293,6 +326,10 @@ def on_note(fields, address):
             logger.debug('%s:     -- %s',
                     address, mention)
 
+        # We take hashtags from the list the sender gave us,
+        # rather than looking for them in the HTML.
+        trilby_models.StatusTag.add(newbie, hashtags)
+
         logger.debug('%s:   -- tags done',
                 address)
 
@@ -405,7 +442,7 @@ def on_person(fields, address,
             user.key_name = key['id']
 
         if 'publicKeyPem' in key:
-            user.publicKey = key['publicKeyPem']
+            user.replace_public_key(key['publicKeyPem'])
 
     if user.acct is None:
 
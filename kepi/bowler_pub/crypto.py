@@ -15,6 +15,7 @@ logger = logging.getLogger(name="kepi")
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
 from struct import pack
+from django.conf import settings
 import base64
 import hashlib
 
@@ -50,8 +51,17 @@ class Key(object):
     So I'm wrapping it, instead.
     """
 
-    def __init__(self):
-        self._rsa_key = RSA.generate(1024)
+    def __init__(self,
+            size = None,
+            ):
+        """
+        Generates a new key pair. "size" is the size of the key
+        in bits; it defaults to KEPI['KEY_SIZE'].
+        """
+        if size is None:
+            size = settings.KEPI['KEY_SIZE']
+
+        self._rsa_key = RSA.generate(size)
 
     def private_as_pem(self):
         return str(self._rsa_key.exportKey('PEM'),
@@ -0,0 +1,164 @@
+# document_cache.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+A cache of rendered ActivityPub documents.
+
+Remote servers ask for the same actors and statuses over and
+over. Rendering them means running the serialisers, and
+rendering Markdown, so we keep the rendered forms here.
+
+Documents are stored under the URL of the object they describe,
+along with a version string: the ETag which KepiView works out
+for the object (see Validators). A document is only used if its
+version matches, so a stale document is never served. We also
+delete documents when their objects change, so that they don't
+take up room.
+
+The cache is the Django cache named in KEPI['DOCUMENT_CACHE'].
+If that's None, it's a local in-memory cache of at most
+KEPI['DOCUMENT_CACHE_SIZE'] documents.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import kepi.trilby_api.models as trilby_models
+import kepi.kepi.instrumentation as instrumentation
+import hashlib
+
+_local_cache = None
+
+def _cache():
+    global _local_cache
+
+    if settings.KEPI['DOCUMENT_CACHE'] is not None:
+        return caches[settings.KEPI['DOCUMENT_CACHE']]
+
+    if _local_cache is None:
+        _local_cache = LocMemCache('kepi-documents', {
+            'TIMEOUT': settings.KEPI['DOCUMENT_CACHE_TIMEOUT'],
+            'OPTIONS': {
+                'MAX_ENTRIES': settings.KEPI['DOCUMENT_CACHE_SIZE'],
+                },
+            })
+
+    return _local_cache
+
+def _key(url):
+    # Some cache backends, such as memcached, don't like
+    # the characters in URLs.
+    return 'kepi-document:' + hashlib.sha1(
+            url.encode('UTF-8')).hexdigest()
+
+# Counts of hits and misses, by the name of the view
+# which asked. See stats().
+_hits = defaultdict(int)
+_misses = defaultdict(int)
+
+def get_or_render(url, version, render,
+        view = None):
+    """
+    Returns the rendered document for the object at "url",
+    as a dict.
+
+    Parameters:
+        url: the URL of the object.
+        version: a string which changes whenever the document
+            would change.
+        render: a function with no parameters which renders the
+            document. We call it if we don't have this version
+            of the document cached.
+        view: the name of whatever's asking, for stats().
+
+    The caller may modify the dict it gets back.
+    """
+
+    key = _key(url)
+    found = _cache().get(key)
+
+    if found is not None and found[0]==version:
+        logger.debug('%s: document cache hit', url)
+        _hits[view] += 1
+        instrumentation.count('cache_hits')
+        return found[1]
+
+    logger.debug('%s: document cache miss', url)
+    _misses[view] += 1
+    instrumentation.count('cache_misses')
+
+    with instrumentation.measure('serialise'):
+        result = render()
+
+    # Django's cache backends store a copy, so it doesn't
+    # matter if the caller changes "result" afterwards.
+    _cache().set(key, (version, result),
+            timeout = settings.KEPI['DOCUMENT_CACHE_TIMEOUT'],
+            )
+
+    return result
+
+def invalidate(url):
+    """
+    Removes the document for the object at "url", if any.
+    """
+    if url is None:
+        return
+
+    logger.debug('%s: removing from document cache', url)
+    _cache().delete(_key(url))
+
+def clear():
+    """
+    Empties the cache, and resets the stats.
+    """
+    _cache().clear()
+    _hits.clear()
+    _misses.clear()
+
+def stats():
+    """
+    Returns a dict mapping the names of views to dicts of
+    "hits", "misses" and "hit_rate", since this process
+    started or clear() was last called.
+    """
+    result = {}
+
+    for view in set(_hits.keys()) | set(_misses.keys()):
+        hits = _hits[view]
+        misses = _misses[view]
+
+        result[view] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits+misses),
+                }
+
+    return result
+
+#########################################
+
+@receiver(post_save, sender=trilby_models.LocalPerson)
+def on_person_saved(sender, instance, **kwargs):
+    invalidate(instance.url)
+
+@receiver(post_delete, sender=trilby_models.Status)
+def on_status_deleted(sender, instance, **kwargs):
+    invalidate(instance.url)
+
+@receiver(post_save, sender=trilby_models.Follow)
+@receiver(post_delete, sender=trilby_models.Follow)
+def on_follow_changed(sender, instance, **kwargs):
+    # In case people's documents include how many people
+    # follow them, or they follow.
+    invalidate(instance.follower.url)
+    invalidate(instance.following.url)
@@ -0,0 +1,74 @@
+# fast_serializers.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Hand-written versions of some of the serialisers in serializers.py.
+
+Actor documents get fetched a lot: every remote server which
+wants to check one of our signatures asks for one. This builds
+the same dict as PersonSerializer, without d-r-f walking its
+fields each time.
+
+The output must match PersonSerializer's exactly;
+tests/test_fast_serializers.py checks this.
+"""
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from kepi.bowler_pub.utils import uri_to_url
+from django.conf import settings
+
+def _image(url):
+    if url is None:
+        return None
+
+    return {
+            'type': 'Image',
+            'mediaType': 'image/jpeg', # FIXME always?
+            'url': url,
+            }
+
+def _char(value):
+    if value is None:
+        return None
+    return str(value)
+
+def person_as_dict(person):
+    """
+    Same as PersonSerializer(person).data.
+    """
+
+    url = person.url
+
+    return {
+            'id': _char(url),
+            'type': 'Person',
+            'following': _char(person.following_url),
+            'followers': _char(person.followers_url),
+            'inbox': _char(person.inbox_url),
+            'outbox': _char(person.outbox_url),
+            'featured': _char(person.featured_url),
+            'endpoints': {
+                'sharedInbox': uri_to_url(
+                    settings.KEPI['SHARED_INBOX_LINK'],
+                    ),
+                },
+            'preferredUsername': _char(person.username),
+            'name': _char(person.display_name),
+            'summary': _char(person.note_as_html),
+            'url': url,
+            'manuallyApprovesFollowers': bool(person.auto_follow),
+            'publicKey': {
+                'id': url+'#main-key',
+                'owner': url,
+                'publicKey': person.publicKey,
+                },
+            'tag': [],
+            'attachment': [],
+            'icon': _image(person.icon_or_default),
+            'image': _image(person.header_or_default),
+            }
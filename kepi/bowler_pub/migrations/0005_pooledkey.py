@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bowler_pub', '0004_remove_incomingmessage_is_local_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('private_key', models.TextField()),
+                ('public_key', models.TextField()),
+                ('size', models.PositiveIntegerField(help_text='The size of the key, in bits.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -1,5 +1,8 @@
 from .incoming import Incoming
+from .keypool import PooledKey, fill_key_pool
 
 __all__ = [
         'Incoming',
+        'PooledKey',
+        'fill_key_pool',
         ]
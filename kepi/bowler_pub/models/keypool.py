@@ -0,0 +1,131 @@
+# keypool.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+A pool of RSA key pairs, generated ahead of time.
+
+Generating a key pair takes a noticeable fraction of a second,
+and more for bigger keys. We don't want to do that while
+someone's waiting for their account to be created. So
+LocalPerson takes a key pair from this pool, and the pool
+gets topped up in the background, by fill_key_pool().
+"""
+
+import logging
+logger = logging.getLogger(name="kepi")
+
+from django.db import models, transaction
+from django.conf import settings
+from celery import shared_task
+import kepi.bowler_pub.crypto as crypto
+
+class PooledKey(models.Model):
+    """
+    An RSA key pair which nobody is using yet.
+    """
+
+    private_key = models.TextField()
+
+    public_key = models.TextField()
+
+    size = models.PositiveIntegerField(
+            help_text = 'The size of the key, in bits.',
+            )
+
+    created_at = models.DateTimeField(
+            auto_now_add = True,
+            )
+
+    def __str__(self):
+        return '[PooledKey %s: %d bits]' % (
+                self.pk, self.size,
+                )
+
+    @classmethod
+    def take(cls,
+            size = None,
+            ):
+        """
+        Removes a key pair of the given size from the pool,
+        and returns it. If the pool has none left, returns None.
+
+        "size" defaults to KEPI['KEY_SIZE'].
+        """
+
+        if size is None:
+            size = settings.KEPI['KEY_SIZE']
+
+        while True:
+            with transaction.atomic():
+                result = cls.objects.select_for_update(
+                        skip_locked = True,
+                        ).filter(
+                                size = size,
+                                ).order_by('pk').first()
+
+                if result is None:
+                    logger.info('Key pool has no %d-bit keys left',
+                            size)
+                    return None
+
+                # Databases without SELECT ... FOR UPDATE
+                # could give the same key to two callers; only
+                # the one that manages to delete it gets it.
+                deleted, _ = cls.objects.filter(
+                        pk = result.pk,
+                        ).delete()
+
+            if deleted:
+                logger.debug('Took %s from the key pool', result)
+                return result
+
+    @classmethod
+    def fill(cls,
+            size = None,
+            count = None,
+            ):
+        """
+        Generates key pairs until the pool holds "count" of
+        the given size. Returns how many it generated.
+
+        "size" defaults to KEPI['KEY_SIZE'], and "count"
+        to KEPI['KEY_POOL_SIZE'].
+        """
+
+        if size is None:
+            size = settings.KEPI['KEY_SIZE']
+
+        if count is None:
+            count = settings.KEPI['KEY_POOL_SIZE']
+
+        made = 0
+
+        while cls.objects.filter(size=size).count() < count:
+            key = crypto.Key(
+                    size = size,
+                    )
+
+            cls(
+                    private_key = key.private_as_pem(),
+                    public_key = key.public_as_pem(),
+                    size = size,
+                    ).save()
+
+            made += 1
+
+        if made:
+            logger.info('Added %d %d-bit keys to the key pool',
+                    made, size)
+
+        return made
+
+@shared_task()
+def fill_key_pool():
+    """
+    Tops up the key pool. Schedule this to run every so often,
+    or run "manage.py fill_key_pool".
+    """
+    return PooledKey.fill()
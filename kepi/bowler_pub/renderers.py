@@ -1,5 +1,33 @@
 from rest_framework.renderers import JSONRenderer
+from kepi.bowler_pub.utils import as_json_bytes
 
-class ActivityRenderer(JSONRenderer):
+class FastJSONRenderer(JSONRenderer):
+    """
+    A JSONRenderer which encodes using as_json_bytes(), so it's
+    compact unless we're debugging, and it uses orjson if that's
+    installed.
+
+    If the client asks for indented JSON, we leave it to
+    JSONRenderer, because that's rare and it knows how.
+    """
+
+    def render(self, data,
+            accepted_media_type=None, renderer_context=None):
+
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+
+        if self.get_indent(accepted_media_type, renderer_context):
+            return super().render(data,
+                    accepted_media_type, renderer_context)
+
+        return as_json_bytes(data,
+                sort_keys = False,
+                encoder_class = self.encoder_class,
+                )
+
+class ActivityRenderer(FastJSONRenderer):
 
     media_type = 'application/activity+json'
@@ -26,15 +26,20 @@ class StatusObjectSerializer(serializers.ModelSerializer):
     def to_representation(self, status):
 
         replies = [
-                StatusObjectSerializer(x).data()
+                StatusObjectSerializer(x).data
                 for x in status.replies.all()]
 
+        if status.in_reply_to is None:
+            in_reply_to = None
+        else:
+            in_reply_to = status.in_reply_to.url
+
         return {
                 'id': status.url,
                 'url': status.url,
                 'type': 'Note',
                 'summary': status.spoiler_text_as_html,
-                'inReplyTo': status.in_reply_to,
+                'inReplyTo': in_reply_to,
                 'published': status.created_at,
                 'attributedTo': status.account.url,
                 'to': status.to,
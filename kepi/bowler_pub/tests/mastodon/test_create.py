@@ -315,6 +315,36 @@ class Tests(Create_TestCase):
                 msg = 'status is in the same conversation',
                 )
 
+        self.assertEqual(
+                status.thread_root,
+                original_status,
+                msg = 'status has the same thread root',
+                )
+
+    def test_with_conversation(self):
+
+        object_form = {
+            'id': 'https://example.com/status/456',
+            'type': 'Note',
+            'content': 'Dolor sit amet',
+            'attributedTo': REMOTE_ALICE,
+            'conversation': 'tag:example.com,2020:objectId=17:objectType=Conversation',
+          }
+
+        status = self._send_create_for_object(object_form)
+
+        self.assertEqual(
+                status.conversation,
+                object_form['conversation'],
+                msg = 'status has the conversation it was given',
+                )
+
+        self.assertEqual(
+                status.thread_root,
+                status,
+                msg = 'status is its own thread root',
+                )
+
     @httpretty.activate
     def test_with_mentions(self):
 
@@ -366,9 +396,75 @@ class Tests(Create_TestCase):
                 msg = 'it creates status',
                 )
 
+    @httpretty.activate
+    def test_with_hashtags(self):
+
+        object_form = {
+            'id': 'https://example.com/status/987',
+            'attributedTo': REMOTE_ALICE,
+            'type': 'Note',
+            'content': 'Lorem ipsum #dolor',
+            'tag': [
+              {
+                'type': 'Hashtag',
+                'href': 'https://example.com/tags/dolor',
+                'name': '#Dolor',
+              },
+              {
+                'type': 'Hashtag',
+                'name': '#sit',
+              },
+            ],
+          }
+
+        status = self._send_create_for_object(object_form)
+
+        self.assertIsNotNone(
+                status,
+                msg = 'it creates status',
+                )
+
+        self.assertEqual(
+                [x.name for x in status.hashtags],
+                ['dolor', 'sit'],
+                msg = 'status has hashtags',
+                )
+
+    @httpretty.activate
+    def test_with_malformed_tags(self):
+
+        for tags in [
+                ['#dolor', None, ['Hashtag'], {'type': None}],
+                {'type': 'Hashtag', 'name': '#dolor'},
+                '#dolor',
+                ]:
+
+            object_form = {
+                'id': 'https://example.com/status/987',
+                'attributedTo': REMOTE_ALICE,
+                'type': 'Note',
+                'content': 'Lorem ipsum #dolor',
+                'tag': tags,
+              }
+
+            status = self._send_create_for_object(object_form)
+
+            self.assertIsNotNone(
+                    status,
+                    msg = f'it creates status with tags {tags!r}',
+                    )
+
+            if isinstance(tags, dict):
+                self.assertEqual(
+                        [x.name for x in status.hashtags],
+                        ['dolor'],
+                        msg = 'a single tag on its own counts',
+                        )
+
+            status.delete()
+
     # For the time being, ignoring tests for:
     #   - media
-    #   - hashtags
     #   - emoji
     #   - polls
 
@@ -0,0 +1,146 @@
+from django.test import TestCase
+from unittest.mock import patch
+from . import *
+from kepi.trilby_api.tests import create_local_person, create_local_status
+import kepi.trilby_api.models as trilby_models
+import kepi.bowler_pub.fast_serializers as bowler_fast_serializers
+import logging
+import json
+
+logger = logging.getLogger(name='kepi')
+
+class Tests(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+        self._alice = create_local_person('alice')
+        self._bob = create_local_person('bob')
+
+    def _check_revalidation(self, path):
+        """
+        Fetches "path", checks that it has validators, and that
+        sending them back gets a 304. Returns the ETag.
+        """
+
+        c = BowlerClient()
+
+        response = c.get(path)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'),
+                msg = 'ETag is strong')
+
+        self.assertIn('max-age=', response['Cache-Control'])
+        self.assertIn('Accept', response['Vary'])
+
+        again = c.get(path,
+                HTTP_IF_NONE_MATCH = etag,
+                )
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+        self.assertEqual(again['ETag'], etag)
+
+        return etag
+
+    def test_person(self):
+
+        etag = self._check_revalidation('/users/alice')
+
+        c = BowlerClient()
+
+        response = c.get('/users/alice')
+        self.assertIn('Last-Modified', response)
+        self.assertIn('public', response['Cache-Control'])
+
+        with patch.object(bowler_fast_serializers, 'person_as_dict',
+                side_effect = AssertionError("shouldn't render")):
+            response = c.get('/users/alice',
+                    HTTP_IF_NONE_MATCH = etag,
+                    )
+            self.assertEqual(response.status_code, 304)
+
+        self._alice.note = 'I enjoy falling down rabbitholes.'
+        self._alice.save()
+
+        response = c.get('/users/alice',
+                HTTP_IF_NONE_MATCH = etag,
+                )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_person_after_rotation(self):
+
+        etag = self._check_revalidation('/users/alice')
+
+        self._alice.rotate_keys()
+
+        response = BowlerClient().get('/users/alice',
+                HTTP_IF_NONE_MATCH = etag,
+                )
+        self.assertEqual(response.status_code, 200,
+                msg = 'peers which revalidate get the new key')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(
+                json.loads(response.content)['publicKey']['publicKey'],
+                self._alice.publicKey,
+                )
+
+    def test_status(self):
+
+        status = create_local_status(posted_by=self._alice)
+        path = '/users/alice/%d' % (status.pk,)
+
+        etag = self._check_revalidation(path)
+
+        # A reply changes the status's list of replies.
+        create_local_status(
+                posted_by = self._bob,
+                in_reply_to = status,
+                )
+
+        response = BowlerClient().get(path,
+                HTTP_IF_NONE_MATCH = etag,
+                )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['replies']), 1)
+
+    def test_collections(self):
+
+        create_local_status(posted_by=self._alice)
+
+        for path in [
+                '/users/alice/outbox',
+                '/users/alice/outbox?page=true',
+                ]:
+            etag = self._check_revalidation(path)
+
+            create_local_status(posted_by=self._alice)
+
+            response = BowlerClient().get(path,
+                    HTTP_IF_NONE_MATCH = etag,
+                    )
+            self.assertEqual(response.status_code, 200)
+
+    def test_followers(self):
+
+        carol = create_local_person('carol')
+        path = '/users/alice/followers'
+
+        trilby_models.Follow(follower=self._bob,
+                following=self._alice).save()
+
+        etag = self._check_revalidation(path)
+
+        # The number of followers stays the same, but
+        # who they are changes.
+        trilby_models.Follow.objects.all().delete()
+        trilby_models.Follow(follower=carol,
+                following=self._alice).save()
+
+        response = BowlerClient().get(path,
+                HTTP_IF_NONE_MATCH = etag,
+                )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
@@ -4,8 +4,12 @@ from kepi.trilby_api.tests import create_local_person
 import kepi.trilby_api.utils as trilby_utils
 import kepi.trilby_api.models as trilby_models
 import httpretty
+from unittest.mock import patch
+import kepi.bowler_pub.views.activitypub as activitypub_views
 import logging
 import json
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 ALICE_ID = 'https://altair.example.com/users/alice'
 OUTBOX = ALICE_ID+'/outbox'
@@ -117,9 +121,10 @@ class Tests(TestCase):
 
         contents = self._get_collection(OUTBOX)
 
+        # Collections run newest first.
         self.assertEqual(
                 [x['type'] for x in contents],
-                ['Create', 'Announce'])
+                ['Announce', 'Create'])
 
     def test_following_and_followers(self):
 
@@ -158,3 +163,102 @@ class Tests(TestCase):
                 )),
             [charlie.url],
             )
+
+    @patch.object(activitypub_views, 'PAGE_LENGTH', 3)
+    def test_paging(self):
+
+        statuses = [
+                trilby_models.Status(
+                    account = self._alice,
+                    visibility = trilby_utils.VISIBILITY_PUBLIC,
+                    content = f'Status number {i}.',
+                    )
+                for i in range(8)]
+
+        for status in statuses:
+            status.save()
+
+        # The URLs in the collection are based on the request.
+        outbox = 'http://testserver'+OUTBOX_PATH
+
+        newest_first = [x.activity_url for x in reversed(statuses)]
+
+        index = self._get(OUTBOX, Client())
+
+        self.assertEqual(index['totalItems'], 8)
+        self.assertEqual(index['first'], outbox+'?page=true')
+        self.assertEqual(index['last'], outbox+'?page=true&min_id=0')
+
+        first = self._get(index['first'], Client())
+
+        self.assertEqual(
+                [x['id'] for x in first['orderedItems']],
+                newest_first[:3])
+        self.assertEqual(first['totalItems'], 8)
+        self.assertEqual(first['next'],
+                outbox+'?page=true&max_id=%d' % (statuses[5].pk,))
+        self.assertNotIn('prev', first)
+
+        second = self._get(first['next'], Client())
+
+        self.assertEqual(
+                [x['id'] for x in second['orderedItems']],
+                newest_first[3:6])
+        self.assertEqual(second['prev'],
+                outbox+'?page=true&min_id=%d' % (statuses[4].pk,))
+
+        # Going back from the second page gives the first page.
+        self.assertEqual(
+                [x['id'] for x in self._get(second['prev'],
+                    Client())['orderedItems']],
+                newest_first[:3])
+
+        last = self._get(index['last'], Client())
+
+        self.assertEqual(
+                [x['id'] for x in last['orderedItems']],
+                newest_first[5:])
+        self.assertIn('prev', last)
+
+        self.assertEqual(
+                [x['id'] for x in self._get_collection(OUTBOX)],
+                newest_first)
+
+    def test_paging_bad_cursor(self):
+
+        response = Client().get(OUTBOX_PATH+'?page=true&max_id=wombat',
+                HTTP_ACCEPT = MIME_TYPE,
+                )
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_paging_queries(self):
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                self._get(OUTBOX_PATH+'?page=true', Client())
+            return len(queries)
+
+        bob = create_local_person('bob')
+
+        for person in [self._alice, bob]:
+            trilby_models.Status(
+                    account = person,
+                    visibility = trilby_utils.VISIBILITY_PUBLIC,
+                    content = 'Hello world.',
+                    ).save()
+
+        victoria_wood = self._add_Victoria_Wood_post()
+        trilby_models.Status(
+                account = self._alice,
+                reblog_of = victoria_wood,
+                ).save()
+
+        few = count_queries()
+
+        for i in range(5):
+            self._add_Victoria_Wood_post()
+
+        # Everything is prefetched, except that Status.tags
+        # still makes a query for each status.
+        self.assertEqual(count_queries(), few+5)
@@ -0,0 +1,95 @@
+from django.test import TestCase
+from unittest.mock import patch
+from . import *
+from kepi.trilby_api.tests import create_local_person, create_local_status
+import kepi.trilby_api.models as trilby_models
+import kepi.bowler_pub.fast_serializers as bowler_fast_serializers
+import kepi.bowler_pub.document_cache as document_cache
+import logging
+import json
+
+logger = logging.getLogger(name='kepi')
+
+class Tests(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+        document_cache.clear()
+
+        self._alice = create_local_person('alice')
+
+    def _get(self, path):
+        response = BowlerClient().get(path)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_person(self):
+
+        first = self._get('/users/alice')
+
+        with patch.object(bowler_fast_serializers, 'person_as_dict',
+                side_effect = AssertionError("shouldn't render")):
+            self.assertEqual(self._get('/users/alice'), first)
+
+        self.assertEqual(document_cache.stats(), {
+            'PersonView': {
+                'hits': 1,
+                'misses': 1,
+                'hit_rate': 0.5,
+                },
+            })
+
+        self._alice.note = 'I enjoy falling down rabbitholes.'
+        self._alice.save()
+
+        second = self._get('/users/alice')
+        self.assertIn('rabbitholes', second['summary'])
+        self.assertEqual(document_cache.stats()['PersonView']['misses'], 2)
+
+    def test_status(self):
+
+        status = create_local_status(posted_by=self._alice,
+                content = 'Hello world',
+                )
+        path = '/users/alice/%d' % (status.pk,)
+
+        self._get(path)
+        self._get(path)
+        self.assertEqual(document_cache.stats()['StatusView']['hits'], 1)
+
+        url = status.url
+        status.delete()
+
+        self.assertIsNone(document_cache._cache().get(
+            document_cache._key(url)))
+
+    def test_stale_version(self):
+
+        document_cache.get_or_render(
+                url = 'https://example.com/thing',
+                version = '1',
+                render = lambda: {'name': 'old'},
+                )
+
+        self.assertEqual(
+                document_cache.get_or_render(
+                    url = 'https://example.com/thing',
+                    version = '2',
+                    render = lambda: {'name': 'new'},
+                    ),
+                {'name': 'new'})
+
+    def test_size_limit(self):
+
+        with patch.dict(settings.KEPI, {'DOCUMENT_CACHE_SIZE': 3}), \
+                patch.object(document_cache, '_local_cache', None):
+
+            for i in range(10):
+                document_cache.get_or_render(
+                        url = 'https://example.com/%d' % (i,),
+                        version = '1',
+                        render = lambda: {'number': i},
+                        )
+
+            self.assertLessEqual(
+                    len(document_cache._cache()._cache), 3)
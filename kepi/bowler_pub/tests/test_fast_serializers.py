@@ -0,0 +1,36 @@
+from django.test import TestCase
+from . import *
+from kepi.trilby_api.tests import create_local_person
+import kepi.bowler_pub.serializers as bowler_serializers
+import kepi.bowler_pub.fast_serializers as bowler_fast_serializers
+import logging
+import json
+
+logger = logging.getLogger(name='kepi')
+
+class Tests(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+        self.maxDiff = None
+
+    def test_person(self):
+
+        alice = create_local_person('alice',
+                note = 'I *enjoy* falling down rabbitholes.',
+                auto_follow = False,
+                )
+
+        bob = create_local_person('bob',
+                icon_image = 'bob.jpg',
+                )
+
+        for person in [alice, bob]:
+            # Compare the JSON, so that the order of the keys counts.
+            self.assertEqual(
+                    json.dumps(bowler_fast_serializers.person_as_dict(
+                        person)),
+                    json.dumps(bowler_serializers.PersonSerializer(
+                        person).data),
+                    msg = f'serialising {person}',
+                    )
@@ -0,0 +1,106 @@
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+from . import *
+from kepi.trilby_api.tests import create_local_person
+import kepi.bowler_pub.utils as bowler_utils
+import datetime
+import logging
+import json
+
+logger = logging.getLogger(name='kepi')
+
+EXAMPLE = {
+        'type': 'Note',
+        'content': 'Café society',
+        'published': datetime.datetime(2020, 1, 2, 3, 4, 5, 678901,
+            tzinfo=datetime.timezone.utc),
+        'to': ['https://example.com/users/alice'],
+        }
+
+EXAMPLE_COMPACT = b'{"content":"Caf\xc3\xa9 society",' + \
+        b'"published":"2020-01-02T03:04:05.678Z",' + \
+        b'"to":["https://example.com/users/alice"],"type":"Note"}'
+
+class Tests(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+    def _check_encoders(self, test):
+        # Run the test with orjson, if it's installed,
+        # and again without it.
+
+        if bowler_utils.orjson is not None:
+            test()
+
+        with patch.object(bowler_utils, 'orjson', None):
+            test()
+
+    def test_compact(self):
+
+        def test():
+            self.assertEqual(
+                    bowler_utils.as_json_bytes(EXAMPLE, pretty=False),
+                    EXAMPLE_COMPACT,
+                    )
+
+        self._check_encoders(test)
+
+    def test_pretty(self):
+
+        def test():
+            result = bowler_utils.as_json_bytes(EXAMPLE, pretty=True)
+
+            self.assertIn(b'\n  "content": ', result)
+            self.assertEqual(
+                    json.loads(result),
+                    json.loads(EXAMPLE_COMPACT),
+                    )
+
+        self._check_encoders(test)
+
+    def test_unsorted(self):
+
+        def test():
+            result = bowler_utils.as_json(
+                    {'b': 1, 'a': 2},
+                    )
+            self.assertEqual(result, '{"a":2,"b":1}')
+
+            result = bowler_utils.as_json_bytes(
+                    {'b': 1, 'a': 2},
+                    sort_keys = False,
+                    )
+            self.assertEqual(result, b'{"b":1,"a":2}')
+
+        with override_settings(DEBUG=False):
+            self._check_encoders(test)
+
+    def test_pretty_follows_debug(self):
+
+        with override_settings(DEBUG=True):
+            self.assertIn('\n', bowler_utils.as_json({'a': 1}))
+
+        with override_settings(DEBUG=False):
+            self.assertNotIn('\n', bowler_utils.as_json({'a': 1}))
+
+        settings.KEPI['PRETTY_JSON'] = True
+        try:
+            with override_settings(DEBUG=False):
+                self.assertIn('\n', bowler_utils.as_json({'a': 1}))
+        finally:
+            settings.KEPI['PRETTY_JSON'] = None
+
+    def test_view_is_compact(self):
+
+        create_local_person('alice')
+
+        c = BowlerClient()
+        response = c.get('/users/alice')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'\n', response.content)
+        self.assertEqual(
+                json.loads(response.content)['preferredUsername'],
+                'alice',
+                )
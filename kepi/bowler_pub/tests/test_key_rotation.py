@@ -0,0 +1,173 @@
+from django.test import TestCase
+from unittest.mock import patch
+from . import *
+from kepi.trilby_api.tests import create_local_person
+from kepi.trilby_api.models import Follow, LocalPerson
+import kepi.sombrero_sendpub.delivery as sombrero_delivery
+import datetime
+import logging
+import httpretty
+import json
+
+logger = logging.getLogger(name='kepi')
+
+# Small keys, so that the tests run quickly.
+TEST_KEY_SIZE = 1024
+
+class Tests(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+        self._keys = json.load(open(
+            'kepi/bowler_pub/tests/keys/keys-0001.json', 'r'))
+
+        self._alice = create_local_person(
+                name = 'alice',
+                publicKey = self._keys['public'],
+                privateKey = self._keys['private'],
+                )
+        self._bob = create_local_person(
+                name = 'bob',
+                )
+
+    def _rotate(self):
+        with patch.dict(settings.KEPI, {'KEY_SIZE': TEST_KEY_SIZE}):
+            self._alice.rotate_keys()
+
+    def _expire_grace(self):
+        self._alice.public_key_changed_at -= datetime.timedelta(
+                seconds = settings.KEPI['KEY_ROTATION_GRACE']+1,
+                )
+        self._alice.save()
+
+    def _send_follow(self, secret):
+        body, headers = test_message_body_and_headers(
+                fields = {
+                    'id': ACTIVITY_ID,
+                    'type': "Follow",
+                    'actor': LOCAL_ALICE,
+                    'object': LOCAL_BOB,
+                    },
+                secret = secret,
+                )
+
+        validate(path=INBOX_PATH,
+                headers=headers,
+                body=body)
+
+        result = Follow.objects.filter(
+                follower = self._alice,
+                following = self._bob,
+                ).exists()
+
+        Follow.objects.all().delete()
+        return result
+
+    def test_rotate(self):
+
+        self._rotate()
+
+        self.assertNotEqual(self._alice.publicKey, self._keys['public'])
+        self.assertNotEqual(self._alice.privateKey, self._keys['private'])
+
+        self.assertEqual(
+                self._alice.verification_keys,
+                [self._alice.publicKey, self._keys['public']],
+                )
+
+        self._expire_grace()
+
+        self.assertEqual(
+                self._alice.verification_keys,
+                [self._alice.publicKey],
+                )
+
+    @httpretty.activate
+    def test_old_signature_during_grace(self):
+
+        self._rotate()
+
+        self.assertTrue(self._send_follow(self._alice.privateKey),
+                msg = 'new key is accepted')
+        self.assertTrue(self._send_follow(self._keys['private']),
+                msg = 'old key is accepted during the grace period')
+
+        self._expire_grace()
+
+        self.assertFalse(self._send_follow(self._keys['private']),
+                msg = 'old key is refused afterwards')
+
+    @httpretty.activate
+    def test_update_sent_to_followers(self):
+
+        peter = create_remote_person(
+                remote_url = REMOTE_FRED,
+                name = 'fred',
+                auto_fetch = True,
+                )
+
+        received = []
+
+        def on_post(request, uri, headers):
+            received.append(json.loads(request.body))
+            return [200, headers, 'Thank you']
+
+        httpretty.register_uri(
+                httpretty.POST,
+                FREDS_INBOX,
+                body = on_post,
+                )
+
+        Follow(follower=peter, following=self._alice).save()
+
+        self._rotate()
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0]['type'], 'Update')
+        self.assertEqual(received[0]['actor'], LOCAL_ALICE)
+        self.assertEqual(
+                received[0]['object']['publicKey']['publicKey'],
+                self._alice.publicKey,
+                )
+
+    def test_signer_follows_key(self):
+
+        first = sombrero_delivery._signer_for_localperson(self._alice)
+        self.assertIs(
+                sombrero_delivery._signer_for_localperson(self._alice),
+                first,
+                msg = 'signers are reused')
+
+        self._rotate()
+
+        self.assertIsNot(
+                sombrero_delivery._signer_for_localperson(self._alice),
+                first,
+                msg = 'a new key gets a new signer')
+
+    def test_stale_rotation(self):
+
+        # A copy of alice from before someone else rotated
+        # her keys, as another process might have.
+        stale = LocalPerson.objects.get(pk=self._alice.pk)
+
+        self._rotate()
+        first_key = self._alice.publicKey
+
+        # Meanwhile, she edits her profile.
+        elsewhere = LocalPerson.objects.get(pk=self._alice.pk)
+        elsewhere.note = 'I have a new bio.'
+        elsewhere.save()
+
+        with patch.dict(settings.KEPI, {'KEY_SIZE': TEST_KEY_SIZE}):
+            stale.rotate_keys()
+
+        alice = LocalPerson.objects.get(pk=self._alice.pk)
+
+        self.assertEqual(alice.previous_public_key, first_key,
+                msg = 'the first rotation is kept')
+        self.assertEqual(alice.publicKey, stale.publicKey)
+        self.assertEqual(alice.privateKey, stale.privateKey)
+        self.assertEqual(alice.note, 'I have a new bio.',
+                msg = "other fields aren't written back")
@@ -0,0 +1,66 @@
+from django.test import TestCase
+from unittest.mock import patch
+from . import *
+from kepi.bowler_pub.models import PooledKey
+import kepi.bowler_pub.crypto as crypto
+import kepi.trilby_api.models as trilby_models
+import logging
+
+logger = logging.getLogger(name='kepi')
+
+# Small keys, so that the tests run quickly.
+TEST_KEY_SIZE = 1024
+
+class Tests(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+    def test_fill_and_take(self):
+
+        made = PooledKey.fill(size=TEST_KEY_SIZE, count=2)
+        self.assertEqual(made, 2)
+
+        self.assertEqual(
+                PooledKey.fill(size=TEST_KEY_SIZE, count=2),
+                0,
+                msg = "a full pool isn't filled")
+
+        first = PooledKey.take(size=TEST_KEY_SIZE)
+        second = PooledKey.take(size=TEST_KEY_SIZE)
+
+        self.assertIn('PRIVATE KEY', first.private_key)
+        self.assertIn('PUBLIC KEY', first.public_key)
+        self.assertNotEqual(first.private_key, second.private_key)
+
+        self.assertIsNone(PooledKey.take(size=TEST_KEY_SIZE))
+
+    def test_size(self):
+
+        PooledKey.fill(size=TEST_KEY_SIZE, count=1)
+
+        self.assertIsNone(PooledKey.take(size=TEST_KEY_SIZE*2))
+        self.assertIsNotNone(PooledKey.take(size=TEST_KEY_SIZE))
+
+    def test_new_person_uses_pool(self):
+
+        with patch.dict(settings.KEPI, {'KEY_SIZE': TEST_KEY_SIZE}):
+            PooledKey.fill(count=1)
+            pooled = PooledKey.objects.get()
+
+            with patch.object(crypto, 'Key',
+                    side_effect = AssertionError("shouldn't generate")):
+                alice = trilby_models.LocalPerson(username='alice')
+                alice.save()
+
+        self.assertEqual(alice.privateKey, pooled.private_key)
+        self.assertEqual(alice.publicKey, pooled.public_key)
+        self.assertFalse(PooledKey.objects.exists())
+
+    def test_new_person_with_empty_pool(self):
+
+        with patch.dict(settings.KEPI, {'KEY_SIZE': TEST_KEY_SIZE}):
+            alice = trilby_models.LocalPerson(username='alice')
+            alice.save()
+
+        self.assertIn('PRIVATE KEY', alice.privateKey)
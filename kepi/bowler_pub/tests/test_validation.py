@@ -5,6 +5,7 @@ from unittest import skip
 import httpretty
 from . import *
 from kepi.trilby_api.tests import create_local_person, create_local_status
+from kepi.kepi.instrumentation import registry
 import logging
 import httpsig
 import json
@@ -110,6 +111,8 @@ class TestValidation(TestCase):
                 secret = keys['private'],
                 )
 
+        registry.clear()
+
         validate(path=INBOX_PATH,
                 headers=headers,
                 body=body)
@@ -121,6 +124,19 @@ class TestValidation(TestCase):
                 1,
                 msg="The message validated successfully")
 
+        self.assertEqual(
+                registry.get('kepi_validations_total',
+                    host = 'remote.example.org',
+                    outcome = 'valid',
+                    ),
+                1)
+
+        self.assertEqual(
+                registry.get('kepi_validation_bytes_received_total',
+                    host = 'remote.example.org',
+                    ),
+                len(body))
+
         fred = trilby_models.RemotePerson.objects.get(
             remote_url=REMOTE_FRED,
             )
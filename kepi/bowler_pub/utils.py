@@ -14,15 +14,96 @@ logger = logging.getLogger(name="kepi")
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
 from urllib.parse import urlparse
+from collections import namedtuple
+import functools
+import re
 
-def as_json(d,
-        indent=2):
+# orjson is optional. If it's installed, we use it to encode JSON,
+# because it's several times faster than the json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def pretty_json():
+    """
+    Returns True if we should pretty-print the JSON we send.
+
+    This is KEPI['PRETTY_JSON'] if it's set, and otherwise
+    it's the same as DEBUG. Pretty JSON is easier to read,
+    but it's bigger and slower to produce.
+    """
+    result = settings.KEPI.get('PRETTY_JSON', None)
+
+    if result is None:
+        result = settings.DEBUG
+
+    return result
+
+def as_json_bytes(d,
+        pretty = None,
+        sort_keys = True,
+        encoder_class = DjangoJSONEncoder,
+        ):
+    """
+    Encodes d as JSON, and returns it as UTF-8 bytes.
+
+    Parameters:
+        d: the value to encode.
+        pretty: True to indent the JSON; False to make it
+            as compact as possible; None to decide based on
+            the settings (see pretty_json()).
+        sort_keys: whether to sort the keys of dicts. This
+            means the same value always gives the same bytes.
+        encoder_class: a json.JSONEncoder whose default()
+            method handles anything JSON can't represent
+            directly, such as datetimes.
+    """
+
+    if pretty is None:
+        pretty = pretty_json()
 
-    encoder = DjangoJSONEncoder(
-        indent=indent,
-        sort_keys=True)
+    if orjson is not None:
 
-    return encoder.encode(d)
+        option = orjson.OPT_PASSTHROUGH_DATETIME | \
+                orjson.OPT_NON_STR_KEYS
+
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+
+        # We pass datetimes through to encoder_class, because
+        # orjson formats them differently from Django.
+        return orjson.dumps(d,
+                default = encoder_class().default,
+                option = option,
+                )
+
+    if pretty:
+        encoder = encoder_class(
+                indent = 2,
+                sort_keys = sort_keys,
+                )
+    else:
+        encoder = encoder_class(
+                separators = (',', ':'),
+                ensure_ascii = False,
+                sort_keys = sort_keys,
+                )
+
+    return encoder.encode(d).encode('UTF-8')
+
+def as_json(d,
+        pretty = None):
+    """
+    Encodes d as JSON, and returns it as a string.
+    See as_json_bytes() for the parameters.
+    """
+    return as_json_bytes(d,
+            pretty = pretty,
+            ).decode('UTF-8')
 
 def uri_to_url(uri):
     """
@@ -48,6 +129,17 @@ def configured_path(keyname,
     uri = settings.KEPI[keyname] % kwargs
     return uri
 
+@functools.lru_cache(maxsize=64)
+def _url_template(template, hostname):
+    """
+    Returns "template", the template for a path, made into
+    a template for a full URL, as uri_to_url() would.
+    """
+    return 'https://%s%s' % (
+            hostname.replace('%', '%%'),
+            template,
+            )
+
 def configured_url(keyname,
         **kwargs):
     """
@@ -55,7 +147,10 @@ def configured_url(keyname,
     passes the result through uri_to_url()
     so it's a full URL.
     """
-    return uri_to_url(configured_path(keyname, **kwargs))
+    return _url_template(
+            settings.KEPI[keyname],
+            settings.KEPI['LOCAL_OBJECT_HOSTNAME'],
+            ) % kwargs
 
 def is_short_id(s):
     try:
@@ -97,6 +192,85 @@ def is_local(url):
     parsed_url = urlparse(url)
     return parsed_url.hostname in settings.ALLOWED_HOSTS
 
+# The settings which give the paths of local objects that
+# resolve_local_url() knows about, and what kind of object
+# each one is. Earlier ones are tried first.
+LOCAL_URL_KINDS = [
+        ('USER_LINK', 'person'),
+        ('STATUS_LINK', 'status'),
+        ]
+
+LocalURL = namedtuple('LocalURL', ['kind', 'fields'])
+
+def _template_to_regex(template):
+    """
+    Turns a path template from the settings, such as
+    "/users/%(username)s/%(id)s", into a regex which
+    matches the paths it makes.
+    """
+    result = ''
+
+    for piece in re.split(r'(%\([a-z_]+\)[sdx])', template):
+        parameter = re.fullmatch(r'%\(([a-z_]+)\)([sdx])', piece)
+
+        if parameter is None:
+            result += re.escape(piece.replace('%%', '%'))
+            continue
+
+        name, conversion = parameter.groups()
+
+        if conversion=='x':
+            value = '[0-9a-fA-F]+'
+        elif conversion=='d' or name in ['id', 'number']:
+            value = '[0-9]+'
+        else:
+            value = '[^/]+'
+
+        result += '(?P<%s>%s)' % (name, value)
+
+    return re.compile(result)
+
+@functools.lru_cache(maxsize=256)
+def _resolve_local_url(url, hosts, templates):
+
+    parsed_url = urlparse(url)
+
+    if parsed_url.hostname not in hosts:
+        return None
+
+    for kind, template in templates:
+        found = _template_to_regex(template).fullmatch(parsed_url.path)
+
+        if found is not None:
+            return LocalURL(
+                    kind = kind,
+                    fields = found.groupdict(),
+                    )
+
+    return None
+
+def resolve_local_url(url):
+    """
+    If "url" is the URL of a local object, returns a LocalURL
+    whose "kind" says what sort of object it is (see
+    LOCAL_URL_KINDS), and whose "fields" are the parameters
+    in the URL, such as "username". Otherwise, returns None.
+
+    This parses the templates in the settings directly,
+    rather than going through the URL dispatcher, and it
+    remembers the answers, so it's cheap to call often.
+    """
+    if not isinstance(url, str):
+        return None
+
+    return _resolve_local_url(url,
+            hosts = tuple(settings.ALLOWED_HOSTS),
+            templates = tuple([
+                (kind, settings.KEPI[keyname])
+                for keyname, kind in LOCAL_URL_KINDS
+                ]),
+            )
+
 def log_one_message(
         direction = None,
         body = None,
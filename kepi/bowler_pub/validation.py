@@ -21,8 +21,11 @@ from urllib.parse import urlparse
 import django.core.exceptions
 import uuid
 from httpsig.verify import HeaderVerifier
-from kepi.sombrero_sendpub.fetch import fetch
+from kepi.sombrero_sendpub.fetch import fetch, is_known, prefetch
 from kepi.bowler_pub.create import create
+import kepi.kepi.task_instrumentation as task_instrumentation
+import kepi.kepi.celery as kepi_celery
+from kepi.bowler_pub.utils import is_local
 
 class IncomingMessage(models.Model):
 
@@ -135,11 +138,94 @@ def validate(path, headers, body):
             )
     message.save()
 
-    logger.debug('%s: invoking the validation task',
-            message.id)
-    _run_validation(message.id)
+    priority = kepi_celery.broker_priority(_priority(message))
+
+    validation = _run_validation.si(
+            str(message.id),
+            ).set(
+            priority = priority,
+            )
+
+    if _actor_is_known(message):
+        logger.debug('%s: invoking the validation task',
+                message.id)
+        validation.apply_async()
+    else:
+        # Fetching the actor means waiting on their server, so
+        # do that on kepi.fetch rather than holding up kepi.inbound.
+        logger.debug('%s: fetching the actor, then validating',
+                message.id)
+        fetching = prefetch.si(
+                message.actor,
+                'trilby_api.Person',
+                ).set(
+                priority = priority,
+                )
+        (fetching | validation).apply_async()
+
+def _actor_is_known(message):
+    """
+    Returns False if validating "message" would have to fetch
+    its actor over the network. If we can't tell who the actor
+    is, returns True, and _run_validation() will drop the message.
+    """
+    import kepi.trilby_api.models as trilby_models
+
+    try:
+        fields = message.fields
+    except ValueError:
+        return True
+
+    if not isinstance(fields, dict):
+        return True
+
+    actor = message.actor
+
+    if not actor or not isinstance(actor, str):
+        return True
+
+    return is_known(actor, trilby_models.Person)
+
+# Types of activity which someone is waiting on.
+INTERACTIVE_TYPES = [
+        'Follow',
+        'Accept',
+        'Reject',
+        ]
+
+def _priority(message):
+    """
+    Returns the priority to validate "message" at. Messages that
+    someone local is waiting on, such as follow requests and replies
+    to their statuses, go at PRIORITY_INTERACTIVE. Everything else
+    goes at the default priority. See kepi.kepi.celery.
+
+    We haven't validated the message yet, so this is only a
+    guess about where it should go in the queue.
+    """
+    try:
+        fields = message.fields
+    except ValueError:
+        return None
+
+    if not isinstance(fields, dict):
+        return None
+
+    if fields.get('type') in INTERACTIVE_TYPES:
+        return kepi_celery.PRIORITY_INTERACTIVE
+
+    thing = fields.get('object')
+
+    if isinstance(thing, dict):
+        in_reply_to = thing.get('inReplyTo')
+
+        if isinstance(in_reply_to, str) and is_local(in_reply_to):
+            return kepi_celery.PRIORITY_INTERACTIVE
+
+    return None
 
 @shared_task()
+@task_instrumentation.instrumented
 def _run_validation(
         message_id,
         ):
@@ -154,6 +240,16 @@ def _run_validation(
 
     valid = _run_validation_inner(message)
 
+    try:
+        signed_by = message.key_id
+    except ValueError:
+        signed_by = None
+
+    task_instrumentation.record_validation(signed_by,
+            valid = valid,
+            received = len(message.body.encode('UTF-8')),
+            )
+
     if valid:
         result = create(
                 fields = message.fields,
@@ -218,13 +314,27 @@ def _run_validation_inner(
     # XXX key used to sign must "_obviously_belong_to" the actor
 
     try:
-        key = actor.publicKey
+        keys = actor.verification_keys
     except TypeError as te:
         logger.info('%s: actor has an invalid public key (%s); dropping message',
                 message, te,
                 )
         return False
 
+    for key in keys:
+        if _verify(message, key):
+            logger.debug('%s: validation passed!', message)
+            return True
+
+    logger.info('%s: spoofing attempt; message dropped',
+            message)
+    return False
+
+def _verify(message, key):
+    """
+    Returns True iff message was signed with the given public key.
+    """
+
     logger.debug('Verifying; key=%s, path=%s, host=%s',
             key, message.path, message.host)
 
@@ -258,11 +368,4 @@ def _run_validation_inner(
             sign_header = 'Signature',
         )
 
-    if not hv.verify():
-        logger.info('%s: spoofing attempt; message dropped',
-                message)
-        return False
-
-    logger.debug('%s: validation passed!', message)
-
-    return True
+    return hv.verify()
@@ -7,6 +7,7 @@
 from kepi.bowler_pub import ATSIGN_CONTEXT
 import kepi.bowler_pub.validation
 from kepi.bowler_pub.utils import *
+import kepi.bowler_pub.utils as bowler_utils
 from django.shortcuts import render, get_object_or_404
 import django.views
 from django.http import HttpResponse, JsonResponse, Http404
@@ -16,7 +17,9 @@ from django.core.exceptions import ValidationError
 from django.conf import settings
 from kepi.bowler_pub.models import *
 from kepi.bowler_pub.validation import validate
+import kepi.bowler_pub.document_cache as document_cache
 import kepi.bowler_pub.serializers as bowler_serializers
+import kepi.bowler_pub.fast_serializers as bowler_fast_serializers
 import kepi.bowler_pub.renderers
 import kepi.trilby_api.models as trilby_models
 from collections.abc import Iterable
@@ -24,11 +27,79 @@ import logging
 import urllib.parse
 import json
 from rest_framework import generics, response
+from django.db.models import QuerySet, prefetch_related_objects, \
+        Count, Max
+from django.utils.cache import get_conditional_response, \
+        patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+import hashlib
 
 logger = logging.getLogger(name='kepi')
 
 PAGE_LENGTH = 50
 PAGE_FIELD = 'page'
+MAX_ID_FIELD = 'max_id'
+MIN_ID_FIELD = 'min_id'
+
+class Validators(object):
+    """
+    The validators for one version of a document: an ETag,
+    and optionally a Last-Modified time.
+
+    "version" is a string which changes whenever the document
+    would. The ETag is a hash of it, along with anything else
+    which changes the bytes we'd send, such as whether we're
+    pretty-printing the JSON.
+    """
+
+    def __init__(self, version, last_modified=None):
+
+        version = '%s|%s|%s' % (
+                version,
+                bowler_utils.pretty_json(),
+                bowler_utils.orjson is not None,
+                )
+
+        self.etag = '"%s"' % (
+                hashlib.sha1(version.encode('UTF-8')).hexdigest(),
+                )
+
+        if last_modified is None:
+            self.last_modified = None
+        else:
+            self.last_modified = int(last_modified.timestamp())
+
+    def conditional_response(self, request):
+        """
+        If the request's If-None-Match or If-Modified-Since headers
+        show that the client's copy is current, returns a response
+        saying so (usually a 304). Otherwise returns None.
+        """
+        return get_conditional_response(request,
+                etag = self.etag,
+                last_modified = self.last_modified,
+                )
+
+    def add_headers(self, response, cache_control):
+        """
+        Adds the validators, and the caching policy in the
+        dict "cache_control", to "response".
+        """
+        if response.status_code not in [200, 304, 410]:
+            return
+
+        response['ETag'] = self.etag
+
+        if self.last_modified is not None:
+            response['Last-Modified'] = http_date(self.last_modified)
+
+        patch_cache_control(response,
+                max_age = settings.KEPI['CACHE_MAX_AGE'],
+                **cache_control,
+                )
+
+        # tophat_ui serves HTML from the same URLs.
+        patch_vary_headers(response, ['Accept'])
 
 class KepiView(django.views.View):
 
@@ -81,7 +152,27 @@ class KepiView(django.views.View):
                     result)
             return result
 
-        data = self._render_object(result)
+        validators = self._get_validators(result)
+
+        if validators is not None:
+            httpresponse = validators.conditional_response(request)
+
+            if httpresponse is not None:
+                logger.debug('  -- client has the current version')
+                validators.add_headers(httpresponse, self.cache_control)
+                return httpresponse
+
+        if validators is None:
+            data = self._render_object(result)
+        else:
+            # The ETag changes whenever the document would,
+            # so it does nicely as the version for the cache.
+            data = document_cache.get_or_render(
+                    url = result.url,
+                    version = validators.etag,
+                    render = lambda: self._render_object(result),
+                    view = self.__class__.__name__,
+                    )
 
         log_one_message(
                 direction=f"response to {request.path}",
@@ -89,23 +180,45 @@ class KepiView(django.views.View):
                 )
 
         httpresponse = self._to_httpresponse(data)
+
+        if validators is not None:
+            validators.add_headers(httpresponse, self.cache_control)
+
         return httpresponse
 
+    # Directives for the Cache-Control header, for responses
+    # which have validators. max-age comes from the settings.
+    cache_control = {
+            'public': True,
+            }
+
+    def _get_validators(self, something):
+        """
+        Returns Validators for the rendered form of "something",
+        or None if we can't tell when it changes, in which case
+        the response won't be cached, either by the client or
+        in the document cache. If you return Validators,
+        "something" must have a "url" attribute.
+
+        This gets called before we render "something", so that we
+        don't have to render it if the client has it already.
+        So it should be cheap, and it mustn't render it.
+
+        Override this method in your subclass. In KepiView
+        it returns None.
+        """
+        return None
+
     def _to_httpresponse(self, data):
 
         if '@context' not in data:
             data['@context'] = ATSIGN_CONTEXT
 
-        result = JsonResponse(
-                data=data,
-                json_dumps_params={
-                    'sort_keys': True,
-                    'indent': 2,
-                    }
+        result = HttpResponse(
+                content = as_json_bytes(data),
+                content_type = 'application/activity+json; charset=utf-8',
                 )
 
-        result['Content-Type'] = 'application/activity+json; charset=utf-8'
-
         if 'former_type' in data:
             result.reason = 'Entombed'
             result.status_code = 410
@@ -123,7 +236,7 @@ class PersonView(KepiView):
 
         try:
             person = trilby_models.LocalPerson.objects.get(
-                    local_user__username = self._username,
+                    local_username = self._username,
                     )
             logger.debug('  -- found user: %s', person)
             return person
@@ -193,6 +306,17 @@ class PersonView(KepiView):
 
         return result
 
+    def _get_validators(self, something):
+        return Validators(
+                version = 'person|%d|%s|%s|%d' % (
+                    something.pk,
+                    something.username,
+                    something.updated_at.isoformat(),
+                    something.note_html_version,
+                    ),
+                last_modified = something.updated_at,
+                )
+
     def _render_object(self, something):
         if something.gone:
             result = {
@@ -201,10 +325,11 @@ class PersonView(KepiView):
                     'id': something.url,
                     }
         else:
-            serializer = bowler_serializers.PersonSerializer(
-                    something
+            # Same as bowler_serializers.PersonSerializer,
+            # only faster.
+            result = bowler_fast_serializers.person_as_dict(
+                    something,
                     )
-            result = serializer.data
 
         return super()._render_object(result)
 
@@ -243,46 +368,134 @@ class CollectionView(generics.GenericAPIView):
         if isinstance(items, ActivityResponse):
             items = items.activity_value
 
-        # XXX assert that items.ordered
+        if isinstance(items, HttpResponse):
+            return items
+
+        if isinstance(items, QuerySet) and items.query.combinator:
+            # You can't filter() the result of union() and
+            # friends, but you can select from it.
+            items = items.model.objects.filter(
+                    pk__in = items.values('pk'),
+                    )
+
+        # One query gives us both the size of the collection,
+        # and whether it's changed.
+        state = self._get_state(items)
+
+        validators = Validators(
+                version = 'collection|%s|%d|%s' % (
+                    self.listname,
+                    PAGE_LENGTH,
+                    state['version'],
+                    ),
+                )
+
+        httpresponse = validators.conditional_response(request)
+
+        if httpresponse is None:
+            httpresponse = self._render_collection(request, items,
+                    count = state['count'])
+
+        validators.add_headers(httpresponse, self.cache_control)
+
+        return httpresponse
+
+    # As for KepiView.
+    cache_control = {
+            'public': True,
+            }
+
+    # The field which we look at to see whether the collection
+    # has changed. Adding an item must increase its maximum value,
+    # so it's usually the primary key of the items, but for
+    # collections of people it's the primary key of the Follow.
+    version_key = 'pk'
+
+    def _get_state(self, items):
+        """
+        Returns a dict with:
+            count: the number of items
+            version: a string which changes whenever the
+                items do
+        """
+
+        if isinstance(items, QuerySet):
+            result = items.order_by().aggregate(
+                    count = Count(self.version_key),
+                    latest = Max(self.version_key),
+                    updated = Max('updated_at'),
+                    )
+
+            result['version'] = '%(count)d|%(latest)s|%(updated)s' % result
+            return result
+
+        return {
+                'count': len(items),
+                'version': '|'.join([
+                    '%s:%s' % (x.pk, x.updated_at.isoformat())
+                    for x in items]),
+                }
+
+    def _render_collection(self, request, items, count):
 
         our_url = request.build_absolute_uri()
-        index_url = self._make_query_page_url(request, None)
+        index_url = self._make_query_page_url(request, page=False)
 
         if PAGE_FIELD in request.GET:
 
-            page_number = int(request.GET[PAGE_FIELD])
-            logger.debug("    -- it's a request for page %d",
-                    page_number)
+            try:
+                max_id = self._get_cursor(request, MAX_ID_FIELD)
+                min_id = self._get_cursor(request, MIN_ID_FIELD)
+            except ValueError:
+                return HttpResponse(
+                        status = 400,
+                        reason = 'Invalid cursor',
+                        )
 
-            start = (page_number-1) * PAGE_LENGTH
+            logger.debug("    -- it's a request for a page: "+\
+                    "max_id=%s, min_id=%s",
+                    max_id, min_id)
 
-            listed_items = items[start: start+PAGE_LENGTH]
+            listed_items, more = self._get_page(items,
+                    max_id = max_id,
+                    min_id = min_id,
+                    )
+
+            self._prefetch(listed_items)
 
             result = {
                     "@context": ATSIGN_CONTEXT,
                     "type" : "OrderedCollectionPage",
                     "id" : our_url,
-                    "totalItems" : items.count(),
+                    "totalItems" : count,
                     "orderedItems" : [self._modify_list_item(x)
                         for x in listed_items],
                     "partOf": index_url,
                     }
 
-            if page_number > 1:
+            # Pages run from newest to oldest. "next" is older;
+            # "prev" is newer.
+
+            if min_id is None:
+                has_older = more
+                has_newer = max_id is not None
+            else:
+                has_older = True
+                has_newer = more
+
+            if listed_items and has_newer:
                result["prev"] = self._make_query_page_url(request,
-                       page_number-1)
+                       min_id = listed_items[0].pk)
 
-            if start+PAGE_LENGTH < items.count():
+            if listed_items and has_older:
                result["next"] = self._make_query_page_url(request,
-                       page_number+1)
+                       max_id = listed_items[-1].pk)
 
         else:
 
             # Index page.
             logger.debug("    -- it's a request for the index")
 
-            count = len(items)
-
             result = {
                     "@context": ATSIGN_CONTEXT,
                     "type": "OrderedCollection",
@@ -293,18 +506,91 @@ class CollectionView(generics.GenericAPIView):
             if count>0:
                     result["first"] = self._make_query_page_url(
                             request = request,
-                            page_number = 1,
                             )
 
                     result["last"] = self._make_query_page_url(
                             request = request,
-                            page_number = int(
-                                1 + ((count+1)/PAGE_LENGTH),
-                            ),
+                            min_id = 0,
                             )
 
         return self._to_httpresponse(result)
 
+    def _get_cursor(self, request, fieldname):
+        """
+        Returns the value of the cursor "fieldname" in the
+        query string, as an int, or None if there isn't one.
+        Raises ValueError if it's not a number.
+        """
+        if fieldname not in request.GET:
+            return None
+
+        return int(request.GET[fieldname])
+
+    def _get_page(self, items,
+            max_id = None,
+            min_id = None):
+        """
+        Returns one page of "items", newest first, as a list,
+        along with whether there are more items beyond it.
+
+        We page by primary key, rather than by offset, so that
+        the database can go straight to the right place however
+        far back the page is.
+
+        If max_id is given, the page starts with the newest item
+        older than max_id, and "more" means there are older items
+        after the page.
+
+        If min_id is given, the page ends with the oldest item
+        newer than min_id, and "more" means there are newer items
+        before the page.
+        """
+
+        if isinstance(items, QuerySet):
+
+            if min_id is not None:
+                items = items.filter(pk__gt=min_id).order_by('pk')
+            else:
+                if max_id is not None:
+                    items = items.filter(pk__lt=max_id)
+
+                items = items.order_by('-pk')
+
+            result = list(items[:PAGE_LENGTH+1])
+
+        else:
+            # Lists are only used for very short collections,
+            # such as "featured".
+
+            if min_id is not None:
+                result = sorted([x for x in items if x.pk>min_id],
+                        key = lambda x: x.pk)
+            else:
+                result = sorted([x for x in items
+                    if max_id is None or x.pk<max_id],
+                        key = lambda x: x.pk,
+                        reverse = True)
+
+        more = len(result)>PAGE_LENGTH
+        result = result[:PAGE_LENGTH]
+
+        if min_id is not None:
+            result.reverse()
+
+        return result, more
+
+    def _prefetch(self, items):
+        """
+        Loads anything _modify_list_item() will need for
+        the given items, all at once.
+        """
+        prefetch_related_objects(items,
+                'account',
+                'reblog_of__account',
+                'in_reply_to',
+                'replies',
+                )
+
     def activity_get(self, request,
             username,
             listname = None,
@@ -319,7 +605,7 @@ class CollectionView(generics.GenericAPIView):
 
         try:
             user = LocalPerson.objects.get(
-                    local_user__username = username,
+                    local_username = username,
                     )
         except LocalPerson.DoesNotExist:
             logger.debug('  -- user does not exist')
@@ -365,16 +651,11 @@ class CollectionView(generics.GenericAPIView):
         if 'former_type' in data:
             data['type'] = 'Tombstone'
 
-        result = JsonResponse(
-                data=data,
-                json_dumps_params={
-                    'sort_keys': True,
-                    'indent': 2,
-                    }
+        result = HttpResponse(
+                content = as_json_bytes(data),
+                content_type = 'application/activity+json; charset=utf-8',
                 )
 
-        result['Content-Type'] = 'application/activity+json; charset=utf-8'
-
         if 'former_type' in data:
             result.reason = 'Entombed'
             result.status_code = 410
@@ -384,17 +665,32 @@ class CollectionView(generics.GenericAPIView):
     def _make_query_page_url(
             self,
             request,
-            page_number,
+            page = True,
+            max_id = None,
+            min_id = None,
             ):
-        fields = dict(request.GET)
+        """
+        Returns the URL of this collection, with the query string
+        changed to ask for the given page. If "page" is False,
+        returns the URL of the index.
+        """
+        fields = dict(request.GET.lists())
 
-        if page_number is None:
-            if PAGE_FIELD in fields:
-                del fields[PAGE_FIELD]
-        else:
-            fields[PAGE_FIELD] = page_number
+        for fieldname in [PAGE_FIELD, MAX_ID_FIELD, MIN_ID_FIELD]:
+            if fieldname in fields:
+                del fields[fieldname]
+
+        if page:
+            fields[PAGE_FIELD] = 'true'
+
+            if max_id is not None:
+                fields[MAX_ID_FIELD] = max_id
 
-        encoded = urllib.parse.urlencode(fields)
+            if min_id is not None:
+                fields[MIN_ID_FIELD] = min_id
+
+        encoded = urllib.parse.urlencode(fields,
+                doseq = True)
 
         if encoded!='':
             encoded = '?'+encoded
@@ -420,6 +716,10 @@ class InboxView(CollectionView):
 
     listname = 'inbox'
 
+    cache_control = {
+            'private': True,
+            }
+
     # FIXME: Only externally visible to the owner
     def activity_get(self, request, username=None, *args, **kwargs):
 
@@ -501,12 +801,24 @@ class FollowingView(CollectionView):
 
     listname = 'following'
 
+    version_key = 'rel_followers__pk'
+
     def _modify_list_item(self, item):
         return item.url
 
+    def _prefetch(self, items):
+        # A person's URL doesn't need anything else loading.
+        pass
+
 class FollowersView(CollectionView):
 
     listname = 'followers'
 
+    version_key = 'rel_following__pk'
+
     def _modify_list_item(self, item):
         return item.url
+
+    def _prefetch(self, items):
+        # A person's URL doesn't need anything else loading.
+        pass
@@ -50,6 +50,17 @@ class StatusView(ap.KepiView):
 
         return result
 
+    def _get_validators(self, something):
+        return ap.Validators(
+                version = 'status|%d|%s|%s|%d' % (
+                    something.pk,
+                    something.account.username,
+                    something.updated_at.isoformat(),
+                    something.html_version,
+                    ),
+                last_modified = something.updated_at,
+                )
+
     def _render_object(self, something):
         serializer = bowler_serializers.StatusObjectSerializer(
                 something
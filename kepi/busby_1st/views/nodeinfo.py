@@ -19,7 +19,7 @@ from django.shortcuts import render
 from django.http import HttpResponse
 from kepi import __version__
 import re
-from kepi.bowler_pub.utils import as_json
+from kepi.bowler_pub.utils import as_json_bytes
 
 class NodeinfoPart1(django.views.View):
     """
@@ -43,8 +43,7 @@ class NodeinfoPart1(django.views.View):
         return HttpResponse(
                 status = 200,
                 reason = 'Here you go',
-                content = bytes(as_json(result),
-                    encoding='utf-8'),
+                content = as_json_bytes(result),
                 content_type='application/json; '+\
                         'profile=http://nodeinfo.diaspora.software/ns/schema/2.0#')
 
@@ -86,8 +85,7 @@ class NodeinfoPart2(django.views.View):
         return HttpResponse(
                 status = 200,
                 reason = 'Here you go',
-                content = bytes(as_json(result),
-                    encoding='utf-8'),
+                content = as_json_bytes(result),
                 content_type='application/json; '+\
                         'profile=http://nodeinfo.diaspora.software/ns/schema/2.0#')
 
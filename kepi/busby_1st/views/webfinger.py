@@ -19,7 +19,7 @@ from django.shortcuts import render
 from django.http import HttpResponse
 import re
 import json
-from kepi.bowler_pub.utils import as_json, configured_url
+from kepi.bowler_pub.utils import as_json_bytes, configured_url
 import kepi.trilby_api.models as trilby_models
 
 class Webfinger(django.views.View):
@@ -117,8 +117,7 @@ class Webfinger(django.views.View):
         return HttpResponse(
                 status = 200,
                 reason = 'Here you go',
-                content = bytes(as_json(result),
-                    encoding='utf-8'),
+                content = as_json_bytes(result),
                 content_type='application/jrd+json; charset=utf-8')
 
     def get(self, request):
@@ -0,0 +1,6 @@
+# Make sure kepi's Celery app is the one the tasks use.
+from .celery import app as celery_app
+
+__all__ = [
+        'celery_app',
+        ]
@@ -0,0 +1,13 @@
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kepi.kepi.settings')
+
+django_application = get_asgi_application()
+
+# The streaming API is served here, outside Django, so that
+# idle connections don't each keep a thread busy.
+from kepi.trilby_api.streaming import StreamingApp
+
+application = StreamingApp(django_application)
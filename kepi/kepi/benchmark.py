@@ -0,0 +1,237 @@
+# benchmark.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Micro-benchmarks for kepi's hot paths.
+
+Any installed app may have a module called "benchmarks".
+Functions in it which are decorated with @benchmark get
+run by "manage.py kepi_benchmark".
+
+A benchmark function is passed a Timer. It sets up whatever
+it needs, and then calls timer.run() with the code to time,
+and the number of objects that code deals with on each call.
+For example:
+
+    @benchmark('trilby_api.serializers.status.drf')
+    def status_drf(timer):
+        alice = create_local_person('alice')
+        ...
+        timer.run(lambda: StatusSerializer(statuses, many=True).data,
+            items = len(statuses))
+
+Each benchmark runs in a transaction which is rolled back
+afterwards, so it may create whatever objects it likes.
+
+"manage.py kepi_benchmark --output FILE" stores the results as
+JSON, along with a description of what they were run on; see
+environment(). "--compare FILE" compares a run with a stored one,
+so that you can check a change for regressions; see regressions().
+For the figures to be comparable, benchmarks should make the same
+objects every time: use fixed seeds for anything random.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import datetime
+import platform
+import timeit
+from django.db import connection, transaction
+from django.utils.module_loading import autodiscover_modules
+
+_registry = {}
+
+def benchmark(name):
+    """
+    Decorator which registers a benchmark under the given name.
+
+    Names are dotted, starting with the name of the app;
+    related benchmarks should share a prefix, so that they
+    can be run together.
+    """
+
+    def register(fn):
+        if name in _registry:
+            raise ValueError(f'benchmark {name} registered twice')
+
+        _registry[name] = fn
+        return fn
+
+    return register
+
+def find_benchmarks():
+    """
+    Returns a dict mapping the names of all the benchmarks
+    in all the installed apps to their functions, in order
+    of name.
+    """
+    autodiscover_modules('benchmarks')
+
+    return dict(sorted(_registry.items()))
+
+class Timer(object):
+    """
+    Times the code a benchmark gives it.
+
+    The code is run enough times to take at least 0.2 seconds
+    (see timeit.Timer.autorange), and then that many times again,
+    "repeat" times over. We report the fastest round, because
+    anything slower was slowed by something other than the code.
+    But we keep them all, so that regressions() can tell how
+    much they varied.
+    """
+
+    def __init__(self,
+            repeat = 5,
+            ):
+
+        self.repeat = repeat
+        self.result = None
+
+    def run(self, fn, items=1, **extra):
+        """
+        Times fn(), which deals with "items" objects on each call.
+
+        Any other keyword arguments are recorded along with
+        the timings; use them for anything else worth reporting,
+        such as the size of what fn() produced.
+        """
+
+        timer = timeit.Timer(fn)
+
+        number, _ = timer.autorange()
+
+        rounds = timer.repeat(
+                repeat = self.repeat,
+                number = number,
+                )
+
+        rounds = sorted([x / number for x in rounds])
+        per_call = rounds[0]
+
+        self.result = {
+                'calls': number * self.repeat,
+                'items': items,
+                'seconds_per_call': per_call,
+                'rounds': rounds,
+                'items_per_second': items / per_call,
+                'extra': extra,
+                }
+
+def local_hostname():
+    """
+    Makes sure that our own URLs count as local, which they
+    don't with the default settings. Use it as a context manager
+    around anything which looks at whether URLs are local.
+    """
+    from unittest.mock import patch
+    from django.conf import settings
+
+    return patch.dict(settings.KEPI, {
+        'LOCAL_OBJECT_HOSTNAME': settings.ALLOWED_HOSTS[0],
+        })
+
+class _Rollback(Exception):
+    pass
+
+def run_benchmark(fn,
+        repeat = 5,
+        ):
+    """
+    Runs one benchmark function, and returns the Timer's result.
+    Anything the benchmark wrote to the database is rolled back.
+    """
+
+    timer = Timer(
+            repeat = repeat,
+            )
+
+    try:
+        with transaction.atomic():
+            fn(timer)
+            raise _Rollback()
+    except _Rollback:
+        pass
+
+    if timer.result is None:
+        raise ValueError(f'{fn.__name__} never called timer.run()')
+
+    return timer.result
+
+def environment():
+    """
+    Returns a dict describing what the benchmarks are being
+    run on, to store along with their results.
+    """
+    import django
+    import kepi
+
+    return {
+            'kepi': kepi.__version__,
+            'python': '%s %s' % (
+                platform.python_implementation(),
+                platform.python_version(),
+                ),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'when': datetime.datetime.utcnow().isoformat()+'Z',
+            }
+
+def compare(old, new):
+    """
+    Compares two sets of results, each a dict mapping the names
+    of benchmarks to what run_benchmark() returned for them.
+
+    Returns a dict mapping the name of each benchmark which is in
+    both to how long it took in "new", as a multiple of how long
+    it took in "old". So 1.5 means it's half as slow again.
+    """
+
+    return dict([
+        (name, new[name]['seconds_per_call'] /
+            old[name]['seconds_per_call'])
+        for name in sorted(new.keys())
+        if name in old
+        ])
+
+def combine(first, second):
+    """
+    Returns a result made from two results for the same benchmark,
+    as though all their rounds had been timed together.
+    """
+    rounds = sorted(first.get('rounds', []) + second.get('rounds', []))
+    per_call = min(first['seconds_per_call'], second['seconds_per_call'])
+
+    return dict(first,
+            calls = first['calls'] + second['calls'],
+            seconds_per_call = per_call,
+            items_per_second = first['items'] / per_call,
+            rounds = rounds,
+            )
+
+def _slowest(result):
+    # Results stored before we kept every round only have the fastest.
+    return max(result.get('rounds') or [result['seconds_per_call']])
+
+def regressions(old, new, threshold):
+    """
+    Returns the names of the benchmarks which are in both "old" and
+    "new", dicts like the ones compare() takes, and which have got
+    slower by more than "threshold", a fraction.
+
+    Timings of the same code vary a good deal from one run to the
+    next, so a ratio on its own mostly finds noise. A benchmark
+    only counts as slower if every round in "new" was slower than
+    every round in "old", as well as the fastest being slower by
+    more than "threshold".
+    """
+
+    return [name for name, ratio in compare(old, new).items()
+            if ratio > 1+threshold and
+            new[name]['seconds_per_call'] > _slowest(old[name])]
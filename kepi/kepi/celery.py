@@ -0,0 +1,108 @@
+# celery.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+kepi's Celery app, and the queues its tasks go to.
+
+Tasks are routed to one of four queues, so that a big job of one
+kind can't hold up the others:
+
+    INBOUND: validating messages which arrive in our inboxes.
+    OUTBOUND: delivering activities to remote inboxes.
+    FETCH: fetching remote objects before the tasks which need them;
+        see kepi.sombrero_sendpub.fetch.prefetch().
+    MAINTENANCE: housekeeping, such as filling the key pool.
+
+CELERY['task_routes'] in settings.py says which task goes where.
+Within a queue, tasks with a higher priority go first; see
+PRIORITY_INTERACTIVE and PRIORITY_BULK. Pass them through
+broker_priority() when you queue a task, because not every
+broker counts the same way.
+
+Start a worker with "celery -A kepi.kepi worker -Q <queues>";
+docs/installation.md suggests how many of each to run.
+
+Unless you set a broker in CELERY['broker_url'], tasks run as
+soon as they're queued, in the same process, because
+CELERY['task_always_eager'] is True. The tests work that way too.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from celery import Celery
+from django.conf import settings
+from urllib.parse import urlparse
+
+INBOUND = 'kepi.inbound'
+OUTBOUND = 'kepi.outbound'
+FETCH = 'kepi.fetch'
+MAINTENANCE = 'kepi.maintenance'
+
+QUEUES = [
+        INBOUND,
+        OUTBOUND,
+        FETCH,
+        MAINTENANCE,
+        ]
+
+# Priorities run from 0, the lowest, to
+# CELERY['task_queue_max_priority']. These are the priorities as
+# we think of them; broker_priority() turns them into what the
+# broker wants.
+
+# For things someone is waiting to see: Accepts for their
+# follow requests, and activities addressed to particular people,
+# such as replies and mentions.
+PRIORITY_INTERACTIVE = 8
+
+# For things nobody in particular is waiting for, such as
+# sending a status to every follower its poster has.
+PRIORITY_BULK = 2
+
+# Brokers which kombu serves lowest priority number first.
+# kombu's Redis transport keeps a list for each priority step,
+# and pops from the list for 0 before the others.
+LOWEST_FIRST = [
+        'redis',
+        'rediss',
+        'redis+socket',
+        'sentinel',
+        ]
+
+app = Celery('kepi')
+
+# Read lazily, so that importing this doesn't need settings.
+app.add_defaults(lambda: settings.CELERY)
+
+app.autodiscover_tasks()
+
+def _lowest_first():
+    broker_url = app.conf.broker_url or ''
+
+    if isinstance(broker_url, (list, tuple)):
+        broker_url = broker_url[0] if broker_url else ''
+
+    return urlparse(broker_url.split(';')[0]).scheme in LOWEST_FIRST
+
+def broker_priority(priority):
+    """
+    Returns the priority to queue a task with, for "priority",
+    which is one of the PRIORITY_* constants, or None for
+    CELERY['task_default_priority'].
+
+    RabbitMQ runs the highest number first, so that's what we
+    use. But with Redis, kombu runs the lowest number first, so
+    there we count down from CELERY['task_queue_max_priority']
+    instead. The default priority is near the middle either way.
+    """
+    if priority is None:
+        return None
+
+    if _lowest_first():
+        return app.conf.task_queue_max_priority - priority
+
+    return priority
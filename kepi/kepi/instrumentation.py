@@ -0,0 +1,642 @@
+# instrumentation.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Measures where the time goes in each request.
+
+InstrumentationMiddleware keeps a Measurement for each request.
+While the request runs, it records:
+
+    - the wall time of the whole request;
+    - how many database queries were made, and how long they took;
+    - how many outbound HTTP calls were made, and how long they took;
+    - cache hits and misses; and
+    - how long we spent serialising the response.
+
+Database queries are counted automatically. Other code tells us
+about the rest: wrap outbound HTTP calls in measure('http'),
+serialisation in measure('serialise'), and call count('cache_hits')
+or count('cache_misses') when a cache is consulted. Outside a
+request, these do nothing, and cost very little.
+
+At the end of the request, the measurement is added to the totals
+for the view class which handled it. The totals are served in
+Prometheus's text format by MetricsView, at /metrics. If
+KEPI['SERVER_TIMING'] says so, the measurement is also sent back
+in a Server-Timing header, which browsers show in their
+developer tools.
+
+The totals belong to the process which collected them. If several
+processes share a port, as gunicorn's workers do, each scrape sees
+whichever one answers it. So by default each series is labelled
+with the process's ID, and the series of each process stay
+separate. If KEPI['METRICS_DIR'] names a directory, each process
+also saves its totals in a file there, at most every SAVE_INTERVAL
+seconds, and /metrics adds up the totals from all the files.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from contextlib import contextmanager, ExitStack
+from collections import defaultdict
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from django.views import View
+import atexit
+import contextvars
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+
+# The upper bounds of the buckets of the request time histogram,
+# in seconds.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1,
+        0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How often, in seconds, a process saves its totals in
+# KEPI['METRICS_DIR'], at most.
+SAVE_INTERVAL = 1.0
+
+# The view label for requests which didn't reach a view,
+# such as those which didn't match any URL.
+NO_VIEW = '(none)'
+
+#########################################
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % (','.join([
+        '%s="%s"' % (name, _escape(value))
+        for name, value in labels
+        ]),)
+
+def _number(value):
+    if value==int(value):
+        return str(int(value))
+    return repr(value)
+
+class Registry(object):
+    """
+    Counters, gauges and histograms, each with a set of labels,
+    which can be listed in Prometheus's text format.
+
+    Every metric must be described with describe() before
+    it's used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._values = defaultdict(dict)
+        self._collectors = []
+        self._saved_at = 0
+
+    def describe(self, name, kind, help,
+            buckets = DURATION_BUCKETS):
+        """
+        Describes the metric "name". "kind" is 'counter', 'gauge'
+        or 'histogram'. Histograms put their observations into
+        "buckets", a list of upper bounds.
+        """
+        if kind not in ('counter', 'gauge', 'histogram'):
+            raise ValueError(f'unknown kind of metric: {kind}')
+
+        self._metrics[name] = (kind, help, tuple(buckets))
+
+    def add_collector(self, collector):
+        """
+        Adds a function which exposition() calls, with this
+        registry, before it lists anything. Use it to set gauges
+        which are only worth finding out when someone's looking.
+        """
+        self._collectors.append(collector)
+
+    def set(self, name, value, **labels):
+        """
+        Sets the gauge "name" with "labels" to "value".
+        """
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            self._values[name][key] = value
+
+        self._autosave()
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Adds "amount" to the counter "name" with "labels".
+        """
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+
+        self._autosave()
+
+    def observe(self, name, value, **labels):
+        """
+        Adds "value" to the histogram "name" with "labels".
+        """
+        key = tuple(sorted(labels.items()))
+        buckets = self._metrics[name][2]
+
+        with self._lock:
+            values = self._values[name]
+
+            if key not in values:
+                # A count for each bucket, then the sum and the count.
+                values[key] = [0] * (len(buckets)+2)
+
+            found = values[key]
+
+            for i, bound in enumerate(buckets):
+                if value<=bound:
+                    found[i] += 1
+
+            found[-2] += value
+            found[-1] += 1
+
+        self._autosave()
+
+    def get(self, name, **labels):
+        """
+        Returns the value of the counter or gauge "name" with
+        "labels", or, for a histogram, how many values it has seen.
+        """
+        key = tuple(sorted(labels.items()))
+
+        with self._lock:
+            found = self._values[name].get(key, 0)
+
+        if isinstance(found, list):
+            return found[-1]
+
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _autosave(self):
+        directory = settings.KEPI['METRICS_DIR']
+
+        if directory is None:
+            return
+
+        if time.monotonic()-self._saved_at < SAVE_INTERVAL:
+            return
+
+        self.save(directory)
+
+    def _filename(self, directory):
+        return os.path.join(directory, '%d.json' % (os.getpid(),))
+
+    def save(self, directory):
+        """
+        Saves this process's totals in "directory", so that
+        other processes can add them to theirs; see load().
+        """
+        self._saved_at = time.monotonic()
+
+        with self._lock:
+            values = dict([
+                (name, [[list(labels), value]
+                    for labels, value in found.items()])
+                for name, found in self._values.items()])
+
+        filename = self._filename(directory)
+
+        try:
+            with open(filename+'.new', 'w') as f:
+                json.dump(values, f)
+            os.replace(filename+'.new', filename)
+        except OSError as e:
+            logger.warning('Can\'t save metrics in %s: %s', filename, e)
+
+    def load(self, directory):
+        """
+        Returns the totals which other processes have saved in
+        "directory", as a list with an item for each process.
+        """
+        result = []
+        ours = self._filename(directory)
+
+        for filename in glob.glob(os.path.join(directory, '*.json')):
+
+            if filename==ours:
+                continue
+
+            try:
+                with open(filename, 'r') as f:
+                    values = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning('Can\'t load metrics from %s: %s',
+                        filename, e)
+                continue
+
+            result.append(dict([
+                (name, dict([
+                    (tuple([tuple(x) for x in labels]), value)
+                    for labels, value in found]))
+                for name, found in values.items()]))
+
+        return result
+
+    def exposition(self, labels=(), others=()):
+        """
+        Returns all the metrics, in Prometheus's text format.
+
+        "labels" are added to every series. "others" are totals
+        from other processes, as load() returns them; their
+        counters and histograms are added to ours. Gauges are
+        only ever ours, because the collectors set them when
+        we're asked.
+        """
+
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logger.warning('Metrics collector %s failed: %s',
+                        collector, e)
+
+        with self._lock:
+            values = dict([(name, dict([
+                (key, list(value) if isinstance(value, list) else value)
+                for key, value in found.items()]))
+                for name, found in self._values.items()])
+
+        for other in others:
+            for name, found in other.items():
+
+                if name not in self._metrics or \
+                        self._metrics[name][0]=='gauge':
+                    continue
+
+                ours = values.setdefault(name, {})
+
+                for key, value in found.items():
+                    if key not in ours:
+                        ours[key] = value
+                    elif isinstance(value, list):
+                        ours[key] = [a+b for a, b in zip(ours[key], value)]
+                    else:
+                        ours[key] += value
+
+        lines = []
+
+        for name, (kind, help, buckets) in sorted(self._metrics.items()):
+
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            for key, value in sorted(values.get(name, {}).items()):
+
+                key = key + tuple(labels)
+
+                if kind!='histogram':
+                    lines.append(f'{name}{_labels(key)} '+\
+                            _number(value))
+                    continue
+
+                for bound, count in zip(
+                        [_number(x) for x in buckets]+['+Inf'],
+                        value[:len(buckets)]+[value[-1]],
+                        ):
+                    lines.append(f'{name}_bucket'+\
+                            _labels(key+(('le', bound),))+\
+                            f' {count}')
+
+                lines.append(f'{name}_sum{_labels(key)} '+\
+                        _number(value[-2]))
+                lines.append(f'{name}_count{_labels(key)} '+\
+                        _number(value[-1]))
+
+        return '\n'.join(lines)+'\n'
+
+registry = Registry()
+
+@atexit.register
+def _save_at_exit():
+    # So that the last second of a process's totals isn't lost.
+    if settings.configured and settings.KEPI['METRICS_DIR'] is not None:
+        registry.save(settings.KEPI['METRICS_DIR'])
+
+def exposition():
+    """
+    Returns the totals for /metrics, in Prometheus's text format.
+
+    If KEPI['METRICS_DIR'] is set, these are the totals of all the
+    processes which save there. Otherwise, they're this process's,
+    labelled with its ID.
+    """
+    directory = settings.KEPI['METRICS_DIR']
+
+    if directory is None:
+        return registry.exposition(
+                labels = [('pid', os.getpid())],
+                )
+
+    registry.save(directory)
+
+    return registry.exposition(
+            others = registry.load(directory),
+            )
+
+for name, kind, help in [
+        ('kepi_request_duration_seconds', 'histogram',
+            'Wall time of requests.'),
+        ('kepi_responses_total', 'counter',
+            'Responses, by class of status code.'),
+        ('kepi_request_db_queries_total', 'counter',
+            'Database queries made during requests.'),
+        ('kepi_request_db_seconds_total', 'counter',
+            'Time spent on database queries during requests.'),
+        ('kepi_request_http_calls_total', 'counter',
+            'Outbound HTTP calls made during requests.'),
+        ('kepi_request_http_seconds_total', 'counter',
+            'Time spent on outbound HTTP calls during requests.'),
+        ('kepi_request_cache_hits_total', 'counter',
+            'Cache hits during requests.'),
+        ('kepi_request_cache_misses_total', 'counter',
+            'Cache misses during requests.'),
+        ('kepi_request_serialise_seconds_total', 'counter',
+            'Time spent serialising responses.'),
+        ]:
+    registry.describe(name, kind, help)
+
+#########################################
+
+class Measurement(object):
+    """
+    What happened during one request.
+    """
+
+    __slots__ = (
+            'view',
+            'started',
+            'seconds',
+            'db_queries',
+            'db_seconds',
+            'http_calls',
+            'http_seconds',
+            'cache_hits',
+            'cache_misses',
+            'serialise_seconds',
+            )
+
+    def __init__(self):
+        self.view = NO_VIEW
+        self.started = time.perf_counter()
+        self.seconds = None
+
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.http_calls = 0
+        self.http_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.serialise_seconds = 0.0
+
+    def query(self, execute, sql, params, many, context):
+        """
+        A database execute_wrapper, which times each query.
+        """
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter()-started
+            self.db_queries += 1
+
+    def finish(self):
+        self.seconds = time.perf_counter()-self.started
+
+    def record(self, status_code, registry=registry):
+        """
+        Adds this measurement to the totals in "registry".
+        "status_code" is the status code of the response.
+        """
+        view = self.view
+
+        registry.observe('kepi_request_duration_seconds', self.seconds,
+                view = view)
+
+        registry.inc('kepi_responses_total',
+                view = view,
+                code = '%dxx' % (status_code//100,),
+                )
+
+        for name, value in [
+                ('kepi_request_db_queries_total', self.db_queries),
+                ('kepi_request_db_seconds_total', self.db_seconds),
+                ('kepi_request_http_calls_total', self.http_calls),
+                ('kepi_request_http_seconds_total', self.http_seconds),
+                ('kepi_request_cache_hits_total', self.cache_hits),
+                ('kepi_request_cache_misses_total', self.cache_misses),
+                ('kepi_request_serialise_seconds_total',
+                    self.serialise_seconds),
+                ]:
+            registry.inc(name, value, view=view)
+
+    def server_timing(self):
+        """
+        Returns the value of a Server-Timing header describing
+        this measurement.
+        """
+        def ms(seconds):
+            return '%.1f' % (seconds*1000,)
+
+        return ', '.join([
+            f'db;dur={ms(self.db_seconds)};desc="{self.db_queries} queries"',
+            f'http;dur={ms(self.http_seconds)};'+\
+                    f'desc="{self.http_calls} calls"',
+            f'cache;desc="{self.cache_hits} hits, '+\
+                    f'{self.cache_misses} misses"',
+            f'serialise;dur={ms(self.serialise_seconds)}',
+            f'total;dur={ms(self.seconds)}',
+            ])
+
+_current = contextvars.ContextVar('kepi_measurement',
+        default = None)
+
+def current():
+    """
+    Returns the Measurement for the request we're handling,
+    or None if we're not handling one.
+    """
+    return _current.get()
+
+@contextmanager
+def measure(what):
+    """
+    Adds the time spent in the "with" block to the current
+    request's measurement. "what" is 'http', which also counts
+    a call, or 'serialise'.
+    """
+    measurement = _current.get()
+
+    if measurement is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter()-started
+
+        if what=='http':
+            measurement.http_calls += 1
+            measurement.http_seconds += elapsed
+        else:
+            measurement.serialise_seconds += elapsed
+
+def count(what):
+    """
+    Counts a cache hit or miss against the current request.
+    "what" is 'cache_hits' or 'cache_misses'.
+    """
+    measurement = _current.get()
+
+    if measurement is not None:
+        setattr(measurement, what, getattr(measurement, what)+1)
+
+#########################################
+
+def _view_name(view_func):
+    view_class = getattr(view_func, 'view_class',
+            getattr(view_func, 'cls', None))
+
+    if view_class is not None:
+        return f'{view_class.__module__}.{view_class.__qualname__}'
+
+    return f'{view_func.__module__}.{view_func.__qualname__}'
+
+def _server_timing_wanted():
+    result = settings.KEPI['SERVER_TIMING']
+
+    if result is None:
+        return settings.DEBUG
+
+    return result
+
+class InstrumentationMiddleware(object):
+    """
+    Measures each request. See the top of this module.
+
+    Put it first in MIDDLEWARE, so that it sees the time
+    the other middleware takes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+
+        if not settings.KEPI['INSTRUMENTATION']:
+            return self.get_response(request)
+
+        measurement = Measurement()
+        token = _current.set(measurement)
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                            connection.execute_wrapper(measurement.query),
+                            )
+
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        measurement.finish()
+        measurement.record(response.status_code)
+
+        if _server_timing_wanted():
+            response['Server-Timing'] = measurement.server_timing()
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        measurement = _current.get()
+
+        if measurement is not None:
+            measurement.view = _view_name(view_func)
+
+    def process_template_response(self, request, response):
+        measurement = _current.get()
+
+        if measurement is None:
+            return response
+
+        # d-r-f's Responses are rendered after the view returns,
+        # and after this; the callback runs once they're done.
+        started = time.perf_counter()
+
+        def rendered(response):
+            measurement.serialise_seconds += time.perf_counter()-started
+
+        response.add_post_render_callback(rendered)
+
+        return response
+
+class MetricsView(View):
+    """
+    Serves the totals in Prometheus's text format, to anyone
+    whose address is in KEPI['METRICS_ALLOWED_ADDRESSES'] (None
+    there means anyone at all), or who sends the bearer token
+    in KEPI['METRICS_TOKEN'].
+
+    Nobody is allowed by default. Behind a reverse proxy on the
+    same machine, every request seems to come from 127.0.0.1,
+    so allowing that would allow the whole world.
+    """
+
+    def _allowed(self, request):
+
+        allowed = settings.KEPI['METRICS_ALLOWED_ADDRESSES']
+
+        if allowed is None or \
+                request.META.get('REMOTE_ADDR') in allowed:
+            return True
+
+        token = settings.KEPI['METRICS_TOKEN']
+
+        if token is None:
+            return False
+
+        return hmac.compare_digest(
+                request.META.get('HTTP_AUTHORIZATION', ''),
+                'Bearer '+token,
+                )
+
+    def get(self, request, *args, **kwargs):
+
+        if not self._allowed(request):
+            return HttpResponse(
+                    status = 403,
+                    content = 'Forbidden',
+                    content_type = 'text/plain',
+                    )
+
+        return HttpResponse(
+                content = exposition(),
+                content_type = 'text/plain; version=0.0.4; charset=utf-8',
+                )
@@ -0,0 +1,837 @@
+# loadtest.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+A load test for federation, run by "manage.py kepi_loadtest".
+
+RemoteInstance is a stand-in for another ActivityPub server. It
+runs in a thread of this process, on a local address, and makes up
+actors as they're asked for: their documents, keys, collections and
+webfinger records. It keeps a note of everything posted to their
+inboxes, and when it arrived.
+
+LoadTest plays the part of that server's users. It sends kepi
+signed Creates, Likes, Announces and Follows at the rates it's
+given, by posting them to kepi's inboxes through the usual views.
+Meanwhile, kepi's own users post statuses, which kepi delivers to
+their followers on the RemoteInstance. Nothing leaves the machine.
+
+For each inbound activity, the latency is the time from when it
+was due to be sent until its effect, such as a new status, shows
+up in the database. For each outbound delivery, it's the time from
+when the status was due to be posted until the delivery arrived.
+Timing from when things were *due*, rather than when we got round
+to them, means that if kepi can't keep up, the latencies say so.
+
+Unless CELERY['task_always_eager'] is turned off, all of this
+happens within the calls to the views. With a broker, workers do
+the work; they must be able to reach the RemoteInstance, so run
+them on the same machine.
+
+The test adds people, statuses and follows to the database, and
+doesn't remove them afterwards, so use a scratch database.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from collections import Counter, namedtuple
+from kepi.bowler_pub.utils import as_json, as_json_bytes, \
+        configured_url, is_local
+import kepi.sombrero_sendpub.delivery as sombrero_delivery
+import django.test
+import datetime
+import secrets
+import threading
+import math
+import time
+import json
+import re
+import zlib
+
+# Kinds of activity the RemoteInstance's users send to kepi.
+INBOUND_KINDS = ['create', 'like', 'announce', 'follow']
+
+# Kinds of activity kepi's users send to the RemoteInstance.
+# "post" is a status posted locally; "accept" is kepi's reply to
+# an inbound Follow, which isn't sent at a rate of its own.
+OUTBOUND_KINDS = ['post', 'accept']
+
+# Activities per second of each kind, by default.
+DEFAULT_RATES = {
+        'create': 10.0,
+        'like': 5.0,
+        'announce': 2.0,
+        'follow': 1.0,
+        'post': 1.0,
+        }
+
+PUBLIC = 'https://www.w3.org/ns/activitystreams#Public'
+
+ACTIVITY_MIME_TYPE = 'application/activity+json'
+
+# A record of something posted to a RemoteInstance inbox.
+# "arrived" is in the same terms as time.monotonic().
+Delivery = namedtuple('Delivery', ['arrived', 'path', 'fields', 'signed'])
+
+#########################################
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # Keep connections open between requests, as a real server
+    # would; kepi's deliveries can share them.
+    protocol_version = 'HTTP/1.1'
+
+    # Set by RemoteInstance.start() on a subclass.
+    instance = None
+
+    def _reply(self, code, document=None):
+        content = b''
+        if document is not None:
+            content = as_json_bytes(document, pretty=False)
+
+        self.send_response(code)
+        self.send_header('Content-Type', ACTIVITY_MIME_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        document = self.instance._get(self.path)
+        self._reply(404 if document is None else 200, document)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        if self.instance._receive(self.path, self.headers, body):
+            self._reply(202)
+        else:
+            self._reply(404)
+
+    def log_message(self, format, *args):
+        logger.debug('remote instance: '+format, *args)
+
+class RemoteInstance(object):
+    """
+    A stand-in for a remote ActivityPub server, serving from
+    "address" on "port"; the default port of 0 picks a free one.
+
+    Any username is an actor here: /users/fred is made up when
+    someone first asks. There are only "keys" key pairs, which
+    the actors share out between them by name, because making
+    a key for each one would take longer than the test.
+
+    Use it as a context manager, or call start() and stop().
+    """
+
+    def __init__(self,
+            address = '127.0.0.1',
+            port = 0,
+            keys = 4,
+            ):
+
+        from kepi.trilby_api.crypto import Key
+
+        self.address = address
+        self.port = port
+        self.url = None
+        self.keys = [Key() for i in range(keys)]
+        self.requests = Counter()
+
+        self._objects = {}
+        self._received = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'instance': self})
+
+        self._server = ThreadingHTTPServer(
+                (self.address, self.port),
+                handler,
+                )
+        self._server.daemon_threads = True
+
+        self.port = self._server.server_address[1]
+        self.url = 'http://%s:%d' % (self.address, self.port)
+
+        thread = threading.Thread(
+                target = self._server.serve_forever,
+                name = 'kepi-remote-instance',
+                daemon = True,
+                )
+        thread.start()
+
+        logger.info('Remote instance is serving at %s', self.url)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def hostname(self):
+        return urlparse(self.url).netloc
+
+    def actor_url(self, name):
+        return '%s/users/%s' % (self.url, name)
+
+    def _key_for(self, name):
+        return self.keys[zlib.crc32(name.encode('UTF-8')) % len(self.keys)]
+
+    def private_key(self, name):
+        return self._key_for(name).private_as_pem()
+
+    def actor(self, name):
+        url = self.actor_url(name)
+
+        return {
+                '@context': 'https://www.w3.org/ns/activitystreams',
+                'id': url,
+                'type': 'Person',
+                'preferredUsername': name,
+                'name': name.capitalize(),
+                'summary': '<p>Not a real person.</p>',
+                'url': url,
+                'inbox': url+'/inbox',
+                'outbox': url+'/outbox',
+                'followers': url+'/followers',
+                'following': url+'/following',
+                'featured': url+'/collections/featured',
+                'manuallyApprovesFollowers': False,
+                'publicKey': {
+                    'id': url+'#main-key',
+                    'owner': url,
+                    'publicKeyPem': self._key_for(name).public_as_pem(),
+                    },
+                }
+
+    def add_object(self, fields):
+        """
+        Serves "fields" at the path of its "id", as though one of
+        our actors had posted it.
+        """
+        with self._lock:
+            self._objects[urlparse(fields['id']).path] = fields
+
+    def deliveries(self):
+        """
+        Returns a list of everything posted to our inboxes so far.
+        """
+        with self._lock:
+            return list(self._received)
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def _get(self, path):
+        parsed = urlparse(path)
+
+        if parsed.path=='/.well-known/webfinger':
+            self._count('webfinger')
+
+            resource = parse_qs(parsed.query).get('resource', [''])[0]
+            found = re.fullmatch(r'acct:([^@]+)@(.+)', resource)
+
+            if found is None or found.group(2)!=self.hostname:
+                return None
+
+            return {
+                    'subject': resource,
+                    'links': [
+                        {
+                            'rel': 'self',
+                            'type': ACTIVITY_MIME_TYPE,
+                            'href': self.actor_url(found.group(1)),
+                            },
+                        ],
+                    }
+
+        found = re.fullmatch(r'/users/([^/]+)', parsed.path)
+        if found is not None:
+            self._count('actor')
+            return self.actor(found.group(1))
+
+        found = re.fullmatch(
+                r'/users/[^/]+/(followers|following|outbox|collections/featured)',
+                parsed.path)
+        if found is not None:
+            self._count('collection')
+            return {
+                    '@context': 'https://www.w3.org/ns/activitystreams',
+                    'id': self.url+parsed.path,
+                    'type': 'OrderedCollection',
+                    'totalItems': 0,
+                    'orderedItems': [],
+                    }
+
+        self._count('object')
+        with self._lock:
+            return self._objects.get(parsed.path)
+
+    def _receive(self, path, headers, body):
+        if re.fullmatch(r'/users/[^/]+/inbox|/inbox', path) is None:
+            return False
+
+        self._count('inbox')
+
+        try:
+            fields = json.loads(body)
+        except ValueError:
+            fields = None
+
+        delivery = Delivery(
+                arrived = time.monotonic(),
+                path = path,
+                fields = fields,
+                signed = 'Signature' in headers,
+                )
+
+        with self._lock:
+            self._received.append(delivery)
+
+        return True
+
+#########################################
+
+def latency_summary(latencies):
+    """
+    Summarises a list of latencies, in seconds: the mean, the
+    median, the 90th and 99th percentiles, and the maximum.
+    Returns None if the list is empty.
+    """
+    if not latencies:
+        return None
+
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[max(0, math.ceil(p/100*len(latencies))-1)]
+
+    return {
+            'mean': sum(latencies)/len(latencies),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': latencies[-1],
+            }
+
+def row_counts():
+    """
+    Returns a dict mapping the name of each of kepi's models
+    to the number of rows it has.
+    """
+    result = {}
+
+    for model in apps.get_models():
+        if not model.__module__.startswith('kepi.'):
+            continue
+
+        if model._meta.proxy or not model._meta.managed:
+            continue
+
+        result[model._meta.label] = model._base_manager.count()
+
+    return result
+
+def database_bytes():
+    """
+    Returns the size of the database in bytes, if we know
+    how to find out for this kind of database; otherwise None.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor=='sqlite':
+            cursor.execute('PRAGMA page_count')
+            pages = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_size')
+            return pages * cursor.fetchone()[0]
+
+        if connection.vendor=='postgresql':
+            cursor.execute('SELECT pg_database_size(current_database())')
+            return cursor.fetchone()[0]
+
+    return None
+
+class LoadTest(object):
+    """
+    Sends kepi federation traffic from "remote", a RemoteInstance
+    which has been started, and measures how kepi copes.
+
+    "rates" maps kinds of activity in INBOUND_KINDS, and "post",
+    to how many of each to send per second; kinds which aren't
+    given use DEFAULT_RATES. They're all sent for "duration"
+    seconds, and then we wait up to "timeout" seconds for the
+    last of them to be dealt with.
+
+    setup() makes "local_people" local people, each with
+    "local_statuses" statuses between them to like and announce,
+    and "followers" followers on the RemoteInstance. Inbound
+    activities come from "actors" remote actors, in turn.
+    Follows and Likes are spread between the actors so that
+    nobody does the same thing twice, as long as there are
+    enough actors.
+    """
+
+    def __init__(self,
+            remote,
+            rates = None,
+            duration = 10.0,
+            actors = 50,
+            local_people = 5,
+            local_statuses = 20,
+            followers = 20,
+            timeout = 30.0,
+            poll_interval = 0.01,
+            ):
+
+        self.remote = remote
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+
+        for kind in self.rates.keys():
+            if kind not in INBOUND_KINDS+['post']:
+                raise ValueError(f'unknown kind of activity: {kind}')
+
+        self.duration = duration
+        self.actors = actors
+        self.local_people = local_people
+        self.local_statuses = local_statuses
+        self.followers = followers
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+        self.people = []
+        self.statuses = []
+
+        self._client = django.test.Client()
+        self._hostname = settings.KEPI['LOCAL_OBJECT_HOSTNAME']
+        self._shared_inbox = urlparse(
+                configured_url('SHARED_INBOX_LINK')).path
+
+    def setup(self):
+        """
+        Makes the local people, their statuses, and their
+        followers on the RemoteInstance.
+        """
+        from kepi.trilby_api.models import LocalPerson, Person, \
+                Status, Follow
+        from kepi.sombrero_sendpub.fetch import fetch
+
+        prefix = 'lt%s' % (secrets.token_hex(3),)
+
+        self.people = []
+        for i in range(self.local_people):
+            person = LocalPerson(
+                    username = '%s_%d' % (prefix, i),
+                    )
+            person.save()
+            self.people.append(person)
+
+        self.statuses = []
+        for i in range(self.local_statuses):
+            status = Status(
+                    account = self.people[i % len(self.people)],
+                    content = 'Load test status %d' % (i,),
+                    )
+            status.save()
+            self.statuses.append(status)
+
+        for i in range(self.followers):
+            follower = fetch(
+                    self.remote.actor_url('%s_follower%d' % (prefix, i)),
+                    expected_type = Person,
+                    )
+
+            if follower is None:
+                raise ValueError(
+                        f"couldn't fetch followers from {self.remote.url}")
+
+            for person in self.people:
+                Follow(
+                        follower = follower,
+                        following = person,
+                        ).save()
+
+        self._prefix = prefix
+
+        logger.info('Load test: made %d local people, %d statuses, '+\
+                '%d remote followers',
+                len(self.people), len(self.statuses), self.followers)
+
+    def _actor(self, k):
+        return '%s_actor%d' % (self._prefix, k % self.actors)
+
+    def _pair(self, k, targets):
+        """
+        Returns the name of the actor for the k'th activity of a
+        kind which is done to one of "targets", and the target.
+        """
+        return (self._actor(k),
+                targets[(k // self.actors) % len(targets)])
+
+    def _post(self, name, activity, path):
+        """
+        Signs "activity" as the remote actor "name", and posts
+        it to kepi's inbox at "path".
+        """
+        body = as_json(activity)
+
+        signer = sombrero_delivery._signer(
+                key_id = self.remote.actor_url(name)+'#main-key',
+                secret = self.remote.private_key(name),
+                )
+
+        headers = signer.sign(
+                {
+                    'Date': sombrero_delivery._rfc822_datetime(),
+                    'Host': self._hostname,
+                    'content-type': ACTIVITY_MIME_TYPE,
+                    },
+                method = 'POST',
+                path = path,
+                )
+
+        response = self._client.post(
+                path,
+                data = body,
+                content_type = ACTIVITY_MIME_TYPE,
+                HTTP_DATE = headers['Date'],
+                HTTP_HOST = self._hostname,
+                HTTP_SIGNATURE = headers['signature'],
+                )
+
+        if response.status_code!=200:
+            logger.warning('Load test: %s to %s got %d',
+                    activity['type'], path, response.status_code)
+
+    def _activity_id(self, name, kind, k):
+        return '%s/activities/%s/%d' % (
+                self.remote.actor_url(name), kind, k)
+
+    # Each _send_* method sends the k'th activity of its kind,
+    # and returns a function which is True once it's taken effect.
+
+    def _send_create(self, k):
+        from kepi.trilby_api.models import Status
+
+        name = self._actor(k)
+        actor = self.remote.actor_url(name)
+
+        note = {
+                'id': '%s/statuses/%d' % (actor, k),
+                'type': 'Note',
+                'attributedTo': actor,
+                'content': '<p>Load test status %d #loadtest</p>' % (k,),
+                'published': datetime.datetime.utcnow().isoformat()+'Z',
+                'to': [PUBLIC],
+                'cc': [actor+'/followers'],
+                'tag': [
+                    {
+                        'type': 'Hashtag',
+                        'name': '#loadtest',
+                        },
+                    ],
+                }
+
+        self.remote.add_object(note)
+
+        self._post(name, {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': self._activity_id(name, 'create', k),
+            'type': 'Create',
+            'actor': actor,
+            'to': note['to'],
+            'cc': note['cc'],
+            'object': note,
+            },
+            path = self._shared_inbox,
+            )
+
+        return Status.objects.filter(
+                remote_url = note['id'],
+                ).exists
+
+    def _send_like(self, k):
+        from kepi.trilby_api.models import Like, RemotePerson
+
+        name, status = self._pair(k, self.statuses)
+        actor = self.remote.actor_url(name)
+
+        self._post(name, {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': self._activity_id(name, 'like', k),
+            'type': 'Like',
+            'actor': actor,
+            'object': status.url,
+            },
+            path = urlparse(status.account.inbox_url).path,
+            )
+
+        return Like.objects.filter(
+                liker__in = RemotePerson.objects.filter(
+                    remote_url = actor),
+                liked = status,
+                ).exists
+
+    def _send_announce(self, k):
+        from kepi.trilby_api.models import Status, RemotePerson
+
+        name, status = self._pair(k, self.statuses)
+        actor = self.remote.actor_url(name)
+
+        self._post(name, {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': self._activity_id(name, 'announce', k),
+            'type': 'Announce',
+            'actor': actor,
+            'to': [PUBLIC],
+            'object': status.url,
+            },
+            path = urlparse(status.account.inbox_url).path,
+            )
+
+        return Status.objects.filter(
+                account__in = RemotePerson.objects.filter(
+                    remote_url = actor),
+                reblog_of = status,
+                ).exists
+
+    def _send_follow(self, k):
+        from kepi.trilby_api.models import Follow, RemotePerson
+
+        name, person = self._pair(k, self.people)
+        actor = self.remote.actor_url(name)
+        offer = self._activity_id(name, 'follow', k)
+
+        self._expect('accept', offer, [urlparse(actor+'/inbox').path])
+
+        self._post(name, {
+            '@context': 'https://www.w3.org/ns/activitystreams',
+            'id': offer,
+            'type': 'Follow',
+            'actor': actor,
+            'object': person.url,
+            },
+            path = urlparse(person.inbox_url).path,
+            )
+
+        return Follow.objects.filter(
+                follower__in = RemotePerson.objects.filter(
+                    remote_url = actor),
+                following = person,
+                ).exists
+
+    def _send_post(self, k):
+        from kepi.trilby_api.models import Status
+
+        person = self.people[k % len(self.people)]
+
+        status = Status(
+                account = person,
+                content = 'Outbound load test status %d' % (k,),
+                )
+        status.save(
+                send_signal = True,
+                )
+
+        self._expect('post', status.url, [
+            urlparse(inbox).path
+            for inbox in sombrero_delivery.follower_inboxes([person])
+            if not is_local(inbox)
+            ])
+
+        return None
+
+    def _expect(self, kind, key, paths):
+        """
+        Notes that the RemoteInstance should receive an activity
+        of "kind" in OUTBOUND_KINDS about "key"-- a status's URL,
+        or a Follow's id-- at each of the inboxes in "paths",
+        because of the activity we're sending now.
+        """
+        self._expected[key] = (kind, self._due, set(paths))
+
+    def _poll(self, pending):
+        now = time.monotonic()
+        still_pending = []
+
+        for kind, due, done in pending:
+            if done():
+                self._latencies[kind].append(now-due)
+            else:
+                still_pending.append((kind, due, done))
+
+        pending[:] = still_pending
+
+    def _outbound(self, deliveries):
+        """
+        Matches what the RemoteInstance received with what
+        we expected it to, and works out the latencies.
+        """
+        latencies = dict([(kind, []) for kind in OUTBOUND_KINDS])
+        expected = dict([(kind, 0) for kind in OUTBOUND_KINDS])
+        seen = set()
+
+        for kind, due, paths in self._expected.values():
+            expected[kind] += len(paths)
+
+        for delivery in deliveries:
+            fields = delivery.fields
+
+            if not isinstance(fields, dict):
+                continue
+
+            if fields.get('type')=='Create':
+                key = (fields.get('object') or {}).get('id')
+            elif fields.get('type')=='Accept':
+                key = fields.get('object')
+            else:
+                continue
+
+            if key not in self._expected:
+                continue
+
+            kind, due, paths = self._expected[key]
+
+            if delivery.path not in paths or (key, delivery.path) in seen:
+                continue
+
+            seen.add((key, delivery.path))
+            latencies[kind].append(delivery.arrived-due)
+
+        return expected, latencies
+
+    def run(self):
+        """
+        Runs the test, and returns the results as a dict.
+        Call setup() first.
+        """
+
+        kinds = [kind for kind in INBOUND_KINDS+['post']
+                if self.rates[kind]>0]
+
+        schedule = sorted([
+            (k/self.rates[kind], kind, k)
+            for kind in kinds
+            for k in range(int(self.duration*self.rates[kind]))
+            ])
+
+        rows_before = row_counts()
+        bytes_before = database_bytes()
+
+        self._latencies = dict([(kind, []) for kind in INBOUND_KINDS])
+        self._expected = {}
+        sent = Counter()
+        pending = []
+
+        logger.info('Load test: sending %d activities over %g seconds',
+                len(schedule), self.duration)
+
+        started = time.monotonic()
+
+        for offset, kind, k in schedule:
+            self._due = started+offset
+
+            while time.monotonic() < self._due:
+                self._poll(pending)
+                time.sleep(min(self.poll_interval,
+                    max(0, self._due-time.monotonic())))
+
+            done = getattr(self, '_send_'+kind)(k)
+            sent[kind] += 1
+
+            if done is not None:
+                pending.append((kind, self._due, done))
+
+            self._poll(pending)
+
+        sending = time.monotonic()-started
+
+        deadline = time.monotonic()+self.timeout
+
+        while time.monotonic() < deadline:
+            self._poll(pending)
+
+            expected, outbound = self._outbound(self.remote.deliveries())
+
+            if not pending and all([
+                len(outbound[kind])>=expected[kind]
+                for kind in OUTBOUND_KINDS]):
+                break
+
+            time.sleep(self.poll_interval)
+
+        elapsed = time.monotonic()-started
+
+        # Once more, in case the loop above never ran.
+        expected, outbound = self._outbound(self.remote.deliveries())
+
+        rows_after = row_counts()
+        bytes_after = database_bytes()
+
+        def describe(rate, sent, expected, latencies):
+            return {
+                    'rate': rate,
+                    'sent': sent,
+                    'expected': expected,
+                    'completed': len(latencies),
+                    'per_second': len(latencies)/elapsed,
+                    'latency': latency_summary(latencies),
+                    }
+
+        result = {
+                'duration': sending,
+                'elapsed': elapsed,
+                'inbound': dict([
+                    (kind, describe(
+                        rate = self.rates[kind],
+                        sent = sent[kind],
+                        expected = sent[kind],
+                        latencies = self._latencies[kind],
+                        ))
+                    for kind in INBOUND_KINDS]),
+                'outbound': {
+                    'post': describe(
+                        rate = self.rates['post'],
+                        sent = sent['post'],
+                        expected = expected['post'],
+                        latencies = outbound['post'],
+                        ),
+                    'accept': describe(
+                        rate = None,
+                        sent = sent['follow'],
+                        expected = expected['accept'],
+                        latencies = outbound['accept'],
+                        ),
+                    },
+                'database': {
+                    'rows': dict([
+                        (name, rows_after[name]-rows_before.get(name, 0))
+                        for name in sorted(rows_after.keys())
+                        if rows_after[name]!=rows_before.get(name, 0)
+                        ]),
+                    'bytes': None if bytes_before is None else \
+                            bytes_after-bytes_before,
+                    },
+                'remote': dict(sorted(self.remote.requests.items())),
+                }
+
+        return result
@@ -54,9 +54,115 @@ KEPI = {
         'USER_FEATURED_LINK': '/users/%(username)s/featured',
         'FOLLOW_REQUEST_LINK' : '/users/%(username)s/follow/%(number)x',
         'SHARED_INBOX_LINK': '/sharedInbox',
+        'TAG_LINK': '/tags/%(name)s',
 
         'TOMBSTONES': True,
 
+        # Whether to indent the JSON we send. None means
+        # only if DEBUG is on.
+        'PRETTY_JSON': None,
+
+        # How long, in seconds, other servers and proxies may
+        # keep our ActivityPub documents before checking back.
+        'CACHE_MAX_AGE': 60,
+
+        # The size, in bits, of the keys we make for local people.
+        'KEY_SIZE': 2048,
+
+        # How many spare keys to keep ready. See
+        # kepi.bowler_pub.models.keypool.
+        'KEY_POOL_SIZE': 20,
+
+        # For how long, in seconds, we still accept signatures
+        # made with someone's previous key after they change it.
+        'KEY_ROTATION_GRACE': 60*60*24,
+
+        # If True, automatic Accepts for remote follow requests
+        # wait for a worker to send them. See kepi.trilby_api.accepts.
+        'ACCEPT_IN_BACKGROUND': False,
+
+        # How many follow requests to accept in each batch.
+        'ACCEPT_BATCH_SIZE': 100,
+
+        # How many seconds a worker has to send the Accepts in a
+        # batch before another worker may take them over.
+        'ACCEPT_CLAIM_SECONDS': 900,
+
+        # If this is a number of seconds, favourites and reblogs
+        # of the same status within that time share a group, which
+        # /api/v2/notifications lists as a single notification.
+        # /api/v1/notifications still lists each of them. None means
+        # no groups. See kepi.trilby_api.models.Notification.add().
+        'NOTIFICATION_GROUP_PERIOD': None,
+
+        # How many of the people in a shared notification we list.
+        'NOTIFICATION_GROUP_SAMPLES': 3,
+
+        # Where the streaming API finds out about new statuses
+        # and notifications. LocalBackend only works within one
+        # process; RedisBackend works across several, and
+        # needs STREAMING_REDIS_URL. See kepi.trilby_api.streaming.
+        'STREAMING_BACKEND': 'kepi.trilby_api.streaming.LocalBackend',
+        'STREAMING_REDIS_URL': 'redis://localhost:6379/0',
+
+        # How many events each streaming connection holds before
+        # it drops the oldest.
+        'STREAMING_QUEUE_SIZE': 50,
+
+        # How often, in seconds, to send something down an idle
+        # streaming connection, to keep it open.
+        'STREAMING_HEARTBEAT': 15,
+
+        # Whether to measure each request, for /metrics.
+        # See kepi.kepi.instrumentation.
+        'INSTRUMENTATION': True,
+
+        # Whether to describe those measurements in a Server-Timing
+        # header on each response. None means only if DEBUG is on.
+        'SERVER_TIMING': None,
+
+        # The addresses which may read /metrics. None means anyone.
+        # Behind a proxy, everyone seems to be at 127.0.0.1, so
+        # think twice before listing it.
+        'METRICS_ALLOWED_ADDRESSES': [],
+
+        # If this is a string, anyone who sends it as a bearer
+        # token may read /metrics too.
+        'METRICS_TOKEN': None,
+
+        # If this is a directory, each process saves its totals
+        # there, and /metrics adds them all up. Otherwise each
+        # process's totals are labelled with its pid. See
+        # kepi.kepi.instrumentation.
+        'METRICS_DIR': None,
+
+        # How many remote hosts get metrics of their own; the rest
+        # are lumped together. See kepi.kepi.task_instrumentation.
+        'METRICS_MAX_HOSTS': 500,
+
+        # Queues whose length /metrics asks the broker for.
+        'METRICS_QUEUES': [],
+
+        # If this is a port number, Celery workers serve /metrics
+        # on it, and prefork children on the ports after it.
+        'WORKER_METRICS_PORT': None,
+        'WORKER_METRICS_ADDRESS': '127.0.0.1',
+
+        # The search index: a dotted path to a backend class, or
+        # None to pick the best one for the database. See
+        # kepi.trilby_api.search.
+        'SEARCH_BACKEND': None,
+
+        # The name of the cache in CACHES which keeps rendered
+        # ActivityPub documents. None means a cache in the
+        # memory of each process, holding DOCUMENT_CACHE_SIZE
+        # documents at most.
+        'DOCUMENT_CACHE': None,
+        'DOCUMENT_CACHE_SIZE': 1000,
+
+        # How long, in seconds, to keep a rendered document.
+        'DOCUMENT_CACHE_TIMEOUT': 3600,
+
         'INSTANCE_NAME': 'kepi server',
         'INSTANCE_DESCRIPTION': 'this is a test server',
         'CONTACT_ACCOUNT': 'marnanel',
@@ -66,6 +172,7 @@ KEPI = {
         }
 
 MIDDLEWARE = [
+        'kepi.kepi.instrumentation.InstrumentationMiddleware',
         'django.middleware.security.SecurityMiddleware',
         'django.contrib.sessions.middleware.SessionMiddleware',
         'django.middleware.common.CommonMiddleware',
@@ -113,8 +220,40 @@ ALLOWED_HOSTS = [
         'localhost',
         ]
 
+# Settings for kepi's Celery app; see kepi.kepi.celery.
 CELERY = {
         'task_ignore_result': True,
+
+        # Until there's a broker, run tasks as soon as they're
+        # queued, in the same process. To run them in workers,
+        # set 'broker_url' and turn this off.
+        'task_always_eager': True,
+        'task_eager_propagates': True,
+
+        # Which queue each task goes to.
+        'task_routes': {
+            'kepi.bowler_pub.validation.*': {'queue': 'kepi.inbound'},
+            'kepi.sombrero_sendpub.delivery.*': {'queue': 'kepi.outbound'},
+            'kepi.trilby_api.accepts.*': {'queue': 'kepi.outbound'},
+            'kepi.sombrero_sendpub.fetch.*': {'queue': 'kepi.fetch'},
+            'kepi.bowler_pub.models.keypool.*': {'queue': 'kepi.maintenance'},
+            },
+        'task_default_queue': 'kepi.maintenance',
+
+        # Priorities run from 0 to this. With RabbitMQ, queues are
+        # declared with x-max-priority; Redis approximates it with
+        # a list for each step, and runs 0 first. See
+        # kepi.kepi.celery.broker_priority().
+        'task_queue_max_priority': 9,
+        'task_default_priority': 5,
+        'broker_transport_options': {
+            'priority_steps': list(range(10)),
+            'sep': ':',
+            },
+
+        # Otherwise a worker takes several tasks at a time, and
+        # a task with a high priority can wait behind them.
+        'worker_prefetch_multiplier': 1,
         }
 
 LOGGING = {
@@ -206,6 +345,11 @@ REST_FRAMEWORK = {
             'kepi.bowler_pub.parsers.ActivityParser',
             ),
 
+        'DEFAULT_RENDERER_CLASSES': (
+            'kepi.bowler_pub.renderers.FastJSONRenderer',
+            'rest_framework.renderers.BrowsableAPIRenderer',
+            ),
+
 #        'PAGE_SIZE': 50,
         }
 
@@ -0,0 +1,305 @@
+# task_instrumentation.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Measures kepi's Celery tasks, and the deliveries and validations
+which they do, so we can tell when they're falling behind.
+
+For each task decorated with @instrumented, we record how long
+it waited in the queue before a worker started it, how long it
+ran, whether it succeeded, and how often it was retried. Tasks
+which are called directly, rather than through a queue, have
+no waiting time, so they only count towards the rest.
+
+sombrero_sendpub.delivery calls record_delivery() for each post
+to a remote inbox, and bowler_pub.validation calls
+record_validation() for each incoming message. These are counted
+by the peer's host, along with the bytes sent and received.
+
+Everything goes into kepi.kepi.instrumentation.registry, along with
+the web tier's figures. A Celery worker isn't a web server, so if
+KEPI['WORKER_METRICS_PORT'] is set, each worker serves /metrics
+itself; see _serve_metrics(). If KEPI['METRICS_QUEUES'] names any
+queues, /metrics also asks the broker how many tasks are waiting
+in each.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from celery import current_app
+from celery.signals import before_task_publish, task_prerun, \
+        task_retry, worker_ready, worker_process_init
+from django.conf import settings
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from kepi.kepi.instrumentation import registry
+import functools
+import threading
+import time
+
+# The message header which says when a task was queued.
+ENQUEUED_HEADER = 'kepi_enqueued_at'
+
+# The host label for hosts beyond KEPI['METRICS_MAX_HOSTS'].
+OTHER_HOST = '(other)'
+
+# Seconds; a task can wait much longer than a request takes.
+LAG_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0,
+        60.0, 300.0, 900.0, 3600.0)
+
+for name, kind, help in [
+        ('kepi_task_duration_seconds', 'histogram',
+            'Run time of tasks.'),
+        ('kepi_task_runs_total', 'counter',
+            'Task runs, by outcome.'),
+        ('kepi_task_retries_total', 'counter',
+            'Task retries.'),
+        ('kepi_task_queued', 'gauge',
+            'Tasks waiting in each queue.'),
+        ('kepi_deliveries_total', 'counter',
+            'Posts to remote inboxes, by host and class of status code.'),
+        ('kepi_delivery_bytes_sent_total', 'counter',
+            'Bytes posted to remote inboxes, by host.'),
+        ('kepi_delivery_bytes_received_total', 'counter',
+            'Bytes received in reply from remote inboxes, by host.'),
+        ('kepi_validations_total', 'counter',
+            'Incoming messages validated, by host and outcome.'),
+        ('kepi_validation_bytes_received_total', 'counter',
+            'Bytes of incoming messages, by host.'),
+        ]:
+    registry.describe(name, kind, help)
+
+registry.describe('kepi_task_lag_seconds', 'histogram',
+        'Time from queueing a task to starting it.',
+        buckets = LAG_BUCKETS,
+        )
+
+#########################################
+
+_hosts = set()
+_hosts_lock = threading.Lock()
+
+def peer_host(url):
+    """
+    Returns the host part of "url", as a label for metrics.
+
+    Every host gets a series of its own, and we can't stop anyone
+    sending us messages from new hosts, so we only label the first
+    KEPI['METRICS_MAX_HOSTS'] hosts we see by name. After that,
+    any new ones are OTHER_HOST.
+    """
+
+    host = urlparse(url or '').netloc.lower() or '(none)'
+
+    with _hosts_lock:
+        if host in _hosts:
+            return host
+
+        if len(_hosts) >= settings.KEPI['METRICS_MAX_HOSTS']:
+            return OTHER_HOST
+
+        _hosts.add(host)
+        return host
+
+def _code_class(status_code):
+    if status_code is None:
+        return 'error'
+
+    return '%dxx' % (status_code//100,)
+
+def record_delivery(url, status_code, sent, received):
+    """
+    Records a post to the remote inbox at "url". "status_code" is
+    the status code of the reply, or None if we couldn't connect.
+    "sent" and "received" are the sizes, in bytes, of what we
+    posted and what came back.
+    """
+
+    host = peer_host(url)
+
+    registry.inc('kepi_deliveries_total',
+            host = host,
+            code = _code_class(status_code),
+            )
+    registry.inc('kepi_delivery_bytes_sent_total', sent,
+            host = host)
+    registry.inc('kepi_delivery_bytes_received_total', received,
+            host = host)
+
+def record_validation(url, valid, received):
+    """
+    Records the validation of an incoming message, which was
+    signed with the key at "url". "valid" is whether it passed,
+    and "received" is the size of its body, in bytes.
+    """
+
+    host = peer_host(url)
+
+    registry.inc('kepi_validations_total',
+            host = host,
+            outcome = 'valid' if valid else 'invalid',
+            )
+    registry.inc('kepi_validation_bytes_received_total', received,
+            host = host)
+
+#########################################
+
+def instrumented(fn):
+    """
+    Decorator for the function of a Celery task, which records how
+    long it runs and whether it raises an exception. Put it
+    underneath @shared_task.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        task = fn.__name__
+        outcome = 'failure'
+        started = time.perf_counter()
+
+        try:
+            result = fn(*args, **kwargs)
+            outcome = 'success'
+            return result
+        finally:
+            registry.observe('kepi_task_duration_seconds',
+                    time.perf_counter()-started,
+                    task = task)
+            registry.inc('kepi_task_runs_total',
+                    task = task,
+                    outcome = outcome,
+                    )
+
+    return wrapper
+
+def _task_label(task):
+    return task.name.rsplit('.', 1)[-1]
+
+@before_task_publish.connect
+def _stamp_enqueued(headers=None, **kwargs):
+    if headers is not None:
+        headers[ENQUEUED_HEADER] = time.time()
+
+@task_prerun.connect
+def _record_lag(task=None, **kwargs):
+    request = getattr(task, 'request', None)
+
+    if request is None:
+        return
+
+    enqueued = request.get(ENQUEUED_HEADER) or \
+            (request.get('headers') or {}).get(ENQUEUED_HEADER)
+
+    if enqueued is None:
+        # It wasn't queued, or it was queued by something
+        # which doesn't stamp its messages.
+        return
+
+    registry.observe('kepi_task_lag_seconds',
+            max(0.0, time.time()-float(enqueued)),
+            task = _task_label(task),
+            )
+
+@task_retry.connect
+def _record_retry(sender=None, **kwargs):
+    registry.inc('kepi_task_retries_total',
+            task = _task_label(sender),
+            )
+
+#########################################
+
+def _queue_depths(registry):
+    """
+    A collector which sets kepi_task_queued for each queue
+    in KEPI['METRICS_QUEUES'], by asking the broker.
+    """
+
+    queues = settings.KEPI['METRICS_QUEUES']
+
+    if not queues:
+        return
+
+    with current_app.connection_for_read() as connection:
+        connection.ensure_connection(max_retries=1)
+        channel = connection.default_channel
+
+        for queue in queues:
+            _, waiting, _ = channel.queue_declare(
+                    queue = queue,
+                    passive = True,
+                    )
+            registry.set('kepi_task_queued', waiting,
+                    queue = queue)
+
+registry.add_collector(_queue_depths)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path!='/metrics':
+            self.send_error(404)
+            return
+
+        content = registry.exposition().encode('UTF-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type',
+                'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug('worker metrics: '+format, *args)
+
+def _serve_metrics(port):
+    """
+    Serves /metrics on "port" of KEPI['WORKER_METRICS_ADDRESS'],
+    from a thread of this process.
+    """
+
+    try:
+        server = ThreadingHTTPServer(
+                (settings.KEPI['WORKER_METRICS_ADDRESS'], port),
+                _MetricsHandler,
+                )
+    except OSError as e:
+        logger.warning('Can\'t serve worker metrics on port %d: %s',
+                port, e)
+        return None
+
+    thread = threading.Thread(
+            target = server.serve_forever,
+            name = 'kepi-worker-metrics',
+            daemon = True,
+            )
+    thread.start()
+
+    logger.info('Serving worker metrics on port %d', port)
+    return server
+
+@worker_ready.connect
+def _serve_from_worker(**kwargs):
+    # With the solo and threads pools, tasks run in
+    # the worker itself, so it serves their figures.
+    port = settings.KEPI['WORKER_METRICS_PORT']
+
+    if port is not None:
+        _serve_metrics(port)
+
+@worker_process_init.connect
+def _serve_from_child(**kwargs):
+    # With the prefork pool, each child process keeps its own
+    # figures, so each serves them on a port of its own,
+    # counting up from the one after the worker's.
+    from billiard.process import current_process
+
+    port = settings.KEPI['WORKER_METRICS_PORT']
+    index = getattr(current_process(), 'index', None)
+
+    if port is not None and index is not None:
+        _serve_metrics(port+1+index)
@@ -8,6 +8,7 @@ import kepi.bowler_pub.urls
 import kepi.trilby_api.urls
 import kepi.tophat_ui.urls
 from kepi.trilby_api.views import fix_oauth2_redirects
+from kepi.kepi.instrumentation import MetricsView
 from . import settings
 
 ##################################
@@ -31,6 +32,9 @@ urlpatterns = [
         path('accounts/logout/', auth_views.LogoutView.as_view(), name='logout'),
         path('oauth/', include((oauth2_endpoint_views, 'oauth2_provider'), namespace="oauth2_provider")),
 
+        # measurements; see kepi.kepi.instrumentation
+        path('metrics', MetricsView.as_view()),
+
         # kepi's own stuff
         path(r'', include(kepi.tophat_ui.urls)),
         path(r'', include(kepi.busby_1st.urls)),
@@ -0,0 +1,148 @@
+# benchmarks.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Benchmarks for sombrero_sendpub. Run them with "manage.py kepi_benchmark".
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.conf import settings
+from unittest.mock import patch
+from urllib.parse import urlparse
+from kepi.kepi.benchmark import benchmark, local_hostname
+from kepi.trilby_api.models import Follow
+from kepi.trilby_api.tests import create_local_person, create_local_status
+from kepi.bowler_pub.utils import as_json
+from kepi.bowler_pub.validation import validate
+import kepi.bowler_pub.validation as bowler_validation
+import kepi.sombrero_sendpub.delivery as sombrero_delivery
+import kepi.sombrero_sendpub.fetch as sombrero_fetch
+
+def _alice_and_bob():
+    """
+    Creates two local people, where bob follows alice, and
+    a status by alice. Returns alice, bob, and a Create
+    activity for the status.
+    """
+    alice = create_local_person('alice')
+    bob = create_local_person('bob')
+
+    Follow(follower=bob, following=alice).save()
+
+    status = create_local_status(
+            posted_by = alice,
+            content = 'Hello world',
+            )
+
+    activity = {
+            "type": "Create",
+            "actor": alice.url,
+            "object": {
+                "type": "Note",
+                "id": status.url,
+                "content": status.content,
+                },
+            }
+
+    return alice, bob, activity
+
+@benchmark('sombrero_sendpub.delivery.local.skipped')
+def local_skipped(timer):
+    """
+    What deliver() costs when its only recipient is local. There's
+    nothing to apply (see _deliver_local()), so this only measures
+    deciding that: looking up the recipient and routing the activity.
+    It says nothing about the cost of applying an activity.
+    """
+    with local_hostname():
+        alice, bob, activity = _alice_and_bob()
+
+        timer.run(
+                lambda: sombrero_delivery.deliver(
+                    activity = activity,
+                    sender = alice,
+                    target_people = [bob],
+                    ),
+                )
+
+@benchmark('sombrero_sendpub.delivery.local.via_inbox')
+def local_via_inbox(timer):
+    """
+    What delivering to bob would cost if we treated him like a
+    remote user: encode and sign the activity, then parse it and
+    check the signature as if it had arrived at his inbox.
+
+    We stop short of applying it, because alice has already
+    done that, and doing it again would only fail.
+    """
+    def via_inbox():
+        body = as_json(activity)
+
+        signer = sombrero_delivery._signer_for_localperson(alice)
+        headers = signer.sign(
+                {
+                    'Date': sombrero_delivery._rfc822_datetime(),
+                    'Host': settings.KEPI['LOCAL_OBJECT_HOSTNAME'],
+                    'content-type': 'application/activity+json',
+                    },
+                method = 'POST',
+                path = urlparse(bob.inbox_url).path,
+                )
+
+        validate(
+                path = urlparse(bob.inbox_url).path,
+                headers = headers,
+                body = body,
+                )
+
+    with local_hostname(), \
+            patch.object(bowler_validation, 'create'):
+
+        alice, bob, activity = _alice_and_bob()
+        timer.run(via_inbox)
+
+# Addresses as fetch() gets them: URLs of remote and local
+# actors and statuses, and atstyle names.
+ADDRESSES = [
+        'https://remote.example.org/users/fred',
+        'https://remote.example.org/users/fred/statuses/103256',
+        'https://altair.example.com/users/alice',
+        'fred@remote.example.org',
+        ]
+
+@benchmark('sombrero_sendpub.fetch.parse_address')
+def parse_address(timer):
+
+    def parse_all():
+        for address in ADDRESSES:
+            sombrero_fetch._parse_address(address)
+
+    timer.run(parse_all,
+            items = len(ADDRESSES),
+            )
+
+@benchmark('sombrero_sendpub.httpsig.sign')
+def sign(timer):
+    """
+    Signs the headers of a delivery, as _deliver_remote() does.
+    The signer is cached, so this doesn't include loading the key.
+    """
+    alice = create_local_person('alice')
+    signer = sombrero_delivery._signer_for_localperson(alice)
+
+    timer.run(
+            lambda: signer.sign(
+                {
+                    'Date': sombrero_delivery._rfc822_datetime(),
+                    'Host': 'remote.example.org',
+                    'content-type': 'application/activity+json',
+                    },
+                method = 'POST',
+                path = '/users/fred/inbox',
+                ),
+            )
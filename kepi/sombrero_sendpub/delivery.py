@@ -9,15 +9,17 @@ logger = logging.getLogger(name='kepi')
 
 from celery import shared_task
 import requests
-import json
 import httpsig
 import random
-from django.http.request import HttpRequest
+import functools
 from django.conf import settings
 from urllib.parse import urlparse
 from kepi.bowler_pub.utils import *
 import datetime
 import pytz
+import kepi.kepi.instrumentation as instrumentation
+import kepi.kepi.task_instrumentation as task_instrumentation
+import kepi.kepi.celery as kepi_celery
 
 def _rfc822_datetime(when=None):
     """
@@ -36,17 +38,58 @@ def _rfc822_datetime(when=None):
 class _Postie(object):
 
     def __init__(self,
-            message,
+            activity,
             sender,
+            session = None,
             ):
 
-        self.message = message.content
+        self.activity = activity
         self.sender = sender
+        self.session = session
+        self.outgoing = None
+        self.message = None
         self.signer = None
         self.sent_to = set()
         self.sent_to_local = False
+        self.failed = set()
 
-    def send_to(self, inbox):
+    def _get_message(self):
+        """
+        Returns the activity encoded as bytes, ready to post.
+
+        We only store and encode the activity when we first
+        send it to a remote inbox, and then only once, rather
+        than once for every inbox we send it to.
+        """
+        import kepi.sombrero_sendpub.models as sombrero_models
+
+        if self.message is None:
+            self.outgoing = sombrero_models.OutgoingActivity(
+                    content=as_json(self.activity),
+                    )
+            self.outgoing.save()
+
+            log_one_message(
+                    direction = "outgoing: "+str(self.outgoing.pk),
+                    body = self.activity,
+                    )
+
+            self.message = self.outgoing.content.encode('UTF-8')
+
+        return self.message
+
+    def send_to(self, inbox,
+            remember = True,
+            ):
+        """
+        Sends the activity to "inbox", unless we've sent it
+        there already.
+
+        If "remember" is False, we don't note that we've sent it
+        to this inbox. Use that when the caller knows it won't
+        ask again, so that we don't have to remember every inbox
+        of a big list of followers.
+        """
 
         from kepi.bowler_pub import PUBLIC_IDS
 
@@ -67,7 +110,8 @@ class _Postie(object):
             logger.debug("Sending to local inbox: %s", inbox)
 
             _deliver_local(
-                    message=self.message,
+                    activity=self.activity,
+                    sender=self.sender,
                     )
 
             self.sent_to_local = True
@@ -78,41 +122,64 @@ class _Postie(object):
             return
 
         logger.info("Sending to remote inbox: %s", inbox)
-        parsed_target_url = urlparse(inbox)
-
-        headers = {
-                'Date': _rfc822_datetime(),
-                'Host': parsed_target_url.netloc,
-                # lowercase is deliberate, to work around
-                # an infelicity of the signer library
-                'content-type': "application/activity+json",
-                }
 
         if self.signer is None and self.sender is not None:
             self.signer = _signer_for_localperson(
                     localperson = self.sender,
                     )
 
-        if self.signer is not None:
-            headers = self.signer.sign(
-                    headers,
-                    method = 'POST',
-                    path = parsed_target_url.path,
-                    )
-
-        logger.debug('  -- headers are %s', headers)
-
-        _deliver_remote(
-                message=self.message,
+        if not _deliver_remote(
+                message=self._get_message(),
                 recipient=inbox,
                 signer=self.signer,
-                )
+                session=self.session,
+                ):
+            self.failed.add(inbox)
 
         # Even if _deliver_remote fails, we continue here.
         # If we've failed once to deliver, we don't
         # want to hammer on the remote server.
 
-        self.sent_to.add(inbox)
+        if remember:
+            self.sent_to.add(inbox)
+
+# How many inboxes follower_inboxes() reads from the database at once.
+FOLLOWER_CHUNK_SIZE = 1000
+
+def follower_inboxes(people,
+        chunk_size = FOLLOWER_CHUNK_SIZE,
+        ):
+    """
+    Yields the inboxes which the followers of the local people
+    in "people" should receive activities at.
+
+    Each remote inbox is yielded only once, even if several
+    followers share it. The inboxes come straight from the
+    database, "chunk_size" at a time, so however many
+    followers there are, we never hold them all in memory.
+
+    If any of the followers are local, we also yield our
+    shared inbox, once.
+    """
+    from kepi.trilby_api.models import RemotePerson, LocalPerson
+
+    remote_inboxes = RemotePerson.objects.filter(
+            rel_following__following__in = people,
+            inbox_url__isnull = False,
+            ).order_by(
+                    'inbox_url',
+                    ).values_list(
+                            'inbox_url',
+                            flat = True,
+                            ).distinct()
+
+    for inbox in remote_inboxes.iterator(chunk_size=chunk_size):
+        yield inbox
+
+    if LocalPerson.objects.filter(
+            rel_following__following__in = people,
+            ).exists():
+        yield configured_url('SHARED_INBOX_LINK')
 
 def _signer_for_localperson(localperson):
 
@@ -131,12 +198,9 @@ def _signer_for_localperson(localperson):
         return None
 
     try:
-        return httpsig.HeaderSigner(
-                key_id=localperson.key_name,
-                secret=localperson.privateKey,
-                algorithm='rsa-sha256',
-                headers=['(request-target)', 'host', 'date', 'content-type'],
-                sign_header='signature',
+        return _signer(
+                key_id = localperson.key_name,
+                secret = localperson.privateKey,
                 )
     except httpsig.utils.HttpSigException as hse:
         logger.warning('Local private key was not honoured.')
@@ -145,57 +209,91 @@ def _signer_for_localperson(localperson):
         logger.warning('Key was: %s', localperson.privateKey)
         return None
 
+@functools.lru_cache(maxsize=256)
+def _signer(key_id, secret):
+    """
+    Returns an httpsig.HeaderSigner for the given key.
+
+    Loading the key is slow, so we keep the signers. They're
+    keyed by the key itself, so when someone's keys are rotated
+    their next delivery gets a new signer; deliveries already
+    under way carry on with the old one.
+    """
+    return httpsig.HeaderSigner(
+            key_id=key_id,
+            secret=secret,
+            algorithm='rsa-sha256',
+            headers=['(request-target)', 'host', 'date', 'content-type'],
+            sign_header='signature',
+            )
+
 def _deliver_local(
-        message,
+        activity,
+        sender,
         ):
 
     """
-    Deliver an activity to the shared inbox.
+    Deliver an activity to the local users it's addressed to.
+
+    The sender is local as well, and the recipients share their
+    database. So whatever the sender did which gave rise to
+    this activity-- posting a status, say-- has already been
+    saved, and has already sent its signals (which is how
+    notifications get made). There's nothing left to apply.
+
+    So local delivery is deliberately skipped: we don't sign the
+    activity, encode it, post it to our own inbox, or apply it.
+    In particular, we don't pass it to create() as we would
+    an activity from a remote server, because that would
+    apply it a second time.
+
+    These are the activities deliver() is given, and why none
+    of them has anything left to do for a local recipient:
+
+      Create -- the Status is saved, and the "posted" signal has
+        made the notifications. Timelines are read from the
+        database, so they already include it.
+      Update (of a person, when their keys are rotated) -- local
+        people's keys are read from the database, so the new
+        one is already in use.
+      Follow -- only sent when the person followed is remote.
+      Accept -- only sent for Follows from remote people
+        (see kepi.trilby_api.accepts). When one local person
+        follows another, the Follow view settles it directly.
+
+    kepi never sends Reject, Like, Announce, Undo or Delete. If it
+    starts sending any of them, check whether they have effects
+    for local recipients which no signal applies.
 
     Keyword arguments:
-    message -- the OutgoingActivity we're delivering.
+    activity -- the activity we're delivering, as a dict.
+    sender -- the LocalPerson who sent it.
     """
 
-    from kepi.bowler_pub.views.activitypub import InboxView
-
-    class InboxPostRequest(HttpRequest):
-        """
-        This is a fake HttpRequest.
-        """
-
-        def __init__(self):
-            super().__init__()
-
-            self.path = '/sharedInbox'
-            self.method = 'POST'
-
-    request = InboxPostRequest()
-
-    result = InboxView.as_view()(
-        request = request,
-        username = None,
-        )
-
-    if result.status_code==200:
-        logger.debug("Message posted to local /sharedInbox")
-    else:
-        logger.warning("Message failed to post to local /sharedInbox: error %d",
-                result.status_code)
+    logger.debug("Delivered %s from %s to local inboxes",
+            activity.get('type'), sender)
 
 def _deliver_remote(
         message,
         recipient,
         signer,
+        session = None,
         ):
 
     """
     Deliver an activity to a remote actor.
 
     Keyword arguments:
-    message -- the OutgoingActivity we're delivering.
+    message -- the body of the activity we're delivering, as bytes.
     recipient -- the URL of the recipient
     signer -- an httpsig.HeaderSigner for the
         local actor who sent this activity
+    session -- a requests.Session to post with, or None
+
+    Returns True if the remote server got the activity, even if
+    it didn't like it. Returns False if we couldn't connect, or
+    the server had trouble (a 5xx status), so that it's worth
+    trying again later.
     """
 
     logger.debug('  -- delivering to remote user %s', recipient)
@@ -223,18 +321,30 @@ def _deliver_remote(
     # if we don't have it, and post to that
 
     try:
-        response = requests.post(
-                recipient,
-                data=str(message),
-                headers=headers,
-                )
+        with instrumentation.measure('http'):
+            response = (session or requests).post(
+                    recipient,
+                    data=message,
+                    headers=headers,
+                    )
     except requests.exceptions.ConnectionError:
         logger.debug('    -- cannot connect')
-        return
+        task_instrumentation.record_delivery(recipient,
+                status_code = None,
+                sent = len(message),
+                received = 0,
+                )
+        return False
 
     logger.debug('    -- posted; server replied: %d %s',
             response.status_code, response.reason)
 
+    task_instrumentation.record_delivery(recipient,
+            status_code = response.status_code,
+            sent = len(message),
+            received = len(response.content),
+            )
+
     if response.status_code>=400 and response.status_code<=499 and \
             (response.status_code not in [404, 410]):
 
@@ -246,12 +356,35 @@ def _deliver_remote(
         logger.debug("    -- and this is how the message ran: %s %s",
                 headers, message)
 
+    return response.status_code<500
+
+def _as_people(people):
+    """
+    Returns a list of the Persons in "people", which may be
+    Persons or their primary keys. Tasks which were queued
+    only have the keys.
+    """
+    from kepi.trilby_api.models import Person
+
+    people = list(people)
+    wanted = [x for x in people if not isinstance(x, Person)]
+
+    if not wanted:
+        return people
+
+    found = Person.objects.in_bulk(wanted)
+
+    return [x if isinstance(x, Person) else found[x]
+            for x in people]
+
 @shared_task()
+@task_instrumentation.instrumented
 def deliver(
         activity,
         sender,
         target_people = [],
         target_followers_of = [],
+        session = None,
         ):
 
     """
@@ -264,47 +397,110 @@ def deliver(
         target_followers_of -- list of Person objects whose followers
             should receive it.
 
-    This function is a shared task; it will be run by Celery behind
-    the scenes.
-    """
+        Any of the Persons may be given by their primary key
+        instead, as they are when deliver() is queued.
+        session -- a requests.Session to post with, so that
+            deliveries to the same host can share a connection.
+            Only when calling deliver() directly.
 
-    import kepi.sombrero_sendpub.models as sombrero_models
+    The activity is only stored as an OutgoingActivity, encoded
+    and signed if it's going to a remote inbox. Local recipients
+    get it in-process; see _deliver_local().
 
-    message = sombrero_models.OutgoingActivity(
-            content=json.dumps(activity,
-                indent=2,
-                ),
-            )
-    message.save()
+    Returns a list of the remote inboxes which didn't get the
+    activity, because we couldn't connect or their server had
+    trouble. Nothing here tries them again; callers which care,
+    such as kepi.trilby_api.accepts, have to do that themselves.
 
-    log_one_message(
-            direction = "outgoing: "+str(message.pk),
-            body = activity,
-            )
+    This function is a shared task. To queue it, call
+    queue_delivery().
+    """
+
+    sender, = _as_people([sender])
+    target_people = _as_people(target_people)
+    target_followers_of = _as_people(target_followers_of)
 
-    signer = None
     postie = _Postie(
-            message = message,
+            activity = activity,
             sender = sender,
+            session = session,
             )
 
     for target in target_people:
 
         logger.debug("outgoing %s: person %s has inbox %s",
-                message.pk, target, target.inbox_url)
+                activity.get('type'), target, target.inbox_url)
 
         postie.send_to(target.inbox_url)
 
-    for following in target_followers_of:
+    local_following = [x for x in target_followers_of
+            if x.is_local]
+    remote_following = [x for x in target_followers_of
+            if not x.is_local]
+
+    if local_following:
+        logger.debug("outgoing %s: sending to followers of %s...",
+                activity.get('type'), local_following)
+
+        for inbox in follower_inboxes(local_following):
+            logger.debug("outgoing %s:   -- to %s",
+                    activity.get('type'), inbox)
+
+            # follower_inboxes() doesn't repeat itself, so we
+            # only need to remember where we've been if
+            # remote_following might send us there again.
+            postie.send_to(inbox,
+                    remember = bool(remote_following),
+                    )
+
+    for following in remote_following:
 
         logger.debug("outgoing %s: sending to person %s's followers...",
-                message.pk, following)
+                activity.get('type'), following)
 
         for follower in following.followers:
             logger.debug("outgoing %s:   -- to %s",
-                    message.pk, follower)
+                    activity.get('type'), follower)
 
             postie.send_to(follower.inbox_url)
 
     logger.debug('outgoing %s: message posted to all inboxes',
-        message.pk)
+        activity.get('type'))
+
+    if postie.failed:
+        logger.info('outgoing %s: couldn\'t deliver to %s',
+                activity.get('type'), sorted(postie.failed))
+
+    return sorted(postie.failed)
+
+def queue_delivery(
+        activity,
+        sender,
+        target_people = [],
+        target_followers_of = [],
+        ):
+    """
+    Queues deliver(), with the same arguments, on the outbound queue.
+
+    Activities which are only for particular people, such as
+    Follows, go at PRIORITY_INTERACTIVE, because someone's waiting
+    for them. Activities for everyone's followers go at
+    PRIORITY_BULK, so that sending a status to thousands of
+    followers doesn't hold them up. See kepi.kepi.celery.
+    """
+
+    if target_followers_of:
+        priority = kepi_celery.PRIORITY_BULK
+    else:
+        priority = kepi_celery.PRIORITY_INTERACTIVE
+
+    return deliver.apply_async(
+            kwargs = {
+                'activity': activity,
+                'sender': sender.pk,
+                'target_people': [x.pk for x in target_people],
+                'target_followers_of': [x.pk
+                    for x in target_followers_of],
+                },
+            priority = kepi_celery.broker_priority(priority),
+            )
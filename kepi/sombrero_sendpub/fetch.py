@@ -9,14 +9,16 @@ logger = logging.getLogger(name="kepi")
 
 import requests
 import django.db.utils
+from celery import shared_task
+from django.apps import apps
 from urllib.parse import urlparse
-from django.http.request import HttpRequest
 from django.conf import settings
 from kepi.trilby_api.models import *
-from kepi.bowler_pub.utils import log_one_message
-from kepi.bowler_pub.activityresponse import ActivityResponse
+from kepi.bowler_pub.utils import log_one_message, resolve_local_url
 from kepi.sombrero_sendpub.webfinger import get_webfinger
 import kepi.sombrero_sendpub.models as sombrero_models
+import kepi.kepi.instrumentation as instrumentation
+import kepi.kepi.task_instrumentation as task_instrumentation
 import kepi.bowler_pub.create as bowler_create
 from django.http import HttpResponse, JsonResponse, Http404
 
@@ -34,7 +36,7 @@ def fetch(address,
     For local objects-- that is, ones where the hostname
     is listed in this project's ALLOWED_HOSTS setting--
     look it up locally and return it. If the address is
-    a URL, this will pass through the dispatcher.
+    a URL, we find it using resolve_local_url().
 
     "address" is the address of the thing we're looking for.
     It's usually a URL. For Persons it can also be atstyle
@@ -76,6 +78,73 @@ def fetch(address,
 
     return handler(address, wanted)
 
+def is_known(address,
+        expected_type,
+        ):
+
+    """
+    Returns True if fetch() can answer for "address" without
+    going over the network: because it's local, because we
+    already have it, or because we've failed to fetch it before.
+
+    Callers which are about to fetch() something in a task which
+    shouldn't wait on other servers can use this to decide whether
+    to queue prefetch() first.
+    """
+
+    if address is None:
+        return True
+
+    wanted = _parse_address(address)
+
+    if wanted['is_local']:
+        return True
+
+    if wanted['is_atstyle']:
+        kwargs = {"acct": address}
+    else:
+        if sombrero_models.Failure.objects.filter(
+                url = address,
+                ).exists():
+            return True
+
+        kwargs = {"remote_url": address}
+
+    try:
+        return expected_type.remote_form().objects.filter(
+                **kwargs,
+                ).exists()
+    except AttributeError:
+        return False
+
+@shared_task()
+@task_instrumentation.instrumented
+def prefetch(
+        address,
+        expected_type,
+        ):
+
+    """
+    fetch() something, as a task on the kepi.fetch queue, so that
+    a slow remote server holds up that queue and not the one which
+    wanted the object. Chain the task which wanted it after this;
+    by the time that runs, fetch() will find it locally.
+
+    "expected_type" is the model's label, such as
+    "trilby_api.Person", because tasks only take primitive types.
+
+    Returns the primary key of what we found, or None.
+    """
+
+    result = fetch(address,
+            apps.get_model(expected_type),
+            )
+
+    if result is None:
+        return None
+
+    return result.pk
+
 def _parse_address(address):
 
     result = {
@@ -107,7 +176,7 @@ def _fetch_local_by_atstyle(address, wanted):
 
     try:
         result = LocalPerson.objects.get(
-                local_user__username = wanted['username'],
+                local_username = wanted['username'],
                 )
         logger.info("%s: found local user: %s",
                 address, result)
@@ -119,49 +188,35 @@ def _fetch_local_by_atstyle(address, wanted):
     return result
 
 def _fetch_local_by_url(address, wanted):
-    from django.urls import resolve
-
-    class ActivityRequest(HttpRequest):
-        """
-        These are fake HttpRequests which we send to the views
-        as an ACTIVITY_GET method.
-        """
 
-        headers = {
-                'Accept': 'application/activity+json',
-                }
+    local_url = resolve_local_url(address)
 
-        def __init__(self, path):
-            super().__init__()
-
-            self.path = path
-            self.method = 'ACTIVITY_GET'
-
-    try:
-        resolved = resolve(wanted['path'])
-    except django.urls.Resolver404:
+    if local_url is None:
         logger.info('%s: not found', address)
         return None
 
-    logger.debug('%s: handled by %s, %s, %s',
-            address,
-            str(resolved.func),
-            str(resolved.args),
-            str(resolved.kwargs),
-            )
+    logger.debug('%s: local %s, %s',
+            address, local_url.kind, local_url.fields)
 
-    request = ActivityRequest(
-            path=wanted['path'],
-            )
-    result = resolved.func(request,
-            *resolved.args,
-            **resolved.kwargs)
+    if local_url.kind=='person':
+        result = LocalPerson.objects.filter(
+                local_username = local_url.fields['username'],
+                ).first()
 
-    logger.info("%s: result from handler was %s",
-            address, result)
+    elif local_url.kind=='status':
+        # Reblogs aren't served at their own URLs; see StatusView.
+        result = Status.objects.filter(
+                id = int(local_url.fields['id']),
+                account__localperson__local_username = \
+                        local_url.fields['username'],
+                reblog_of = None,
+                ).first()
 
-    if isinstance(result, ActivityResponse):
-        result = result.activity_value
+    else:
+        result = None
+
+    logger.info("%s: found %s",
+            address, result)
 
     if result is not None and not isinstance(result, wanted['type']):
         logger.info("%s: type mismatch (%s vs %s); discarding",
@@ -242,12 +297,13 @@ def _fetch_remote(address, wanted):
     # okay, time to go looking online
 
     try:
-        response = requests.get(
-                address,
-                headers = {
-                    'Accept': 'application/activity+json',
-                    },
-                )
+        with instrumentation.measure('http'):
+            response = requests.get(
+                    address,
+                    headers = {
+                        'Accept': 'application/activity+json',
+                        },
+                    )
     except requests.ConnectionError:
 
         logger.info("%s: can't reach host",
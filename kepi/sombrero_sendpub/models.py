@@ -52,7 +52,7 @@ class OutgoingActivity(models.Model):
                     raise ValueError("activity is missing required fields: "+\
                             str(self.content))
 
-            self.content = json.dumps(self.content)
+            self.content = as_json(self.content)
 
         super().save(*args, **kwargs)
 
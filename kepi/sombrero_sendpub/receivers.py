@@ -9,7 +9,7 @@ logger = logging.getLogger(name='kepi')
 
 import kepi.trilby_api.signals as kepi_signals
 from django.dispatch import receiver
-from kepi.sombrero_sendpub.delivery import deliver
+from kepi.sombrero_sendpub.delivery import queue_delivery
 
 @receiver(kepi_signals.followed)
 def on_follow(sender, **kwargs):
@@ -26,7 +26,7 @@ def on_follow(sender, **kwargs):
 
     logger.info("Follow received: %s", sender)
 
-    deliver(
+    queue_delivery(
             activity = {
                 'type': 'Follow',
                 'object': sender.following.url,
@@ -52,7 +52,7 @@ def on_posted(sender, **kwargs):
 
     logger.info("%s: status creation received", sender)
 
-    deliver(
+    queue_delivery(
             activity = {
                 "type": "Create",
                 "actor": sender.account.url,
@@ -63,8 +63,35 @@ def on_posted(sender, **kwargs):
                     }
                 },
             sender = sender.account,
-            target_people = sender.account.followers,
+            target_followers_of = [sender.account],
             )
 
     logger.info("%s: status creation notification delivered",
             sender)
+
+@receiver(kepi_signals.keys_rotated)
+def on_keys_rotated(sender, **kwargs):
+    """
+    If a local person's keys have been replaced, send their
+    followers an ActivityPub "Update" with the new public key,
+    so that they can check our signatures.
+
+    The spec for "Update" is here:
+    https://www.w3.org/TR/activitystreams-vocabulary/#dfn-update
+    """
+    import kepi.bowler_pub.fast_serializers as bowler_fast_serializers
+
+    logger.info("%s: keys rotated; sending Update", sender)
+
+    queue_delivery(
+            activity = {
+                "type": "Update",
+                "actor": sender.url,
+                "to": [
+                    "https://www.w3.org/ns/activitystreams#Public",
+                    ],
+                "object": bowler_fast_serializers.person_as_dict(sender),
+                },
+            sender = sender,
+            target_followers_of = [sender],
+            )
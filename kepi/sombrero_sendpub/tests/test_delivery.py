@@ -8,13 +8,23 @@ import logging
 logger = logging.getLogger(name='kepi')
 
 from unittest import skip
+from unittest.mock import patch
 from django.test import TestCase
-from kepi.sombrero_sendpub.delivery import deliver
-from kepi.trilby_api.tests import create_local_person
-from kepi.trilby_api.models import Follow
+from django.conf import settings
+from kepi.sombrero_sendpub.delivery import deliver, follower_inboxes, \
+        queue_delivery
+from kepi.trilby_api.tests import create_local_person, create_local_status
+from kepi.trilby_api.models import Follow, Status
+from kepi.sombrero_sendpub.models import OutgoingActivity
+from kepi.bowler_pub.validation import IncomingMessage
 from kepi.bowler_pub.tests import create_remote_person, mock_remote_object
 import kepi.bowler_pub.views as bowler_views
+from kepi.kepi.instrumentation import registry
+from kepi.kepi.celery import app as celery_app
+import kepi.kepi.celery as kepi_celery
+import kepi.bowler_pub.validation as bowler_validation
 import httpretty
+import json
 
 TEST_ACTIVITY = {
         'id': 'https://example.com/foo',
@@ -26,9 +36,13 @@ TEST_ACTIVITY = {
           },
         }
 
+SHARED_INBOX = 'https://example.org/sharedInbox'
+
 class Tests(TestCase):
 
     def setup_locals(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
         self.alice = create_local_person("alice")
         self.bob = create_local_person("bob")
         self.carol = create_local_person("carol")
@@ -60,6 +74,8 @@ class Tests(TestCase):
             return result
 
         bowler_views.InboxView.post = mock_post
+        self.addCleanup(setattr, bowler_views.InboxView, 'post',
+                self._real_inbox_post)
 
     def acknowledge_remote(self, name):
         logger.info("Received remote post for %s", name)
@@ -87,25 +103,51 @@ class Tests(TestCase):
 
         self.setup_locals()
 
+        with self.assertNumQueries(0):
+            deliver(
+                    activity = TEST_ACTIVITY,
+                    sender = self.alice,
+                    target_people = [
+                        self.bob, self.carol,
+                        ],
+                    )
+
+        # Local delivery doesn't go through the inbox.
+        self.assertEqual(
+                self.received_post,
+                set(),
+                )
+
+        self.assertFalse(OutgoingActivity.objects.exists())
+        self.assertFalse(IncomingMessage.objects.exists())
+
+    def test_send_to_followers_of_local_user(self):
+
+        self.setup_locals()
+
+        Follow(following=self.alice, follower=self.bob).save()
+        Follow(following=self.alice, follower=self.carol).save()
+
         deliver(
                 activity = TEST_ACTIVITY,
                 sender = self.alice,
-                target_people = [
-                    self.bob, self.carol,
+                target_followers_of = [
+                    self.alice,
                     ],
                 )
 
         self.assertEqual(
                 self.received_post,
-                set(['(shared)']),
+                set(),
                 )
 
-    def test_send_to_followers_of_local_user(self):
-
+    @httpretty.activate
+    def test_send_to_remote_followers_of_local_user(self):
         self.setup_locals()
+        self.setup_remotes()
 
-        Follow(following=self.alice, follower=self.bob).save()
-        Follow(following=self.alice, follower=self.carol).save()
+        for follower in list(self.remotes.values())+[self.bob]:
+            Follow(following=self.alice, follower=follower).save()
 
         deliver(
                 activity = TEST_ACTIVITY,
@@ -117,9 +159,123 @@ class Tests(TestCase):
 
         self.assertEqual(
                 self.received_post,
-                set(['(shared)']),
+                set(['peter', 'quentin', 'robert']),
+                )
+
+    @httpretty.activate
+    def test_metrics(self):
+        self.setup_locals()
+        self.setup_remotes()
+        registry.clear()
+
+        deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [
+                    self.remotes['peter'],
+                    self.remotes['robert'],
+                    ],
+                )
+
+        self.assertEqual(
+                registry.get('kepi_deliveries_total',
+                    host = 'example.org',
+                    code = '2xx',
+                    ),
+                2)
+
+        self.assertEqual(
+                registry.get('kepi_delivery_bytes_received_total',
+                    host = 'example.org',
+                    ),
+                len('Thank you')*2)
+
+        self.assertGreater(
+                registry.get('kepi_delivery_bytes_sent_total',
+                    host = 'example.org',
+                    ),
+                0)
+
+        self.assertEqual(
+                registry.get('kepi_task_runs_total',
+                    task = 'deliver',
+                    outcome = 'success',
+                    ),
+                1)
+
+    @httpretty.activate
+    def test_follower_inboxes(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        for name in ['robert', 'quentin']:
+            self.remotes[name].inbox_url = SHARED_INBOX
+            self.remotes[name].save()
+
+        for follower in list(self.remotes.values())+[self.bob, self.carol]:
+            Follow(following=self.alice, follower=follower).save()
+
+        # carol follows bob too, but that's nothing to do with alice
+        Follow(following=self.bob, follower=self.carol).save()
+
+        with self.assertNumQueries(2):
+            inboxes = list(follower_inboxes([self.alice]))
+
+        self.assertEqual(
+                sorted(inboxes),
+                sorted([
+                    'https://example.org/people/peter/inbox',
+                    SHARED_INBOX,
+                    'https://testserver/sharedInbox',
+                    ]))
+
+        self.assertEqual(
+                list(follower_inboxes([self.carol])),
+                [],
                 )
 
+    def test_local_post_is_not_applied_twice(self):
+
+        self.setup_locals()
+
+        Follow(following=self.alice, follower=self.bob).save()
+
+        status = create_local_status(
+                posted_by = self.alice,
+                content = 'Hello world',
+                send_signal = True,
+                )
+
+        self.assertEqual(
+                list(Status.objects.all()),
+                [status],
+                )
+
+        self.assertFalse(IncomingMessage.objects.exists())
+
+    @httpretty.activate
+    def test_send_to_local_and_remote_users(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [
+                    self.bob,
+                    self.remotes['peter'],
+                    self.carol,
+                    self.remotes['robert'],
+                    ],
+                )
+
+        self.assertEqual(
+                self.received_post,
+                set(['peter', 'robert']),
+                )
+
+        self.assertEqual(OutgoingActivity.objects.count(), 1)
+
     @httpretty.activate
     def test_send_to_remote_user(self):
         self.setup_locals()
@@ -138,6 +294,37 @@ class Tests(TestCase):
                 set(['peter']),
                 )
 
+    @httpretty.activate
+    def test_failed_inboxes(self):
+        self.setup_locals()
+        self.setup_remotes()
+
+        mock_remote_object(
+                remote_url = 'https://example.org/people/robert/inbox',
+                content = 'Try later',
+                status = 503,
+                as_post = True,
+                )
+
+        quentin = self.remotes['quentin']
+        quentin.inbox_url = 'http://127.0.0.1:1/people/quentin/inbox'
+        quentin.save()
+
+        failed = deliver(
+                activity = TEST_ACTIVITY,
+                sender = self.alice,
+                target_people = [
+                    self.remotes['peter'],
+                    self.remotes['robert'],
+                    quentin,
+                    ],
+                )
+
+        self.assertEqual(failed, sorted([
+            'https://example.org/people/robert/inbox',
+            quentin.inbox_url,
+            ]))
+
     @httpretty.activate
     def test_send_to_followers_of_remote_user(self):
         self.setup_locals()
@@ -169,3 +356,185 @@ class Tests(TestCase):
                 self.received_post,
                 set(['quentin', 'robert']),
                 )
+
+class TestQueues(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+        # Queue tasks on an in-memory broker, rather than
+        # running them straight away.
+        old = dict([(key, celery_app.conf[key]) for key in
+            ['task_always_eager', 'broker_url']])
+        celery_app.conf.update(
+                task_always_eager = False,
+                broker_url = 'memory://',
+                )
+        self.addCleanup(celery_app.conf.update, **old)
+
+        # Forget any connections made with the old broker_url;
+        # this is what Celery does in a newly forked process.
+        celery_app._after_fork()
+        self.addCleanup(celery_app._after_fork)
+
+    def _queued(self, queue):
+        """
+        Returns a list of (task name, priority) for each task in "queue".
+        """
+        result = []
+
+        with celery_app.connection_for_read() as connection:
+            waiting = connection.SimpleQueue(queue)
+
+            while True:
+                try:
+                    message = waiting.get(timeout=0.1)
+                except waiting.Empty:
+                    break
+
+                message.ack()
+                result.append((
+                    message.headers['task'].rsplit('.', 1)[-1],
+                    message.properties.get('priority'),
+                    ))
+
+            waiting.close()
+
+        return result
+
+    def test_delivery_priorities(self):
+        alice = create_local_person("alice")
+        bob = create_local_person("bob")
+
+        queue_delivery(
+                activity = TEST_ACTIVITY,
+                sender = alice,
+                target_people = [bob],
+                )
+
+        queue_delivery(
+                activity = TEST_ACTIVITY,
+                sender = alice,
+                target_followers_of = [alice],
+                )
+
+        self.assertEqual(
+                self._queued(kepi_celery.OUTBOUND),
+                [
+                    ('deliver', kepi_celery.PRIORITY_INTERACTIVE),
+                    ('deliver', kepi_celery.PRIORITY_BULK),
+                    ])
+
+    def test_redis_priorities(self):
+        alice = create_local_person("alice")
+        bob = create_local_person("bob")
+
+        # kombu's Redis transport runs the lowest number first.
+        with patch.object(kepi_celery, '_lowest_first',
+                return_value = True):
+
+            queue_delivery(
+                    activity = TEST_ACTIVITY,
+                    sender = alice,
+                    target_followers_of = [alice],
+                    )
+
+            queue_delivery(
+                    activity = TEST_ACTIVITY,
+                    sender = alice,
+                    target_people = [bob],
+                    )
+
+        (_, bulk), (_, interactive) = self._queued(kepi_celery.OUTBOUND)
+
+        self.assertLess(interactive, celery_app.conf.task_default_priority)
+        self.assertLess(celery_app.conf.task_default_priority, bulk)
+
+    def test_lowest_first(self):
+        for broker_url, expected in [
+                ('memory://', False),
+                ('amqp://guest@localhost//', False),
+                ('redis://localhost:6379/0', True),
+                ('rediss://localhost:6380/0', True),
+                ('sentinel://a:26379;sentinel://b:26379', True),
+                ]:
+            celery_app.conf.broker_url = broker_url
+            self.assertEqual(kepi_celery._lowest_first(), expected,
+                    msg = broker_url)
+
+    def test_deliver_takes_keys(self):
+        alice = create_local_person("alice")
+
+        # This is what a worker would do with a queued delivery.
+        deliver(
+                activity = TEST_ACTIVITY,
+                sender = alice.pk,
+                target_people = [alice.pk],
+                )
+
+    def test_validation_priorities(self):
+        for fields, expected in [
+                ({'type': 'Follow', 'object': 'https://testserver/users/alice'},
+                    kepi_celery.PRIORITY_INTERACTIVE),
+                ({'type': 'Create', 'object': {
+                    'inReplyTo': 'https://testserver/users/alice/1'}},
+                    kepi_celery.PRIORITY_INTERACTIVE),
+                ({'type': 'Create', 'object': {
+                    'inReplyTo': 'https://example.org/statuses/1'}},
+                    None),
+                ({'type': 'Like', 'object': 'https://testserver/users/alice/1'},
+                    None),
+                ]:
+            message = bowler_validation.IncomingMessage(
+                    body = json.dumps(fields),
+                    )
+
+            self.assertEqual(
+                    bowler_validation._priority(message),
+                    expected,
+                    msg = fields)
+
+        bowler_validation.validate(
+                path = '/sharedInbox',
+                headers = {},
+                body = json.dumps({'type': 'Follow'}),
+                )
+
+        self.assertEqual(
+                self._queued(kepi_celery.INBOUND),
+                [('_run_validation', kepi_celery.PRIORITY_INTERACTIVE)],
+                )
+
+    @httpretty.activate
+    def test_fetch_before_validation(self):
+        create_remote_person(
+                remote_url = 'https://example.org/users/known',
+                name = 'known',
+                auto_fetch = True,
+                )
+
+        for actor in [
+                'https://example.org/users/known',
+                'https://example.org/users/unknown',
+                ]:
+            bowler_validation.validate(
+                    path = '/sharedInbox',
+                    headers = {},
+                    body = json.dumps({
+                        'type': 'Follow',
+                        'actor': actor,
+                        }),
+                    )
+
+        # We know the first actor already, so that goes straight
+        # to validation. The second has to be fetched first, and
+        # validation is only queued once that's done.
+        self.assertEqual(
+                self._queued(kepi_celery.INBOUND),
+                [('_run_validation', kepi_celery.PRIORITY_INTERACTIVE)],
+                )
+
+        self.assertEqual(
+                self._queued(kepi_celery.FETCH),
+                [('prefetch', kepi_celery.PRIORITY_INTERACTIVE)],
+                )
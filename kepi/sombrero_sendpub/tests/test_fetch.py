@@ -12,7 +12,9 @@ from django.test import TestCase
 from django.conf import settings
 from kepi.sombrero_sendpub.fetch import fetch
 from kepi.trilby_api.models import RemotePerson, Person, Status
-from kepi.trilby_api.tests import create_local_person
+from kepi.trilby_api.tests import create_local_person, create_local_status
+from kepi.bowler_pub.utils import resolve_local_url, LocalURL
+from unittest.mock import patch
 from kepi.sombrero_sendpub.collections import Collection
 from . import suppress_thread_exceptions
 import httpretty
@@ -588,5 +590,82 @@ class TestFetchLocalUser(TestCase):
                 None,
                 )
 
-class TestFetchStatus(TestCase):
-    pass
+class TestFetchLocalStatus(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+        self._alice = create_local_person(
+                name = 'alice',
+                )
+        self._status = create_local_status(
+                posted_by = self._alice,
+                )
+
+    @httpretty.activate
+    def test_url(self):
+
+        with self.assertNumQueries(1):
+            found = fetch(self._status.url,
+                    expected_type = Status)
+
+        self.assertEqual(found, self._status)
+
+        self.assertEqual(
+                Status.lookup(self._status.url),
+                self._status,
+                )
+
+    @httpretty.activate
+    def test_wrong_username(self):
+
+        create_local_person(
+                name = 'bob',
+                )
+
+        url = 'https://testserver/users/bob/%d' % (self._status.pk,)
+
+        self.assertIsNone(fetch(url, expected_type=Status))
+        self.assertIsNone(Status.lookup(url))
+
+    @httpretty.activate
+    def test_wrong_type(self):
+
+        self.assertIsNone(fetch(self._status.url,
+            expected_type = Person))
+
+        self.assertIsNone(fetch(self._alice.url,
+            expected_type = Status))
+
+        self.assertIsNone(Status.lookup(self._alice.url))
+
+class TestResolveLocalURL(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+    def test_resolve(self):
+
+        for url, expected in [
+                ('https://testserver/users/alice',
+                    LocalURL('person', {'username': 'alice'})),
+                ('https://testserver/users/alice/123',
+                    LocalURL('status', {'username': 'alice', 'id': '123'})),
+                ('https://testserver/users/alice/outbox', None),
+                ('https://testserver/users/alice/123/activity', None),
+                ('https://example.org/users/alice', None),
+                ("My old man's a dustman", None),
+                (None, None),
+                ]:
+            self.assertEqual(resolve_local_url(url), expected,
+                    msg = url)
+
+    def test_settings(self):
+
+        with patch.dict(settings.KEPI, {
+            'STATUS_LINK': '/statuses/%(id)s/by/%(username)s',
+            }):
+            self.assertEqual(
+                    resolve_local_url('https://testserver/statuses/5/by/bob'),
+                    LocalURL('status', {'username': 'bob', 'id': '5'}),
+                    )
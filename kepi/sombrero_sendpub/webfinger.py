@@ -9,6 +9,7 @@ logger = logging.getLogger(name="kepi")
 
 import requests
 import kepi.sombrero_sendpub.models as sombrero_models
+import kepi.kepi.instrumentation as instrumentation
 
 def get_webfinger(username, hostname):
 
@@ -21,12 +22,13 @@ def get_webfinger(username, hostname):
             f'webfinger?acct={username}'
 
     try:
-        response = requests.get(
-                url,
-                headers = {
-                    'Accept': 'application/activity+json',
-                    },
-                )
+        with instrumentation.measure('http'):
+            response = requests.get(
+                    url,
+                    headers = {
+                        'Accept': 'application/activity+json',
+                        },
+                    )
     except requests.ConnectionError:
         logger.info("webfinger: Connection to %s failed",
                 hostname)
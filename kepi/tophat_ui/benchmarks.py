@@ -0,0 +1,74 @@
+# benchmarks.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Benchmarks for tophat_ui. Run them with "manage.py kepi_benchmark".
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.test import RequestFactory
+from kepi.kepi.benchmark import benchmark
+from kepi.tophat_ui.parse_accept import parse_accept_header
+from kepi.tophat_ui.view_for_mimetype import view_for_mimetype
+
+# Accept headers as they come in: from Mastodon fetching an
+# actor, from a browser, from curl, and from a client which
+# asks for ActivityPub the other way.
+ACCEPT_HEADERS = [
+        'application/activity+json, application/ld+json',
+        'text/html,application/xhtml+xml,application/xml;q=0.9,'+\
+                'image/webp,*/*;q=0.8',
+        '*/*',
+        'application/ld+json; '+\
+                'profile="https://www.w3.org/ns/activitystreams"',
+        ]
+
+@benchmark('tophat_ui.parse_accept_header')
+def parse_accept(timer):
+
+    def parse_all():
+        for header in ACCEPT_HEADERS:
+            parse_accept_header(header)
+
+    timer.run(parse_all,
+            items = len(ACCEPT_HEADERS),
+            )
+
+@benchmark('tophat_ui.view_for_mimetype')
+def dispatch(timer):
+    """
+    Routes a request with each of ACCEPT_HEADERS, as the
+    URLs which serve both HTML and ActivityPub do.
+    """
+
+    def found(request, *args, **kwargs):
+        return None
+
+    view = view_for_mimetype(
+            [
+                ('application', 'activity+json', found),
+                ('application', 'ld+json', found),
+                ('text', 'html', found),
+                ],
+            default = found,
+            )
+
+    factory = RequestFactory()
+    requests = [
+            factory.get('/users/alice',
+                HTTP_ACCEPT = header,
+                )
+            for header in ACCEPT_HEADERS]
+
+    def dispatch_all():
+        for request in requests:
+            view(request)
+
+    timer.run(dispatch_all,
+            items = len(requests),
+            )
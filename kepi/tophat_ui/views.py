@@ -41,7 +41,7 @@ class UserPage(View):
                 )
 
         user = trilby_models.LocalPerson.objects.get(
-                local_user__username = username,
+                local_username = username,
                 )
 
         result = render(
@@ -0,0 +1,361 @@
+# accepts.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Automatic Accepts for follow requests from remote people.
+
+When a local person who follows back automatically is followed
+from elsewhere, we owe the follower an Accept, and the local
+person a notification. If someone popular gets followed by
+hundreds of people at once, doing all that while each Follow
+comes in would tie up the inbox for as long as it takes to
+post to every follower's server.
+
+So bowler_pub.create marks the Follow as accept_pending, and
+send_accepts() picks up the pending ones a batch at a time. The
+Accepts go out grouped by the follower's host, so each host gets
+one connection for all of its Accepts.
+
+Each batch is claimed before its Accepts go out, so that two
+workers don't send the same ones. A Follow stops being pending,
+and its notification is stored, only once its Accept has gone
+out; that's written for the whole batch in one transaction. If
+a host doesn't answer, its Follows stay pending and are picked
+up next time. If a worker dies halfway through a batch, its
+claim runs out after KEPI['ACCEPT_CLAIM_SECONDS'] and another
+worker picks them up. So an Accept may go out twice, but it is
+never lost.
+
+If the follower's inbox can't be posted to at all, such as when
+its URL is nonsense, we give up on that Follow. It stays an
+offer, and nobody is notified.
+
+Each call of send_accepts() does one batch. If there are more
+waiting, it queues another call for them, rather than doing them
+all inside whichever inbox request happened to come first.
+
+If KEPI['ACCEPT_IN_BACKGROUND'] is True, send_accepts() is left
+to a worker: schedule the task, or run "manage.py send_accepts".
+Otherwise it runs as soon as each Follow comes in.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.db import transaction, DatabaseError
+from django.db.models import Q, prefetch_related_objects
+from django.conf import settings
+from django.utils.timezone import now
+from celery import shared_task
+from urllib.parse import urlparse
+import datetime
+import itertools
+import requests
+import kepi.trilby_api.models as trilby_models
+import kepi.sombrero_sendpub.delivery as sombrero_delivery
+import kepi.trilby_api.streaming as kepi_streaming
+import kepi.kepi.celery as kepi_celery
+
+def _accept_for(follow):
+    return {
+            'type': 'Accept',
+            'to': [follow.follower.url],
+            'actor': follow.following.url,
+            'object': follow.offer,
+            }
+
+def _host_of(follow):
+    return urlparse(follow.follower.inbox_url or '').netloc
+
+def _take_batch(batch_size):
+    """
+    Claims up to "batch_size" pending Follows, oldest first, so
+    that no other worker sends their Accepts while we do.
+
+    Returns the Follows, when we claimed them, and whether there
+    are more pending after them.
+
+    A claim lasts for KEPI['ACCEPT_CLAIM_SECONDS']. If the worker
+    which made it dies, another worker takes the Follows over
+    after that.
+    """
+
+    claimed_at = now()
+
+    unclaimed = Q(accept_claimed_at__isnull = True) | Q(
+            accept_claimed_at__lt = claimed_at - datetime.timedelta(
+                seconds = settings.KEPI['ACCEPT_CLAIM_SECONDS'],
+                ))
+
+    with transaction.atomic():
+        # Where the database can, we pass over Follows which
+        # another worker is claiming at the same moment.
+        pks = list(trilby_models.Follow.objects.select_for_update(
+            skip_locked = True,
+            ).filter(
+                unclaimed,
+                accept_pending = True,
+                ).order_by('pk').values_list(
+                    'pk',
+                    flat = True,
+                    )[:batch_size+1])
+
+        more = len(pks) > batch_size
+        pks = pks[:batch_size]
+
+        trilby_models.Follow.objects.filter(
+                unclaimed,
+                pk__in = pks,
+                ).update(
+                        accept_claimed_at = claimed_at,
+                        )
+
+    batch = list(trilby_models.Follow.objects.filter(
+                pk__in = pks,
+                accept_claimed_at = claimed_at,
+                ).order_by('pk'))
+
+    prefetch_related_objects(batch, 'follower', 'following')
+
+    return batch, claimed_at, more
+
+# Mistakes in the follower's inbox URL. Trying again won't help.
+HOPELESS = (
+        requests.exceptions.InvalidURL,
+        requests.exceptions.InvalidSchema,
+        requests.exceptions.MissingSchema,
+        )
+
+def _deliver_accepts(batch):
+    """
+    Sends an Accept for each Follow in "batch". Follows whose
+    followers live on the same host are sent together, over
+    the same connection.
+
+    Returns three lists of Follows: those whose Accepts went
+    out; those we gave up on, because trying again won't help;
+    and those left pending, because their host or our database
+    had trouble.
+    """
+
+    sent = []
+    given_up = []
+    left = []
+
+    batch = sorted(batch, key=_host_of)
+
+    for host, follows in itertools.groupby(batch, key=_host_of):
+
+        logger.debug('  -- sending Accepts to %s', host)
+        follows = list(follows)
+
+        with requests.Session() as session:
+            for i, follow in enumerate(follows):
+
+                if not follow.follower.inbox_url:
+                    logger.warning(
+                            '  -- can\'t send Accept for %s: '+\
+                                    'no inbox; giving up',
+                            follow)
+                    given_up.append(follow)
+                    continue
+
+                try:
+                    failed = sombrero_delivery.deliver(
+                            activity = _accept_for(follow),
+                            sender = follow.following,
+                            target_people = [
+                                follow.follower,
+                                ],
+                            session = session,
+                            )
+                except HOPELESS as e:
+                    logger.warning(
+                            '  -- can\'t send Accept for %s: %s; giving up',
+                            follow, e)
+                    given_up.append(follow)
+                    continue
+                except (requests.exceptions.RequestException,
+                        DatabaseError) as e:
+                    failed = e
+                except Exception as e:
+                    logger.exception(
+                            '  -- can\'t send Accept for %s; giving up',
+                            follow)
+                    given_up.append(follow)
+                    continue
+
+                if failed:
+                    logger.warning(
+                            '  -- can\'t send Accepts to %s: %s; '+\
+                                    'leaving %d pending',
+                            host, failed, len(follows)-i)
+                    left.extend(follows[i:])
+                    break
+
+                sent.append(follow)
+
+    return sent, given_up, left
+
+def _settle(claimed_at, sent, given_up, left):
+    """
+    Records what became of a batch claimed at "claimed_at",
+    all in one transaction, and notifies the people who were
+    followed. The lists are as _deliver_accepts() returns them.
+
+    Follows whose Accepts were sent are accepted. Those we gave
+    up on stop being pending, but stay offers: nobody is told
+    about them, because the follower never heard back. Those
+    left pending are let go, for the next send_accepts().
+
+    If our claim ran out and another worker has taken over
+    some of the Follows, we leave those alone; that worker
+    settles them.
+
+    Returns how many Follows were accepted.
+    """
+
+    Follow = trilby_models.Follow
+    Notification = trilby_models.Notification
+
+    ours = Follow.objects.filter(
+            accept_claimed_at = claimed_at,
+            )
+
+    with transaction.atomic():
+
+        accepted = set(ours.select_for_update().filter(
+                pk__in = [x.pk for x in sent],
+                ).values_list(
+                    'pk',
+                    flat = True,
+                    ))
+
+        ours.filter(
+                pk__in = accepted,
+                ).update(
+                        offer = None,
+                        accept_pending = False,
+                        accept_claimed_at = None,
+                        )
+
+        ours.filter(
+                pk__in = [x.pk for x in given_up],
+                ).update(
+                        accept_pending = False,
+                        accept_claimed_at = None,
+                        )
+
+        ours.filter(
+                pk__in = [x.pk for x in left],
+                ).update(
+                        accept_claimed_at = None,
+                        )
+
+        when = now()
+        followers = [x.follower for x in sent if x.pk in accepted]
+
+        notifications = Notification.objects.bulk_create([
+            Notification(
+                notification_type = Notification.FOLLOW,
+                for_account = follow.following,
+                about_account = follow.follower,
+                created_at = when,
+                )
+            for follow in sent if follow.pk in accepted])
+
+        if notifications and notifications[0].pk is None:
+            # Not every database tells us the IDs of new rows.
+            notifications = list(Notification.objects.filter(
+                notification_type = Notification.FOLLOW,
+                about_account__in = followers,
+                created_at = when,
+                ))
+
+    for notification in notifications:
+        kepi_streaming.publish_notification(notification)
+
+    return len(accepted)
+
+def _runs_eagerly():
+    return bool(send_accepts.app.conf.task_always_eager)
+
+@shared_task()
+def send_accepts(
+        batch_size = None,
+        drain = False,
+        ):
+    """
+    Sends Accepts for the oldest "batch_size" pending follow
+    requests. Returns how many it accepted.
+
+    If there are more waiting, queues another send_accepts()
+    for them. If tasks are running eagerly, that would just
+    carry on here, so instead they wait for the next call.
+
+    If "drain" is True, carries on until there are none left
+    (or until a host has trouble), and returns the total.
+
+    "batch_size" defaults to KEPI['ACCEPT_BATCH_SIZE'].
+    """
+
+    if batch_size is None:
+        batch_size = settings.KEPI['ACCEPT_BATCH_SIZE']
+
+    accepted = 0
+
+    while True:
+        batch, claimed_at, more = _take_batch(batch_size)
+
+        if not batch:
+            return accepted
+
+        logger.info('Accepting %d follow requests', len(batch))
+
+        sent, given_up, left = _deliver_accepts(batch)
+
+        accepted += _settle(
+                claimed_at = claimed_at,
+                sent = sent,
+                given_up = given_up,
+                left = left,
+                )
+
+        if left or not more:
+            # If a host is having trouble, going round again
+            # would only retry it straight away.
+            return accepted
+
+        if not drain:
+            break
+
+    if not _runs_eagerly():
+        send_accepts.apply_async(
+                kwargs = {
+                    'batch_size': batch_size,
+                    },
+                priority = kepi_celery.broker_priority(
+                    kepi_celery.PRIORITY_BULK),
+                )
+
+    return accepted
+
+def follow_needs_accept(follow):
+    """
+    Queues an Accept for "follow", which must already be marked
+    accept_pending. Unless KEPI['ACCEPT_IN_BACKGROUND'] is True,
+    sends it straight away, along with any others which are waiting.
+    """
+
+    if settings.KEPI['ACCEPT_IN_BACKGROUND']:
+        logger.info('    -- queueing automatic Accept')
+        return
+
+    logger.info('    -- sending automatic Accept')
+    send_accepts.apply_async(
+            priority = kepi_celery.broker_priority(
+                kepi_celery.PRIORITY_INTERACTIVE),
+            )
@@ -0,0 +1,247 @@
+# benchmarks.py
+#
+# Part of kepi, an ActivityPub daemon.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Benchmarks for trilby_api. Run them with "manage.py kepi_benchmark".
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from kepi.kepi.benchmark import benchmark
+from kepi.trilby_api.models import *
+from kepi.trilby_api.serializers import *
+from kepi.trilby_api.tests import create_local_person, create_local_status
+import kepi.trilby_api.fast_serializers as fast_serializers
+import kepi.trilby_api.rendering as trilby_rendering
+
+TIMELINE_LENGTH = 20
+
+def _make_timeline():
+    """
+    Creates a timeline's worth of statuses, with some replies
+    and reblogs among them, and some notifications about them.
+    Returns the owner of the timeline.
+    """
+
+    alice = create_local_person('alice')
+    bob = create_local_person('bob')
+
+    Follow(follower=bob, following=alice).save()
+
+    previous = None
+    for i in range(TIMELINE_LENGTH):
+
+        if i % 5 == 4:
+            status = create_local_status(
+                    posted_by = bob,
+                    reblog_of = previous,
+                    )
+        else:
+            status = create_local_status(
+                    posted_by = [alice, bob][i % 2],
+                    content = f'Status number *{i}*.',
+                    in_reply_to = previous,
+                    )
+
+        Notification(
+                notification_type = Notification.MENTION,
+                for_account = alice,
+                about_account = bob,
+                status = status,
+                ).save()
+
+        previous = status
+
+    return alice
+
+def _timeline():
+    return Status.objects.all()[:TIMELINE_LENGTH]
+
+def _notifications(owner):
+    return Notification.objects.filter(
+            for_account = owner,
+            )
+
+@benchmark('trilby_api.serializers.status.drf')
+def status_drf(timer):
+    _make_timeline()
+
+    timer.run(
+            lambda: StatusSerializer(_timeline(), many=True).data,
+            items = TIMELINE_LENGTH,
+            )
+
+@benchmark('trilby_api.serializers.status.fast')
+def status_fast(timer):
+    _make_timeline()
+
+    timer.run(
+            lambda: fast_serializers.statuses_as_list(_timeline()),
+            items = TIMELINE_LENGTH,
+            )
+
+@benchmark('trilby_api.serializers.notification.drf')
+def notification_drf(timer):
+    owner = _make_timeline()
+
+    timer.run(
+            lambda: NotificationSerializer(_notifications(owner),
+                many=True).data,
+            items = TIMELINE_LENGTH,
+            )
+
+@benchmark('trilby_api.serializers.notification.fast')
+def notification_fast(timer):
+    owner = _make_timeline()
+
+    timer.run(
+            lambda: fast_serializers.notifications_as_list(
+                _notifications(owner)),
+            items = TIMELINE_LENGTH,
+            )
+
+# Toots of the kinds people write: short and plain, with a link,
+# with Markdown and a hashtag, and long with several paragraphs.
+TOOTS = [
+        'Good morning!',
+        'Reading https://example.org/2020/06/some-article about '+\
+                'the fediverse.',
+        'I *really* like **kepi**, and `manage.py` too. #kepi',
+        '\n\n'.join([
+            'This is the first paragraph of a longer post, which '+\
+                    'goes on for a while, as they do.',
+            '* one thing\n* another thing\n* a third thing',
+            '> Somebody else said this, and I\'m quoting it.',
+            'And in conclusion: [a link](https://example.org/).',
+            ]),
+        ]
+
+@benchmark('trilby_api.rendering.markdown')
+def render_markdown(timer):
+    """
+    Renders TOOTS as HTML, bypassing the cache,
+    as happens when they're saved.
+    """
+    render = trilby_rendering.render.__wrapped__
+
+    def render_all():
+        for toot in TOOTS:
+            render(toot)
+
+    timer.run(render_all,
+            items = len(TOOTS),
+            )
+
+@benchmark('trilby_api.rendering.markdown.cached')
+def render_markdown_cached(timer):
+    def render_all():
+        for toot in TOOTS:
+            trilby_rendering.render(toot)
+
+    timer.run(render_all,
+            items = len(TOOTS),
+            )
+
+def _popular_status():
+    """
+    Creates a status as a popular one would be: a reply, with a
+    mention, a hashtag, likes and reblogs, by someone with
+    followers. Returns a function which fetches it afresh,
+    as StatusView does.
+    """
+
+    alice = create_local_person('alice',
+            note = 'I *enjoy* falling down rabbitholes.',
+            )
+    bob = create_local_person('bob')
+
+    fans = [create_local_person('fan%d' % (i,)) for i in range(5)]
+
+    for fan in fans:
+        Follow(follower=fan, following=alice).save()
+
+    question = create_local_status(
+            posted_by = bob,
+            content = 'What are you doing?',
+            )
+
+    status = create_local_status(
+            posted_by = alice,
+            content = '@bob Benchmarking #kepi, *again*.',
+            in_reply_to = question,
+            )
+
+    Mention(status=status, whom=bob).save()
+    StatusTag.add(status, ['kepi'])
+
+    for fan in fans:
+        Like(liker=fan, liked=status).save()
+
+    for fan in fans[:2]:
+        create_local_status(
+                posted_by = fan,
+                reblog_of = status,
+                )
+
+    return lambda: Status.objects.get(pk=status.pk)
+
+@benchmark('trilby_api.serializers.status.single')
+def status_single(timer):
+    status = _popular_status()
+
+    timer.run(
+            lambda: StatusSerializer(status()).data,
+            )
+
+@benchmark('trilby_api.serializers.user.drf')
+def user_drf(timer):
+    status = _popular_status()
+    alice = status().account.pk
+
+    timer.run(
+            lambda: UserSerializer(
+                LocalPerson.objects.get(pk=alice)).data,
+            )
+
+# How many statuses the search benchmarks index. Real sites have
+# many more, but the searches shouldn't take longer when they do.
+SEARCH_INDEX_SIZE = 20000
+
+def _fill_search_index():
+    """
+    Puts SEARCH_INDEX_SIZE made-up statuses into the search index,
+    without making the statuses themselves.
+    """
+    import random
+    import kepi.trilby_api.search as search
+
+    vocabulary = ['word%d' % (i,) for i in range(5000)]
+    rng = random.Random(0)
+
+    for i in range(SEARCH_INDEX_SIZE):
+        search.backend().put_status(i+1,
+                ' '.join(rng.sample(vocabulary, 20)))
+
+    return search.backend()
+
+@benchmark('trilby_api.search.statuses.word')
+def search_word(timer):
+    backend = _fill_search_index()
+
+    timer.run(
+            lambda: backend.search_statuses(['word123'], 20, 0),
+            backend = backend.__class__.__name__,
+            )
+
+@benchmark('trilby_api.search.statuses.prefix')
+def search_prefix(timer):
+    backend = _fill_search_index()
+
+    timer.run(
+            lambda: backend.search_statuses(['word12'], 20, 0),
+            backend = backend.__class__.__name__,
+            )
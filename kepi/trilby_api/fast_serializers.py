@@ -0,0 +1,383 @@
+# fast_serializers.py
+#
+# Part of kepi, an ActivityPub daemon.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Hand-written versions of some of the serialisers in serializers.py.
+
+d-r-f's serialisers walk their fields for every object they
+serialise, and each nested serialiser does the same again.
+That's fine for one object, but timelines and notifications
+serialise dozens of statuses at a time, each with an account.
+The functions here build the same dicts directly.
+
+They must produce exactly what the d-r-f serialisers produce:
+same keys, in the same order, with the same values.
+tests/test_fast_serializers.py checks this. If you change
+a serialiser in serializers.py, change its counterpart here.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from collections import defaultdict
+from django.db.models import Count, prefetch_related_objects
+from rest_framework import serializers
+from kepi.trilby_api.models import *
+import kepi.kepi.instrumentation as instrumentation
+
+# We borrow d-r-f's own field classes for the conversions which
+# have fiddly details, such as timezones, so that we can't
+# disagree with it about them.
+
+_DATETIME = serializers.DateTimeField()
+_BOOLEAN = serializers.BooleanField()
+
+def _char(value):
+    if value is None:
+        return None
+    return str(value)
+
+def _datetime(value):
+    if value is None:
+        return None
+    return _DATETIME.to_representation(value)
+
+def _boolean(value):
+    if value is None:
+        return None
+    return _BOOLEAN.to_representation(value)
+
+#########################################
+
+class Batch(object):
+    """
+    Counts and related objects for a list of statuses and people,
+    looked up all at once.
+
+    Without this, serialising each status makes a few queries of
+    its own (how many reblogs, which hashtags, and so on),
+    and so does each account. With it, a whole timeline takes
+    a fixed number of queries.
+    """
+
+    def __init__(self,
+            statuses = (),
+            people = (),
+            ):
+
+        self.statuses = {}
+        self.people = {}
+
+        todo = [x for x in statuses if x is not None]
+
+        while todo:
+            prefetch_related_objects(todo,
+                    'account',
+                    'in_reply_to',
+                    'reblog_of',
+                    )
+
+            for status in todo:
+                self.statuses[status.pk] = status
+
+            # Reblogs are serialised along with the status
+            # they reblog, so that needs loading too.
+            todo = [x.reblog_of for x in todo
+                    if x.reblog_of is not None and
+                    x.reblog_of.pk not in self.statuses]
+
+        for status in self.statuses.values():
+            if status.account is not None:
+                self.people[status.account.pk] = status.account
+
+        for person in people:
+            if person is not None:
+                self.people[person.pk] = person
+
+        local_people = [x for x in self.people.values()
+                if isinstance(x, LocalPerson)]
+
+        status_ids = list(self.statuses.keys())
+        local_ids = [x.pk for x in local_people]
+
+        self.reblogs_counts = self._counts(
+                Status.objects.filter(reblog_of__in=status_ids),
+                'reblog_of',
+                )
+
+        self.following_counts = self._counts(
+                Follow.objects.filter(follower__in=local_ids, offer=None),
+                'follower',
+                )
+
+        self.followers_counts = self._counts(
+                Follow.objects.filter(following__in=local_ids, offer=None),
+                'following',
+                )
+
+        self.statuses_counts = self._counts(
+                Status.objects.filter(account__in=local_ids),
+                'account',
+                )
+
+        status_tags = list(StatusTag.objects.filter(
+            status__in = status_ids,
+            ))
+
+        prefetch_related_objects(status_tags, 'hashtag')
+
+        self.tags = defaultdict(list)
+        for status_tag in sorted(status_tags,
+                key = lambda x: x.hashtag.name):
+            self.tags[status_tag.status_id].append(status_tag.hashtag)
+
+    def _counts(self, queryset, fieldname):
+        return dict(queryset.order_by().values_list(
+            fieldname,
+            ).annotate(
+                count = Count('pk'),
+                ))
+
+#########################################
+
+def hashtag_as_dict(hashtag):
+    """
+    Same as HashtagSerializer(hashtag).data.
+    """
+    return {
+            'name': _char(hashtag.name),
+            'url': _char(hashtag.url),
+            }
+
+def user_as_dict(person, batch=None):
+    """
+    Same as UserSerializer(person).data.
+    """
+
+    icon = person.icon_or_default
+    header = person.header_or_default
+
+    result = {
+            'id': _char(person.id),
+            'uri': _char(person.uri),
+            'url': _char(person.url),
+            'username': _char(person.username),
+            'acct': _char(person.acct),
+            'display_name': _char(person.display_name),
+            'locked': _boolean(person.locked),
+            'created_at': _datetime(person.created_at),
+            }
+
+    # Only local people have these counts; UserSerializer
+    # leaves them out for anyone else.
+    if isinstance(person, LocalPerson):
+        if batch is None:
+            result['followers_count'] = person.followers_count
+            result['following_count'] = person.following_count
+            result['statuses_count'] = person.statuses_count
+        else:
+            result['followers_count'] = batch.followers_counts.get(
+                    person.pk, 0)
+            result['following_count'] = batch.following_counts.get(
+                    person.pk, 0)
+            result['statuses_count'] = batch.statuses_counts.get(
+                    person.pk, 0)
+
+    result['note'] = _char(person.note)
+    result['avatar'] = _char(icon)
+    result['avatar_static'] = _char(icon)
+    result['header'] = _char(header)
+    result['header_static'] = _char(header)
+    result['moved_to'] = _char(person.moved_to)
+    result['fields'] = person.fields
+    result['emojis'] = person.emojis
+    result['bot'] = _boolean(person.bot)
+
+    return result
+
+def status_as_dict(status, batch=None):
+    """
+    Same as StatusSerializer(status).data.
+    """
+
+    if batch is None:
+        reblogs_count = status.reblogs_count
+        reblogged = status.reblogged
+        tags = status.hashtags
+    else:
+        reblogs_count = batch.reblogs_counts.get(status.pk, 0)
+        reblogged = reblogs_count!=0
+        tags = batch.tags.get(status.pk, [])
+
+    try:
+        in_reply_to_account_id = status.in_reply_to_account_id
+    except AttributeError:
+        in_reply_to_account_id = None
+
+    if status.account is None:
+        account = None
+    else:
+        account = user_as_dict(status.account, batch)
+
+    if status.reblog_of is None:
+        reblog = None
+    else:
+        reblog = status_as_dict(status.reblog_of, batch)
+
+    if status.content:
+        content = status.content_as_html
+    else:
+        content = ''
+
+    return {
+            'id': str(status.id),
+            'uri': _char(status.uri),
+            'url': _char(status.url),
+            'account': account,
+            'in_reply_to_id': status.in_reply_to_id,
+            'in_reply_to_account_id': in_reply_to_account_id,
+            'reblog': reblog,
+            'content': content,
+            'created_at': _datetime(status.created_at),
+            'emojis': status.emojis,
+            'reblogs_count': reblogs_count,
+            'favourites_count': status.favourites_count,
+            'reblogged': reblogged,
+            'favourited': status.favourited,
+            'muted': status.muted,
+            'sensitive': _boolean(status.sensitive),
+            'spoiler_text': _char(status.spoiler_text),
+            'visibility': _char(status.visibility),
+            'media_attachments': status.media_attachments,
+            'tags': [hashtag_as_dict(x) for x in tags],
+            'card': status.card,
+            'poll': status.poll,
+            'language': _char(status.language),
+            'pinned': status.pinned,
+            }
+
+def notification_as_dict(notification, batch=None):
+    """
+    Same as NotificationSerializer(notification).data.
+    """
+
+    if notification.about_account is None:
+        account = None
+    else:
+        account = user_as_dict(notification.about_account, batch)
+
+    if notification.status is None:
+        status = None
+    else:
+        status = status_as_dict(notification.status, batch)
+
+    return {
+            'id': notification.id,
+            'type': notification.get_notification_type_display(),
+            'created_at': _datetime(notification.created_at),
+            'account': account,
+            'status': status,
+            }
+
+#########################################
+
+def statuses_as_list(statuses):
+    """
+    Same as StatusSerializer(statuses, many=True).data,
+    but with a fixed number of queries.
+    """
+
+    statuses = list(statuses)
+    batch = Batch(statuses = statuses)
+
+    with instrumentation.measure('serialise'):
+        return [status_as_dict(x, batch) for x in statuses]
+
+def users_as_list(people):
+    """
+    Same as UserSerializer(people, many=True).data,
+    but with a fixed number of queries.
+    """
+
+    people = list(people)
+    batch = Batch(people = people)
+
+    with instrumentation.measure('serialise'):
+        return [user_as_dict(x, batch) for x in people]
+
+def notifications_as_list(notifications):
+    """
+    Same as NotificationSerializer(notifications, many=True).data,
+    but with a fixed number of queries.
+    """
+
+    notifications = list(notifications)
+
+    prefetch_related_objects(notifications,
+            'about_account',
+            'status',
+            )
+
+    batch = Batch(
+            statuses = [x.status for x in notifications],
+            people = [x.about_account for x in notifications],
+            )
+
+    with instrumentation.measure('serialise'):
+        return [notification_as_dict(x, batch) for x in notifications]
+
+def notification_groups_as_dict(notifications):
+    """
+    Serialises notifications in the format of Mastodon's
+    /api/v2/notifications, with a fixed number of queries.
+
+    Each notification becomes a group, which refers to its
+    people and status by ID. The people and statuses themselves
+    are listed once each, however many groups refer to them.
+    """
+
+    notifications = list(notifications)
+
+    prefetch_related_objects(notifications,
+            'status',
+            )
+
+    samples = dict([(x.pk, x.sample_ids) for x in notifications])
+
+    people = Person.objects.in_bulk(
+            set().union(*samples.values()))
+
+    statuses = {}
+    for notification in notifications:
+        if notification.status is not None:
+            statuses[notification.status.pk] = notification.status
+
+    batch = Batch(
+            statuses = statuses.values(),
+            people = people.values(),
+            )
+
+    return {
+            'accounts': [user_as_dict(x, batch)
+                for x in people.values()],
+            'statuses': [status_as_dict(x, batch)
+                for x in statuses.values()],
+            'notification_groups': [
+                {
+                    'group_key': x.group_key or 'ungrouped-%d' % (x.pk,),
+                    'notifications_count': x.count,
+                    'type': x.get_notification_type_display(),
+                    'most_recent_notification_id': _char(x.id),
+                    'page_min_id': _char(x.id),
+                    'page_max_id': _char(x.id),
+                    'latest_page_notification_at': _datetime(x.created_at),
+                    'sample_account_ids': [_char(person_id)
+                        for person_id in samples[x.pk]
+                        if person_id in people],
+                    'status_id': _char(x.status_id),
+                    }
+                for x in notifications],
+            }
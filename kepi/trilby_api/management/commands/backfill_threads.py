@@ -0,0 +1,120 @@
+# backfill_threads.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Fills in the thread_root and conversation fields of statuses
+which were saved before kepi kept track of them.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kepi.trilby_api.models import Status
+
+class Command(BaseCommand):
+
+    help = 'Fills in the thread root and conversation of each status.'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+                '--all',
+                action = 'store_true',
+                help = 'Recalculate every status, not just the ones '+\
+                        'which are missing the fields.',
+                )
+
+        parser.add_argument(
+                '--batch-size',
+                type = int,
+                default = 1000,
+                help = 'How many statuses to update at once.',
+                )
+
+    def handle(self, *args, **options):
+
+        # Parents are always saved before their replies, so if we
+        # work through the statuses in order of ID, we'll always
+        # have seen a status's parent before we reach the status.
+        # We keep track of (thread root, conversation) for each
+        # status we've seen.
+        #
+        # If a parent is missing (because it was deleted),
+        # the reply starts a new thread.
+
+        known = {}
+        pending = []
+        changed = 0
+
+        fields = [
+                'id',
+                'in_reply_to_id',
+                'reblog_of_id',
+                'remote_url',
+                'created_at',
+                'thread_root_id',
+                'conversation',
+                ]
+
+        for row in Status.objects.order_by('id').values(
+                *fields).iterator(chunk_size=options['batch_size']):
+
+            if not options['all'] and row['thread_root_id'] is not None \
+                    and row['conversation'] is not None:
+                known[row['id']] = (row['thread_root_id'], row['conversation'])
+                continue
+
+            parent = known.get(row['in_reply_to_id'])
+
+            if parent is None or row['reblog_of_id'] is not None:
+                root_id = row['id']
+                conversation = row['conversation'] or \
+                        Status(**row).default_conversation
+            else:
+                root_id, conversation = parent
+
+                if row['remote_url'] is not None and row['conversation']:
+                    # remote servers get to say for themselves
+                    conversation = row['conversation']
+
+            known[row['id']] = (root_id, conversation)
+
+            if row['thread_root_id'] == root_id and \
+                    row['conversation'] == conversation:
+                continue
+
+            pending.append(Status(
+                id = row['id'],
+                thread_root_id = root_id,
+                conversation = conversation,
+                ))
+
+            if len(pending) >= options['batch_size']:
+                changed += self._write(pending)
+                pending = []
+
+        changed += self._write(pending)
+
+        self.stdout.write(
+                f'Updated {changed} of {len(known)} statuses.')
+
+    def _write(self, pending):
+
+        if not pending:
+            return 0
+
+        with transaction.atomic():
+            Status.objects.bulk_update(
+                    pending,
+                    ['thread_root', 'conversation'],
+                    )
+
+        logger.info('backfill_threads: updated %d statuses',
+                len(pending))
+
+        return len(pending)
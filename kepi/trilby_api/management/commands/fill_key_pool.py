@@ -0,0 +1,62 @@
+# fill_key_pool.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Tops up the pool of spare key pairs which new local people
+take their keys from. See kepi.bowler_pub.models.keypool.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand
+from kepi.bowler_pub.models import PooledKey
+import time
+
+class Command(BaseCommand):
+
+    help = 'Generates spare key pairs for new local users.'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+                '--size',
+                type = int,
+                default = None,
+                help = 'The size of the keys, in bits. '+\
+                        "Defaults to KEPI['KEY_SIZE'].",
+                )
+
+        parser.add_argument(
+                '--count',
+                type = int,
+                default = None,
+                help = 'How many keys the pool should hold. '+\
+                        "Defaults to KEPI['KEY_POOL_SIZE'].",
+                )
+
+        parser.add_argument(
+                '--every',
+                type = int,
+                default = None,
+                metavar = 'SECONDS',
+                help = "Keep running, and top up the pool this often.",
+                )
+
+    def handle(self, *args, **options):
+
+        while True:
+            made = PooledKey.fill(
+                    size = options['size'],
+                    count = options['count'],
+                    )
+
+            self.stdout.write(f'Generated {made} keys.')
+
+            if options['every'] is None:
+                break
+
+            time.sleep(options['every'])
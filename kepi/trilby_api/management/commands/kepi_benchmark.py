@@ -0,0 +1,186 @@
+# kepi_benchmark.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Runs kepi's micro-benchmarks. See kepi.kepi.benchmark.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand, CommandError
+from kepi.kepi.benchmark import find_benchmarks, run_benchmark, \
+        environment, compare, regressions, combine
+import json
+
+class Command(BaseCommand):
+
+    help = "Runs kepi's micro-benchmarks."
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+                'names',
+                nargs = '*',
+                help = 'Only run benchmarks whose names start with '+\
+                        'one of these. By default, run them all.',
+                )
+
+        parser.add_argument(
+                '--list',
+                action = 'store_true',
+                help = "List the benchmarks, but don't run them.",
+                )
+
+        parser.add_argument(
+                '--repeat',
+                type = int,
+                default = 5,
+                help = 'How many rounds of timing to take the best of.',
+                )
+
+        parser.add_argument(
+                '--output',
+                help = 'Write the results to this file, as JSON.',
+                )
+
+        parser.add_argument(
+                '--compare',
+                metavar = 'FILE',
+                help = 'Compare the results with those in FILE, '+\
+                        'which was written by --output.',
+                )
+
+        parser.add_argument(
+                '--threshold',
+                type = float,
+                default = 0.25,
+                help = 'With --compare, report any benchmark which is '+\
+                        'slower by more than this fraction, and by more '+\
+                        'than its timings vary.',
+                )
+
+        parser.add_argument(
+                '--retries',
+                type = int,
+                default = 2,
+                help = 'With --compare, run anything which seems slower '+\
+                        'again, up to this many times, in case it was '+\
+                        'only unlucky.',
+                )
+
+        parser.add_argument(
+                '--fail',
+                action = 'store_true',
+                help = 'With --compare, fail if anything is slower, '+\
+                        'rather than just saying so.',
+                )
+
+    def handle(self, *args, **options):
+
+        benchmarks = find_benchmarks()
+
+        if options['names']:
+            benchmarks = dict([
+                (name, fn) for name, fn in benchmarks.items()
+                if any([name.startswith(x) for x in options['names']])
+                ])
+
+            if not benchmarks:
+                raise CommandError('No benchmarks match %s.' % (
+                    ', '.join(options['names']),
+                    ))
+
+        if options['list']:
+            for name in benchmarks.keys():
+                self.stdout.write(name)
+            return
+
+        previous = None
+        if options['compare']:
+            try:
+                with open(options['compare'], 'r') as f:
+                    previous = json.load(f)['results']
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError('Can\'t read results from %s: %s' % (
+                    options['compare'], e))
+
+        width = max([len(name) for name in benchmarks.keys()])
+        results = {}
+
+        def describe(name, result):
+            line = '%-*s %12.1f us/call %12.1f items/s' % (
+                width,
+                name,
+                result['seconds_per_call'] * 1e6,
+                result['items_per_second'],
+                )
+
+            if previous is not None and name in previous:
+                line += '  x%.2f' % (
+                        compare(previous, {name: result})[name],)
+
+            for k, v in sorted(result['extra'].items()):
+                line += f'  {k}={v}'
+
+            return line
+
+        for name, fn in benchmarks.items():
+            logger.info('Running benchmark %s', name)
+
+            result = run_benchmark(fn,
+                    repeat = options['repeat'],
+                    )
+            results[name] = result
+
+            self.stdout.write(describe(name, result))
+
+        slower = []
+
+        if previous is not None:
+            for i in range(options['retries']+1):
+                slower = regressions(previous, results,
+                        threshold = options['threshold'],
+                        )
+
+                if not slower or i==options['retries']:
+                    break
+
+                for name in slower:
+                    logger.info('Running benchmark %s again', name)
+
+                    results[name] = combine(results[name],
+                            run_benchmark(benchmarks[name],
+                                repeat = options['repeat'],
+                                ))
+
+                    self.stdout.write(describe(name, results[name])+\
+                            '  (again)')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'environment': environment(),
+                    'repeat': options['repeat'],
+                    'results': results,
+                    }, f,
+                    indent = 2,
+                    sort_keys = True,
+                    )
+
+        if not slower:
+            return
+
+        message = 'More than %d%% slower than in %s: %s' % (
+                options['threshold']*100,
+                options['compare'],
+                ', '.join(slower),
+                )
+
+        if options['fail']:
+            raise CommandError(message)
+
+        self.stderr.write(message)
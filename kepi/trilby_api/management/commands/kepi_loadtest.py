@@ -0,0 +1,210 @@
+# kepi_loadtest.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Runs a federation load test against a simulated remote
+instance. See kepi.kepi.loadtest.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection
+from kepi.kepi.benchmark import local_hostname
+from kepi.kepi.celery import app as celery_app
+from kepi.kepi.loadtest import RemoteInstance, LoadTest, \
+        INBOUND_KINDS, DEFAULT_RATES
+import contextlib
+import json
+
+class Command(BaseCommand):
+
+    help = 'Runs a federation load test against a simulated remote instance.'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+                '--rate',
+                action = 'append',
+                default = [],
+                metavar = 'KIND=N',
+                help = ('Send N activities of KIND per second. '+\
+                        'KIND is one of %s, or "post" for statuses '+\
+                        'posted locally. Defaults: %s.') % (
+                            ', '.join(INBOUND_KINDS),
+                            ', '.join(['%s=%g' % x
+                                for x in DEFAULT_RATES.items()]),
+                            ),
+                )
+
+        parser.add_argument(
+                '--duration',
+                type = float,
+                default = 10.0,
+                help = 'How many seconds to send activities for.',
+                )
+
+        parser.add_argument(
+                '--timeout',
+                type = float,
+                default = 30.0,
+                help = 'How many seconds to wait afterwards for '+\
+                        'the last activities to be dealt with.',
+                )
+
+        parser.add_argument(
+                '--actors',
+                type = int,
+                default = 50,
+                help = 'How many remote actors send activities.',
+                )
+
+        parser.add_argument(
+                '--local-people',
+                type = int,
+                default = 5,
+                help = 'How many local people to make.',
+                )
+
+        parser.add_argument(
+                '--local-statuses',
+                type = int,
+                default = 20,
+                help = 'How many statuses the local people have '+\
+                        'for remote actors to like and announce.',
+                )
+
+        parser.add_argument(
+                '--followers',
+                type = int,
+                default = 20,
+                help = 'How many remote followers each local person has.',
+                )
+
+        parser.add_argument(
+                '--address',
+                default = '127.0.0.1',
+                help = 'The address to serve the remote instance from.',
+                )
+
+        parser.add_argument(
+                '--output',
+                help = 'Write the results to this file, as JSON.',
+                )
+
+        parser.add_argument(
+                '--noinput', '--no-input',
+                action = 'store_false',
+                dest = 'interactive',
+                help = "Don't ask before adding to the database.",
+                )
+
+    def _rates(self, options):
+        result = {}
+
+        for rate in options['rate']:
+            try:
+                kind, value = rate.split('=')
+                result[kind] = float(value)
+            except ValueError:
+                raise CommandError(f'Rates look like create=10, not {rate}.')
+
+            if kind not in DEFAULT_RATES:
+                raise CommandError(f'There is no kind of activity "{kind}".')
+
+        return result
+
+    def _local_hostname(self):
+        """
+        Makes sure our own URLs count as local, which they
+        don't with the default settings.
+        """
+        hostname = settings.KEPI['LOCAL_OBJECT_HOSTNAME']
+
+        if hostname in settings.ALLOWED_HOSTS:
+            return contextlib.nullcontext()
+
+        if not celery_app.conf.task_always_eager:
+            # Workers wouldn't see the patch.
+            raise CommandError(
+                    f"KEPI['LOCAL_OBJECT_HOSTNAME'] ({hostname}) "+\
+                            'must be in ALLOWED_HOSTS.')
+
+        logger.info('Load test: using %s as our hostname',
+                settings.ALLOWED_HOSTS[0])
+
+        return local_hostname()
+
+    def handle(self, *args, **options):
+
+        rates = self._rates(options)
+
+        if options['interactive']:
+            confirm = input(
+                    'This adds people, statuses and follows to the '+\
+                    'database %r, and leaves them there.\n'
+                    'Type "yes" to continue, or "no" to cancel: ' % (
+                        connection.settings_dict['NAME'],
+                        ))
+
+            if confirm!='yes':
+                raise CommandError('Load test cancelled.')
+
+        with self._local_hostname(), \
+                RemoteInstance(address=options['address']) as remote:
+
+            if remote.address in settings.ALLOWED_HOSTS:
+                raise CommandError(
+                        f'{remote.address} is in ALLOWED_HOSTS, so it '+\
+                                "can't be a remote instance.")
+
+            test = LoadTest(
+                    remote,
+                    rates = rates,
+                    duration = options['duration'],
+                    timeout = options['timeout'],
+                    actors = options['actors'],
+                    local_people = options['local_people'],
+                    local_statuses = options['local_statuses'],
+                    followers = options['followers'],
+                    )
+
+            test.setup()
+            result = test.run()
+
+        for direction in ['inbound', 'outbound']:
+            for kind, figures in result[direction].items():
+                line = '%-8s %-8s %6d/%-6d done %8.1f/s' % (
+                        direction,
+                        kind,
+                        figures['completed'],
+                        figures['expected'],
+                        figures['per_second'],
+                        )
+
+                if figures['latency'] is not None:
+                    line += '   latency ms: p50 %.1f  p90 %.1f  '+\
+                            'p99 %.1f  max %.1f'
+                    line %= tuple([figures['latency'][x]*1000
+                        for x in ['p50', 'p90', 'p99', 'max']])
+
+                self.stdout.write(line)
+
+        for name, rows in result['database']['rows'].items():
+            self.stdout.write('database %-30s %+8d rows' % (name, rows))
+
+        if result['database']['bytes'] is not None:
+            self.stdout.write('database size %+d bytes' % (
+                result['database']['bytes'],))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(result, f,
+                        indent = 2,
+                        sort_keys = True,
+                        )
@@ -0,0 +1,28 @@
+# rebuild_search_index.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Rebuilds the full-text search index from scratch.
+See kepi.trilby_api.search.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand
+import kepi.trilby_api.search as kepi_search
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the search index for people and statuses.'
+
+    def handle(self, *args, **options):
+
+        kepi_search.rebuild()
+
+        self.stdout.write('Rebuilt the search index, using %s.' % (
+            kepi_search.backend().__class__.__name__,
+            ))
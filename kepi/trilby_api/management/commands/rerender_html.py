@@ -0,0 +1,109 @@
+# rerender_html.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Brings the stored HTML of statuses and bios up to date
+with the current renderer. See kepi.trilby_api.rendering.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kepi.trilby_api.models import Status, Person
+import kepi.trilby_api.rendering as trilby_rendering
+
+class Command(BaseCommand):
+
+    help = 'Re-renders the stored HTML of statuses and bios.'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+                '--all',
+                action = 'store_true',
+                help = 'Re-render everything, even if it was rendered '+\
+                        'by the current renderer.',
+                )
+
+        parser.add_argument(
+                '--batch-size',
+                type = int,
+                default = 500,
+                help = 'How many rows to update at once.',
+                )
+
+    def handle(self, *args, **options):
+
+        statuses = Status.objects.non_polymorphic().only(
+                'id', 'content', 'spoiler_text',
+                )
+
+        people = Person.objects.non_polymorphic().only(
+                'id', 'note',
+                )
+
+        if not options['all']:
+            statuses = statuses.exclude(
+                    html_version = trilby_rendering.RENDERER_VERSION,
+                    )
+            people = people.exclude(
+                    note_html_version = trilby_rendering.RENDERER_VERSION,
+                    )
+
+        count = self._rerender(
+                queryset = statuses,
+                fields = ['content_html', 'spoiler_text_html',
+                    'html_version'],
+                batch_size = options['batch_size'],
+                )
+        self.stdout.write(f'Re-rendered {count} statuses.')
+
+        count = self._rerender(
+                queryset = people,
+                fields = ['note_html', 'note_html_version'],
+                batch_size = options['batch_size'],
+                )
+        self.stdout.write(f'Re-rendered {count} people.')
+
+    def _rerender(self, queryset, fields, batch_size):
+
+        model = queryset.model
+        count = 0
+        batch = []
+
+        def write(batch):
+            with transaction.atomic():
+                model.objects.non_polymorphic().bulk_update(
+                        batch, fields,
+                        )
+            logger.info('rerender_html: updated %d %s',
+                    len(batch), model.__name__)
+
+        # We iterate by primary key, rather than holding open
+        # a cursor, so that we can write as we go.
+        queryset = queryset.order_by('pk')
+        last_pk = None
+
+        while True:
+            page = queryset
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+
+            batch = list(page[:batch_size])
+
+            if not batch:
+                break
+
+            for item in batch:
+                item.render_html()
+
+            write(batch)
+            count += len(batch)
+            last_pk = batch[-1].pk
+
+        return count
@@ -0,0 +1,57 @@
+# rotate_keys.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Gives local users new key pairs, and tells their followers.
+See LocalPerson.rotate_keys().
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand, CommandError
+from kepi.trilby_api.models import LocalPerson
+
+class Command(BaseCommand):
+
+    help = "Replaces local users' key pairs."
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+                'usernames',
+                nargs = '*',
+                help = 'The users whose keys to replace.',
+                )
+
+        parser.add_argument(
+                '--all',
+                action = 'store_true',
+                help = 'Replace the keys of every local user.',
+                )
+
+    def handle(self, *args, **options):
+
+        if options['all']:
+            people = LocalPerson.objects.filter(gone=False)
+        elif options['usernames']:
+            people = LocalPerson.objects.filter(
+                    local_username__in = options['usernames'],
+                    )
+
+            found = set([x.username for x in people])
+            missing = set(options['usernames']) - found
+
+            if missing:
+                raise CommandError('No such users: %s' % (
+                    ', '.join(sorted(missing)),
+                    ))
+        else:
+            raise CommandError('Give some usernames, or --all.')
+
+        for person in people:
+            person.rotate_keys()
+            self.stdout.write(f'Rotated keys for {person.username}.')
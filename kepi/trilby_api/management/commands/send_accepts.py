@@ -0,0 +1,54 @@
+# send_accepts.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Sends the automatic Accepts for follow requests which are
+waiting for them. See kepi.trilby_api.accepts.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.core.management.base import BaseCommand
+from kepi.trilby_api.accepts import send_accepts
+import time
+
+class Command(BaseCommand):
+
+    help = 'Accepts pending follow requests for people who follow back.'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+                '--batch-size',
+                type = int,
+                default = None,
+                help = 'How many requests to accept at once. '+\
+                        "Defaults to KEPI['ACCEPT_BATCH_SIZE'].",
+                )
+
+        parser.add_argument(
+                '--every',
+                type = int,
+                default = None,
+                metavar = 'SECONDS',
+                help = "Keep running, and check for requests this often.",
+                )
+
+    def handle(self, *args, **options):
+
+        while True:
+            sent = send_accepts(
+                    batch_size = options['batch_size'],
+                    drain = True,
+                    )
+
+            self.stdout.write(f'Sent {sent} Accepts.')
+
+            if options['every'] is None:
+                break
+
+            time.sleep(options['every'])
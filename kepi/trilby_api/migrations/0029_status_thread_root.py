@@ -0,0 +1,24 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0028_mention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='status',
+            name='conversation',
+            field=models.CharField(blank=True, db_index=True, default=None, help_text='The ID of the conversation this status is part of. Replies inherit it from the status they reply to.', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='status',
+            name='thread_root',
+            field=models.ForeignKey(blank=True, help_text="The status at the top of this status's thread. A status which isn't a reply is its own thread root.", null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='thread_members', to='trilby_api.status'),
+        ),
+    ]
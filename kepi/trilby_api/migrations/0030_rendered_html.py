@@ -0,0 +1,38 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0029_status_thread_root'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='note_html',
+            field=models.TextField(blank=True, default=None, editable=False, help_text='The bio, rendered as HTML.', null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='note_html_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='The version of the renderer which produced note_html.'),
+        ),
+        migrations.AddField(
+            model_name='status',
+            name='content_html',
+            field=models.TextField(blank=True, default=None, editable=False, help_text='The content, rendered as HTML.', null=True),
+        ),
+        migrations.AddField(
+            model_name='status',
+            name='html_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='The version of the renderer which produced content_html and spoiler_text_html.'),
+        ),
+        migrations.AddField(
+            model_name='status',
+            name='spoiler_text_html',
+            field=models.TextField(blank=True, default=None, editable=False, help_text='The spoiler text, rendered as HTML.', null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:28
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0030_rendered_html'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text="When this person's details last changed. We use it to tell other servers whether their copy is up to date."),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='status',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, help_text='When this status, or anything shown with it, last changed. We use it to tell other servers whether their copy is up to date.'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:38
+
+from django.db import migrations, models
+
+
+def copy_usernames(apps, schema_editor):
+    LocalPerson = apps.get_model('trilby_api', 'LocalPerson')
+
+    for person in LocalPerson.objects.exclude(
+            local_user = None).select_related('local_user'):
+        person.local_username = person.local_user.username
+        person.save(update_fields=['local_username'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0031_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='localperson',
+            name='local_username',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text="A copy of local_user.username, so that we don't have to look up local_user to find it.", max_length=150),
+        ),
+        migrations.RunPython(copy_usernames, migrations.RunPython.noop),
+    ]
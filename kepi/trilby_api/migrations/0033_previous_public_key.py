@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0032_localperson_local_username'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='previous_public_key',
+            field=models.TextField(blank=True, default=None, editable=False, help_text="The public key before it was last replaced. Signatures made with it are still accepted for KEPI['KEY_ROTATION_GRACE'] seconds.", null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='public_key_changed_at',
+            field=models.DateTimeField(default=None, editable=False, help_text='When the public key was last replaced.', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0033_previous_public_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='follow',
+            name='accept_pending',
+            field=models.BooleanField(db_index=True, default=False, help_text="True if we're going to accept this offer automatically, but haven't yet. See kepi.trilby_api.accepts."),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0034_follow_accept_pending'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['for_account', '-created_at', '-id'], name='notifications_by_date'),
+        ),
+    ]
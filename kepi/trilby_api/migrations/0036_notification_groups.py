@@ -0,0 +1,32 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0035_notifications_by_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='count',
+            field=models.PositiveIntegerField(default=1, help_text='How many notifications this stands for.'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='group_key',
+            field=models.CharField(blank=True, default=None, help_text='If this notification stands for several of the same type about the same status, a key which they all share. Otherwise, None. See Notification.add().', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='sample_accounts',
+            field=models.ManyToManyField(blank=True, help_text="If this notification stands for several, the first few people it's about.", related_name='_notification_sample_accounts_+', to='trilby_api.Person'),
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('for_account', 'group_key'), name='notification_group_once'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Creates the tables for the full-text search index, if the
+# database can hold it. Otherwise, kepi.trilby_api.search
+# uses MemoryBackend.
+#
+# The SQL is written out here, rather than taken from
+# kepi.trilby_api.search, so that changing that module can't
+# change what this migration does.
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+TABLES = ['kepi_search_people', 'kepi_search_statuses']
+
+SQLITE_INSTALL = [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS %s '
+        'USING fts5(text, tokenize="unicode61", prefix="2 3")',
+        ]
+
+POSTGRES_INSTALL = [
+        'CREATE TABLE IF NOT EXISTS %s '
+        '(id bigint PRIMARY KEY, document tsvector NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS %s_document '
+        'ON %s USING gin(document)',
+        ]
+
+UNINSTALL = [
+        'DROP TABLE IF EXISTS %s',
+        ]
+
+def _run(connection, statements):
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            for statement in statements:
+                cursor.execute(statement.replace('%s', table))
+
+def install(apps, schema_editor):
+    connection = schema_editor.connection
+
+    if connection.vendor=='sqlite':
+        try:
+            _run(connection, SQLITE_INSTALL)
+        except OperationalError:
+            # SQLite without FTS5
+            pass
+    elif connection.vendor=='postgresql':
+        _run(connection, POSTGRES_INSTALL)
+
+def uninstall(apps, schema_editor):
+    connection = schema_editor.connection
+
+    if connection.vendor in ['sqlite', 'postgresql']:
+        _run(connection, UNINSTALL)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0036_notification_groups'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
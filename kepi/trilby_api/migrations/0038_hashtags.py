@@ -0,0 +1,38 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0037_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Hashtag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatusTag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('hashtag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='trilby_api.hashtag')),
+                ('status', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_tags', to='trilby_api.status')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='statustag',
+            index=models.Index(fields=['hashtag', '-created_at', '-status'], name='status_tags_by_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='statustag',
+            constraint=models.UniqueConstraint(fields=('hashtag', 'status'), name='status_tag_unique'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.1.14 on 2026-10-19 16:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def list_existing_groups(apps, schema_editor):
+    # Groups from before this migration have no members, so the
+    # v1 API would stop listing them. Give each one a member about
+    # its most recent person, which is what the v1 API showed.
+    Notification = apps.get_model('trilby_api', 'Notification')
+
+    Notification.objects.bulk_create([
+        Notification(
+            notification_type = group.notification_type,
+            for_account_id = group.for_account_id,
+            about_account_id = group.about_account_id,
+            status_id = group.status_id,
+            created_at = group.created_at,
+            group = group,
+            )
+        for group in Notification.objects.filter(
+            group_key__isnull = False,
+            )
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0038_hashtags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='group',
+            field=models.ForeignKey(blank=True, help_text='If this is one of several notifications which share a group, the notification which stands for them all. Otherwise, None. See Notification.add().', null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='members', to='trilby_api.notification'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(group__isnull=True), fields=['for_account', '-created_at', '-id'], name='notification_groups_by_date'),
+        ),
+        migrations.RunPython(list_existing_groups, migrations.RunPython.noop),
+    ]
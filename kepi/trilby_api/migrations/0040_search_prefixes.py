@@ -0,0 +1,43 @@
+# Gives the SQLite full-text search index longer prefix indexes.
+# See kepi.trilby_api.search.SQLiteBackend.
+#
+# FTS5 can't change the options of a table it's already made,
+# so we make new tables and copy across what was in the old ones.
+# As in 0037, the SQL is written out here.
+
+from django.db import migrations
+
+TABLES = ['kepi_search_people', 'kepi_search_statuses']
+
+def reinstall(apps, schema_editor):
+    connection = schema_editor.connection
+
+    if connection.vendor!='sqlite':
+        return
+
+    if TABLES[-1] not in connection.introspection.table_names():
+        # SQLite without FTS5
+        return
+
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(
+                    'ALTER TABLE %s RENAME TO %s_old' % (table, table))
+            cursor.execute(
+                    'CREATE VIRTUAL TABLE %s '
+                    'USING fts5(text, tokenize="unicode61", '
+                    'prefix="2 3 4 5 6")' % (table,))
+            cursor.execute(
+                    'INSERT INTO %s(rowid, text) '
+                    'SELECT rowid, text FROM %s_old' % (table, table))
+            cursor.execute('DROP TABLE %s_old' % (table,))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0039_notification_group_members'),
+    ]
+
+    operations = [
+        migrations.RunPython(reinstall, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-19 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0040_search_prefixes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='follow',
+            name='accept_claimed_at',
+            field=models.DateTimeField(blank=True, default=None, help_text='If a worker is sending the Accept for this offer, when it started. Otherwise, None. See kepi.trilby_api.accepts.', null=True),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 3.1.14 on 2026-10-19 17:11
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def drop_group_members(apps, schema_editor):
+    Notification = apps.get_model('trilby_api', 'Notification')
+    Like = apps.get_model('trilby_api', 'Like')
+
+    # Likes have only just got their created_at. Where they
+    # were notified, that's a better guess.
+    Like.objects.update(
+            created_at = Coalesce(
+                Subquery(Notification.objects.filter(
+                    notification_type = 'L',
+                    group_key = None,
+                    status = OuterRef('liked'),
+                    about_account = OuterRef('liker'),
+                    ).order_by('created_at').values('created_at')[:1]),
+                F('created_at'),
+                ),
+            )
+
+    Through = Notification._meta.get_field('sample_accounts').remote_field.through
+
+    samples = {}
+    for notification_id, person_id in Through.objects.order_by(
+            'pk').values_list('notification_id', 'person_id'):
+        samples.setdefault(notification_id, []).append(str(person_id))
+
+    for notification_id, person_ids in samples.items():
+        Notification.objects.filter(
+                pk = notification_id,
+                ).update(
+                        sample_account_ids = ','.join(person_ids),
+                        )
+
+    # The v1 API lists the members of groups from their
+    # Likes and reblogs now.
+    Notification.objects.filter(
+            group__isnull = False,
+            ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trilby_api', '0041_follow_accept_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='like',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='sample_account_ids',
+            field=models.TextField(blank=True, default='', help_text="If this notification stands for several, the IDs of the first few people it's about, separated by commas."),
+        ),
+        migrations.RunPython(drop_group_members, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='notification',
+            name='notification_groups_by_date',
+        ),
+        migrations.RemoveField(
+            model_name='notification',
+            name='group',
+        ),
+        migrations.RemoveField(
+            model_name='notification',
+            name='sample_accounts',
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['liked', '-created_at', '-id'], name='likes_by_date'),
+        ),
+    ]
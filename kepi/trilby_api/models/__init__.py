@@ -4,6 +4,7 @@ from .notification import *
 from .like import *
 from .follow import *
 from .mention import *
+from .hashtag import *
 
 __all__ = [
         'TrilbyUser',
@@ -15,4 +16,6 @@ __all__ = [
         'Like',
         'Follow',
         'Mention',
+        'Hashtag',
+        'StatusTag',
         ]
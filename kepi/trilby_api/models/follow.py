@@ -46,6 +46,23 @@ class Follow(models.Model):
                     "If this isn't an offer, None.",
             )
 
+    accept_pending = models.BooleanField(
+            default = False,
+            db_index = True,
+            help_text = "True if we're going to accept this offer "+\
+                    "automatically, but haven't yet. "+\
+                    "See kepi.trilby_api.accepts.",
+            )
+
+    accept_claimed_at = models.DateTimeField(
+            default = None,
+            null = True,
+            blank = True,
+            help_text = "If a worker is sending the Accept for this "+\
+                    "offer, when it started. Otherwise, None. "+\
+                    "See kepi.trilby_api.accepts.",
+            )
+
     show_reblogs = models.BooleanField(
             default=True,
             help_text = "True if the following person wants to see "+\
@@ -0,0 +1,164 @@
+# hashtag.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.db import models
+from django.db.models.constraints import UniqueConstraint
+from kepi.bowler_pub.utils import configured_url
+import re
+import unicodedata
+
+# The longest hashtag we'll store. Anything longer is ignored.
+HASHTAG_MAX_LENGTH = 255
+
+# A hash sign, not in the middle of a word or a URL, followed
+# by a word with at least one letter in it. So "#kepi" and
+# "#2020s" are hashtags, but "#1", "a#b" and "/page#top" aren't.
+HASHTAG_RE = re.compile(
+        r'(?:^|(?<=[^\w/#&]))#(\w*[^\W\d_]\w*)',
+        )
+
+class Hashtag(models.Model):
+
+    """
+    A hashtag. Statuses are linked to it through StatusTag.
+
+    "name" is in normal form, as given by Hashtag.normalise(),
+    so "#Kepi" and "#kepi" are the same hashtag.
+    """
+
+    name = models.CharField(
+            max_length = HASHTAG_MAX_LENGTH,
+            unique = True,
+            )
+
+    def __str__(self):
+        return '#'+self.name
+
+    @property
+    def url(self):
+        return configured_url('TAG_LINK',
+                name = self.name,
+                )
+
+    @classmethod
+    def normalise(cls, name):
+        """
+        Returns the normal form of the hashtag "name", with or
+        without its hash sign; or None if it isn't a hashtag.
+        """
+        name = unicodedata.normalize('NFKC', name).lstrip('#').casefold()
+
+        if not name or len(name)>HASHTAG_MAX_LENGTH:
+            return None
+
+        if HASHTAG_RE.fullmatch('#'+name) is None:
+            return None
+
+        return name
+
+    @classmethod
+    def names_in(cls, text):
+        """
+        Returns the normal forms of the hashtags in "text",
+        without duplicates, in the order they first appear.
+        """
+        result = []
+
+        for match in HASHTAG_RE.finditer(text or ''):
+            name = cls.normalise(match.group(1))
+
+            if name is not None and name not in result:
+                result.append(name)
+
+        return result
+
+class StatusTag(models.Model):
+
+    """
+    Says that a status has a hashtag.
+
+    We keep a copy of the status's created_at here, so that
+    the "status_tags_by_date" index can find a hashtag's
+    statuses in order without looking at the statuses themselves.
+    See kepi.trilby_api.views.TagTimeline.
+    """
+
+    hashtag = models.ForeignKey(
+            'Hashtag',
+            on_delete = models.CASCADE,
+            )
+
+    status = models.ForeignKey(
+            'Status',
+            on_delete = models.CASCADE,
+            related_name = 'status_tags',
+            )
+
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+                UniqueConstraint(
+                    fields = ['hashtag', 'status'],
+                    name = 'status_tag_unique',
+                    ),
+                ]
+
+        indexes = [
+                models.Index(
+                    fields = ['hashtag', '-created_at', '-status'],
+                    name = 'status_tags_by_date',
+                    ),
+                ]
+
+    def __str__(self):
+        return '[%s is tagged %s]' % (self.status, self.hashtag)
+
+    @classmethod
+    def add(cls, status, names):
+        """
+        Tags "status", which must already be saved, with the
+        hashtags called "names", making any that don't exist yet.
+        Names which aren't hashtags are ignored.
+
+        Returns the Hashtags.
+        """
+
+        names = [x for x in
+                [Hashtag.normalise(name) for name in names]
+                if x is not None]
+
+        if not names:
+            return []
+
+        names = list(dict.fromkeys(names))
+
+        Hashtag.objects.bulk_create(
+                [Hashtag(name=name) for name in names],
+                ignore_conflicts = True,
+                )
+
+        hashtags = list(Hashtag.objects.filter(
+            name__in = names,
+            ))
+
+        cls.objects.bulk_create([
+            cls(
+                hashtag = hashtag,
+                status = status,
+                created_at = status.created_at,
+                )
+            for hashtag in hashtags
+            ],
+            ignore_conflicts = True,
+            )
+
+        logger.debug('%s: tagged with %s', status, hashtags)
+
+        return hashtags
@@ -29,6 +29,10 @@ class Like(models.Model):
             on_delete = models.DO_NOTHING,
             )
 
+    created_at = models.DateTimeField(
+            default = now,
+            )
+
     class Meta:
         constraints = [
                 UniqueConstraint(
@@ -37,6 +41,16 @@ class Like(models.Model):
                     ),
                 ]
 
+        indexes = [
+                # Each status's likes, newest first. Favourites
+                # which share a notification group are listed from
+                # these; see kepi.trilby_api.views.Notifications.
+                models.Index(
+                    fields = ['liked', '-created_at', '-id'],
+                    name = 'likes_by_date',
+                    ),
+                ]
+
     def __str__(self):
         return '[%s likes %s]' % (
                 self.liker,
@@ -30,5 +30,11 @@ class Mention(models.Model):
                     ),
                 ]
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        # The status's tags have changed.
+        self.status.touch()
+
     def __str__(self):
         return '[%s mentions %s]' % (self.status, self.whom)
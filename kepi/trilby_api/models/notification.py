@@ -7,7 +7,9 @@
 import logging
 logger = logging.getLogger(name='kepi')
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Concat
 from django.db.models.constraints import UniqueConstraint
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
@@ -60,6 +62,54 @@ class Notification(models.Model):
             null = True,
             )
 
+    group_key = models.CharField(
+            max_length = 255,
+            default = None,
+            null = True,
+            blank = True,
+            help_text = "If this notification stands for several "+\
+                    "of the same type about the same status, a key "+\
+                    "which they all share. Otherwise, None. "+\
+                    "See Notification.add().",
+            )
+
+    count = models.PositiveIntegerField(
+            default = 1,
+            help_text = "How many notifications this stands for.",
+            )
+
+    sample_account_ids = models.TextField(
+            default = '',
+            blank = True,
+            help_text = "If this notification stands for several, "+\
+                    "the IDs of the first few people it's about, "+\
+                    "separated by commas.",
+            )
+
+    # Types of notification which Notification.add() groups.
+    GROUPED_TYPES = [
+            FAVOURITE,
+            REBLOG,
+            ]
+
+    class Meta:
+        constraints = [
+                UniqueConstraint(
+                    fields = ['for_account', 'group_key'],
+                    name = 'notification_group_once',
+                    ),
+                ]
+
+        indexes = [
+                # Each person's notifications, newest first.
+                # See kepi.trilby_api.views.Notifications.
+                models.Index(
+                    fields = ['for_account', '-created_at', '-id'],
+                    name = 'notifications_by_date',
+                    ),
+
+                ]
+
     def __str__(self):
 
         if self.notification_type == self.FOLLOW:
@@ -77,3 +127,164 @@ class Notification(models.Model):
                 self.for_account.id,
                 detail,
                 )
+
+    @property
+    def sample_ids(self):
+        """
+        The IDs of the people this notification is about: the
+        first few if it stands for several, or else just the one.
+        """
+        if self.group_key is None:
+            if self.about_account_id is None:
+                return []
+            return [self.about_account_id]
+
+        return [int(x) for x in self.sample_account_ids.split(',')
+                if x]
+
+    @property
+    def samples(self):
+        """
+        The people whose IDs are in sample_ids, in the same order.
+        """
+        from kepi.trilby_api.models import Person
+
+        if self.group_key is None:
+            if self.about_account is None:
+                return []
+            return [self.about_account]
+
+        people = Person.objects.in_bulk(self.sample_ids)
+        return [people[x] for x in self.sample_ids if x in people]
+
+    # How many times add() tries to join or start a group
+    # before giving up.
+    GROUP_ATTEMPTS = 3
+
+    @classmethod
+    def add(cls,
+            notification_type,
+            for_account,
+            about_account = None,
+            status = None,
+            ):
+        """
+        Stores a notification.
+
+        If KEPI['NOTIFICATION_GROUP_PERIOD'] is None, this is the
+        same as making a Notification and saving it, and returns
+        the Notification. Otherwise, favourites and reblogs of the
+        same status which happen within the same period share a
+        group instead: a single Notification whose "count" says
+        how many there were. It's about whoever came along most
+        recently, and it keeps the IDs of the first
+        KEPI['NOTIFICATION_GROUP_SAMPLES'] people in
+        "sample_account_ids". Its "created_at" is when the group
+        began, and doesn't change, so that clients paging by ID
+        don't lose their place. In that case this returns None.
+
+        Joining a group costs a single UPDATE, and the favourites
+        and reblogs in it don't get Notifications of their own.
+        The Mastodon v1 API lists them from their Likes and
+        reblogs instead; see for_like() and for_reblog().
+        """
+
+        period = settings.KEPI['NOTIFICATION_GROUP_PERIOD']
+
+        if period is None or status is None or \
+                notification_type not in cls.GROUPED_TYPES:
+
+            result = cls(
+                    notification_type = notification_type,
+                    for_account = for_account,
+                    about_account = about_account,
+                    status = status,
+                    )
+            result.save()
+            return result
+
+        when = now()
+
+        group_key = '%s-%s-%d' % (
+                dict(cls.TYPE_CHOICES)[notification_type],
+                status.pk,
+                when.timestamp() // period,
+                )
+
+        for attempt in range(cls.GROUP_ATTEMPTS):
+
+            joined = cls.objects.filter(
+                    for_account = for_account,
+                    group_key = group_key,
+                    ).update(
+                            count = F('count')+1,
+                            about_account = about_account,
+                            sample_account_ids = Case(
+                                When(
+                                    count__lt = settings.KEPI[
+                                        'NOTIFICATION_GROUP_SAMPLES'],
+                                    then = Concat(
+                                        F('sample_account_ids'),
+                                        Value(',%d' % (about_account.pk,)),
+                                        output_field = models.TextField(),
+                                        ),
+                                    ),
+                                default = F('sample_account_ids'),
+                                ),
+                            )
+
+            if joined:
+                return None
+
+            try:
+                with transaction.atomic():
+                    cls(
+                            notification_type = notification_type,
+                            for_account = for_account,
+                            about_account = about_account,
+                            status = status,
+                            group_key = group_key,
+                            created_at = when,
+                            sample_account_ids = str(about_account.pk),
+                            ).save()
+                return None
+
+            except IntegrityError:
+                # Someone else started this group just now;
+                # go round again and join it.
+                logger.debug('Notification group %s already exists',
+                        group_key)
+
+                if attempt == cls.GROUP_ATTEMPTS-1:
+                    raise
+
+    @classmethod
+    def for_like(cls, like, for_account):
+        """
+        Returns an unsaved Notification about "like", which is
+        how the Mastodon v1 API lists a favourite which joined
+        a group. Its ID is "like-" followed by the Like's ID.
+        """
+        return cls(
+                id = 'like-%d' % (like.pk,),
+                notification_type = cls.FAVOURITE,
+                for_account = for_account,
+                about_account_id = like.liker_id,
+                status_id = like.liked_id,
+                created_at = like.created_at,
+                )
+
+    @classmethod
+    def for_reblog(cls, reblog, for_account):
+        """
+        The same as for_like(), but for a reblog, given as the
+        Status which reblogs. Its ID begins with "reblog-".
+        """
+        return cls(
+                id = 'reblog-%d' % (reblog.pk,),
+                notification_type = cls.REBLOG,
+                for_account = for_account,
+                about_account_id = reblog.account_id,
+                status_id = reblog.reblog_of_id,
+                created_at = reblog.created_at,
+                )
@@ -8,18 +8,20 @@ import logging
 logger = logging.getLogger(name='kepi')
 
 from polymorphic.models import PolymorphicModel
-from django.db import models
+from django.db import models, transaction
 from django.db.models.constraints import UniqueConstraint
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 import kepi.bowler_pub.crypto as crypto
 from kepi.bowler_pub.utils import uri_to_url
 import kepi.trilby_api.utils as trilby_utils
+import kepi.trilby_api.signals as trilby_signals
 import kepi.bowler_pub.utils as bowler_utils
+import kepi.trilby_api.rendering as trilby_rendering
 from django.utils.timezone import now
+import datetime
 from django.core.exceptions import ValidationError
 from urllib.parse import urlparse
-import markdown
 
 class Person(PolymorphicModel):
 
@@ -61,6 +63,23 @@ class Person(PolymorphicModel):
             verbose_name='public key',
             )
 
+    previous_public_key = models.TextField(
+            blank = True,
+            null = True,
+            default = None,
+            editable = False,
+            help_text = "The public key before it was last replaced. "+\
+                    "Signatures made with it are still accepted for "+\
+                    "KEPI['KEY_ROTATION_GRACE'] seconds.",
+            )
+
+    public_key_changed_at = models.DateTimeField(
+            null = True,
+            default = None,
+            editable = False,
+            help_text = "When the public key was last replaced.",
+            )
+
     note = models.TextField(
             max_length=255,
             help_text="Your biography. Something like "+\
@@ -91,6 +110,28 @@ class Person(PolymorphicModel):
             help_text="If True, this account is a bot. If False, it's a human.",
             )
 
+    note_html = models.TextField(
+            null = True,
+            blank = True,
+            default = None,
+            editable = False,
+            help_text = "The bio, rendered as HTML.",
+            )
+
+    note_html_version = models.PositiveSmallIntegerField(
+            default = 0,
+            editable = False,
+            help_text = "The version of the renderer which produced "+\
+                    "note_html.",
+            )
+
+    updated_at = models.DateTimeField(
+            auto_now = True,
+            help_text = "When this person's details last changed. We "+\
+                    "use it to tell other servers whether their "+\
+                    "copy is up to date.",
+            )
+
     moved_to = models.URLField(
             max_length = 255,
             null = True,
@@ -106,6 +147,39 @@ class Person(PolymorphicModel):
         # this matches the behaviour of Mastodon
         return self.url
 
+    def replace_public_key(self, new_key):
+        """
+        Sets publicKey to new_key, remembering the old one for
+        verification_keys. Doesn't save.
+        """
+        if self.publicKey and self.publicKey!=new_key:
+            self.previous_public_key = self.publicKey
+            self.public_key_changed_at = now()
+
+        self.publicKey = new_key
+
+    @property
+    def verification_keys(self):
+        """
+        The public keys which signatures by this person may be
+        made with: the current one, and, for a while after it
+        was replaced, the previous one. Messages which were
+        signed just before the change may still be on their way.
+        """
+        result = [self.publicKey]
+
+        if self.previous_public_key and \
+                self.public_key_changed_at is not None:
+
+            grace = datetime.timedelta(
+                    seconds = settings.KEPI['KEY_ROTATION_GRACE'],
+                    )
+
+            if now() < self.public_key_changed_at + grace:
+                result.append(self.previous_public_key)
+
+        return result
+
     @property
     def following(self):
         return Person.objects.filter(
@@ -126,9 +200,26 @@ class Person(PolymorphicModel):
     def emojis(self):
         return [] # FIXME
 
+    def render_html(self):
+        """
+        Renders the bio as HTML, and stores the result.
+        You don't usually need to call this yourself,
+        because save() does it.
+        """
+        self.note_html = trilby_rendering.render(self.note or '')
+        self.note_html_version = trilby_rendering.RENDERER_VERSION
+
     @property
     def note_as_html(self):
-        return markdown.markdown(self.note)
+        if self.note_html is not None and \
+                self.note_html_version == trilby_rendering.RENDERER_VERSION:
+            return self.note_html
+
+        return trilby_rendering.render(self.note or '')
+
+    def save(self, *args, **kwargs):
+        self.render_html()
+        super().save(*args, **kwargs)
 
     def has_liked(self, status):
         from kepi.trilby_api.models.like import Like
@@ -369,6 +460,15 @@ class TrilbyUser(AbstractUser):
     A Django user.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # So that save() can tell if we've been renamed. If the
+        # username was deferred, reading it would cost a query,
+        # so we don't; save() assumes we may have been renamed
+        # if it's been set since.
+        self._saved_username = self.__dict__.get('username')
+
     def save(self,
             create_twin = True,
             *args, **kwargs):
@@ -377,6 +477,14 @@ class TrilbyUser(AbstractUser):
 
         super().save(*args, **kwargs)
 
+        username = self.__dict__.get('username')
+
+        if not first_time and username is not None and \
+                username!=self._saved_username:
+            self._rename_twin(username)
+
+        self._saved_username = username
+
         if create_twin and first_time:
 
             local_person = LocalPerson(
@@ -387,6 +495,27 @@ class TrilbyUser(AbstractUser):
             logger.info('%s: created twin %s',
                 self, local_person)
 
+    def _rename_twin(self, username):
+        """
+        Tells our LocalPerson that we've been renamed to "username".
+
+        We save it, rather than updating its row, so that it's
+        indexed for search again, and so that it forgets its URLs.
+        """
+        try:
+            twin = self.localperson
+        except LocalPerson.DoesNotExist:
+            return
+
+        twin.local_username = username
+        twin._urls = {}
+        twin.save(
+                update_fields = [
+                    'local_username',
+                    'updated_at',
+                    ],
+                )
+
 class LocalPerson(Person):
 
     local_user = models.OneToOneField(
@@ -396,6 +525,16 @@ class LocalPerson(Person):
             blank = True,
             )
 
+    local_username = models.CharField(
+            max_length = 150,
+            default = '',
+            blank = True,
+            db_index = True,
+            editable = False,
+            help_text = "A copy of local_user.username, so that we "+\
+                    "don't have to look up local_user to find it.",
+            )
+
     created_at = models.DateTimeField(
             default = now,
             )
@@ -447,12 +586,67 @@ class LocalPerson(Person):
 
     def _generate_keys(self):
 
-        logger.info('%s: generating key pair.',
+        from kepi.bowler_pub.models import PooledKey
+
+        pooled = PooledKey.take()
+
+        if pooled is not None:
+            logger.info('%s: using key pair from the pool.',
+                    self.url)
+
+            self.privateKey = pooled.private_key
+            self.replace_public_key(pooled.public_key)
+            return
+
+        logger.info('%s: key pool is empty; generating key pair.',
                 self.url)
 
         key = crypto.Key()
         self.privateKey = key.private_as_pem()
-        self.publicKey = key.public_as_pem()
+        self.replace_public_key(key.public_as_pem())
+
+    def rotate_keys(self):
+        """
+        Replaces this person's key pair with a new one, and
+        sends their followers an Update with the new public key.
+
+        Deliveries which are already under way finish with the old
+        key. Remote servers check our signatures against whatever
+        key they have for us, and we can't make them accept the old
+        one: a delivery signed with it which arrives after they've
+        fetched the new key may be refused. The grace period in
+        verification_keys only covers signatures which kepi checks.
+        """
+
+        key_fields = [
+                'privateKey',
+                'publicKey',
+                'previous_public_key',
+                'public_key_changed_at',
+                # so that the actor's ETag changes
+                'updated_at',
+                ]
+
+        with transaction.atomic():
+            # Work on a fresh copy of our row, locked, so that two
+            # rotations at once happen one after the other, and so
+            # that we don't write back anything else that's stale.
+            fresh = LocalPerson.objects.select_for_update().get(
+                    pk = self.pk,
+                    )
+
+            fresh._generate_keys()
+            fresh.save(
+                    update_fields = key_fields,
+                    )
+
+        self.refresh_from_db(
+                fields = key_fields,
+                )
+
+        logger.info('%s: rotated key pair', self)
+
+        trilby_signals.keys_rotated.send(sender=self)
 
     def __init__(self, *args, **kwargs):
 
@@ -484,18 +678,55 @@ class LocalPerson(Person):
         if self.privateKey is None and self.publicKey is None:
             self._generate_keys()
 
+        # If we're renamed later, TrilbyUser.save() updates this.
+
+        if not self.local_username and self.local_user is not None:
+            self.local_username = self.local_user.username
+
         # All good.
 
         super().save(*args, **kwargs)
 
     @property
     def username(self):
-        return self.local_user.username
+        if not self.local_username:
+            self.local_username = self.local_user.username
+
+        return self.local_username
 
     @username.setter
     def username(self, newname):
         self.local_user.username = newname
         self.local_user.save()
+        self.local_username = newname
+        self._urls = {}
+
+    def _configured_url(self, keyname):
+        """
+        Returns configured_url(keyname) for this person.
+
+        Serialising a person asks for their URLs over and over,
+        so we remember them. The answers are keyed by the template
+        and hostname too, in case the settings change.
+        """
+        key = (
+                settings.KEPI[keyname],
+                settings.KEPI['LOCAL_OBJECT_HOSTNAME'],
+                )
+
+        try:
+            return self._urls[key]
+        except AttributeError:
+            self._urls = {}
+        except KeyError:
+            pass
+
+        result = bowler_utils.configured_url(keyname,
+                username = self.username,
+                )
+        self._urls[key] = result
+
+        return result
 
     @property
     def is_local(self):
@@ -503,16 +734,14 @@ class LocalPerson(Person):
 
     @property
     def acct(self):
-        return self.local_user.username
+        return self.username
 
     def __str__(self):
         return self.username
 
     @property
     def url(self):
-        return uri_to_url(settings.KEPI['USER_LINK'] % {
-                'username': self.local_user.username,
-                })
+        return self._configured_url('USER_LINK')
 
     @property
     def following_count(self):
@@ -572,9 +801,7 @@ class LocalPerson(Person):
 
     @property
     def inbox_url(self):
-        return uri_to_url(settings.KEPI['USER_INBOX_LINK'] % {
-                'username': self.local_user.username,
-                })
+        return self._configured_url('USER_INBOX_LINK')
 
     @property
     def inbox(self):
@@ -637,30 +864,20 @@ class LocalPerson(Person):
 
     @property
     def inbox_url(self):
-        return uri_to_url(settings.KEPI['USER_INBOX_LINK'] % {
-            'username': self.local_user.username,
-            })
+        return self._configured_url('USER_INBOX_LINK')
 
     @property
     def outbox_url(self):
-        return uri_to_url(settings.KEPI['USER_OUTBOX_LINK'] % {
-            'username': self.local_user.username,
-            })
+        return self._configured_url('USER_OUTBOX_LINK')
 
     @property
     def featured_url(self):
-        return uri_to_url(settings.KEPI['USER_FEATURED_LINK'] % {
-            'username': self.local_user.username,
-            })
+        return self._configured_url('USER_FEATURED_LINK')
 
     @property
     def following_url(self):
-        return uri_to_url(settings.KEPI['USER_FOLLOWING_LINK'] % {
-            'username': self.local_user.username,
-            })
+        return self._configured_url('USER_FOLLOWING_LINK')
 
     @property
     def followers_url(self):
-        return uri_to_url(settings.KEPI['USER_FOLLOWERS_LINK'] % {
-            'username': self.local_user.username,
-            })
+        return self._configured_url('USER_FOLLOWERS_LINK')
@@ -7,21 +7,97 @@
 import logging
 logger = logging.getLogger(name='kepi')
 
-from django.db import models
+from django.db import models, connection
+from django.db.models.expressions import RawSQL
 from django.db.models.constraints import UniqueConstraint
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 import kepi.bowler_pub.crypto as crypto
-from kepi.bowler_pub.utils import uri_to_url, is_local
+from kepi.bowler_pub.utils import uri_to_url, is_local, \
+        resolve_local_url, configured_url
 import kepi.trilby_api.utils as trilby_utils
 import kepi.trilby_api.signals as trilby_signals
+import kepi.trilby_api.rendering as trilby_rendering
 from django.utils.timezone import now
 from django.core.exceptions import ValidationError
 from polymorphic.models import PolymorphicModel
-import markdown
 
 PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
 
+# How far we'll follow a thread before giving up.
+# This also keeps us safe from loops in the reply chain.
+THREAD_MAX_DEPTH = 256
+
+# The most replies we'll return from get_descendants().
+THREAD_MAX_DESCENDANTS = 4096
+
+def _supports_recursive_cte():
+    """
+    True if the database can run WITH RECURSIVE queries
+    as a subquery. If it can't, we walk the thread
+    one level at a time instead.
+    """
+
+    if connection.vendor == 'postgresql':
+        return True
+
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 8, 3)
+
+    # MySQL 8 has recursive CTEs, but it won't allow LIMIT
+    # in an IN subquery, so we use the fallback there too.
+    return False
+
+def _ancestors_sql():
+    """
+    SQL which finds the ids of a status and everything above it
+    in the thread. Its parameters are the id of the status and
+    the maximum depth.
+    """
+
+    qn = connection.ops.quote_name
+    return (
+            'WITH RECURSIVE ancestors(id, parent, depth) AS ('
+            'SELECT {id}, {parent}, 1 FROM {table} WHERE {id} = %s '
+            'UNION ALL '
+            'SELECT t.{id}, t.{parent}, a.depth+1 FROM {table} t '
+            'JOIN ancestors a ON t.{id} = a.parent '
+            'WHERE a.depth < %s'
+            ') SELECT id FROM ancestors'
+            ).format(
+                    table = qn(Status._meta.db_table),
+                    id = qn('id'),
+                    parent = qn(Status._meta.get_field('in_reply_to').column),
+                    )
+
+def _descendants_sql():
+    """
+    SQL which finds the ids of everything below a status in
+    the thread, nearest first. Its parameters are the id of the
+    status, the maximum depth, and the maximum number of results.
+
+    Reblogs copy the in_reply_to field of the status they reblog,
+    so we have to leave them out explicitly.
+    """
+
+    qn = connection.ops.quote_name
+    return (
+            'WITH RECURSIVE descendants(id, depth) AS ('
+            'SELECT {id}, 1 FROM {table} '
+            'WHERE {parent} = %s AND {reblog} IS NULL '
+            'UNION ALL '
+            'SELECT t.{id}, d.depth+1 FROM {table} t '
+            'JOIN descendants d ON t.{parent} = d.id '
+            'WHERE t.{reblog} IS NULL AND d.depth < %s'
+            ') SELECT id FROM descendants ORDER BY depth, id LIMIT %s'
+            ).format(
+                    table = qn(Status._meta.db_table),
+                    id = qn('id'),
+                    parent = qn(Status._meta.get_field('in_reply_to').column),
+                    reblog = qn(Status._meta.get_field('reblog_of').column),
+                    )
+
 class Status(PolymorphicModel):
 
     class Meta:
@@ -66,6 +142,13 @@ class Status(PolymorphicModel):
             default = now,
             )
 
+    updated_at = models.DateTimeField(
+            auto_now = True,
+            help_text = "When this status, or anything shown with it, "+\
+                    "last changed. We use it to tell other servers "+\
+                    "whether their copy is up to date.",
+            )
+
     # TODO Media
 
     sensitive = models.BooleanField(
@@ -107,6 +190,49 @@ class Status(PolymorphicModel):
             default = None,
             )
 
+    thread_root = models.ForeignKey(
+            'self',
+            related_name = 'thread_members',
+            on_delete = models.DO_NOTHING,
+            null = True,
+            blank = True,
+            help_text = "The status at the top of this status's thread. "+\
+                    "A status which isn't a reply is its own thread root.",
+            )
+
+    content_html = models.TextField(
+            null = True,
+            blank = True,
+            default = None,
+            editable = False,
+            help_text = "The content, rendered as HTML.",
+            )
+
+    spoiler_text_html = models.TextField(
+            null = True,
+            blank = True,
+            default = None,
+            editable = False,
+            help_text = "The spoiler text, rendered as HTML.",
+            )
+
+    html_version = models.PositiveSmallIntegerField(
+            default = 0,
+            editable = False,
+            help_text = "The version of the renderer which produced "+\
+                    "content_html and spoiler_text_html.",
+            )
+
+    conversation = models.CharField(
+            max_length = 255,
+            null = True,
+            blank = True,
+            default = None,
+            db_index = True,
+            help_text = "The ID of the conversation this status is part of. "+\
+                    "Replies inherit it from the status they reply to.",
+            )
+
     @property
     def emojis(self):
         return [] # TODO
@@ -160,6 +286,14 @@ class Status(PolymorphicModel):
                 mention__status = self,
                 ))
 
+    @property
+    def hashtags(self):
+        import kepi.trilby_api.models.hashtag as trilby_hashtag
+
+        return list(trilby_hashtag.Hashtag.objects.filter(
+                statustag__status = self,
+                ).order_by('name'))
+
     @property
     def card(self):
         return None # FIXME
@@ -172,13 +306,9 @@ class Status(PolymorphicModel):
     def application(self):
         return None # FIXME
 
-    @property
-    def conversation(self):
-        return 'conversation' # FIXME
-
     @property
     def in_reply_to_account_id(self):
-        return self.in_reply_to.account.id
+        return self.in_reply_to.account_id
 
     @property
     def uri(self):
@@ -191,10 +321,30 @@ class Status(PolymorphicModel):
         if self.remote_url is not None:
             return self.remote_url
 
-        return uri_to_url(settings.KEPI['STATUS_LINK'] % {
-                'username': self.account.username,
-                'id': self.id,
-                })
+        if self.pk is None:
+            return None
+
+        # Remembered, because serialising a status asks for it
+        # several times. Keyed by the settings it depends on,
+        # in case they change.
+        key = (
+                settings.KEPI['STATUS_LINK'],
+                settings.KEPI['LOCAL_OBJECT_HOSTNAME'],
+                )
+
+        try:
+            if self._url[0]==key:
+                return self._url[1]
+        except AttributeError:
+            pass
+
+        result = configured_url('STATUS_LINK',
+                username = self.account.username,
+                id = self.id,
+                )
+        self._url = (key, result)
+
+        return result
 
     @property
     def activity_url(self):
@@ -210,32 +360,128 @@ class Status(PolymorphicModel):
 
     @property
     def ancestors(self):
+        return self.get_ancestors()
 
-        result = []
-        parent = self.in_reply_to
+    @property
+    def descendants(self):
+        return self.get_descendants()
+
+    def get_ancestors(self,
+            max_depth = THREAD_MAX_DEPTH,
+            queryset = None,
+            ):
+        """
+        Returns a list of the statuses this status is replying to,
+        starting at the root of the thread and ending with
+        our immediate parent.
+
+        We stop after max_depth levels. If you want the
+        results to have related objects prefetched, pass in
+        a suitable queryset of Statuses.
+        """
+
+        if self.in_reply_to_id is None:
+            return []
+
+        if queryset is None:
+            queryset = Status.objects.all()
+
+        if _supports_recursive_cte():
+
+            found = dict([(x.id, x) for x in
+                queryset.filter(
+                    id__in = RawSQL(
+                        _ancestors_sql(),
+                        [self.in_reply_to_id, max_depth],
+                        ),
+                    )])
 
-        while parent is not None:
-            result.insert(0, parent)
-            parent = parent.in_reply_to
+            result = []
+            parent_id = self.in_reply_to_id
 
+            while parent_id in found and len(result)<max_depth:
+                parent = found.pop(parent_id)
+                result.append(parent)
+                parent_id = parent.in_reply_to_id
+
+        else:
+
+            result = []
+            parent_id = self.in_reply_to_id
+
+            while parent_id is not None and len(result)<max_depth:
+                try:
+                    parent = queryset.get(id=parent_id)
+                except Status.DoesNotExist:
+                    break
+
+                result.append(parent)
+                parent_id = parent.in_reply_to_id
+
+        result.reverse()
         return result
 
-    @property
-    def descendants(self):
+    def get_descendants(self,
+            max_depth = THREAD_MAX_DEPTH,
+            max_count = THREAD_MAX_DESCENDANTS,
+            queryset = None,
+            ):
+        """
+        Returns a list of all the replies to this status,
+        and all the replies to those, and so on.
+
+        The list is in depth-first order: each reply is
+        followed by its own replies before we move on to
+        its next sibling. Siblings are in the order they
+        were created.
+
+        We look at most max_depth levels down, and return
+        at most max_count statuses. If we have to stop early,
+        it's the deepest replies which get left out.
+
+        If you want the results to have related objects
+        prefetched, pass in a suitable queryset of Statuses.
+        """
+
+        if queryset is None:
+            queryset = Status.objects.all()
+
+        if _supports_recursive_cte():
+
+            found = list(queryset.filter(
+                id__in = RawSQL(
+                    _descendants_sql(),
+                    [self.id, max_depth, max_count],
+                    ),
+                ))
 
-        result = []
-        current = self
+        else:
+
+            found = []
+            parent_ids = [self.id]
+            depth = 0
 
-        while True:
-            try:
-                child = Status.objects.get(
-                        in_reply_to = current,
-                        )
-            except Status.DoesNotExist:
-                break
+            while parent_ids and depth<max_depth and len(found)<max_count:
+                children = list(queryset.filter(
+                    in_reply_to_id__in = parent_ids,
+                    reblog_of = None,
+                    ).order_by('id')[:max_count-len(found)])
 
-            result.append(child)
-            current = child
+                found.extend(children)
+                parent_ids = [x.id for x in children]
+                depth += 1
+
+        children_of = {}
+        for status in sorted(found, key=lambda x: x.id):
+            children_of.setdefault(status.in_reply_to_id, []).append(status)
+
+        result = []
+        stack = list(reversed(children_of.get(self.id, [])))
+
+        while stack:
+            status = stack.pop()
+            result.append(status)
+            stack.extend(reversed(children_of.get(status.id, [])))
 
         return result
 
@@ -268,8 +514,29 @@ class Status(PolymorphicModel):
         if self.in_reply_to == self:
             raise ValueError("Status can't be a reply to itself")
 
+        self._inherit_thread_fields()
+        self.render_html()
+
         super().save(*args, **kwargs)
 
+        if self.thread_root_id is None or self.conversation is None:
+
+            # We're at the top of a thread. We don't know our own
+            # ID until we've been saved, so we fill these in now.
+
+            if self.thread_root_id is None:
+                self.thread_root_id = self.pk
+
+            if self.conversation is None:
+                self.conversation = self.default_conversation
+
+            Status.objects.filter(pk=self.pk).update(
+                    thread_root = self.thread_root_id,
+                    conversation = self.conversation,
+                    )
+
+        self._touch_in_reply_to()
+
         if send_signal and newly_made:
 
             if self.reblog_of is None:
@@ -277,6 +544,82 @@ class Status(PolymorphicModel):
             else:
                 trilby_signals.reblogged.send(sender=self)
 
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self._touch_in_reply_to()
+        return result
+
+    def touch(self):
+        """
+        Marks this status as changed, without saving it.
+        Use this when something which is shown along with
+        the status changes, such as its replies or tags.
+        """
+        Status.objects.filter(pk=self.pk).update(
+                updated_at = now(),
+                )
+
+    def _touch_in_reply_to(self):
+        # The status we're replying to lists its replies,
+        # so whenever we change, so does it.
+
+        if self.in_reply_to_id is not None:
+            Status.objects.filter(pk=self.in_reply_to_id).update(
+                    updated_at = now(),
+                    )
+
+    def _inherit_thread_fields(self):
+        """
+        If we're a reply, and we don't yet know our thread root
+        and conversation, take them from the status we're replying to.
+
+        Reblogs copy the in_reply_to field of the status they
+        reblog, but they aren't part of its thread.
+        """
+
+        if self.in_reply_to_id is None or self.reblog_of_id is not None:
+            return
+
+        if self.thread_root_id is not None and self.conversation is not None:
+            return
+
+        parent = self.in_reply_to
+
+        if parent.thread_root_id is not None and \
+                parent.conversation is not None:
+            root_id = parent.thread_root_id
+            conversation = parent.conversation
+        else:
+            # The parent was saved before we kept track of threads,
+            # and hasn't been backfilled. Find the top the slow way.
+            root = self.get_ancestors()[0]
+            root_id = root.id
+            conversation = parent.conversation or root.conversation or \
+                    root.default_conversation
+
+        if self.thread_root_id is None:
+            self.thread_root_id = root_id
+
+        if self.conversation is None:
+            self.conversation = conversation
+
+    @property
+    def default_conversation(self):
+        """
+        The conversation ID for a new thread starting at this status.
+
+        Remote servers usually tell us the conversation ID,
+        so this is only used for them as a last resort.
+        """
+        if self.remote_url is not None:
+            return self.remote_url
+
+        return 'tag:%s,%d:objectId=%d:objectType=Conversation' % (
+                settings.KEPI['LOCAL_OBJECT_HOSTNAME'],
+                self.created_at.year,
+                self.pk,
+                )
+
     def __str__(self):
         return '[Status %s: %s]' % (
                 self.id,
@@ -286,40 +629,28 @@ class Status(PolymorphicModel):
     @classmethod
     def lookup(cls, url):
 
-        # TODO: not yet tested
-        # FIXME: if url is local, parse and return local <-- current breakage XXX
         # FIXME: if remote is not found, *possibly* create and return?
 
         if is_local(url):
 
-            view = trilby_utils.find_local_view(
-                    url,
-                    )
+            local_url = resolve_local_url(url)
 
-            view = trilby_utils.find_local_view(
-                    url,
-                    which_views = ['StatusView'],
-                    )
-
-            if view is None:
+            if local_url is None or local_url.kind!='status':
+                logger.debug('%s is local but not a status',
+                        url)
                 return None
 
-            statusid = int(view.kwargs['status'])
+            result = cls.objects.filter(
+                    id = int(local_url.fields['id']),
+                    account__localperson__local_username = \
+                            local_url.fields['username'],
+                    ).first()
 
-            try:
-                result = cls.objects.get(
-                        id=statusid,
-                        )
-            except cls.DoesNotExist:
+            if result is None:
                 logger.debug('%s is local but does not exist',
                         url)
                 return None
 
-            if result.account.local_user.username != view.kwargs['username']:
-                logger.debug('%s is local but the username doesn\'t match',
-                        url)
-                return None
-
             logger.debug('%s is local and exists: %s',
                     url, result)
             return result
@@ -356,14 +687,35 @@ class Status(PolymorphicModel):
     def is_local(self):
         return self.remote_url is None
 
+    def render_html(self):
+        """
+        Renders the content and spoiler text as HTML, and stores
+        the results. You don't usually need to call this yourself,
+        because save() does it.
+        """
+        self.content_html = trilby_rendering.render(self.content or '')
+        self.spoiler_text_html = trilby_rendering.render(
+                self.spoiler_text or '')
+        self.html_version = trilby_rendering.RENDERER_VERSION
+
+    def _html_for(self, fieldname):
+
+        if self.html_version == trilby_rendering.RENDERER_VERSION:
+            result = getattr(self, fieldname+'_html')
+
+            if result is not None:
+                return result
+
+        return trilby_rendering.render(getattr(self, fieldname) or '')
+
     @property
     def content_as_html(self):
         if not self.content:
             return '<p></p>'
-        return markdown.markdown(self.content)
+        return self._html_for('content')
 
     @property
     def spoiler_text_as_html(self):
         if not self.spoiler_text:
             return '<p></p>'
-        return markdown.markdown(self.spoiler_text)
+        return self._html_for('spoiler_text')
@@ -9,8 +9,11 @@ logger = logging.getLogger(name='kepi')
 
 import kepi.trilby_api.signals as kepi_signals
 import kepi.trilby_api.models as kepi_models
-import kepi.sombrero_sendpub.delivery as sombrero_delivery
+import kepi.trilby_api.accepts as kepi_accepts
+import kepi.trilby_api.streaming as kepi_streaming
+import kepi.trilby_api.search as kepi_search
 from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
 
 ##################################################
 # Notification handlers
@@ -26,6 +29,11 @@ def on_follow(sender, **kwargs):
         # we're only concerned with local accounts
         return
 
+    if follow.accept_pending:
+        # The notification gets stored along with the Accept.
+        kepi_accepts.follow_needs_accept(follow)
+        return
+
     notification = kepi_models.Notification(
             notification_type = kepi_models.Notification.FOLLOW,
             for_account = follow.following,
@@ -37,27 +45,12 @@ def on_follow(sender, **kwargs):
     logger.info('    -- storing a notification: %s',
             notification)
 
+    kepi_streaming.publish_notification(notification)
+
     if follow.following.auto_follow:
-        logger.info("    -- sending automatic Accept")
-
-        if isinstance(follow.follower, kepi_models.RemotePerson):
-            accept = {
-                    'type': 'Accept',
-                    'to': [follow.follower.url],
-                    'actor': follow.following.url,
-                    'object': follow.offer,
-                    }
-
-            sombrero_delivery.deliver(
-                    activity = accept,
-                    sender = follow.following,
-                    target_people = [
-                        follow.follower,
-                        ],
-                    )
-
-        follow.offer = None
-        follow.save()
+        if follow.offer is not None:
+            follow.offer = None
+            follow.save()
     else:
         logger.info("    -- not sending automatic Accept")
 
@@ -70,14 +63,85 @@ def on_like(sender, **kwargs):
         # we're only concerned with local accounts
         return
 
-    notification = kepi_models.Notification(
+    notification = kepi_models.Notification.add(
             notification_type = kepi_models.Notification.FAVOURITE,
             for_account = like.liked.account,
             about_account = like.liker,
             status = like.liked,
             )
 
-    notification.save()
+    if notification is None:
+        # It joined a group; this is how the v1 API lists it.
+        notification = kepi_models.Notification.for_like(
+                like,
+                for_account = like.liked.account,
+                )
 
     logger.info('    -- storing a notification: %s',
             notification)
+
+    kepi_streaming.publish_notification(notification)
+
+@receiver(kepi_signals.reblogged)
+def on_reblog(sender, **kwargs):
+
+    reblog = sender # rename to prevent confusion below
+
+    if not reblog.reblog_of.account.is_local:
+        # we're only concerned with local accounts
+        return
+
+    notification = kepi_models.Notification.add(
+            notification_type = kepi_models.Notification.REBLOG,
+            for_account = reblog.reblog_of.account,
+            about_account = reblog.account,
+            status = reblog.reblog_of,
+            )
+
+    if notification is None:
+        # It joined a group; this is how the v1 API lists it.
+        notification = kepi_models.Notification.for_reblog(
+                reblog,
+                for_account = reblog.reblog_of.account,
+                )
+
+    logger.info('    -- storing a notification: %s',
+            notification)
+
+    kepi_streaming.publish_notification(notification)
+
+##################################################
+# Streaming
+
+@receiver([
+    kepi_signals.posted,
+    kepi_signals.reblogged,
+    ])
+def on_new_status(sender, **kwargs):
+    kepi_streaming.publish_status(sender)
+
+##################################################
+# Search
+
+def _needs_indexing(fields, update_fields):
+    return update_fields is None or bool(fields & set(update_fields))
+
+@receiver(post_save, sender=kepi_models.LocalPerson)
+@receiver(post_save, sender=kepi_models.RemotePerson)
+def on_person_saved(sender, instance, update_fields=None, **kwargs):
+    if _needs_indexing(kepi_search.PERSON_FIELDS, update_fields):
+        kepi_search.index_person(instance)
+
+@receiver(post_save, sender=kepi_models.Status)
+def on_status_saved(sender, instance, update_fields=None, **kwargs):
+    if _needs_indexing(kepi_search.STATUS_FIELDS, update_fields):
+        kepi_search.index_status(instance)
+
+@receiver(post_delete, sender=kepi_models.LocalPerson)
+@receiver(post_delete, sender=kepi_models.RemotePerson)
+def on_person_deleted(sender, instance, **kwargs):
+    kepi_search.unindex_person(instance)
+
+@receiver(post_delete, sender=kepi_models.Status)
+def on_status_deleted(sender, instance, **kwargs):
+    kepi_search.unindex_status(instance)
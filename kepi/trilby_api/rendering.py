@@ -0,0 +1,34 @@
+# rendering.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Turns the Markdown that people write into HTML.
+
+Rendering is expensive, so statuses and people store the HTML
+alongside the source text when they're saved. If you change the
+way rendering works, increase RENDERER_VERSION, and then run the
+rerender_html management command to update what's stored.
+Anything stored with an older version is rendered on the fly
+until then.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import functools
+import markdown
+
+RENDERER_VERSION = 1
+
+# How many recently rendered texts we remember.
+RENDER_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render(text):
+    """
+    Returns the HTML form of the Markdown in "text".
+    """
+    return markdown.markdown(text)
@@ -0,0 +1,440 @@
+# search.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Full-text search for people and statuses.
+
+We index people by their username, acct, and display name, and
+public and unlisted statuses by their text. The index is kept
+up to date as people and statuses are saved and deleted; see
+the receivers in receivers.py.
+
+The index lives in a backend, which is KEPI['SEARCH_BACKEND'],
+or, if that's None, whichever of these suits the database:
+
+  SQLiteBackend   - SQLite's FTS5 extension
+  PostgresBackend - PostgreSQL's tsvector type, with a GIN index
+  MemoryBackend   - an inverted index in the memory of each
+                    process, built when it's first searched
+
+The first two keep their tables alongside ours, and the
+"search_index" migration creates them. If you're adding search
+to a database which already has people and statuses in, run
+"manage.py rebuild_search_index" once.
+
+Searches match every word in the query. The last word can be
+the start of a word, because people search as they type.
+Statuses come back newest first. That lets the databases
+stop once they've found a page of them, which is what keeps
+searches quick over millions of statuses.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from django.conf import settings
+from django.db import connection
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+import bisect
+import re
+import threading
+import kepi.trilby_api.models as trilby_models
+import kepi.trilby_api.utils as trilby_utils
+
+PEOPLE_TABLE = 'kepi_search_people'
+STATUSES_TABLE = 'kepi_search_statuses'
+
+# Statuses with these visibilities are searchable.
+SEARCHABLE_VISIBILITIES = [
+        trilby_utils.VISIBILITY_PUBLIC,
+        trilby_utils.VISIBILITY_UNLISTED,
+        ]
+
+# Fields whose changes mean a person or status needs reindexing.
+PERSON_FIELDS = set(['username', 'local_username', 'acct', 'display_name'])
+STATUS_FIELDS = set(['content', 'spoiler_text', 'visibility'])
+
+_WORD = re.compile(r'\w+')
+
+def words(text):
+    """
+    Splits text into the lowercase words we index it by.
+    """
+    return _WORD.findall((text or '').lower())
+
+def person_text(person):
+    """
+    Returns the text we index "person" by.
+    """
+    return ' '.join([
+        person.username or '',
+        person.acct or '',
+        person.display_name or '',
+        ])
+
+def status_text(status):
+    """
+    Returns the text we index "status" by, or None if it
+    shouldn't be searchable.
+    """
+    if status.visibility not in SEARCHABLE_VISIBILITIES:
+        return None
+
+    if status.reblog_of_id is not None:
+        # Reblogs are found by way of what they reblog.
+        return None
+
+    return ' '.join([
+        status.spoiler_text or '',
+        strip_tags(status.content or ''),
+        ])
+
+##################################################
+# Backends
+
+class SQLiteBackend(object):
+    """
+    Uses SQLite's FTS5 extension. Each table's rowid is the ID
+    of the person or status it indexes.
+
+    FTS5 looks up the start of a word quickly only if it has a
+    prefix index of that length; otherwise it scans every word
+    which begins the same way. So we keep one for each length
+    from 2 to 6. Each costs about as much space again as the
+    words themselves.
+
+    Migrations 0037 and 0040 make the tables.
+    """
+
+    @classmethod
+    def installed(cls):
+        return connection.vendor=='sqlite' and \
+                STATUSES_TABLE in connection.introspection.table_names()
+
+    def _query(self, terms):
+        result = ['"%s"' % (x,) for x in terms]
+        result[-1] += '*'
+        return ' '.join(result)
+
+    def _put(self, table, pk, text):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                    'DELETE FROM '+table+' WHERE rowid=%s',
+                    [pk])
+
+            if text is not None:
+                cursor.execute(
+                        'INSERT INTO '+table+'(rowid, text) VALUES (%s, %s)',
+                        [pk, text])
+
+    def put_person(self, pk, text):
+        self._put(PEOPLE_TABLE, pk, text)
+
+    def put_status(self, pk, text):
+        self._put(STATUSES_TABLE, pk, text)
+
+    def search_people(self, terms, limit, offset):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                    'SELECT rowid FROM '+PEOPLE_TABLE+\
+                    ' WHERE text MATCH %s ORDER BY rank LIMIT %s OFFSET %s',
+                    [self._query(terms), limit, offset])
+            return [x[0] for x in cursor.fetchall()]
+
+    def search_statuses(self, terms, limit, offset):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                    'SELECT rowid FROM '+STATUSES_TABLE+\
+                    ' WHERE text MATCH %s ORDER BY rowid DESC '+\
+                    'LIMIT %s OFFSET %s',
+                    [self._query(terms), limit, offset])
+            return [x[0] for x in cursor.fetchall()]
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            for table in [PEOPLE_TABLE, STATUSES_TABLE]:
+                cursor.execute('DELETE FROM '+table)
+
+class PostgresBackend(object):
+    """
+    Uses PostgreSQL's full-text search. Each table holds a tsvector
+    for each person or status, with a GIN index over them.
+
+    Migration 0037 makes the tables.
+    """
+
+    @classmethod
+    def installed(cls):
+        return connection.vendor=='postgresql' and \
+                STATUSES_TABLE in connection.introspection.table_names()
+
+    def _query(self, terms):
+        return ' & '.join(terms)+':*'
+
+    def _put(self, table, pk, text):
+        with connection.cursor() as cursor:
+            if text is None:
+                cursor.execute(
+                        'DELETE FROM '+table+' WHERE id=%s',
+                        [pk])
+            else:
+                cursor.execute(
+                        'INSERT INTO '+table+' (id, document) '+\
+                        "VALUES (%s, to_tsvector('simple', %s)) "+\
+                        'ON CONFLICT (id) DO UPDATE '+\
+                        'SET document=EXCLUDED.document',
+                        [pk, text])
+
+    def put_person(self, pk, text):
+        self._put(PEOPLE_TABLE, pk, text)
+
+    def put_status(self, pk, text):
+        self._put(STATUSES_TABLE, pk, text)
+
+    def search_people(self, terms, limit, offset):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                    'SELECT id FROM '+PEOPLE_TABLE+\
+                    " WHERE document @@ to_tsquery('simple', %s)"+\
+                    " ORDER BY ts_rank(document,"+\
+                    " to_tsquery('simple', %s)) DESC, id DESC"+\
+                    ' LIMIT %s OFFSET %s',
+                    [self._query(terms), self._query(terms),
+                        limit, offset])
+            return [x[0] for x in cursor.fetchall()]
+
+    def search_statuses(self, terms, limit, offset):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                    'SELECT id FROM '+STATUSES_TABLE+\
+                    " WHERE document @@ to_tsquery('simple', %s)"+\
+                    ' ORDER BY id DESC LIMIT %s OFFSET %s',
+                    [self._query(terms), limit, offset])
+            return [x[0] for x in cursor.fetchall()]
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            for table in [PEOPLE_TABLE, STATUSES_TABLE]:
+                cursor.execute('DELETE FROM '+table)
+
+class _InvertedIndex(object):
+    """
+    Maps each word to the IDs of the things it appears in.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+
+        # All the words, in order, so that we can find the
+        # ones which start with a prefix.
+        self.sorted_words = []
+
+    def put(self, pk, text):
+        for word in self.documents.pop(pk, ()):
+            posting = self.postings[word]
+            posting.discard(pk)
+
+            if not posting:
+                del self.postings[word]
+                del self.sorted_words[
+                        bisect.bisect_left(self.sorted_words, word)]
+
+        if text is None:
+            return
+
+        document = frozenset(words(text))
+        self.documents[pk] = document
+
+        for word in document:
+            if word not in self.postings:
+                self.postings[word] = set()
+                bisect.insort(self.sorted_words, word)
+
+            self.postings[word].add(pk)
+
+    def _starting_with(self, prefix):
+        result = set()
+
+        i = bisect.bisect_left(self.sorted_words, prefix)
+        while i<len(self.sorted_words) and \
+                self.sorted_words[i].startswith(prefix):
+            result |= self.postings[self.sorted_words[i]]
+            i += 1
+
+        return result
+
+    def search(self, terms):
+        matches = [self.postings.get(x, set()) for x in terms[:-1]]
+        matches.append(self._starting_with(terms[-1]))
+        matches.sort(key=len)
+
+        result = set(matches[0])
+        for match in matches[1:]:
+            result &= match
+
+        return sorted(result, reverse=True)
+
+class MemoryBackend(object):
+    """
+    Keeps an inverted index in the memory of this process. It's
+    built from the database the first time anyone searches,
+    and after that it's kept up to date as things get saved.
+
+    This works with any database, but each process has its own
+    copy of the index, and only hears about changes made by
+    itself; so it's for small sites, and tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._people = None
+        self._statuses = None
+
+    def _load(self):
+        if self._people is not None:
+            return
+
+        people = _InvertedIndex()
+        for person in trilby_models.Person.objects.iterator():
+            people.put(person.pk, person_text(person))
+
+        statuses = _InvertedIndex()
+        for status in trilby_models.Status.objects.filter(
+                visibility__in = SEARCHABLE_VISIBILITIES,
+                reblog_of = None,
+                ).iterator():
+            statuses.put(status.pk, status_text(status))
+
+        self._people = people
+        self._statuses = statuses
+
+    def put_person(self, pk, text):
+        with self._lock:
+            if self._people is not None:
+                self._people.put(pk, text)
+
+    def put_status(self, pk, text):
+        with self._lock:
+            if self._statuses is not None:
+                self._statuses.put(pk, text)
+
+    def search_people(self, terms, limit, offset):
+        with self._lock:
+            self._load()
+            return self._people.search(terms)[offset:offset+limit]
+
+    def search_statuses(self, terms, limit, offset):
+        with self._lock:
+            self._load()
+            return self._statuses.search(terms)[offset:offset+limit]
+
+    def clear(self):
+        with self._lock:
+            self._people = None
+            self._statuses = None
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def backend():
+    """
+    Returns the search backend: KEPI['SEARCH_BACKEND'] if it's set,
+    and otherwise the best one for the database.
+    """
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            if settings.KEPI['SEARCH_BACKEND'] is not None:
+                _backend = import_string(
+                        settings.KEPI['SEARCH_BACKEND'])()
+            elif SQLiteBackend.installed():
+                _backend = SQLiteBackend()
+            elif PostgresBackend.installed():
+                _backend = PostgresBackend()
+            else:
+                _backend = MemoryBackend()
+
+            logger.info('Search backend is %s',
+                    _backend.__class__.__name__)
+
+        return _backend
+
+##################################################
+# Indexing
+
+def index_person(person):
+    backend().put_person(person.pk, person_text(person))
+
+def index_status(status):
+    backend().put_status(status.pk, status_text(status))
+
+def unindex_person(person):
+    backend().put_person(person.pk, None)
+
+def unindex_status(status):
+    backend().put_status(status.pk, None)
+
+def rebuild():
+    """
+    Empties the index, and indexes everyone and everything
+    from scratch.
+    """
+    the_backend = backend()
+    the_backend.clear()
+
+    for person in trilby_models.Person.objects.iterator():
+        the_backend.put_person(person.pk, person_text(person))
+
+    for status in trilby_models.Status.objects.filter(
+            visibility__in = SEARCHABLE_VISIBILITIES,
+            reblog_of = None,
+            ).iterator():
+        the_backend.put_status(status.pk, status_text(status))
+
+##################################################
+# Searching
+
+def _ordered(queryset, ids):
+    found = dict([(x.pk, x) for x in queryset.filter(pk__in=ids)])
+    return [found[x] for x in ids if x in found]
+
+def search_people(query,
+        limit = 40,
+        offset = 0,
+        ):
+    """
+    Returns a list of the Persons who match "query", best first.
+    """
+    terms = words(query)
+
+    if not terms:
+        return []
+
+    return _ordered(
+            trilby_models.Person.objects.all(),
+            backend().search_people(terms, limit, offset),
+            )
+
+def search_statuses(query,
+        limit = 40,
+        offset = 0,
+        ):
+    """
+    Returns a list of the Statuses which match "query",
+    newest first.
+    """
+    terms = words(query)
+
+    if not terms:
+        return []
+
+    return _ordered(
+            trilby_models.Status.objects.all(),
+            backend().search_statuses(terms, limit, offset),
+            )
@@ -12,7 +12,6 @@ from kepi.trilby_api.models import *
 from rest_framework_recursive.fields import RecursiveField
 from oauth2_provider.models import Application
 import kepi.trilby_api.utils as trilby_utils
-import markdown
 
 """
 These are the serialisers for the Mastodon protocol.
@@ -131,6 +130,30 @@ class UserSerializerWithSource(UserSerializer):
 
 #########################################
 
+class HashtagSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Hashtag
+        fields = (
+                'name',
+                'url',
+                )
+
+    url = serializers.URLField(
+            read_only = True)
+
+#########################################
+
+# The related objects which StatusSerializer looks at for each
+# status. If you're serialising a lot of statuses at once,
+# pass these to prefetch_related() first.
+
+STATUS_SERIALIZER_PREFETCH = [
+        'account',
+        'in_reply_to',
+        'reblog_of__account',
+        ]
+
 class StatusSerializer(serializers.ModelSerializer):
     class Meta:
         model = Status
@@ -216,8 +239,9 @@ class StatusSerializer(serializers.ModelSerializer):
             write_only = True)
 
     def get_content(self, status):
-        result = markdown.markdown(status.content)
-        return result
+        if not status.content:
+            return ''
+        return status.content_as_html
 
     created_at = serializers.DateTimeField(
             required = False,
@@ -225,6 +249,11 @@ class StatusSerializer(serializers.ModelSerializer):
 
    # TODO Media
 
+    tags = HashtagSerializer(
+            source = 'hashtags',
+            many = True,
+            read_only = True)
+
     sensitive = serializers.BooleanField(
             required = False)
     spoiler_text = serializers.CharField(
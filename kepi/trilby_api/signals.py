@@ -39,3 +39,6 @@ posted = Signal(
 
 reblogged = Signal(
     )
+
+keys_rotated = Signal(
+    )
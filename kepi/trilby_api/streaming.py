@@ -0,0 +1,818 @@
+# streaming.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+"""
+Mastodon's streaming API.
+
+Rather than polling the timelines and notifications, clients
+can keep a connection open to /api/v1/streaming, and we tell
+them about new statuses and notifications as they happen. The
+docs are here:
+https://docs.joinmastodon.org/methods/streaming/
+
+When a status is posted or reblogged, or a notification is
+stored, we publish an event on the relevant "channels":
+
+  timeline:<id>       - the home timeline of local person <id>
+  notifications:<id>  - the notifications of local person <id>
+  public              - all public statuses
+  public:local        - public statuses posted here
+
+Each of Mastodon's streams is made of one or more of these;
+"user", for example, is the home timeline plus notifications.
+
+The channels live in a backend, which is KEPI['STREAMING_BACKEND'].
+LocalBackend only passes events around inside one process.
+RedisBackend passes them between processes, through Redis.
+
+The endpoints come in two kinds. StreamingApp is an ASGI
+application which serves server-sent events and WebSockets.
+Each connection is a coroutine and a short queue, so a worker can
+hold thousands of idle ones; use it if you can (see kepi/asgi.py).
+Streaming, the Django view, serves server-sent events under WSGI.
+But there, each connection keeps a thread busy for as long as
+it's open.
+"""
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from collections import defaultdict, deque
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.module_loading import import_string
+from django.views import View
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+import asyncio
+import json
+import threading
+import kepi.trilby_api.models as trilby_models
+import kepi.trilby_api.utils as trilby_utils
+from kepi.bowler_pub.utils import as_json
+
+# redis is optional. You only need it for RedisBackend.
+try:
+    import redis
+except ImportError:
+    redis = None
+
+STREAMING_PATH = '/api/v1/streaming'
+
+HEARTBEAT = ':thump\n\n'
+
+##################################################
+# Backends
+
+class LocalBackend(object):
+    """
+    Passes events to subscriptions in the same process.
+
+    That's all you need if there's only one process, and
+    it's what the tests use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, subscription, channels):
+        """
+        Adds "subscription" to each of "channels". Returns the
+        channels which nobody here was subscribed to before.
+        """
+        result = []
+
+        with self._lock:
+            for channel in channels:
+                if channel not in self._subscriptions:
+                    result.append(channel)
+
+                self._subscriptions[channel].add(subscription)
+
+        return result
+
+    def unsubscribe(self, subscription, channels):
+        """
+        Removes "subscription" from each of "channels". Returns
+        the channels which nobody here is subscribed to any more.
+        """
+        result = []
+
+        with self._lock:
+            for channel in channels:
+                subscriptions = self._subscriptions.get(channel)
+
+                if subscriptions is None:
+                    continue
+
+                subscriptions.discard(subscription)
+
+                if not subscriptions:
+                    del self._subscriptions[channel]
+                    result.append(channel)
+
+        return result
+
+    def listening(self, channels):
+        """
+        Returns the members of "channels" which anyone might be
+        subscribed to. We don't bother building events for
+        the others.
+        """
+        with self._lock:
+            return [x for x in channels if x in self._subscriptions]
+
+    def listening_to(self, prefix):
+        """
+        Returns the channels whose names begin with "prefix"
+        which anyone might be subscribed to.
+        """
+        with self._lock:
+            return [x for x in self._subscriptions
+                    if x.startswith(prefix)]
+
+    def publish(self, channel, event, payload):
+        self._dispatch(channel, event, payload)
+
+    def _dispatch(self, channel, event, payload):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+
+        for subscription in subscriptions:
+            subscription.deliver(channel, event, payload)
+
+class RedisBackend(LocalBackend):
+    """
+    Passes events between processes using Redis's pub/sub.
+
+    Each process still keeps track of its own subscriptions, and
+    subscribes in Redis to each channel which someone here is
+    listening to. So Redis knows which channels are live in any
+    process, and we ask it before we build an event. The Redis
+    server is KEPI['STREAMING_REDIS_URL'].
+    """
+
+    PREFIX = 'kepi:streaming:'
+
+    def __init__(self):
+        if redis is None:
+            raise ImproperlyConfigured(
+                    'RedisBackend needs the redis package.')
+
+        super().__init__()
+
+        self._redis = redis.Redis.from_url(
+                settings.KEPI['STREAMING_REDIS_URL'],
+                )
+        self._pubsub = self._redis.pubsub(
+                ignore_subscribe_messages = True,
+                )
+        self._listener = None
+
+        # Held while we subscribe or unsubscribe, so that Redis
+        # hears about each channel in the same order we do.
+        self._redis_lock = threading.Lock()
+
+    def subscribe(self, subscription, channels):
+        with self._redis_lock:
+            result = super().subscribe(subscription, channels)
+
+            if not result:
+                return result
+
+            self._pubsub.subscribe(**dict([
+                (self.PREFIX+channel, self._on_message)
+                for channel in result]))
+
+            if self._listener is None:
+                self._listener = self._pubsub.run_in_thread(
+                        daemon = True,
+                        )
+
+        return result
+
+    def unsubscribe(self, subscription, channels):
+        with self._redis_lock:
+            result = super().unsubscribe(subscription, channels)
+
+            if result:
+                self._pubsub.unsubscribe(*[self.PREFIX+channel
+                    for channel in result])
+
+        return result
+
+    def listening(self, channels):
+        # Other processes might be listening to any of them,
+        # so ask Redis how many subscribers each one has.
+        if not channels:
+            return []
+
+        counts = dict(self._redis.pubsub_numsub(*[
+            self.PREFIX+channel for channel in channels]))
+
+        return [channel for channel in channels
+                if counts.get((self.PREFIX+channel).encode('UTF-8'))]
+
+    def listening_to(self, prefix):
+        return [x.decode('UTF-8')[len(self.PREFIX):]
+                for x in self._redis.pubsub_channels(
+                    self.PREFIX+prefix+'*')]
+
+    def publish(self, channel, event, payload):
+        self._redis.publish(
+                self.PREFIX+channel,
+                json.dumps([event, payload]),
+                )
+
+    def _on_message(self, message):
+        channel = message['channel'].decode('UTF-8')[len(self.PREFIX):]
+        event, payload = json.loads(message['data'])
+        self._dispatch(channel, event, payload)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def backend():
+    """
+    Returns the backend named in KEPI['STREAMING_BACKEND'],
+    creating it if this is the first time.
+    """
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(
+                    settings.KEPI['STREAMING_BACKEND'])()
+
+        return _backend
+
+##################################################
+# Subscriptions
+
+class Subscription(object):
+    """
+    The channels a client's connection is listening to, and
+    the events waiting to be sent to it.
+
+    If the client doesn't keep up, we drop the oldest events,
+    so that no connection holds more than
+    KEPI['STREAMING_QUEUE_SIZE'] of them.
+
+    "wake" is called with no arguments whenever an event arrives.
+    It may be called from any thread.
+    """
+
+    __slots__ = ('streams', 'pending', '_wake')
+
+    def __init__(self, wake):
+        self.streams = {}
+        self.pending = deque(
+                maxlen = settings.KEPI['STREAMING_QUEUE_SIZE'],
+                )
+        self._wake = wake
+
+    def listen(self, stream, channels):
+        for channel in channels:
+            self.streams[channel] = stream
+
+        backend().subscribe(self, channels)
+
+    def stop(self, stream=None):
+        """
+        Stops listening to "stream", or, if it's None, to everything.
+        """
+        channels = [channel
+                for channel, name in self.streams.items()
+                if stream is None or name==stream]
+
+        backend().unsubscribe(self, channels)
+
+        for channel in channels:
+            del self.streams[channel]
+
+    def deliver(self, channel, event, payload):
+        stream = self.streams.get(channel)
+
+        if stream is None:
+            return
+
+        self.pending.append((stream, event, payload))
+        self._wake()
+
+    def take(self):
+        """
+        Returns all the events waiting, and forgets them.
+        """
+        result = []
+        while self.pending:
+            result.append(self.pending.popleft())
+        return result
+
+def channels_for(stream, person):
+    """
+    Returns the channels which make up the Mastodon stream called
+    "stream", as seen by "person", who may be None if the client
+    hasn't logged in.
+
+    Returns None if there's no such stream, or if "person"
+    can't have it.
+    """
+
+    if stream in ('public', 'public:local'):
+        return [stream]
+
+    if person is None:
+        return None
+
+    if stream=='user':
+        return [
+                'timeline:%d' % (person.pk,),
+                'notifications:%d' % (person.pk,),
+                ]
+    elif stream=='user:notification':
+        return [
+                'notifications:%d' % (person.pk,),
+                ]
+
+    return None
+
+def _stream_error(stream, person):
+    """
+    Returns an HTTP status and a reason for why channels_for()
+    has no channels for "stream".
+    """
+    if person is None and stream.startswith('user'):
+        return 401, 'Not logged in'
+    else:
+        return 400, 'Unknown stream type'
+
+def _person_for_token(token):
+    """
+    Returns the LocalPerson who owns the OAuth access token
+    "token", or None if there's no such valid token.
+    """
+    from oauth2_provider.models import get_access_token_model
+
+    try:
+        access_token = get_access_token_model().objects.select_related(
+                'user__localperson',
+                ).get(
+                        token = token,
+                        )
+    except get_access_token_model().DoesNotExist:
+        return None
+
+    if not access_token.is_valid():
+        return None
+
+    return access_token.user.localperson
+
+def _token_from(headers, params):
+    """
+    Finds the access token in a request, if there is one.
+    Clients can send it as a bearer token, as the
+    "access_token" parameter, or, for WebSockets, as the
+    subprotocol.
+    """
+
+    authorization = headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        return authorization[len('bearer '):].strip()
+
+    if params.get('access_token'):
+        return params['access_token']
+
+    return headers.get('sec-websocket-protocol') or None
+
+def _stream_from(path, params):
+    """
+    Works out which stream a request is for. It can be in the path,
+    as in "/api/v1/streaming/public/local", or in the "stream"
+    parameter.
+    """
+    path = path[len(STREAMING_PATH):].strip('/')
+
+    if path:
+        return path.replace('/', ':')
+
+    return params.get('stream', 'user')
+
+def as_sse(stream, event, payload):
+    """
+    Formats an event for server-sent events.
+    """
+    return 'event: %s\ndata: %s\n\n' % (event, payload)
+
+def as_websocket(stream, event, payload):
+    """
+    Formats an event for a WebSocket.
+    """
+    return json.dumps({
+        'stream': [stream],
+        'event': event,
+        'payload': payload,
+        })
+
+##################################################
+# Publishing
+
+def _publish(channels, event, make_payload):
+    """
+    Publishes an event on "channels". We only call "make_payload",
+    which serialises the event's object, if anyone's listening.
+    """
+
+    the_backend = backend()
+
+    channels = the_backend.listening(channels)
+
+    if not channels:
+        return
+
+    payload = as_json(make_payload(),
+            pretty = False,
+            )
+
+    for channel in channels:
+        the_backend.publish(channel, event, payload)
+
+def home_timelines_for(status, among=None):
+    """
+    Returns the IDs of the local people whose home timelines
+    should show "status": the poster, if they're local, and
+    their local followers, as Mastodon does it. Direct
+    statuses only go to the poster.
+
+    If "among" is not None, it's a collection of IDs, and we
+    only return people from it. If it's empty, we don't need
+    to look anything up.
+    """
+
+    poster = status.account
+
+    if status.visibility==trilby_utils.VISIBILITY_DIRECT or \
+            (among is not None and not among):
+        result = set()
+    else:
+        followers = trilby_models.LocalPerson.objects.filter(
+                rel_following__following = poster,
+                rel_following__offer = None,
+                )
+
+        if status.reblog_of is not None:
+            followers = followers.filter(
+                    rel_following__show_reblogs = True,
+                    )
+
+        if among is not None:
+            followers = followers.filter(
+                    pk__in = among,
+                    )
+
+        result = set(followers.values_list('pk', flat=True))
+
+    if poster.is_local and (among is None or poster.pk in among):
+        result.add(poster.pk)
+
+    return result
+
+def publish_status(status):
+    """
+    Tells the timelines which show "status" about it.
+    We only look for the timelines which someone has open.
+    """
+    import kepi.trilby_api.fast_serializers as fast_serializers
+
+    open_timelines = set([
+        int(channel[len('timeline:'):])
+        for channel in backend().listening_to('timeline:')])
+
+    channels = ['timeline:%d' % (pk,)
+            for pk in home_timelines_for(status,
+                among = open_timelines)]
+
+    if status.visibility==trilby_utils.VISIBILITY_PUBLIC and \
+            status.reblog_of is None:
+        channels.append('public')
+
+        if status.is_local:
+            channels.append('public:local')
+
+    _publish(
+            channels = channels,
+            event = 'update',
+            make_payload = lambda: fast_serializers.statuses_as_list(
+                [status])[0],
+            )
+
+def publish_notification(notification):
+    """
+    Tells the person "notification" is for about it.
+    """
+    import kepi.trilby_api.fast_serializers as fast_serializers
+
+    _publish(
+            channels = [
+                'notifications:%d' % (notification.for_account_id,),
+                ],
+            event = 'notification',
+            make_payload = lambda: fast_serializers.notifications_as_list(
+                [notification])[0],
+            )
+
+##################################################
+# Server-sent events, under WSGI
+
+class Streaming(View):
+    """
+    Serves the streaming API as server-sent events.
+
+    This works under WSGI, but every open connection keeps a
+    thread busy. StreamingApp, under ASGI, doesn't have
+    that problem.
+    """
+
+    def get(self, request, *args, **kwargs):
+
+        params = request.GET.dict()
+
+        token = _token_from(
+                dict([(k.lower(), v) for k, v in request.headers.items()]),
+                params,
+                )
+
+        if token is not None:
+            person = _person_for_token(token)
+        elif request.user.is_authenticated:
+            person = request.user.localperson
+        else:
+            person = None
+
+        stream = _stream_from(request.path, params)
+        channels = channels_for(stream, person)
+
+        if channels is None:
+            status, reason = _stream_error(stream, person)
+            return HttpResponse(
+                    json.dumps({'error': reason}),
+                    status = status,
+                    reason = reason,
+                    content_type = 'application/json',
+                    )
+
+        ready = threading.Event()
+        subscription = Subscription(wake = ready.set)
+        subscription.listen(stream, channels)
+
+        result = StreamingHttpResponse(
+                self._events(subscription, ready),
+                content_type = 'text/event-stream',
+                )
+        result['Cache-Control'] = 'no-cache'
+        return result
+
+    def _events(self, subscription, ready):
+        try:
+            # Send something straight away, so that the headers
+            # go out and the client knows it's connected.
+            yield HEARTBEAT
+
+            while True:
+                if not ready.wait(
+                        timeout = settings.KEPI['STREAMING_HEARTBEAT']):
+                    yield HEARTBEAT
+                    continue
+
+                ready.clear()
+
+                for event in subscription.take():
+                    yield as_sse(*event)
+        finally:
+            subscription.stop()
+
+class StreamingHealth(View):
+    def get(self, request, *args, **kwargs):
+        return HttpResponse('OK',
+                content_type = 'text/plain',
+                )
+
+##################################################
+# Server-sent events and WebSockets, under ASGI
+
+class StreamingApp(object):
+    """
+    An ASGI application which serves the streaming API, as
+    server-sent events or WebSockets, and passes everything
+    else to "fallback", which is usually Django.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def _handles(self, scope):
+        if scope['type'] not in ('http', 'websocket'):
+            return False
+
+        path = scope['path'].rstrip('/')
+
+        if path==STREAMING_PATH+'/health':
+            return False
+
+        return path==STREAMING_PATH or \
+                path.startswith(STREAMING_PATH+'/')
+
+    async def __call__(self, scope, receive, send):
+
+        if not self._handles(scope):
+            return await self.fallback(scope, receive, send)
+
+        headers = dict([
+            (k.decode('latin-1').lower(), v.decode('latin-1'))
+            for k, v in scope.get('headers', [])])
+
+        params = dict([
+            (k, v[-1]) for k, v in parse_qs(
+                scope.get('query_string', b'').decode('latin-1'),
+                ).items()])
+
+        token = _token_from(headers, params)
+
+        if token is None:
+            person = None
+        else:
+            person = await sync_to_async(_person_for_token)(token)
+
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        subscription = Subscription(
+                wake = lambda: loop.call_soon_threadsafe(ready.set),
+                )
+
+        try:
+            if scope['type']=='websocket':
+                await self._websocket(
+                        scope, receive, send,
+                        headers, params, person,
+                        subscription, ready)
+            else:
+                await self._sse(
+                        scope, receive, send,
+                        params, person,
+                        subscription, ready)
+        finally:
+            subscription.stop()
+
+    async def _wait(self, ready, other):
+        """
+        Waits until an event arrives, or "other" finishes, or it's
+        time for a heartbeat. Returns True if an event arrived.
+        """
+        waiter = asyncio.ensure_future(ready.wait())
+
+        done, _ = await asyncio.wait(
+                [waiter, other],
+                timeout = settings.KEPI['STREAMING_HEARTBEAT'],
+                return_when = asyncio.FIRST_COMPLETED,
+                )
+
+        if waiter not in done:
+            waiter.cancel()
+            return False
+
+        ready.clear()
+        return True
+
+    async def _sse(self, scope, receive, send,
+            params, person,
+            subscription, ready):
+
+        stream = _stream_from(scope['path'], params)
+        channels = channels_for(stream, person)
+
+        if channels is None:
+            status, reason = _stream_error(stream, person)
+
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [(b'content-type', b'application/json')],
+                })
+            await send({
+                'type': 'http.response.body',
+                'body': json.dumps({'error': reason}).encode('UTF-8'),
+                })
+            return
+
+        subscription.listen(stream, channels)
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                ],
+            })
+
+        await send({
+            'type': 'http.response.body',
+            'body': HEARTBEAT.encode('UTF-8'),
+            'more_body': True,
+            })
+
+        # The request has no body worth reading; after that,
+        # the only message we'll get is the disconnection.
+        await receive()
+        disconnected = asyncio.ensure_future(receive())
+
+        try:
+            while not disconnected.done():
+
+                if await self._wait(ready, disconnected):
+                    body = ''.join([as_sse(*event)
+                        for event in subscription.take()])
+                else:
+                    body = HEARTBEAT
+
+                if body and not disconnected.done():
+                    await send({
+                        'type': 'http.response.body',
+                        'body': body.encode('UTF-8'),
+                        'more_body': True,
+                        })
+        finally:
+            disconnected.cancel()
+
+    async def _websocket(self, scope, receive, send,
+            headers, params, person,
+            subscription, ready):
+
+        message = await receive()
+
+        if message['type']!='websocket.connect':
+            return
+
+        accept = {
+                'type': 'websocket.accept',
+                }
+
+        if 'sec-websocket-protocol' in headers:
+            accept['subprotocol'] = headers['sec-websocket-protocol']
+
+        await send(accept)
+
+        async def listen(stream):
+            channels = channels_for(stream, person)
+
+            if channels is None:
+                _, reason = _stream_error(stream, person)
+                await send({
+                    'type': 'websocket.send',
+                    'text': json.dumps({'error': reason}),
+                    })
+                return
+
+            subscription.listen(stream, channels)
+
+        if 'stream' in params:
+            await listen(params['stream'])
+
+        received = asyncio.ensure_future(receive())
+
+        try:
+            while True:
+
+                if await self._wait(ready, received):
+                    for event in subscription.take():
+                        await send({
+                            'type': 'websocket.send',
+                            'text': as_websocket(*event),
+                            })
+
+                if not received.done():
+                    continue
+
+                message = received.result()
+
+                if message['type']=='websocket.disconnect':
+                    return
+
+                try:
+                    command = json.loads(message.get('text') or '')
+                except ValueError:
+                    command = {}
+
+                if command.get('type')=='subscribe':
+                    await listen(command.get('stream', ''))
+                elif command.get('type')=='unsubscribe':
+                    subscription.stop(command.get('stream', ''))
+
+                received = asyncio.ensure_future(receive())
+        finally:
+            received.cancel()
@@ -0,0 +1,257 @@
+from django.test import TestCase
+from unittest.mock import patch
+from kepi.trilby_api.tests import *
+from kepi.trilby_api.models import *
+from kepi.trilby_api.accepts import send_accepts, _take_batch, _settle
+import kepi.sombrero_sendpub.delivery as sombrero_delivery
+from django.conf import settings
+import httpretty
+import requests
+import json
+import datetime
+import logging
+
+logger = logging.getLogger(name='kepi')
+
+FOLLOWERS = [
+        ('https://example.org', 'peter'),
+        ('https://example.org', 'quentin'),
+        ('https://example.com', 'robert'),
+        ]
+
+class TestAccepts(TestCase):
+
+    def setUp(self):
+        settings.KEPI['LOCAL_OBJECT_HOSTNAME'] = 'testserver'
+
+        self.alice = create_local_person(name='alice')
+        self.follows = []
+
+        for host, name in FOLLOWERS:
+            follower = RemotePerson(
+                    remote_url = f'{host}/users/{name}',
+                    username = name,
+                    inbox_url = f'{host}/users/{name}/inbox',
+                    )
+            follower.save()
+
+            self.follows.append(Follow(
+                follower = follower,
+                following = self.alice,
+                offer = f'{host}/offers/{name}',
+                accept_pending = True,
+                ))
+
+    def _register_inboxes(self):
+        for follow in self.follows:
+            httpretty.register_uri(
+                    httpretty.POST,
+                    follow.follower.inbox_url,
+                    status = 200,
+                    body = 'Thank you!',
+                    )
+
+    def _accepts_received(self):
+        # httpretty can record each request more than once
+        return sorted(set([
+            json.loads(request.body)['object']
+            for request in httpretty.latest_requests()
+            if request.method=='POST'
+            ]))
+
+    @httpretty.activate
+    def test_send_accepts(self):
+        self._register_inboxes()
+
+        for follow in self.follows:
+            follow.save()
+
+        self.assertEqual(
+                send_accepts(batch_size=2, drain=True),
+                3,
+                )
+
+        self.assertEqual(
+                self._accepts_received(),
+                sorted([follow.offer for follow in self.follows]),
+                )
+
+        self.assertFalse(
+                Follow.objects.filter(accept_pending=True).exists())
+        self.assertFalse(
+                Follow.objects.filter(offer__isnull=False).exists())
+
+        self.assertEqual(
+                Notification.objects.filter(
+                    for_account = self.alice,
+                    notification_type = Notification.FOLLOW,
+                    ).count(),
+                3)
+
+        self.assertEqual(
+                send_accepts(),
+                0,
+                msg = "nothing is sent twice",
+                )
+
+    @httpretty.activate
+    def test_in_background(self):
+        self._register_inboxes()
+
+        with patch.dict(settings.KEPI, {'ACCEPT_IN_BACKGROUND': True}):
+            for follow in self.follows:
+                follow.save(send_signal=True)
+
+        self.assertEqual(self._accepts_received(), [])
+        self.assertFalse(Notification.objects.exists())
+
+        self.assertEqual(send_accepts(), 3)
+        self.assertEqual(len(self._accepts_received()), 3)
+        self.assertEqual(Notification.objects.count(), 3)
+
+    @httpretty.activate
+    def test_straight_away(self):
+        self._register_inboxes()
+
+        self.follows[0].save(send_signal=True)
+
+        self.assertEqual(
+                self._accepts_received(),
+                [self.follows[0].offer],
+                )
+
+        self.assertEqual(Notification.objects.count(), 1)
+
+    @httpretty.activate
+    def test_one_batch_per_call(self):
+        self._register_inboxes()
+
+        for follow in self.follows:
+            follow.save()
+
+        self.assertEqual(send_accepts(batch_size=2), 2)
+        self.assertEqual(len(self._accepts_received()), 2)
+        self.assertEqual(
+                Follow.objects.filter(accept_pending=True).count(),
+                1)
+
+        with patch('kepi.trilby_api.accepts._runs_eagerly',
+                return_value = False), \
+                patch.object(send_accepts, 'apply_async') as requeue:
+
+            self.assertEqual(send_accepts(batch_size=1), 1)
+            self.assertFalse(requeue.called,
+                    msg = "nothing left, so nothing re-queued")
+
+            Follow.objects.update(accept_pending=True)
+
+            self.assertEqual(send_accepts(batch_size=2), 2)
+            requeue.assert_called_once()
+
+    @httpretty.activate
+    def test_delivery_fails(self):
+        self._register_inboxes()
+
+        for follow in self.follows:
+            follow.save()
+
+        real_deliver = sombrero_delivery.deliver
+
+        def deliver(**kwargs):
+            if 'example.org' in kwargs['target_people'][0].inbox_url:
+                raise requests.exceptions.ReadTimeout()
+            return real_deliver(**kwargs)
+
+        with patch.object(sombrero_delivery, 'deliver', deliver):
+            self.assertEqual(send_accepts(), 1)
+
+        self.assertEqual(
+                sorted(Follow.objects.filter(
+                    accept_pending = True,
+                    offer__isnull = False,
+                    ).values_list('follower__remoteperson__username', flat=True)),
+                ['peter', 'quentin'],
+                msg = "Follows stay pending if their Accept isn't sent",
+                )
+        self.assertEqual(Notification.objects.count(), 1)
+
+        self.assertEqual(send_accepts(), 2)
+        self.assertEqual(len(self._accepts_received()), 3)
+        self.assertEqual(Notification.objects.count(), 3)
+
+    @httpretty.activate
+    def test_delivery_hopeless(self):
+        self._register_inboxes()
+
+        for follow in self.follows:
+            follow.save()
+
+        with patch.object(sombrero_delivery, 'deliver',
+                side_effect = requests.exceptions.InvalidURL()):
+            self.assertEqual(send_accepts(), 0)
+
+        self.assertFalse(
+                Follow.objects.filter(accept_pending=True).exists(),
+                msg = "a broken inbox URL doesn't block the queue",
+                )
+        self.assertEqual(
+                Follow.objects.filter(offer__isnull=False).count(),
+                3,
+                msg = "Follows we gave up on are still only offers",
+                )
+        self.assertFalse(Notification.objects.exists())
+
+    def test_unreachable_inbox(self):
+        follow = self.follows[0]
+        follow.follower.inbox_url = 'http://127.0.0.1:1/users/peter/inbox'
+        follow.follower.save()
+        follow.save()
+
+        self.assertEqual(send_accepts(), 0)
+
+        follow.refresh_from_db()
+        self.assertTrue(follow.accept_pending)
+        self.assertIsNotNone(follow.offer)
+        self.assertIsNone(follow.accept_claimed_at,
+                msg = "the claim is let go, for next time")
+        self.assertFalse(Notification.objects.exists())
+
+    @httpretty.activate
+    def test_claims(self):
+        self._register_inboxes()
+
+        for follow in self.follows:
+            follow.save()
+
+        batch, claimed_at, more = _take_batch(2)
+        self.assertEqual(len(batch), 2)
+        self.assertTrue(more)
+
+        self.assertEqual(send_accepts(), 1,
+                msg = "another worker doesn't take claimed Follows")
+        self.assertEqual(len(self._accepts_received()), 1)
+
+        Follow.objects.filter(
+                pk = batch[0].pk,
+                ).update(
+                        accept_claimed_at = claimed_at - datetime.timedelta(
+                            seconds = settings.KEPI['ACCEPT_CLAIM_SECONDS']+1,
+                            ))
+
+        self.assertEqual(send_accepts(), 1,
+                msg = "a claim which has run out is taken over")
+
+        self.assertEqual(
+                _settle(
+                    claimed_at = claimed_at,
+                    sent = batch,
+                    given_up = [],
+                    left = [],
+                    ),
+                1,
+                msg = "Follows someone else took over are left alone",
+                )
+
+        self.assertFalse(
+                Follow.objects.filter(accept_pending=True).exists())
+        self.assertEqual(Notification.objects.count(), 3)
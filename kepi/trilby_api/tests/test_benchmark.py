@@ -0,0 +1,64 @@
+from django.test import TestCase
+from kepi.kepi.benchmark import compare, regressions, combine
+import logging
+
+logger = logging.getLogger(name='kepi')
+
+def _result(*rounds):
+    return {
+            'calls': len(rounds),
+            'items': 1,
+            'seconds_per_call': min(rounds),
+            'items_per_second': 1/min(rounds),
+            'rounds': sorted(rounds),
+            }
+
+class TestRegressions(TestCase):
+
+    def test_regressions(self):
+        old = {
+                'steady': _result(1.0, 1.02, 1.05),
+                'noisy': _result(1.0, 1.4, 2.0),
+                'slower': _result(1.0, 1.02, 1.05),
+                'faster': _result(1.0, 1.02, 1.05),
+                'gone': _result(1.0),
+                }
+
+        new = {
+                'steady': _result(1.1, 1.12, 1.15),
+                'noisy': _result(1.5, 1.6, 2.1),
+                'slower': _result(1.5, 1.52, 1.6),
+                'faster': _result(0.5, 0.51, 0.52),
+                'added': _result(1.0),
+                }
+
+        self.assertEqual(
+                sorted(compare(old, new).keys()),
+                ['faster', 'noisy', 'slower', 'steady'],
+                )
+
+        # "steady" is within the threshold, and "noisy" is within
+        # the spread of its old timings.
+        self.assertEqual(
+                regressions(old, new, threshold=0.25),
+                ['slower'],
+                )
+
+    def test_old_results(self):
+        # Results stored without "rounds" still compare.
+        old = {'x': {'seconds_per_call': 1.0}}
+        new = {'x': _result(2.0, 2.1)}
+
+        self.assertEqual(regressions(old, new, threshold=0.25), ['x'])
+
+    def test_combine(self):
+        old = {'x': _result(1.0, 1.05)}
+
+        unlucky = {'x': _result(2.0, 2.1)}
+        self.assertEqual(regressions(old, unlucky, threshold=0.25), ['x'])
+
+        again = {'x': combine(unlucky['x'], _result(1.02, 1.5))}
+        self.assertEqual(again['x']['seconds_per_call'], 1.02)
+        self.assertEqual(again['x']['calls'], 4)
+        self.assertEqual(again['x']['rounds'], [1.02, 1.5, 2.0, 2.1])
+        self.assertEqual(regressions(old, again, threshold=0.25), [])
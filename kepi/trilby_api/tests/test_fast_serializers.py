@@ -0,0 +1,142 @@
+# test_fast_serializers.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+import json
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from kepi.trilby_api.tests import *
+from kepi.trilby_api.models import *
+from kepi.trilby_api.serializers import *
+import kepi.trilby_api.fast_serializers as fast_serializers
+
+# Each function in fast_serializers must give exactly what the
+# d-r-f serialiser gives. We compare the JSON, rather than the
+# dicts, so that the order of the keys counts too.
+
+def _as_json(value):
+    return json.dumps(value, default=str)
+
+class TestFastSerializers(TrilbyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self._alice = create_local_person(name='alice',
+                note = 'I *enjoy* falling down rabbitholes.',
+                )
+        self._bob = create_local_person(name='bob',
+                locked = True,
+                bot = True,
+                )
+        self._carol = RemotePerson(
+                remote_url = 'https://example.com/users/carol',
+                username = 'carol',
+                acct = 'carol@example.com',
+                display_name = 'Carol',
+                )
+        self._carol.save()
+
+        Follow(follower=self._bob, following=self._alice).save()
+        Follow(follower=self._carol, following=self._alice).save()
+
+        self._statuses = []
+
+        original = create_local_status(
+                posted_by = self._alice,
+                content = 'Curiouser and *curiouser*!',
+                spoiler_text = 'rabbits',
+                sensitive = True,
+                )
+        self._statuses.append(original)
+
+        reply = create_local_status(
+                posted_by = self._bob,
+                content = 'Hello @alice',
+                in_reply_to = original,
+                )
+        Mention(status=reply, whom=self._alice).save()
+        self._statuses.append(reply)
+
+        self._statuses.append(create_local_status(
+                posted_by = self._carol,
+                content = '',
+                in_reply_to = reply,
+                ))
+
+        self._statuses.append(create_local_status(
+                posted_by = self._bob,
+                reblog_of = original,
+                ))
+
+        for notification_type, about, status in [
+                (Notification.FOLLOW, self._bob, None),
+                (Notification.MENTION, self._bob, reply),
+                (Notification.REBLOG, self._bob, original),
+                (Notification.FAVOURITE, self._carol, original),
+                ]:
+            Notification(
+                    notification_type = notification_type,
+                    for_account = self._alice,
+                    about_account = about,
+                    status = status,
+                    ).save()
+
+    def test_user(self):
+        for person in Person.objects.all():
+            self.assertEqual(
+                    _as_json(fast_serializers.user_as_dict(person)),
+                    _as_json(UserSerializer(person).data),
+                    msg = f'serialising {person}',
+                    )
+
+    def test_status(self):
+        for status in Status.objects.all():
+            self.assertEqual(
+                    _as_json(fast_serializers.status_as_dict(status)),
+                    _as_json(StatusSerializer(status).data),
+                    msg = f'serialising {status}',
+                    )
+
+    def test_statuses(self):
+        statuses = Status.objects.all()
+
+        self.assertEqual(
+                _as_json(fast_serializers.statuses_as_list(statuses)),
+                _as_json(StatusSerializer(statuses, many=True).data),
+                )
+
+    def test_notifications(self):
+        notifications = Notification.objects.all()
+
+        self.assertEqual(
+                _as_json(fast_serializers.notifications_as_list(
+                    notifications)),
+                _as_json(NotificationSerializer(notifications,
+                    many=True).data),
+                )
+
+    def test_statuses_queries(self):
+
+        # The number of queries shouldn't depend on
+        # the number of statuses.
+
+        numbered = []
+        for i in range(10):
+            numbered.append(create_local_status(
+                    posted_by = self._bob,
+                    content = f'Status number {i}.',
+                    ))
+
+        with CaptureQueriesContext(connection) as few:
+            fast_serializers.statuses_as_list(numbered[:2])
+
+        with CaptureQueriesContext(connection) as many:
+            fast_serializers.statuses_as_list(numbered)
+
+        self.assertEqual(len(few), len(many))
@@ -0,0 +1,314 @@
+from django.test import TestCase, Client
+from unittest.mock import patch
+from kepi.trilby_api.tests import *
+from kepi.trilby_api.models import *
+import kepi.kepi.instrumentation as instrumentation
+import kepi.kepi.task_instrumentation as task_instrumentation
+from urllib.request import urlopen
+import time
+import os
+import shutil
+import tempfile
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(name='kepi')
+
+PUBLIC_TIMELINE = 'kepi.trilby_api.views.PublicTimeline'
+
+class TestRegistry(TestCase):
+
+    def test_exposition(self):
+        registry = instrumentation.Registry()
+        registry.describe('wombats_total', 'counter', 'Wombats seen.')
+        registry.describe('wombat_seconds', 'histogram',
+                'How long wombats take.',
+                buckets = [1, 10],
+                )
+
+        registry.inc('wombats_total', colour='brown')
+        registry.inc('wombats_total', 2, colour='brown')
+        registry.inc('wombats_total', colour='say "grey"')
+
+        for value in [0.5, 5, 50]:
+            registry.observe('wombat_seconds', value)
+
+        self.assertEqual(
+                registry.exposition(),
+                '# HELP wombat_seconds How long wombats take.\n'
+                '# TYPE wombat_seconds histogram\n'
+                'wombat_seconds_bucket{le="1"} 1\n'
+                'wombat_seconds_bucket{le="10"} 2\n'
+                'wombat_seconds_bucket{le="+Inf"} 3\n'
+                'wombat_seconds_sum 55.5\n'
+                'wombat_seconds_count 3\n'
+                '# HELP wombats_total Wombats seen.\n'
+                '# TYPE wombats_total counter\n'
+                'wombats_total{colour="brown"} 3\n'
+                'wombats_total{colour="say \\"grey\\""} 1\n'
+                )
+
+    def test_outside_request(self):
+        # These do nothing, but they mustn't fail.
+        with instrumentation.measure('http'):
+            pass
+
+        instrumentation.count('cache_hits')
+
+        self.assertIsNone(instrumentation.current())
+
+    def test_measure(self):
+        measurement = instrumentation.Measurement()
+        token = instrumentation._current.set(measurement)
+
+        try:
+            with instrumentation.measure('http'):
+                pass
+            with instrumentation.measure('serialise'):
+                pass
+            instrumentation.count('cache_misses')
+        finally:
+            instrumentation._current.reset(token)
+
+        self.assertEqual(measurement.http_calls, 1)
+        self.assertEqual(measurement.cache_misses, 1)
+        self.assertEqual(measurement.cache_hits, 0)
+
+class TestMiddleware(TrilbyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        instrumentation.registry.clear()
+
+        create_local_status(
+                posted_by = create_local_person('alice'),
+                )
+
+    def test_metrics(self):
+        self.get('/api/v1/timelines/public')
+
+        self.assertEqual(
+                instrumentation.registry.get(
+                    'kepi_request_duration_seconds',
+                    view = PUBLIC_TIMELINE,
+                    ),
+                1)
+
+        self.assertGreater(
+                instrumentation.registry.get(
+                    'kepi_request_db_queries_total',
+                    view = PUBLIC_TIMELINE,
+                    ),
+                0)
+
+        self.assertEqual(
+                instrumentation.registry.get(
+                    'kepi_responses_total',
+                    view = PUBLIC_TIMELINE,
+                    code = '2xx',
+                    ),
+                1)
+
+        with patch.dict(settings.KEPI, {
+            'METRICS_ALLOWED_ADDRESSES': ['127.0.0.1'],
+            }):
+            metrics = Client().get('/metrics')
+
+        self.assertEqual(metrics.status_code, 200)
+
+        self.assertIn(
+                'kepi_request_duration_seconds_count'+\
+                        '{view="%s",pid="%d"} 1' % (
+                            PUBLIC_TIMELINE, os.getpid()),
+                metrics.content.decode('UTF-8'))
+
+    def test_metrics_forbidden(self):
+        metrics = Client(REMOTE_ADDR='192.0.2.1').get('/metrics')
+        self.assertEqual(metrics.status_code, 403)
+
+        # Behind a proxy, everyone is at 127.0.0.1.
+        metrics = Client().get('/metrics')
+        self.assertEqual(metrics.status_code, 403)
+
+    def test_metrics_token(self):
+        with patch.dict(settings.KEPI, {'METRICS_TOKEN': 'wombat'}):
+            for authorization, expected in [
+                    ('Bearer wombat', 200),
+                    ('Bearer numbat', 403),
+                    ('', 403),
+                    ]:
+                metrics = Client(REMOTE_ADDR='192.0.2.1').get('/metrics',
+                        HTTP_AUTHORIZATION = authorization,
+                        )
+                self.assertEqual(metrics.status_code, expected,
+                        msg = authorization)
+
+    def test_metrics_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.get('/api/v1/timelines/public')
+
+        # Another worker, which has seen one request.
+        other = instrumentation.Registry()
+        for name, kind, help in [
+                ('kepi_responses_total', 'counter', 'Responses.'),
+                ('kepi_request_duration_seconds', 'histogram', 'Time.'),
+                ]:
+            other.describe(name, kind, help)
+        other.inc('kepi_responses_total', view=PUBLIC_TIMELINE, code='2xx')
+        other.observe('kepi_request_duration_seconds', 0.001,
+                view = PUBLIC_TIMELINE)
+
+        with patch.object(instrumentation.os, 'getpid',
+                return_value = os.getpid()+1):
+            other.save(directory)
+
+        with patch.dict(settings.KEPI, {
+            'METRICS_DIR': directory,
+            'METRICS_ALLOWED_ADDRESSES': None,
+            }):
+            metrics = Client().get('/metrics').content.decode('UTF-8')
+
+        self.assertIn(
+                'kepi_responses_total{code="2xx",view="%s"} 2' % (
+                    PUBLIC_TIMELINE,),
+                metrics)
+        self.assertIn(
+                'kepi_request_duration_seconds_count{view="%s"} 2' % (
+                    PUBLIC_TIMELINE,),
+                metrics)
+        self.assertNotIn('pid=', metrics)
+
+        self.assertEqual(
+                sorted(os.listdir(directory)),
+                sorted(['%d.json' % (os.getpid(),),
+                    '%d.json' % (os.getpid()+1,)]),
+                )
+
+    def test_server_timing(self):
+        with patch.dict(settings.KEPI, {'SERVER_TIMING': True}):
+            response = self.get('/api/v1/timelines/public',
+                    parse_result = False,
+                    )
+
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        self.assertIn('serialise;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        with patch.dict(settings.KEPI, {'SERVER_TIMING': False}):
+            response = self.get('/api/v1/timelines/public',
+                    parse_result = False,
+                    )
+
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_disabled(self):
+        with patch.dict(settings.KEPI, {'INSTRUMENTATION': False}):
+            self.get('/api/v1/timelines/public')
+
+        self.assertEqual(
+                instrumentation.registry.get(
+                    'kepi_request_duration_seconds',
+                    view = PUBLIC_TIMELINE,
+                    ),
+                0)
+
+class TestTasks(TestCase):
+
+    def setUp(self):
+        instrumentation.registry.clear()
+
+    def test_instrumented(self):
+
+        @task_instrumentation.instrumented
+        def wombat(fail):
+            if fail:
+                raise ValueError()
+            return 'ok'
+
+        self.assertEqual(wombat(False), 'ok')
+        with self.assertRaises(ValueError):
+            wombat(True)
+
+        for outcome in ['success', 'failure']:
+            self.assertEqual(
+                    instrumentation.registry.get(
+                        'kepi_task_runs_total',
+                        task = 'wombat',
+                        outcome = outcome,
+                        ),
+                    1)
+
+        self.assertEqual(
+                instrumentation.registry.get(
+                    'kepi_task_duration_seconds',
+                    task = 'wombat',
+                    ),
+                2)
+
+    def test_lag(self):
+
+        class FakeTask(object):
+            name = 'kepi.sombrero_sendpub.delivery.deliver'
+
+        headers = {}
+        task_instrumentation._stamp_enqueued(headers=headers)
+        self.assertIn(task_instrumentation.ENQUEUED_HEADER, headers)
+
+        task = FakeTask()
+        task.request = {
+                task_instrumentation.ENQUEUED_HEADER: time.time()-10,
+                }
+
+        task_instrumentation._record_lag(task=task)
+
+        self.assertEqual(
+                instrumentation.registry.get(
+                    'kepi_task_lag_seconds',
+                    task = 'deliver',
+                    ),
+                1)
+
+        self.assertIn(
+                'kepi_task_lag_seconds_bucket{task="deliver",le="5"} 0',
+                instrumentation.registry.exposition())
+        self.assertIn(
+                'kepi_task_lag_seconds_bucket{task="deliver",le="30"} 1',
+                instrumentation.registry.exposition())
+
+    def test_peer_host(self):
+        with patch.dict(settings.KEPI, {'METRICS_MAX_HOSTS': 0}), \
+                patch.object(task_instrumentation, '_hosts',
+                        set(['example.org'])):
+
+            self.assertEqual(
+                    task_instrumentation.peer_host(
+                        'https://Example.ORG/users/fred'),
+                    'example.org')
+
+            self.assertEqual(
+                    task_instrumentation.peer_host(
+                        'https://example.net/users/jim'),
+                    task_instrumentation.OTHER_HOST)
+
+    def test_worker_server(self):
+        task_instrumentation.record_delivery(
+                'https://example.org/inbox',
+                status_code = 503,
+                sent = 10,
+                received = 0,
+                )
+
+        server = task_instrumentation._serve_metrics(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with urlopen('http://127.0.0.1:%d/metrics' % (
+            server.server_address[1],)) as response:
+            content = response.read().decode('UTF-8')
+
+        self.assertIn(
+                'kepi_deliveries_total{code="5xx",host="example.org"} 1',
+                content)
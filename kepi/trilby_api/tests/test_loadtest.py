@@ -0,0 +1,119 @@
+from django.test import TestCase
+from unittest.mock import patch
+from django.conf import settings
+from kepi.kepi.loadtest import RemoteInstance, LoadTest, latency_summary
+import requests
+import logging
+
+logger = logging.getLogger(name='kepi')
+
+class TestLoadTest(TestCase):
+
+    def setUp(self):
+        patcher = patch.dict(settings.KEPI, {
+            'LOCAL_OBJECT_HOSTNAME': settings.ALLOWED_HOSTS[0],
+            })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.remote = RemoteInstance(keys=1)
+        self.remote.start()
+        self.addCleanup(self.remote.stop)
+
+    def test_remote_instance(self):
+        actor = requests.get(self.remote.actor_url('fred')).json()
+
+        self.assertEqual(actor['id'], self.remote.actor_url('fred'))
+        self.assertIn('BEGIN PUBLIC KEY', actor['publicKey']['publicKeyPem'])
+
+        webfinger = requests.get(self.remote.url+'/.well-known/webfinger',
+                params = {
+                    'resource': 'acct:fred@'+self.remote.hostname,
+                    }).json()
+
+        self.assertEqual(webfinger['links'][0]['href'],
+                self.remote.actor_url('fred'))
+
+        response = requests.post(self.remote.actor_url('fred')+'/inbox',
+                data = '{"type": "Like"}',
+                )
+        self.assertEqual(response.status_code, 202)
+
+        delivery, = self.remote.deliveries()
+        self.assertEqual(delivery.path, '/users/fred/inbox')
+        self.assertEqual(delivery.fields, {'type': 'Like'})
+
+        self.assertEqual(self.remote.requests['actor'], 1)
+
+    def test_run(self):
+        test = LoadTest(
+                self.remote,
+                rates = {
+                    'create': 4,
+                    'like': 2,
+                    'announce': 2,
+                    'follow': 2,
+                    'post': 2,
+                    },
+                duration = 1,
+                actors = 4,
+                local_people = 1,
+                local_statuses = 2,
+                followers = 2,
+                timeout = 10,
+                )
+
+        test.setup()
+        result = test.run()
+
+        for kind, sent in [
+                ('create', 4),
+                ('like', 2),
+                ('announce', 2),
+                ('follow', 2),
+                ]:
+            self.assertEqual(result['inbound'][kind]['sent'], sent)
+            self.assertEqual(result['inbound'][kind]['completed'], sent)
+
+        # Two posts, each to two followers, and to anyone who's
+        # followed since; and each Follow is answered with an Accept.
+        self.assertGreaterEqual(result['outbound']['post']['expected'], 4)
+        self.assertEqual(result['outbound']['post']['completed'],
+                result['outbound']['post']['expected'])
+        self.assertEqual(result['outbound']['accept']['completed'], 2)
+
+        self.assertEqual(result['database']['rows']['trilby_api.Like'], 2)
+        self.assertEqual(result['database']['rows']['trilby_api.Status'],
+                4+2+2)
+
+    def test_no_timeout(self):
+        test = LoadTest(
+                self.remote,
+                rates = {
+                    'create': 1,
+                    'like': 0,
+                    'announce': 0,
+                    'follow': 0,
+                    'post': 1,
+                    },
+                duration = 1,
+                actors = 1,
+                local_people = 1,
+                local_statuses = 1,
+                followers = 1,
+                timeout = 0,
+                )
+
+        test.setup()
+        result = test.run()
+
+        self.assertEqual(result['inbound']['create']['sent'], 1)
+        self.assertGreaterEqual(result['outbound']['post']['expected'], 1)
+
+    def test_latency_summary(self):
+        self.assertIsNone(latency_summary([]))
+
+        summary = latency_summary([x/100 for x in range(100, 0, -1)])
+        self.assertEqual(summary['p50'], 0.5)
+        self.assertEqual(summary['p99'], 0.99)
+        self.assertEqual(summary['max'], 1.0)
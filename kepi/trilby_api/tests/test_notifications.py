@@ -3,8 +3,13 @@ from kepi.trilby_api.views import *
 from kepi.trilby_api.tests import *
 from kepi.trilby_api.models import *
 from django.conf import settings
+from django.db import connection, IntegrityError
+from django.test.utils import CaptureQueriesContext
 import logging
 from unittest import skip
+from unittest.mock import patch
+from django.utils.timezone import now
+import datetime
 
 # Tests for notifications. API docs are here:
 # https://docs.joinmastodon.org/methods/notifications/
@@ -132,3 +137,378 @@ class TestNotifications(TrilbyTestCase):
     @skip("to be implemented later")
     def test_clear_single(self):
         raise NotImplementedError()
+
+class TestNotificationPages(TrilbyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = create_local_person(name='alice')
+        self.bob = create_local_person(name='bob')
+        self.carol = create_local_person(name='carol')
+
+        self.status = create_local_status(
+                content = 'Curiouser and curiouser!',
+                posted_by = self.alice,
+                )
+
+    def _notify(self, count, about=None):
+        for i in range(count):
+            Notification(
+                    notification_type = Notification.FAVOURITE,
+                    for_account = self.alice,
+                    about_account = about or self.bob,
+                    status = self.status,
+                    ).save()
+
+    def _ids(self, **params):
+        return [x['id'] for x in self.get(
+            '/api/v1/notifications',
+            params,
+            as_user = self.alice,
+            )]
+
+    def test_pages(self):
+        self._notify(5)
+
+        everything = self._ids()
+        self.assertEqual(
+                everything,
+                sorted(everything, reverse=True),
+                )
+
+        self.assertEqual(
+                self._ids(limit=2),
+                everything[:2])
+
+        self.assertEqual(
+                self._ids(limit=2, max_id=everything[1]),
+                everything[2:4])
+
+        self.assertEqual(
+                self._ids(since_id=everything[3], limit=2),
+                everything[:2])
+
+        self.assertEqual(
+                self._ids(min_id=everything[3], limit=2),
+                everything[1:3])
+
+    def test_link_header(self):
+        self._notify(3)
+
+        everything = self._ids()
+
+        response = self.get(
+                '/api/v1/notifications',
+                {'limit': 2},
+                as_user = self.alice,
+                parse_result = False,
+                )
+
+        self.assertIn(
+                f'max_id={everything[1]}>; rel="next"',
+                response['Link'],
+                )
+        self.assertIn(
+                f'min_id={everything[0]}>; rel="prev"',
+                response['Link'],
+                )
+        self.assertIn('limit=2', response['Link'])
+
+    def test_filters(self):
+        self._notify(2)
+        self._notify(1, about=self.carol)
+
+        Notification(
+                notification_type = Notification.FOLLOW,
+                for_account = self.alice,
+                about_account = self.bob,
+                ).save()
+
+        self.assertEqual(
+                len(self._ids()),
+                4)
+
+        self.assertEqual(
+                len(self._ids(**{'exclude_types[]': ['favourite']})),
+                1)
+
+        self.assertEqual(
+                len(self._ids(account_id=self.carol.id)),
+                1)
+
+    def test_query_count(self):
+
+        def queries_for_page():
+            with CaptureQueriesContext(connection) as captured:
+                self._ids()
+
+            return len(captured)
+
+        self._notify(2)
+        few = queries_for_page()
+
+        self._notify(30)
+        many = queries_for_page()
+
+        self.assertEqual(few, many)
+
+class TestGroupedNotifications(TrilbyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = create_local_person(name='alice')
+
+        self.status = create_local_status(
+                content = 'Curiouser and curiouser!',
+                posted_by = self.alice,
+                )
+
+        self.fans = [create_local_person(name=f'fan{i}')
+                for i in range(5)]
+
+    def _like_and_reblog(self):
+        for fan in self.fans:
+            Like(liker=fan, liked=self.status).save(
+                    send_signal = True,
+                    )
+
+        create_local_status(
+                posted_by = self.fans[0],
+                reblog_of = self.status,
+                send_signal = True,
+                )
+
+    def test_grouped(self):
+
+        with patch.dict(settings.KEPI, {
+            'NOTIFICATION_GROUP_PERIOD': 3600,
+            'NOTIFICATION_GROUP_SAMPLES': 3,
+            }):
+            self._like_and_reblog()
+
+        self.assertEqual(Notification.objects.count(), 2,
+                msg = "only the groups are stored")
+
+        favourites = Notification.objects.get(
+                notification_type = Notification.FAVOURITE,
+                )
+        self.assertEqual(favourites.count, 5)
+        self.assertEqual(favourites.about_account, self.fans[-1])
+        self.assertEqual(
+                favourites.samples,
+                self.fans[:3],
+                )
+
+        # The Mastodon v1 API still sees every one of them.
+        content = self.get('/api/v1/notifications',
+                as_user = self.alice,
+                )
+
+        self.assertEqual(
+                sorted([(x['type'], x['account']['username'])
+                    for x in content]),
+                [('favourite', fan.username) for fan in self.fans] +
+                [('reblog', 'fan0')],
+                )
+
+        content = self.get('/api/v2/notifications',
+                as_user = self.alice,
+                )
+
+        self.assertEqual(len(content['statuses']), 1)
+        self.assertEqual(len(content['accounts']), 3)
+
+        groups = dict([(x['type'], x)
+            for x in content['notification_groups']])
+
+        self.assertEqual(groups['favourite']['notifications_count'], 5)
+        self.assertEqual(
+                groups['favourite']['sample_account_ids'],
+                [str(fan.id) for fan in self.fans[:3]],
+                )
+        self.assertEqual(
+                groups['favourite']['status_id'],
+                str(self.status.id),
+                )
+        self.assertEqual(groups['reblog']['notifications_count'], 1)
+
+    def test_joining_is_one_update(self):
+
+        with patch.dict(settings.KEPI, {
+            'NOTIFICATION_GROUP_PERIOD': 3600,
+            }):
+
+            self.assertIsNone(Notification.add(
+                    notification_type = Notification.FAVOURITE,
+                    for_account = self.alice,
+                    about_account = self.fans[0],
+                    status = self.status,
+                    ))
+
+            with CaptureQueriesContext(connection) as captured:
+                Notification.add(
+                        notification_type = Notification.FAVOURITE,
+                        for_account = self.alice,
+                        about_account = self.fans[1],
+                        status = self.status,
+                        )
+
+        self.assertEqual(len(captured), 1)
+        self.assertTrue(captured[0]['sql'].startswith('UPDATE'))
+
+    def test_group_attempts(self):
+
+        with patch.dict(settings.KEPI, {
+            'NOTIFICATION_GROUP_PERIOD': 3600,
+            }), patch.object(Notification, 'save',
+                    side_effect = IntegrityError()):
+
+            with self.assertRaises(IntegrityError):
+                Notification.add(
+                        notification_type = Notification.FAVOURITE,
+                        for_account = self.alice,
+                        about_account = self.fans[0],
+                        status = self.status,
+                        )
+
+    def test_grouped_and_not(self):
+        """
+        Favourites from before grouping was switched on have
+        Notifications of their own, and are listed only once.
+        """
+
+        Like(liker=self.fans[0], liked=self.status).save(
+                send_signal = True,
+                )
+
+        with patch.dict(settings.KEPI, {
+            'NOTIFICATION_GROUP_PERIOD': 3600,
+            }):
+            for fan in self.fans[1:]:
+                Like(liker=fan, liked=self.status).save(
+                        send_signal = True,
+                        )
+
+        content = self.get('/api/v1/notifications',
+                as_user = self.alice,
+                )
+
+        self.assertEqual(
+                sorted([x['account']['username'] for x in content]),
+                [fan.username for fan in self.fans],
+                )
+
+        content = self.get('/api/v1/notifications',
+                {'exclude_types[]': ['favourite']},
+                as_user = self.alice,
+                )
+        self.assertEqual(content, [])
+
+        content = self.get('/api/v1/notifications',
+                {'account_id': self.fans[2].id},
+                as_user = self.alice,
+                )
+        self.assertEqual(
+                [x['account']['username'] for x in content],
+                [self.fans[2].username],
+                )
+
+    def test_not_grouped(self):
+
+        self._like_and_reblog()
+
+        self.assertEqual(Notification.objects.count(), 6)
+
+        content = self.get('/api/v2/notifications',
+                as_user = self.alice,
+                )
+
+        self.assertEqual(len(content['notification_groups']), 6)
+
+        for group in content['notification_groups']:
+            self.assertEqual(group['notifications_count'], 1)
+            self.assertEqual(len(group['sample_account_ids']), 1)
+            self.assertTrue(group['group_key'].startswith('ungrouped-'))
+
+    def test_cursors_stay_put(self):
+        """
+        Joining a group doesn't move it, so paging by the ID of
+        a group, or of one of its members, still finds everything
+        which came after.
+        """
+
+        start = now()
+
+        def at(seconds):
+            return start+datetime.timedelta(seconds=seconds)
+
+        with patch.dict(settings.KEPI, {
+            'NOTIFICATION_GROUP_PERIOD': 3600,
+            }):
+
+            with patch('kepi.trilby_api.models.notification.now',
+                    return_value = at(0)):
+                first = Like(
+                        liker = self.fans[0],
+                        liked = self.status,
+                        created_at = at(0),
+                        )
+                first.save(send_signal=True)
+
+            follow = Notification(
+                    notification_type = Notification.FOLLOW,
+                    for_account = self.alice,
+                    about_account = self.fans[1],
+                    created_at = at(10),
+                    )
+            follow.save()
+
+            with patch('kepi.trilby_api.models.notification.now',
+                    return_value = at(20)):
+                last = Like(
+                        liker = self.fans[2],
+                        liked = self.status,
+                        created_at = at(20),
+                        )
+                last.save(send_signal=True)
+
+        group = Notification.objects.get(
+                notification_type = Notification.FAVOURITE,
+                )
+        self.assertEqual(group.count, 2)
+        self.assertEqual(group.created_at, at(0))
+
+        for version, since_id, expected in [
+                ('v1', f'like-{first.pk}', [f'like-{last.pk}', follow.pk]),
+                ('v2', group.pk, [follow.pk]),
+                ]:
+
+            for cursor in ['since_id', 'min_id']:
+                content = self.get(
+                        f'/api/{version}/notifications',
+                        {cursor: since_id},
+                        as_user = self.alice,
+                        )
+
+                if version=='v2':
+                    content = content['notification_groups']
+                    ids = [x['most_recent_notification_id']
+                            for x in content]
+                else:
+                    ids = [x['id'] for x in content]
+
+                self.assertEqual(
+                        [str(x) for x in ids],
+                        [str(x) for x in expected],
+                        msg = f'{version} {cursor}')
+
+        content = self.get('/api/v1/notifications',
+                {'max_id': f'like-{last.pk}'},
+                as_user = self.alice,
+                )
+        self.assertEqual(
+                [str(x['id']) for x in content],
+                [str(follow.pk), f'like-{first.pk}'],
+                )
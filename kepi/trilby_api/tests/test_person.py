@@ -7,6 +7,7 @@
 from kepi.trilby_api.tests import *
 from kepi.bowler_pub.tests import create_remote_person, mock_remote_object
 from rest_framework.test import APIClient, force_authenticate
+import kepi.trilby_api.search as kepi_search
 import logging
 import httpretty
 
@@ -111,3 +112,77 @@ class TestPerson(TrilbyTestCase):
         self.assertFalse(
                 alice.has_liked(status2),
                 )
+
+    def test_urls_without_local_user(self):
+        alice = create_local_person(name='alice')
+        status = create_local_status(posted_by=alice)
+
+        alice = LocalPerson.objects.get(pk=alice.pk)
+        status = Status.objects.get(pk=status.pk)
+
+        with self.assertNumQueries(0):
+            for url in [
+                    alice.url,
+                    alice.inbox_url,
+                    alice.outbox_url,
+                    alice.featured_url,
+                    alice.following_url,
+                    alice.followers_url,
+                    alice.key_name,
+                    ]:
+                self.assertIn('/users/alice', url)
+
+        status.url
+        with self.assertNumQueries(0):
+            self.assertEqual(status.url,
+                    'https://testserver/users/alice/%d' % (status.pk,))
+
+    def test_rename(self):
+        alice = create_local_person(name='alice')
+        self.assertEqual(alice.url, 'https://testserver/users/alice')
+
+        alice.username = 'alicia'
+        self.assertEqual(alice.url, 'https://testserver/users/alicia')
+
+        user = TrilbyUser.objects.get(pk=alice.local_user.pk)
+        user.username = 'ally'
+        user.save()
+
+        self.assertEqual(
+                LocalPerson.objects.get(local_username='ally'),
+                alice,
+                )
+
+    def test_rename_twin(self):
+        alice = create_local_person(name='alice')
+
+        user = TrilbyUser.objects.get(pk=alice.local_user.pk)
+        twin = user.localperson
+        self.assertEqual(twin.url, 'https://testserver/users/alice')
+
+        user.username = 'alicia'
+        user.save()
+
+        self.assertEqual(twin.url, 'https://testserver/users/alicia',
+                msg = "the twin doesn't remember its old URL")
+
+        self.assertEqual(
+                [x.pk for x in kepi_search.search_people('alicia')],
+                [alice.pk],
+                msg = 'the new name is indexed for search',
+                )
+
+    def test_deferred_username(self):
+        alice = create_local_person(name='alice')
+        pk = alice.local_user.pk
+
+        with self.assertNumQueries(1):
+            user = TrilbyUser.objects.only('id').get(pk=pk)
+
+        user.username = 'alicia'
+        user.save()
+
+        self.assertEqual(
+                LocalPerson.objects.get(pk=alice.pk).local_username,
+                'alicia',
+                )
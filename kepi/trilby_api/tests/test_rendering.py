@@ -0,0 +1,87 @@
+# test_rendering.py
+#
+# Part of kepi.
+# Copyright (c) 2018-2020 Marnanel Thurman.
+# Licensed under the GNU Public License v2.
+
+import logging
+logger = logging.getLogger(name='kepi')
+
+from unittest.mock import patch
+from io import StringIO
+from django.core.management import call_command
+from kepi.trilby_api.tests import *
+from kepi.trilby_api.models import *
+import kepi.trilby_api.rendering as trilby_rendering
+
+class TestRendering(TrilbyTestCase):
+
+    def test_stored_on_save(self):
+        alice = create_local_person(name='alice',
+                note = 'I *enjoy* falling down rabbitholes.',
+                )
+
+        status = create_local_status(
+                posted_by = alice,
+                content = 'Curiouser and *curiouser*!',
+                spoiler_text = 'rabbits',
+                )
+
+        status = Status.objects.get(id=status.id)
+        self.assertEqual(status.content_html,
+                '<p>Curiouser and <em>curiouser</em>!</p>')
+        self.assertEqual(status.spoiler_text_html,
+                '<p>rabbits</p>')
+        self.assertEqual(status.html_version,
+                trilby_rendering.RENDERER_VERSION)
+
+        alice = LocalPerson.objects.get(id=alice.id)
+        self.assertEqual(alice.note_html,
+                '<p>I <em>enjoy</em> falling down rabbitholes.</p>')
+
+        with patch.object(trilby_rendering.markdown, 'markdown',
+                side_effect = AssertionError("shouldn't render")):
+            self.assertEqual(status.content_as_html,
+                    '<p>Curiouser and <em>curiouser</em>!</p>')
+            self.assertEqual(status.spoiler_text_as_html,
+                    '<p>rabbits</p>')
+            self.assertEqual(alice.note_as_html,
+                    '<p>I <em>enjoy</em> falling down rabbitholes.</p>')
+
+    def test_empty(self):
+        alice = create_local_person(name='alice')
+
+        status = create_local_status(
+                posted_by = alice,
+                content = '',
+                )
+
+        self.assertEqual(status.content_as_html, '<p></p>')
+        self.assertEqual(status.spoiler_text_as_html, '<p></p>')
+        self.assertEqual(alice.note_as_html, '')
+
+    def test_rerender(self):
+        alice = create_local_person(name='alice',
+                note = 'I *enjoy* falling down rabbitholes.',
+                )
+
+        status = create_local_status(
+                posted_by = alice,
+                content = 'Curiouser and *curiouser*!',
+                )
+
+        with patch.object(trilby_rendering, 'RENDERER_VERSION', 2):
+
+            status = Status.objects.get(id=status.id)
+            self.assertEqual(status.content_as_html,
+                    '<p>Curiouser and <em>curiouser</em>!</p>')
+
+            call_command('rerender_html', stdout=StringIO())
+
+            status = Status.objects.get(id=status.id)
+            self.assertEqual(status.html_version, 2)
+            self.assertEqual(status.content_html,
+                    '<p>Curiouser and <em>curiouser</em>!</p>')
+
+            alice = LocalPerson.objects.get(id=alice.id)
+            self.assertEqual(alice.note_html_version, 2)
@@ -1,19 +1,160 @@
 from rest_framework.test import APIClient, force_authenticate
+from unittest.mock import patch
 from kepi.trilby_api.views import *
 from kepi.trilby_api.tests import *
 from kepi.trilby_api.models import *
+import kepi.trilby_api.search as search
+import kepi.trilby_api.utils as trilby_utils
 from django.conf import settings
 from unittest import skip
 
 # Tests for search. API docs are here:
 # https://docs.joinmastodon.org/methods/search/
 
-class Tests(TrilbyTestCase):
+class SearchTestCase(TrilbyTestCase):
+
+    backend_class = search.SQLiteBackend
+
+    def setUp(self):
+        super().setUp()
+
+        patcher = patch.object(search, '_backend',
+                self.backend_class())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.alice = create_local_person(name='alice',
+                display_name = 'Alice Liddell')
+        self.bob = create_local_person(name='bob',
+                display_name = 'Bob the Builder')
+
+        self.tarts = create_local_status(
+                posted_by = self.alice,
+                content = '<p>The Queen of Hearts, she made some tarts</p>',
+                )
+        self.hatter = create_local_status(
+                posted_by = self.bob,
+                content = 'Why is a raven like a writing desk?',
+                )
+        self.secret = create_local_status(
+                posted_by = self.bob,
+                content = 'The Queen is secretly a raven',
+                visibility = trilby_utils.VISIBILITY_DIRECT,
+                )
+
+    def _statuses(self, query):
+        return [x.id for x in search.search_statuses(query)]
+
+    def _people(self, query):
+        return [x.username for x in search.search_people(query)]
+
+class Tests(SearchTestCase):
+
+    def test_statuses(self):
+        self.assertEqual(self._statuses('queen'), [self.tarts.id])
+        self.assertEqual(self._statuses('RAVEN'), [self.hatter.id])
+        self.assertEqual(self._statuses('raven desk'), [self.hatter.id])
+        self.assertEqual(self._statuses('raven queen'), [])
+        self.assertEqual(self._statuses('wri'), [self.hatter.id],
+                msg = 'the last word can be a prefix')
+        self.assertEqual(self._statuses('p'), [],
+                msg = "HTML tags aren't indexed")
+        self.assertEqual(self._statuses(''), [])
+        self.assertEqual(self._statuses('"*'), [])
+
+    def test_newest_first(self):
+        another = create_local_status(
+                posted_by = self.alice,
+                content = 'Off with their heads, said the Queen',
+                )
+
+        self.assertEqual(
+                self._statuses('queen'),
+                [another.id, self.tarts.id],
+                )
+
+    def test_people(self):
+        self.assertEqual(self._people('alice'), ['alice'])
+        self.assertEqual(self._people('liddell'), ['alice'])
+        self.assertEqual(self._people('build'), ['bob'])
+
+    def test_updates(self):
+        self.hatter.content = 'I have no idea'
+        self.hatter.save()
+        self.assertEqual(self._statuses('raven'), [])
+        self.assertEqual(self._statuses('idea'), [self.hatter.id])
+
+        self.hatter.visibility = trilby_utils.VISIBILITY_DIRECT
+        self.hatter.save()
+        self.assertEqual(self._statuses('idea'), [])
+
+        self.tarts.delete()
+        self.assertEqual(self._statuses('tarts'), [])
+
+        self.bob.display_name = 'Robert'
+        self.bob.save()
+        self.assertEqual(self._people('builder'), [])
+        self.assertEqual(self._people('robert'), ['bob'])
 
-    @skip("to be implemented later")
     def test_v1(self):
-        raise NotImplementedError()
+        result = self.get('/api/v1/accounts/search',
+                {'q': 'ali'},
+                as_user = self.bob,
+                )
+
+        self.assertEqual(
+                [x['username'] for x in result],
+                ['alice'])
 
-    @skip("to be implemented later")
     def test_v2(self):
-        raise NotImplementedError()
+        result = self.get('/api/v2/search',
+                {'q': 'queen'},
+                as_user = self.bob,
+                )
+
+        self.assertEqual(result['accounts'], [])
+        self.assertEqual(
+                [x['id'] for x in result['statuses']],
+                [str(self.tarts.id)])
+        self.assertEqual(result['hashtags'], [])
+
+        result = self.get('/api/v2/search',
+                {'q': 'bob', 'type': 'accounts'},
+                as_user = self.bob,
+                )
+
+        self.assertEqual(
+                [x['username'] for x in result['accounts']],
+                ['bob'])
+        self.assertEqual(result['statuses'], [])
+
+    def test_negative_offset(self):
+        ravens = create_local_status(
+                posted_by = self.alice,
+                content = 'Ravens write with quills',
+                )
+
+        for offset in [0, -1]:
+            result = self.get('/api/v2/search',
+                    {'q': 'raven', 'type': 'statuses', 'offset': offset},
+                    as_user = self.bob,
+                    )
+
+            self.assertEqual(
+                    [x['id'] for x in result['statuses']],
+                    [str(ravens.id), str(self.hatter.id)],
+                    msg = f'offset={offset}')
+
+class TestMemoryBackend(Tests):
+
+    backend_class = search.MemoryBackend
+
+class TestRebuild(SearchTestCase):
+
+    def test_rebuild(self):
+        search.backend().clear()
+        self.assertEqual(self._statuses('queen'), [])
+
+        search.rebuild()
+        self.assertEqual(self._statuses('queen'), [self.tarts.id])
+        self.assertEqual(self._people('alice'), ['alice'])
@@ -6,6 +6,7 @@ from kepi.bowler_pub.tests import create_remote_person
 from kepi.bowler_pub.utils import uri_to_url
 from django.conf import settings
 from unittest import skip
+from unittest.mock import patch
 import httpretty
 
 # Tests for statuses. API docs are here:
@@ -213,6 +214,115 @@ class TestStatus(TrilbyTestCase):
         self.assertEqual(details['descendants'][2]['id'],
             str(statuses[5].id))
 
+    def _make_tree(self):
+
+        # a
+        # +-- b
+        # |   +-- d
+        # |   +-- e
+        # |       +-- g
+        # +-- c
+        #     +-- f
+
+        self._alice = create_local_person(name='alice')
+        statuses = {}
+
+        for name, parent in [
+                ('a', None),
+                ('b', 'a'),
+                ('c', 'a'),
+                ('d', 'b'),
+                ('e', 'b'),
+                ('f', 'c'),
+                ('g', 'e'),
+                ]:
+            statuses[name] = create_local_status(
+                posted_by = self._alice,
+                content = name,
+                in_reply_to = statuses.get(parent),
+                )
+
+        return statuses
+
+    def _check_tree(self, statuses):
+
+        def names(found):
+            return ''.join([x.content for x in found])
+
+        self.assertEqual(names(statuses['a'].descendants), 'bdegcf')
+        self.assertEqual(names(statuses['b'].descendants), 'deg')
+        self.assertEqual(names(statuses['g'].descendants), '')
+
+        self.assertEqual(names(statuses['g'].ancestors), 'abe')
+        self.assertEqual(names(statuses['f'].ancestors), 'ac')
+        self.assertEqual(names(statuses['a'].ancestors), '')
+
+        self.assertEqual(names(statuses['e'].thread), 'abeg')
+
+        self.assertEqual(names(statuses['a'].get_descendants(
+            max_depth = 2)), 'bdecf')
+        self.assertEqual(names(statuses['a'].get_descendants(
+            max_count = 3)), 'bdc')
+        self.assertEqual(names(statuses['g'].get_ancestors(
+            max_depth = 2)), 'be')
+
+    def test_thread_branching(self):
+        statuses = self._make_tree()
+
+        # reblogs share in_reply_to with what they reblog,
+        # but they're not part of the thread
+        Status(
+                account = self._alice,
+                content = 'reblog',
+                reblog_of = statuses['e'],
+                in_reply_to = statuses['b'],
+                ).save()
+
+        self._check_tree(statuses)
+
+    def test_thread_branching_without_cte(self):
+        statuses = self._make_tree()
+
+        import kepi.trilby_api.models.status as status_module
+
+        with patch.object(status_module, '_supports_recursive_cte',
+                return_value = False):
+            self._check_tree(statuses)
+
+    def test_get_context_branching(self):
+        statuses = self._make_tree()
+
+        details = self.get(
+                '/api/v1/statuses/{}/context'.format(
+                    statuses['b'].id,
+                    ),
+                as_user = self._alice,
+                )
+
+        self.assertEqual(
+                [x['content'] for x in details['ancestors']],
+                ['<p>a</p>'],
+                )
+
+        self.assertEqual(
+                [x['content'] for x in details['descendants']],
+                ['<p>d</p>', '<p>e</p>', '<p>g</p>'],
+                )
+
+        self.assertEqual(
+                details['descendants'][2]['in_reply_to_account_id'],
+                self._alice.id,
+                )
+
+    def test_get_context_404(self):
+        self._alice = create_local_person(name='alice')
+
+        self.get(
+                '/api/v1/statuses/1234/context',
+                as_user = self._alice,
+                expect_result = 404,
+                )
+
     def test_get_reblogged_by(self):
         self._alice = create_local_person(name='alice')
         self._bob = create_local_person(name='bob')
@@ -589,6 +699,110 @@ class TestStatus(TrilbyTestCase):
                 '<p>Hello world</p>',
                 )
 
+class TestThreads(TrilbyTestCase):
+
+    def _make_thread(self):
+        self._alice = create_local_person(name='alice')
+
+        root = create_local_status(
+                posted_by = self._alice,
+                content = 'Daisies are our silver.',
+                )
+        reply = create_local_status(
+                posted_by = self._alice,
+                content = 'Buttercups our gold.',
+                in_reply_to = root,
+                )
+        reply_to_reply = create_local_status(
+                posted_by = self._alice,
+                content = 'This is all the treasure',
+                in_reply_to = reply,
+                )
+
+        return root, reply, reply_to_reply
+
+    def test_thread_fields(self):
+
+        root, reply, reply_to_reply = self._make_thread()
+
+        root.refresh_from_db()
+        self.assertEqual(root.thread_root, root)
+        self.assertIn(f'objectId={root.id}:objectType=Conversation',
+                root.conversation)
+
+        for status in [reply, reply_to_reply]:
+            status.refresh_from_db()
+            self.assertEqual(status.thread_root, root)
+            self.assertEqual(status.conversation, root.conversation)
+
+        self.assertEqual(
+                sorted([x.id for x in root.thread_members.all()]),
+                [root.id, reply.id, reply_to_reply.id],
+                )
+
+        other = create_local_status(
+                posted_by = self._alice,
+                content = 'We can have or hold.',
+                )
+        self.assertNotEqual(other.conversation, root.conversation)
+
+    def test_post_reply(self):
+
+        root, reply, reply_to_reply = self._make_thread()
+
+        content = self.post(
+                path = '/api/v1/statuses',
+                data = {
+                    'status': 'Raindrops are our diamonds.',
+                    'in_reply_to_id': str(reply.id),
+                    },
+                as_user = self._alice,
+                )
+
+        posted = Status.objects.get(id=int(content['id']))
+        self.assertEqual(posted.in_reply_to, reply)
+        self.assertEqual(posted.thread_root, root)
+        self.assertEqual(posted.conversation, root.conversation)
+
+    def test_reply_to_old_status(self):
+
+        root, reply, reply_to_reply = self._make_thread()
+
+        # as if they'd been saved before threads were tracked
+        Status.objects.update(
+                thread_root = None,
+                conversation = None,
+                )
+        reply.refresh_from_db()
+
+        newer = create_local_status(
+                posted_by = self._alice,
+                content = 'Raindrops are our diamonds.',
+                in_reply_to = reply,
+                )
+
+        self.assertEqual(newer.thread_root, root)
+
+    def test_backfill(self):
+        from django.core.management import call_command
+        from io import StringIO
+
+        root, reply, reply_to_reply = self._make_thread()
+        root.refresh_from_db()
+        conversation = root.conversation
+
+        Status.objects.update(
+                thread_root = None,
+                conversation = None,
+                )
+
+        call_command('backfill_threads', stdout=StringIO())
+
+        for status in [root, reply, reply_to_reply]:
+            status.refresh_from_db()
+            self.assertEqual(status.thread_root, root)
+            self.assertEqual(status.conversation, conversation)
+
 class TestPublish(TrilbyTestCase):
     def test_publish_simple(self):
 
@@ -0,0 +1,396 @@
+from django.test import TestCase
+from unittest import skipIf
+from unittest.mock import patch, MagicMock
+from kepi.trilby_api.tests import *
+from kepi.trilby_api.models import *
+import kepi.trilby_api.streaming as streaming
+from asgiref.sync import async_to_sync
+from django.conf import settings
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(name='kepi')
+
+class StreamingTestCase(TrilbyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        # Each test gets a backend of its own.
+        patcher = patch.object(streaming, '_backend',
+                streaming.LocalBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _listen(self, stream, person=None):
+        subscription = streaming.Subscription(wake = lambda: None)
+        subscription.listen(stream,
+                streaming.channels_for(stream, person))
+        self.addCleanup(subscription.stop)
+        return subscription
+
+class TestPublishing(StreamingTestCase):
+
+    def test_subscription(self):
+        subscription = self._listen('public')
+
+        streaming.backend().publish('public', 'update', '{}')
+        streaming.backend().publish('public:local', 'update', '{}')
+
+        self.assertEqual(
+                subscription.take(),
+                [('public', 'update', '{}')],
+                )
+        self.assertEqual(subscription.take(), [])
+
+        subscription.stop()
+        self.assertEqual(
+                streaming.backend().listening(['public']),
+                [])
+
+    def test_queue_size(self):
+        with patch.dict(settings.KEPI, {'STREAMING_QUEUE_SIZE': 2}):
+            subscription = self._listen('public')
+
+        for i in range(5):
+            streaming.backend().publish('public', 'update', str(i))
+
+        self.assertEqual(
+                [x[2] for x in subscription.take()],
+                ['3', '4'],
+                )
+
+    def test_status(self):
+        alice = create_local_person(name='alice')
+        bob = create_local_person(name='bob')
+        carol = create_local_person(name='carol')
+
+        Follow(follower=bob, following=alice).save()
+
+        streams = dict([
+            (person.username, self._listen('user', person))
+            for person in [alice, bob, carol]])
+        public = self._listen('public:local')
+
+        status = create_local_status(
+                content = 'Hello world.',
+                posted_by = alice,
+                send_signal = True,
+                )
+
+        for name, expected in [
+                ('alice', True),
+                ('bob', True),
+                ('carol', False),
+                ]:
+            events = streams[name].take()
+
+            if not expected:
+                self.assertEqual(events, [], msg=name)
+                continue
+
+            self.assertEqual(len(events), 1, msg=name)
+            self.assertEqual(events[0][:2], ('user', 'update'))
+            self.assertEqual(
+                    json.loads(events[0][2])['id'],
+                    str(status.id),
+                    )
+
+        self.assertEqual(len(public.take()), 1)
+
+    def test_notification(self):
+        alice = create_local_person(name='alice')
+        bob = create_local_person(name='bob')
+
+        status = create_local_status(
+                posted_by = alice,
+                )
+
+        notifications = self._listen('user:notification', alice)
+
+        Like(liker=bob, liked=status).save(
+                send_signal = True,
+                )
+
+        events = notifications.take()
+        self.assertEqual(len(events), 1)
+
+        stream, event, payload = events[0]
+        self.assertEqual(stream, 'user:notification')
+        self.assertEqual(event, 'notification')
+        self.assertEqual(json.loads(payload)['type'], 'favourite')
+
+    def test_nobody_listening(self):
+        alice = create_local_person(name='alice')
+
+        with patch.object(streaming, 'as_json') as as_json:
+            create_local_status(
+                    posted_by = alice,
+                    send_signal = True,
+                    )
+
+        as_json.assert_not_called()
+
+    def test_no_open_timelines(self):
+        alice = create_local_person(name='alice')
+        bob = create_local_person(name='bob')
+
+        Follow(follower=bob, following=alice).save()
+
+        status = create_local_status(
+                posted_by = alice,
+                )
+
+        # Nobody has a timeline open, so we don't look for
+        # alice's followers.
+        with self.assertNumQueries(0):
+            streaming.publish_status(status)
+
+        timeline = self._listen('user', bob)
+
+        streaming.publish_status(status)
+        self.assertEqual(len(timeline.take()), 1)
+
+    def test_channels_for(self):
+        alice = create_local_person(name='alice')
+
+        self.assertEqual(
+                streaming.channels_for('public', None),
+                ['public'])
+        self.assertIsNone(streaming.channels_for('user', None))
+        self.assertIsNone(streaming.channels_for('wombat', alice))
+        self.assertEqual(
+                streaming.channels_for('user:notification', alice),
+                ['notifications:%d' % (alice.pk,)])
+
+class TestEndpoints(StreamingTestCase):
+
+    def _run_app(self, scope, messages_in, until):
+        """
+        Runs StreamingApp with "scope". It receives "messages_in"
+        in turn, and then waits until "until", which is called
+        with everything sent so far, returns True.
+        """
+
+        sent = []
+        app = streaming.StreamingApp(fallback=None)
+
+        async def run():
+            finished = asyncio.Event()
+            incoming = list(messages_in)
+
+            async def receive():
+                if incoming:
+                    return incoming.pop(0)
+
+                await finished.wait()
+                if scope['type']=='websocket':
+                    return {'type': 'websocket.disconnect'}
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+                # Once we're listening, publish something.
+                if message['type'] in ('http.response.start',
+                        'websocket.accept'):
+                    asyncio.get_running_loop().call_soon(
+                            streaming.backend().publish,
+                            'public', 'update', '{"id": "1"}')
+
+                if until(sent):
+                    finished.set()
+
+            await asyncio.wait_for(
+                    app(scope, receive, send),
+                    timeout = 5,
+                    )
+
+        async_to_sync(run)()
+        return sent
+
+    def test_sse(self):
+
+        def until(sent):
+            return any([b'event: update' in x.get('body', b'')
+                for x in sent])
+
+        sent = self._run_app(
+                scope = {
+                    'type': 'http',
+                    'method': 'GET',
+                    'path': '/api/v1/streaming/public',
+                    'query_string': b'',
+                    'headers': [],
+                    },
+                messages_in = [
+                    {'type': 'http.request', 'body': b''},
+                    ],
+                until = until,
+                )
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn(
+                b'event: update\ndata: {"id": "1"}\n\n',
+                [x.get('body') for x in sent])
+
+        self.assertEqual(
+                streaming.backend().listening(['public']),
+                [],
+                msg = 'unsubscribed on disconnection')
+
+    def test_websocket(self):
+
+        def until(sent):
+            return any(['update' in x.get('text', '')
+                for x in sent])
+
+        sent = self._run_app(
+                scope = {
+                    'type': 'websocket',
+                    'path': '/api/v1/streaming',
+                    'query_string': b'stream=public',
+                    'headers': [],
+                    },
+                messages_in = [
+                    {'type': 'websocket.connect'},
+                    ],
+                until = until,
+                )
+
+        self.assertEqual(sent[0]['type'], 'websocket.accept')
+
+        messages = [json.loads(x['text']) for x in sent
+                if x['type']=='websocket.send']
+
+        self.assertIn(
+                {
+                    'stream': ['public'],
+                    'event': 'update',
+                    'payload': '{"id": "1"}',
+                    },
+                messages)
+
+    def test_sse_needs_login(self):
+
+        sent = self._run_app(
+                scope = {
+                    'type': 'http',
+                    'method': 'GET',
+                    'path': '/api/v1/streaming/user',
+                    'query_string': b'',
+                    'headers': [],
+                    },
+                messages_in = [],
+                until = lambda sent: True,
+                )
+
+        self.assertEqual(sent[0]['status'], 401)
+
+    def test_websocket_subscribe(self):
+
+        def until(sent):
+            return len(sent)==3
+
+        sent = self._run_app(
+                scope = {
+                    'type': 'websocket',
+                    'path': '/api/v1/streaming',
+                    'query_string': b'',
+                    'headers': [],
+                    },
+                messages_in = [
+                    {'type': 'websocket.connect'},
+                    {'type': 'websocket.receive',
+                        'text': json.dumps({
+                            'type': 'subscribe',
+                            'stream': 'wombat',
+                            })},
+                    {'type': 'websocket.receive',
+                        'text': json.dumps({
+                            'type': 'subscribe',
+                            'stream': 'user',
+                            })},
+                    ],
+                until = until,
+                )
+
+        self.assertEqual(
+                [json.loads(x['text']) for x in sent[1:]],
+                [
+                    {'error': 'Unknown stream type'},
+                    {'error': 'Not logged in'},
+                    ])
+
+    def test_wsgi_errors(self):
+        self.get('/api/v1/streaming/user',
+                expect_result = 401,
+                )
+
+        self.get('/api/v1/streaming/wombat',
+                expect_result = 400,
+                )
+
+    def test_health(self):
+        result = self.get('/api/v1/streaming/health',
+                parse_result = False,
+                )
+
+        self.assertEqual(result.content, b'OK')
+
+@skipIf(streaming.redis is None, 'needs the redis package')
+class TestRedisBackend(StreamingTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self.client = MagicMock()
+        patcher = patch.object(streaming.redis.Redis, 'from_url',
+                return_value = self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.backend = streaming.RedisBackend()
+        self.pubsub = self.client.pubsub.return_value
+
+    def test_subscribes_per_channel(self):
+        subscription = streaming.Subscription(wake = lambda: None)
+
+        self.backend.subscribe(subscription, ['public'])
+        self.backend.subscribe(subscription, ['public', 'timeline:1'])
+
+        self.assertEqual(
+                [list(call.kwargs) for call in
+                    self.pubsub.subscribe.call_args_list],
+                [
+                    ['kepi:streaming:public'],
+                    ['kepi:streaming:timeline:1'],
+                    ],
+                )
+
+        self.backend.unsubscribe(subscription, ['public'])
+        self.pubsub.unsubscribe.assert_called_once_with(
+                'kepi:streaming:public')
+
+    def test_listening(self):
+        self.client.pubsub_numsub.return_value = [
+                (b'kepi:streaming:public', 1),
+                (b'kepi:streaming:public:local', 0),
+                ]
+
+        self.assertEqual(
+                self.backend.listening(['public', 'public:local']),
+                ['public'],
+                )
+
+        self.client.pubsub_channels.return_value = [
+                b'kepi:streaming:timeline:3',
+                ]
+
+        self.assertEqual(
+                self.backend.listening_to('timeline:'),
+                ['timeline:3'],
+                )
+        self.client.pubsub_channels.assert_called_once_with(
+                'kepi:streaming:timeline:*')
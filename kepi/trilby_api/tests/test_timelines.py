@@ -26,7 +26,6 @@ TIMELINE_DATA = [
 
         # We haven't yet implemented:
         #   - (user) tags
-        #   - hashtags
         #   - user lists
         #   - following users but hiding reblogs
         # and when we do, these tests will need updating.
@@ -128,10 +127,6 @@ class TestTimelines(TrilbyTestCase):
             as_user = self._alice,
             )
 
-    @skip("to be implemented later")
-    def test_hashtag(self):
-        raise NotImplementedError()
-
     @skip("to be implemented later")
     def test_account_statuses(self):
         # Special case: this isn't considered a timeline method
@@ -141,3 +136,139 @@ class TestTimelines(TrilbyTestCase):
     @skip("to be implemented later")
     def test_list(self):
         raise NotImplementedError()
+
+class TestHashtags(TrilbyTestCase):
+
+    def test_names_in(self):
+        self.assertEqual(
+                Hashtag.names_in(
+                    'I like #Kepi and #kepi and #ÉCLAIRS, '
+                    'but not #1 or a#b or /page#top. #2020s'),
+                ['kepi', 'éclairs', '2020s'],
+                )
+
+    def test_normalise(self):
+        self.assertEqual(Hashtag.normalise('#Kepi'), 'kepi')
+        self.assertEqual(Hashtag.normalise('kepi'), 'kepi')
+        self.assertIsNone(Hashtag.normalise('#123'))
+        self.assertIsNone(Hashtag.normalise('#two words'))
+
+    def test_post(self):
+        alice = create_local_person("alice")
+
+        result = self.post(
+                path = '/api/v1/statuses',
+                data = {
+                    'status': 'Hello #World, and #Kepi.',
+                    },
+                as_user = alice,
+                )
+
+        self.assertEqual(
+                result['tags'],
+                [
+                    {
+                        'name': 'kepi',
+                        'url': 'https://testserver/tags/kepi',
+                        },
+                    {
+                        'name': 'world',
+                        'url': 'https://testserver/tags/world',
+                        },
+                    ])
+
+        status = Status.objects.get(pk=int(result['id']))
+
+        self.assertEqual(
+                [x.name for x in status.hashtags],
+                ['kepi', 'world'])
+
+class TestTagTimeline(TrilbyTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        self._alice = create_local_person("alice")
+
+    def _post(self, content, visibility='A'):
+        status = create_local_status(
+                content = content,
+                posted_by = self._alice,
+                visibility = visibility,
+                )
+        StatusTag.add(status, Hashtag.names_in(content))
+        return status
+
+    def _ids(self, hashtag='kepi', **params):
+        return [x['id'] for x in self.get(
+            '/api/v1/timelines/tag/'+hashtag,
+            params,
+            )]
+
+    def test_visibility(self):
+        wanted = self._post('#kepi public')
+        self._post('#kepi unlisted', visibility='U')
+        self._post('#kepi private', visibility='X')
+        self._post('#kepi direct', visibility='D')
+        self._post('#other public')
+
+        self.assertEqual(
+                self._ids(),
+                [str(wanted.id)])
+
+        self.assertEqual(
+                self._ids('KEPI'),
+                [str(wanted.id)],
+                msg = "hashtags are case-insensitive")
+
+        self.assertEqual(self._ids('nothing'), [])
+
+    def test_pages(self):
+        statuses = [self._post('#kepi %d' % (i,)) for i in range(5)]
+
+        everything = self._ids()
+        self.assertEqual(
+                everything,
+                [str(x.id) for x in reversed(statuses)],
+                )
+
+        self.assertEqual(
+                self._ids(limit=2),
+                everything[:2])
+
+        self.assertEqual(
+                self._ids(limit=2, max_id=everything[1]),
+                everything[2:4])
+
+        self.assertEqual(
+                self._ids(since_id=everything[3], limit=2),
+                everything[:2])
+
+        self.assertEqual(
+                self._ids(min_id=everything[3], limit=2),
+                everything[1:3])
+
+    def test_link_header(self):
+        statuses = [self._post('#kepi %d' % (i,)) for i in range(3)]
+
+        response = self.get(
+                '/api/v1/timelines/tag/kepi',
+                {'limit': 2},
+                parse_result = False,
+                )
+
+        self.assertIn(
+                'max_id=%d>; rel="next"' % (statuses[1].id,),
+                response['Link'])
+        self.assertIn(
+                'min_id=%d>; rel="prev"' % (statuses[2].id,),
+                response['Link'])
+
+    def test_bad_limit(self):
+        self._post('#kepi')
+
+        self.get(
+                '/api/v1/timelines/tag/kepi',
+                {'limit': 'wombat'},
+                expect_result = 400,
+                )
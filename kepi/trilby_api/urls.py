@@ -6,6 +6,7 @@
 
 from django.urls import path
 from .views import *
+from .streaming import Streaming, StreamingHealth
 
 urlpatterns = [
 
@@ -41,12 +42,18 @@ urlpatterns = [
     path('api/v1/statuses/<status>/reblogged_by', StatusRebloggedBy.as_view()),
 
     path('api/v1/notifications', Notifications.as_view()),
+    path('api/v2/notifications', GroupedNotifications.as_view()),
+    path('api/v1/streaming/health', StreamingHealth.as_view()),
+    path('api/v1/streaming', Streaming.as_view()),
+    path('api/v1/streaming/<path:stream>', Streaming.as_view()),
     path('api/v1/filters', Filters.as_view()),
     path('api/v1/custom_emojis', Emojis.as_view()),
     path('api/v1/timelines/public', PublicTimeline.as_view()),
     path('api/v1/timelines/home', HomeTimeline.as_view()),
+    path('api/v1/timelines/tag/<str:hashtag>', TagTimeline.as_view()),
 
     path('api/v1/search', Search.as_view()),
+    path('api/v2/search', Search.as_view()),
 
     path('users/<username>/feed', UserFeed.as_view()),
     ]
@@ -8,6 +8,7 @@ import logging
 logger = logging.getLogger(name='kepi')
 
 from django.db import IntegrityError, transaction
+from django.db.models import Q, Exists, OuterRef
 from django.shortcuts import render, get_object_or_404
 from django.views import View
 from django.http import HttpResponse, JsonResponse, Http404
@@ -20,6 +21,9 @@ from django.core.exceptions import SuspiciousOperation
 from django.conf import settings
 import kepi.trilby_api.models as trilby_models
 import kepi.trilby_api.utils as trilby_utils
+import kepi.trilby_api.signals as trilby_signals
+import kepi.trilby_api.fast_serializers as fast_serializers
+import kepi.trilby_api.search as kepi_search
 from .serializers import *
 from rest_framework import generics, response, mixins
 from rest_framework.permissions import IsAuthenticated, \
@@ -557,6 +561,19 @@ class Statuses(generics.ListCreateAPIView,
                     content = 'You must supply a status or some media IDs',
                     )
 
+        in_reply_to = None
+
+        if data.get('in_reply_to_id'):
+            try:
+                in_reply_to = trilby_models.Status.objects.get(
+                        id = int(data['in_reply_to_id']),
+                        )
+            except (ValueError, trilby_models.Status.DoesNotExist):
+                return error_response(404, 'Status to reply to not found')
+
+        # The thread root and conversation are filled in
+        # from in_reply_to when the status is saved.
+
         status = trilby_models.Status(
                 account = request.user.localperson,
                 content = data.get('status', ''),
@@ -565,14 +582,21 @@ class Statuses(generics.ListCreateAPIView,
                 visibility = data.get('visibility', 'public'),
                 language = data.get('language',
                     settings.KEPI['LANGUAGES'][0]),
-                # FIXME: in_reply_to
+                in_reply_to = in_reply_to,
                 # FIXME: media_ids
                 # FIXME: idempotency_key
                 )
 
-        status.save(
-                send_signal = True,
-                )
+        # Hashtags are found once, here, and stored; see
+        # kepi.trilby_api.models.StatusTag.
+        with transaction.atomic():
+            status.save()
+            trilby_models.StatusTag.add(status,
+                    trilby_models.Hashtag.names_in(status.content))
+
+        # Status.save() would send this for us, but then whoever
+        # was listening wouldn't see the hashtags.
+        trilby_signals.posted.send(sender=status)
 
         serializer = StatusSerializer(
                 status,
@@ -589,16 +613,52 @@ class Statuses(generics.ListCreateAPIView,
                 )
 
 
+# Limits on the size of the thread returned by StatusContext.
+CONTEXT_MAX_DEPTH = 64
+CONTEXT_MAX_DESCENDANTS = 256
+
 class StatusContext(generics.ListCreateAPIView):
 
     queryset = trilby_models.Status.objects.all()
 
     def get(self, request, *args, **kwargs):
 
-        queryset = self.get_queryset()
+        try:
+            status = get_object_or_404(
+                    self.get_queryset(),
+                    id = int(kwargs['status']),
+                    )
+        except ValueError:
+            return error_response(404, 'Non-decimal ID')
+
+        related = self.get_queryset().prefetch_related(
+                *STATUS_SERIALIZER_PREFETCH,
+                )
 
-        status = queryset.get(id=int(kwargs['status']))
-        serializer = StatusContextSerializer(status)
+        context = {
+                'ancestors': status.get_ancestors(
+                    max_depth = CONTEXT_MAX_DEPTH,
+                    queryset = related,
+                    ),
+                'descendants': status.get_descendants(
+                    max_depth = CONTEXT_MAX_DEPTH,
+                    max_count = CONTEXT_MAX_DESCENDANTS,
+                    queryset = related,
+                    ),
+                }
+
+        logger.debug('%s: context has %d ancestors and %d descendants',
+                status,
+                len(context['ancestors']),
+                len(context['descendants']),
+                )
+
+        serializer = StatusContextSerializer(
+                context,
+                context = {
+                    'request': request,
+                    },
+                )
 
         return JsonResponse(serializer.data)
 
@@ -646,6 +706,37 @@ class StatusRebloggedBy(generics.ListCreateAPIView):
                 safe=False, # it's a list
                 )
 
+def _page_links(request, page):
+    """
+    Returns the Link header for "page", a list of things with IDs,
+    newest first: "next" for the page before it, and "prev" for
+    the page after it, in the way Mastodon clients expect.
+    """
+
+    if not page:
+        return {}
+
+    params = request.query_params.copy()
+    for param in ['max_id', 'since_id', 'min_id']:
+        params.pop(param, None)
+
+    links = []
+    for rel, param, item in [
+            ('next', 'max_id', page[-1]),
+            ('prev', 'min_id', page[0]),
+            ]:
+        params[param] = item.id
+        links.append('<{}?{}>; rel="{}"'.format(
+            request.build_absolute_uri(request.path),
+            params.urlencode(),
+            rel,
+            ))
+        del params[param]
+
+    return {
+            'Link': ', '.join(links),
+            }
+
 class AbstractTimeline(generics.ListAPIView):
 
     serializer_class = StatusSerializer
@@ -658,12 +749,12 @@ class AbstractTimeline(generics.ListAPIView):
 
     def get(self, request):
         queryset = self.get_queryset(request)
-        serializer = self.serializer_class(queryset,
-                many = True,
-                context = {
-                    'request': request,
-                    })
-        return Response(serializer.data)
+
+        # This gives the same result as serializer_class,
+        # only faster; see fast_serializers.py.
+        return Response(
+                fast_serializers.statuses_as_list(queryset),
+                )
 
 PUBLIC_TIMELINE_SLICE_LENGTH = 20
 
@@ -694,11 +785,146 @@ class HomeTimeline(AbstractTimeline):
 
         return result
 
+# How many statuses to return at once from a tag timeline,
+# unless asked for something else; and the most we'll return.
+TAG_TIMELINE_DEFAULT_LIMIT = 20
+TAG_TIMELINE_MAX_LIMIT = 40
+
+class TagTimeline(AbstractTimeline):
+
+    """
+    Lists the public statuses with a given hashtag, newest first.
+
+    Takes the Mastodon parameters max_id, since_id, min_id and
+    limit for paging, and "local" for only our own statuses.
+    The hashtags were found when each status arrived, and
+    the "status_tags_by_date" index lists a hashtag's statuses
+    in order, so each page costs the same however popular
+    the hashtag is.
+    """
+
+    permission_classes = ()
+
+    def _cursor(self, status_id, newer):
+        """
+        Returns a Q selecting StatusTags for statuses newer (or
+        older, if "newer" is False) than the given status.
+        """
+
+        created_at = trilby_models.Status.objects.filter(
+                pk = status_id,
+                ).values_list('created_at', flat=True).first()
+
+        if newer:
+            comparison = 'gt'
+        else:
+            comparison = 'lt'
+
+        if created_at is None:
+            return Q(**{'status__'+comparison: status_id})
+
+        return Q(**{'created_at__'+comparison: created_at}) | \
+                Q(created_at = created_at,
+                        **{'status__'+comparison: status_id})
+
+    def _statuses(self, request, hashtag):
+        """
+        Returns the page of statuses which "request" asks for,
+        as a list. Raises ValueError if the parameters don't
+        make sense.
+        """
+
+        params = request.query_params
+
+        name = trilby_models.Hashtag.normalise(hashtag)
+        if name is None:
+            return []
+
+        hashtag = trilby_models.Hashtag.objects.filter(
+                name = name,
+                ).first()
+
+        if hashtag is None:
+            return []
+
+        queryset = trilby_models.StatusTag.objects.filter(
+                hashtag = hashtag,
+                status__visibility = trilby_utils.VISIBILITY_PUBLIC,
+                )
+
+        if params.get('local', '').lower() in ['true', '1']:
+            queryset = queryset.filter(
+                    status__remote_url = None,
+                    )
+
+        if 'max_id' in params:
+            queryset = queryset.filter(
+                    self._cursor(int(params['max_id']),
+                        newer = False),
+                    )
+
+        if 'since_id' in params:
+            queryset = queryset.filter(
+                    self._cursor(int(params['since_id']),
+                        newer = True),
+                    )
+
+        limit = max(1, min(
+                int(params.get('limit', TAG_TIMELINE_DEFAULT_LIMIT)),
+                TAG_TIMELINE_MAX_LIMIT,
+                ))
+
+        if 'min_id' in params:
+            status_ids = list(queryset.filter(
+                    self._cursor(int(params['min_id']),
+                        newer = True),
+                    ).order_by('created_at', 'status').values_list(
+                        'status', flat=True)[:limit])
+            status_ids.reverse()
+        else:
+            status_ids = list(queryset.order_by(
+                    '-created_at', '-status').values_list(
+                        'status', flat=True)[:limit])
+
+        statuses = trilby_models.Status.objects.in_bulk(status_ids)
+
+        return [statuses[x] for x in status_ids if x in statuses]
+
+    def get(self, request, hashtag):
+
+        try:
+            statuses = self._statuses(request, hashtag)
+        except ValueError:
+            return error_response(400, 'Non-decimal ID or limit')
+
+        return Response(
+                fast_serializers.statuses_as_list(statuses),
+                headers = _page_links(request, statuses),
+                )
+
 ########################################
 
-# TODO stub
+# How many search results to return at once, unless asked
+# for something else; and the most we'll return at once.
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 40
+
+def _search_limit(params, default):
+    return max(1, min(
+        int(params.get('limit', default)),
+        SEARCH_MAX_LIMIT,
+        ))
+
+def _search_offset(params):
+    return max(0, int(params.get('offset', 0)))
+
 class AccountsSearch(generics.ListAPIView):
 
+    """
+    Finds people by their username, acct, or display name.
+    See kepi.trilby_api.search.
+    """
+
     queryset = trilby_models.Person.objects.all()
     serializer_class = UserSerializer
 
@@ -706,10 +932,32 @@ class AccountsSearch(generics.ListAPIView):
             IsAuthenticated,
             ]
 
+    def list(self, request, *args, **kwargs):
+
+        params = request.query_params
+
+        try:
+            people = kepi_search.search_people(
+                    params.get('q', ''),
+                    limit = _search_limit(params, 40),
+                    offset = _search_offset(params),
+                    )
+        except ValueError:
+            return error_response(400, 'Non-decimal limit or offset')
+
+        return Response(
+                fast_serializers.users_as_list(people),
+                )
+
 ########################################
 
-# TODO stub
-class Search(View):
+class Search(generics.GenericAPIView):
+
+    """
+    Finds people and statuses. This serves both versions of
+    Mastodon's search; they only differ in how they list hashtags,
+    which we don't search yet.
+    """
 
     permission_classes = [
             IsAuthenticated,
@@ -717,13 +965,38 @@ class Search(View):
 
     def get(self, request, *args, **kwargs):
 
+        params = request.query_params
+        query = params.get('q', '')
+        kind = params.get('type', None)
+
+        try:
+            limit = _search_limit(params, SEARCH_DEFAULT_LIMIT)
+            offset = _search_offset(params)
+        except ValueError:
+            return error_response(400, 'Non-decimal limit or offset')
+
+        people = []
+        statuses = []
+
+        if kind in (None, 'accounts'):
+            people = kepi_search.search_people(query,
+                    limit = limit,
+                    offset = offset,
+                    )
+
+        if kind in (None, 'statuses'):
+            statuses = kepi_search.search_statuses(query,
+                    limit = limit,
+                    offset = offset,
+                    )
+
         result = {
-                'accounts': [],
-                'statuses': [],
+                'accounts': fast_serializers.users_as_list(people),
+                'statuses': fast_serializers.statuses_as_list(statuses),
                 'hashtags': [],
             }
 
-        return JsonResponse(result)
+        return Response(result)
 
 ########################################
 
@@ -787,21 +1060,309 @@ class UserFeed(View):
 
 ########################################
 
+# How many notifications to return at once, unless asked
+# for something else; and the most we'll return at once.
+NOTIFICATIONS_DEFAULT_LIMIT = 20
+NOTIFICATIONS_MAX_LIMIT = 40
+
 class Notifications(generics.ListAPIView):
 
+    """
+    Lists the user's notifications, newest first.
+
+    Takes the Mastodon parameters max_id, since_id, min_id and
+    limit for paging, and exclude_types[] and account_id for
+    filtering. We order by creation date and then by ID, which
+    is what the "notifications_by_date" index is for, so that
+    each page costs the same however many notifications the
+    user has.
+
+    Favourites and reblogs which share a group don't have
+    Notifications of their own (see Notification.add()), so we
+    list their Likes and reblogs instead, with IDs beginning
+    "like-" and "reblog-".
+    """
+
     serializer_class = NotificationSerializer
 
     permission_classes = [
             IsAuthenticated,
             ]
 
+    # The kinds of row we might list, as (prefix, model). A row's
+    # ID is its prefix followed by its primary key. Rows made at
+    # the same moment are listed in this order, then by ID.
+    KINDS = [
+            ('like-', trilby_models.Like),
+            ('reblog-', trilby_models.Status),
+            ('', trilby_models.Notification),
+            ]
+
+    def _kind(self, prefix):
+        return [x[0] for x in self.KINDS].index(prefix)
+
+    def _position(self, notification_id):
+        """
+        Returns where the row with the ID "notification_id" is
+        listed, as (created_at, kind, pk), where "kind" is its
+        index in KINDS. "created_at" is None if the row has gone.
+
+        Raises ValueError if the ID doesn't make sense.
+        """
+
+        for kind, (prefix, model) in enumerate(self.KINDS):
+            if notification_id.startswith(prefix):
+                pk = int(notification_id[len(prefix):])
+
+                created_at = model.objects.filter(
+                        pk = pk,
+                        ).values_list('created_at', flat=True).first()
+
+                return created_at, kind, pk
+
+    def _cursor(self, position, kind, newer):
+        """
+        Returns a Q selecting rows of the given kind listed
+        after (or before, if "newer" is False) "position",
+        which is as _position() returns it.
+        """
+
+        created_at, position_kind, pk = position
+
+        if newer:
+            comparison = 'gt'
+        else:
+            comparison = 'lt'
+
+        if created_at is None:
+            # It's gone, so the best we can do is the ID.
+            if kind==position_kind:
+                return Q(**{'pk__'+comparison: pk})
+            return Q()
+
+        result = Q(**{'created_at__'+comparison: created_at})
+
+        if kind==position_kind:
+            result |= Q(created_at = created_at,
+                    **{'pk__'+comparison: pk})
+        elif (kind > position_kind) == newer:
+            result |= Q(created_at = created_at)
+
+        return result
+
+    def _links(self, request, notifications):
+        return _page_links(request, notifications)
+
+    def _rows(self, person, exclude_types, account_id):
+        """
+        Returns a list of (kind, queryset, as_notification) for the
+        rows we list for "person", except those of the types in
+        "exclude_types" and, unless "account_id" is None, those
+        which aren't about that account. "kind" is an index into
+        KINDS, and "as_notification" makes a row into a Notification.
+        """
+
+        notifications = Notification.objects.filter(
+                for_account = person,
+                group_key = None,
+                ).exclude(
+                        notification_type__in = exclude_types,
+                        )
+
+        if account_id is not None:
+            notifications = notifications.filter(
+                    about_account = account_id,
+                    )
+
+        result = [
+                (self._kind(''), notifications, lambda x: x),
+                ]
+
+        if not Notification.objects.filter(
+                for_account = person,
+                group_key__isnull = False,
+                ).exists():
+            return result
+
+        # The favourites and reblogs in groups are the ones
+        # without a Notification of their own.
+
+        def ungrouped(notification_type, status, about):
+            return Exists(Notification.objects.filter(
+                for_account = person,
+                notification_type = notification_type,
+                group_key = None,
+                status = OuterRef(status),
+                about_account = OuterRef(about),
+                ))
+
+        if Notification.FAVOURITE not in exclude_types:
+            likes = trilby_models.Like.objects.filter(
+                    ~ungrouped(Notification.FAVOURITE, 'liked', 'liker'),
+                    liked__account = person,
+                    )
+
+            if account_id is not None:
+                likes = likes.filter(
+                        liker = account_id,
+                        )
+
+            result.append((
+                self._kind('like-'),
+                likes,
+                lambda x: Notification.for_like(
+                    x,
+                    for_account = person,
+                    ),
+                ))
+
+        if Notification.REBLOG not in exclude_types:
+            reblogs = trilby_models.Status.objects.filter(
+                    ~ungrouped(Notification.REBLOG, 'reblog_of', 'account'),
+                    reblog_of__account = person,
+                    )
+
+            if account_id is not None:
+                reblogs = reblogs.filter(
+                        account = account_id,
+                        )
+
+            result.append((
+                self._kind('reblog-'),
+                reblogs,
+                lambda x: Notification.for_reblog(
+                    x,
+                    for_account = person,
+                    ),
+                ))
+
+        return result
+
+    def _notifications(self, request):
+        """
+        Returns the page of notifications which "request" asks for,
+        as a list. Raises ValueError if the parameters don't
+        make sense.
+        """
+
+        params = request.query_params
+
+        exclude_types = [
+                code for code, name in Notification.TYPE_CHOICES
+                if name in params.getlist('exclude_types[]') + \
+                        params.getlist('exclude_types')
+                ]
+
+        if 'account_id' in params:
+            account_id = int(params['account_id'])
+        else:
+            account_id = None
+
+        cursors = [
+                (self._position(params[param]), newer)
+                for param, newer in [
+                    ('max_id', False),
+                    ('since_id', True),
+                    ('min_id', True),
+                    ]
+                if param in params]
+
+        limit = max(1, min(
+                int(params.get('limit', NOTIFICATIONS_DEFAULT_LIMIT)),
+                NOTIFICATIONS_MAX_LIMIT,
+                ))
+
+        # The page just after min_id, rather than the
+        # newest page after it, which is since_id.
+        oldest_first = 'min_id' in params
+
+        if oldest_first:
+            order = ['created_at', 'id']
+        else:
+            order = ['-created_at', '-id']
+
+        found = []
+
+        for kind, queryset, as_notification in self._rows(
+                request.user.localperson,
+                exclude_types = exclude_types,
+                account_id = account_id,
+                ):
+
+            for position, newer in cursors:
+                queryset = queryset.filter(
+                        self._cursor(position, kind, newer),
+                        )
+
+            found.extend([
+                ((x.created_at, kind, x.pk), as_notification(x))
+                for x in queryset.order_by(*order)[:limit]
+                ])
+
+        found.sort(
+                key = lambda x: x[0],
+                reverse = not oldest_first,
+                )
+
+        notifications = [x[1] for x in found[:limit]]
+
+        if oldest_first:
+            notifications.reverse()
+
+        return notifications
+
+    def _as_list(self, notifications):
+        return fast_serializers.notifications_as_list(notifications)
+
     def list(self, request):
-        queryset = Notification.objects.filter(
-                for_account = request.user.localperson,
+
+        try:
+            notifications = self._notifications(request)
+        except ValueError:
+            return error_response(400, 'Non-decimal ID or limit')
+
+        return Response(
+                self._as_list(notifications),
+                headers = self._links(request, notifications),
                 )
 
-        serializer = self.serializer_class(queryset, many=True)
-        return Response(serializer.data)
+class GroupedNotifications(Notifications):
+
+    """
+    Like Notifications, but in the format of Mastodon's
+    /api/v2/notifications: each notification is a group, listing
+    how many it stands for and the first few people it's about.
+    The people and statuses are listed once each, separately.
+
+    Notifications only stand for more than one if
+    KEPI['NOTIFICATION_GROUP_PERIOD'] is set; see
+    Notification.add().
+    """
+
+    KINDS = [
+            ('', trilby_models.Notification),
+            ]
+
+    def _rows(self, person, exclude_types, account_id):
+        notifications = Notification.objects.filter(
+                for_account = person,
+                ).exclude(
+                        notification_type__in = exclude_types,
+                        )
+
+        if account_id is not None:
+            notifications = notifications.filter(
+                    about_account = account_id,
+                    )
+
+        return [
+                (self._kind(''), notifications, lambda x: x),
+                ]
+
+    def _as_list(self, notifications):
+        return fast_serializers.notification_groups_as_dict(
+                notifications)
+
 
 ########################################
 